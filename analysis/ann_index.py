@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""Approximate nearest neighbour index of normalised pRF model time courses."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import numpy as np
+from model_bank import MdlBnk
+from model_bank import bnk_tile
+
+
+def ann_nrm(aryTc):
+    """
+    De-mean and normalise time courses.
+
+    Parameters
+    ----------
+    aryTc : np.array
+        Time courses, with shape aryTc[time course, time].
+
+    Returns
+    -------
+    aryTc : np.array
+        De-meaned time courses with unit norm (float32). Time courses with a
+        variance of zero are set to zero.
+    """
+    aryTc = aryTc.astype(np.float32)
+    aryTc = np.subtract(aryTc,
+                        np.mean(aryTc, axis=1, dtype=np.float32)[:, None])
+    vecNrm = np.sqrt(np.sum(np.square(aryTc), axis=1, dtype=np.float32))
+    vecNrm[np.less_equal(vecNrm, 0.0)] = np.inf
+    return np.divide(aryTc, vecNrm[:, None])
+
+
+def crt_ann(objBnk, varNumClst=None, varNumIter=20, varNumSmp=20000,
+            varMdlBlk=1000, varSeed=0):
+    """
+    Create cluster index of normalised pRF model time courses.
+
+    Parameters
+    ----------
+    objBnk : np.array or ShmArray or MdlBnk or MdlLzy
+        pRF model time courses (or handle), with shape aryPrfTc[x-position,
+        y-position, SD, time, feature]. Only one feature is supported.
+    varNumClst : int or None
+        Number of clusters. If None, the square root of the number of models.
+    varNumIter : int
+        Number of iterations of the clustering.
+    varNumSmp : int
+        Number of models (random sample) from which the cluster centres are
+        estimated.
+    varMdlBlk : int
+        Number of models that are read (or created) at once.
+    varSeed : int
+        Seed of the random number generator (so that the index is
+        reproducible).
+
+    Returns
+    -------
+    aryCtr : np.array
+        Cluster centres (unit norm), with shape aryCtr[cluster, time].
+    vecIdx : np.array
+        Indices of all models (in the order of `crt_mdl_prms`), sorted by
+        cluster, with shape vecIdx[model].
+    vecPtr : np.array
+        Position of the first model of each cluster in `vecIdx` (plus the
+        total number of models), with shape vecPtr[cluster + 1].
+
+    Notes
+    -----
+    For a single predictor and de-meaned data, the best fitting model is the
+    one with the highest squared correlation with the voxel time course,
+    i.e. the normalised model time course that is closest to the normalised
+    voxel time course (or to its negative). The normalised models are
+    clustered with spherical k-means, where the sign of each model is
+    aligned with the cluster centre (because the sign of the correlation
+    does not matter). The cluster centres are estimated from a random sample
+    of models, and all models are then assigned to the closest centre, one
+    tile at a time, so that the models do not need to fit into memory.
+    """
+    # Shape of the pRF model time courses:
+    tplShp = tuple(objBnk.shape)
+    varNumVol = tplShp[3]
+
+    # Number of pRF models (x-pos * y-pos * SD):
+    varNumMdls = tplShp[0] * tplShp[1] * tplShp[2]
+
+    if (len(tplShp) == 5) and (tplShp[4] != 1):
+        # Error message:
+        strErrMsg = ('---Error: The model index can only be created for one '
+                     + 'predictor per model, but the pRF time course models '
+                     + 'have ' + str(tplShp[4]) + ' features.')
+        raise ValueError(strErrMsg)
+
+    # Number of clusters:
+    if varNumClst is None:
+        varNumClst = int(np.ceil(np.sqrt(varNumMdls)))
+    varNumClst = max(min(int(varNumClst), varNumMdls), 1)
+
+    objRnd = np.random.RandomState(varSeed)
+
+    # Random sample of models (sorted, so that they are read in the order in
+    # which they are stored):
+    varNumSmp = max(min(int(varNumSmp), varNumMdls), varNumClst)
+    vecSmp = np.sort(objRnd.choice(varNumMdls, varNumSmp, replace=False))
+
+    # Normalised model time courses of the sample:
+    arySmp = np.zeros((varNumSmp, varNumVol), dtype=np.float32)
+    for varBlkSrt in range(0, varNumMdls, varMdlBlk):
+        varBlkEnd = min((varBlkSrt + varMdlBlk), varNumMdls)
+        lgcTmp = np.logical_and(np.greater_equal(vecSmp, varBlkSrt),
+                                np.less(vecSmp, varBlkEnd))
+        if np.any(lgcTmp):
+            aryBlk = bnk_tile(objBnk, varBlkSrt, varBlkEnd)[:, :, 0]
+            arySmp[lgcTmp, :] = ann_nrm(aryBlk[(vecSmp[lgcTmp] - varBlkSrt),
+                                               :])
+
+    # Initial cluster centres (random models from the sample):
+    aryCtr = arySmp[objRnd.choice(varNumSmp, varNumClst, replace=False), :]
+
+    # Spherical k-means:
+    for idxIter in range(varNumIter):
+
+        # Similarity of all models in the sample with all centres:
+        arySim = np.dot(arySmp, aryCtr.T)
+        vecClst = np.argmax(np.absolute(arySim), axis=1)
+        vecSgn = np.sign(arySim[np.arange(varNumSmp), vecClst])
+
+        # New centres (sum of sign-aligned members, normalised):
+        aryCtrNew = np.zeros((varNumClst, varNumVol), dtype=np.float32)
+        np.add.at(aryCtrNew, vecClst, np.multiply(arySmp, vecSgn[:, None]))
+        vecNrm = np.sqrt(np.sum(np.square(aryCtrNew), axis=1))
+
+        # Empty clusters are re-initialised with random models:
+        lgcEmpty = np.less_equal(vecNrm, 0.0)
+        aryCtrNew[lgcEmpty, :] = arySmp[
+            objRnd.choice(varNumSmp, np.sum(lgcEmpty), replace=False), :]
+        vecNrm[lgcEmpty] = 1.0
+
+        aryCtr = np.divide(aryCtrNew, vecNrm[:, None]).astype(np.float32)
+
+    # Assign all models to the closest centre:
+    vecClst = np.zeros(varNumMdls, dtype=np.int64)
+    for varBlkSrt in range(0, varNumMdls, varMdlBlk):
+        varBlkEnd = min((varBlkSrt + varMdlBlk), varNumMdls)
+        aryBlk = ann_nrm(bnk_tile(objBnk, varBlkSrt, varBlkEnd)[:, :, 0])
+        vecClst[varBlkSrt:varBlkEnd] = np.argmax(
+            np.absolute(np.dot(aryBlk, aryCtr.T)), axis=1)
+
+    # Models sorted by cluster (stable sort, so that the models of each
+    # cluster remain in the order in which they are stored):
+    vecIdx = np.argsort(vecClst, kind='mergesort').astype(np.int64)
+    vecPtr = np.searchsorted(vecClst[vecIdx],
+                             np.arange(varNumClst + 1)).astype(np.int64)
+
+    return aryCtr, vecIdx, vecPtr
+
+
+def ann_bnk(objBnk, varNumClst=None, varNumIter=20, varNumSmp=20000):
+    """
+    Load the cluster index of a model bank, or create it.
+
+    Parameters
+    ----------
+    objBnk : np.array or ShmArray or MdlBnk
+        pRF model time courses (or handle of model bank file).
+    varNumClst : int or None
+        Number of clusters (see `crt_ann`).
+    varNumIter : int
+        Number of iterations of the clustering.
+    varNumSmp : int
+        Number of models from which the cluster centres are estimated.
+
+    Returns
+    -------
+    aryCtr : np.array
+        Cluster centres, with shape aryCtr[cluster, time].
+    vecIdx : np.array
+        Indices of all models, sorted by cluster.
+    vecPtr : np.array
+        Position of the first model of each cluster in `vecIdx`.
+
+    Notes
+    -----
+    If the models are stored in a finalised model bank file, the index is
+    stored next to the bank (`<basename>_ann_ctr.npy`,
+    `<basename>_ann_idx.npy`, `<basename>_ann_ptr.npy`), and the key of the
+    bank and the parameters of the index are added to the index file of the
+    bank. The index is only
+    created again if the bank has been recreated (e.g. for a new stimulus
+    design), or if the parameters of the index have changed.
+    """
+    # Without model bank file, the index is created every time:
+    if not isinstance(objBnk, MdlBnk):
+        print('---------Create model index')
+        return crt_ann(objBnk, varNumClst=varNumClst, varNumIter=varNumIter,
+                       varNumSmp=varNumSmp)
+
+    strPathIdx = objBnk.path + '.json'
+    with open(strPathIdx, 'r') as objFle:
+        dicIdx = json.load(objFle)
+
+    # Parameters of the index (including the key of the bank, which changes
+    # whenever the bank is recreated):
+    dicAnn = {'key': dicIdx.get('key'),
+              'varNumClst': varNumClst,
+              'varNumIter': varNumIter,
+              'varNumSmp': varNumSmp}
+
+    lstNme = ['ctr', 'idx', 'ptr']
+    lgcHit = ((dicIdx.get('key') is not None)
+              and (dicIdx.get('ann') == dicAnn)
+              and all([os.path.isfile(objBnk.path + '_ann_' + strTmp + '.npy')
+                       for strTmp in lstNme]))
+
+    if lgcHit:
+        print('---------Load model index')
+        return tuple([np.load(objBnk.path + '_ann_' + strTmp + '.npy')
+                      for strTmp in lstNme])
+
+    print('---------Create model index')
+    tplAnn = crt_ann(objBnk, varNumClst=varNumClst, varNumIter=varNumIter,
+                     varNumSmp=varNumSmp)
+    for strTmp, aryTmp in zip(lstNme, tplAnn):
+        np.save(objBnk.path + '_ann_' + strTmp + '.npy', aryTmp)
+
+    # The parameters of the index are added to the index file of the bank
+    # last, so that an incomplete index is not reused:
+    dicIdx['ann'] = dicAnn
+    with open(strPathIdx, 'w') as objFle:
+        json.dump(dicIdx, objFle)
+
+    return tplAnn
+
+
+def ann_chk(vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc, objBnk, aryBstPrm,
+            varMdlBlk=500):
+    """
+    Compare results of the model index with an exhaustive search.
+
+    Parameters
+    ----------
+    vecMdlXpos : np.array
+        1D array with pRF model x positions.
+    vecMdlYpos : np.array
+        1D array with pRF model y positions.
+    vecMdlSd : np.array
+        1D array with pRF model sizes (SD of Gaussian).
+    aryFunc : np.array
+        Functional data of the voxels to be compared, with shape
+        aryFunc[voxel, time].
+    objBnk : np.array or ShmArray or MdlBnk
+        pRF model time courses (or handle).
+    aryBstPrm : np.array
+        Results of the model index for the same voxels, with shape
+        aryBstPrm[voxel, parameter] (x-position, y-position, SD, R2).
+    varMdlBlk : int
+        Number of pRF models that are fitted at once in the exhaustive search.
+
+    Returns
+    -------
+    varAgr : float
+        Fraction of voxels for which the model index finds the same model as
+        the exhaustive search.
+    vecR2Dff : np.array
+        Difference in R2 between exhaustive search and model index, for each
+        voxel (zero or positive).
+    """
+    # The exhaustive search is the 'gemm' version (same model), in this
+    # process:
+    from find_prf_cpu_gemm import find_prf_cpu_gemm
+
+    aryExh = np.zeros((aryFunc.shape[0], 4), dtype=np.float32)
+    find_prf_cpu_gemm(-1, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc, objBnk,
+                      aryExh, varMdlBlk=varMdlBlk)
+
+    # Same model (all parameters identical), or model that explains the same
+    # variance (e.g. models with identical time courses):
+    lgcAgr = np.logical_or(np.all(np.equal(aryExh[:, 0:3],
+                                           aryBstPrm[:, 0:3]), axis=1),
+                           np.less_equal(aryExh[:, 3], aryBstPrm[:, 3]))
+    varAgr = np.mean(lgcAgr)
+    vecR2Dff = np.maximum(np.subtract(aryExh[:, 3], aryBstPrm[:, 3]), 0.0)
+
+    return varAgr, vecR2Dff
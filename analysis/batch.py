@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""Fit several subjects that share the same stimulus design, in a pipeline."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import traceback
+import numpy as np
+import nibabel as nb
+import multiprocessing as mp
+from utilities import load_nii
+from checkpoint import ckp_save
+from daemon import dmn_job
+from pipeline import ppl_func
+from pipeline import ppl_fit
+
+
+def btch_load(strPathMnf):
+    """
+    Load the manifest of a batch of subjects.
+
+    Parameters
+    ----------
+    strPathMnf : str
+        Path of the manifest (JSON file), with a list of subjects. Each
+        subject is given by the path of the mask ('mask'), the paths of the
+        functional runs ('func'), and the path (prefix) of the output images
+        ('out'), in the same way as the jobs of the fitting daemon (see
+        `dmn_job`).
+
+    Returns
+    -------
+    lstSub : list
+        Subjects of the batch (dictionaries with 'mask', 'func' and 'out').
+    """
+    with open(strPathMnf, 'r') as objFle:
+        try:
+            lstSub = json.load(objFle)
+        except ValueError:
+            # Error message:
+            strErrMsg = ('---Error: Manifest is not a valid JSON file: '
+                         + strPathMnf)
+            raise ValueError(strErrMsg)
+
+    if (not isinstance(lstSub, list)) or (len(lstSub) == 0):
+        # Error message:
+        strErrMsg = ('---Error: Manifest needs to contain a list of '
+                     + 'subjects: ' + strPathMnf)
+        raise ValueError(strErrMsg)
+
+    # All subjects are checked before the models are prepared, so that an
+    # error in the manifest does not only become apparent after the first
+    # subjects have been fitted:
+    for idxSub in range(len(lstSub)):
+        strErr = dmn_job(lstSub[idxSub])
+        if strErr is not None:
+            # Error message:
+            strErrMsg = ('---Error: Subject ' + str(idxSub)
+                         + ' of manifest: ' + strErr)
+            raise ValueError(strErrMsg)
+
+    # The output of a subject would be overwritten by another subject:
+    lstOut = [os.path.abspath(dicSub['out']) for dicSub in lstSub]
+    if len(set(lstOut)) != len(lstOut):
+        # Error message:
+        strErrMsg = ('---Error: Output paths of the subjects in the manifest '
+                     + 'need to be different.')
+        raise ValueError(strErrMsg)
+
+    return lstSub
+
+
+def btch_mem(lstPathNiiFunc):
+    """
+    Estimate the memory that is needed for the data of one subject.
+
+    Parameters
+    ----------
+    lstPathNiiFunc : list
+        Paths of the functional runs.
+
+    Returns
+    -------
+    varMem : int
+        Estimated memory [bytes].
+
+    Notes
+    -----
+    Only the nii headers are read. The estimate allows for all functional
+    runs in double precision (i.e. before the mask is applied), which is an
+    upper bound for the preprocessing and for the fitting of the subject. The
+    pRF models are not included, they are shared by all subjects.
+    """
+    varMem = 0
+    for strPthTmp in lstPathNiiFunc:
+        varMem += int(np.prod(nb.load(strPthTmp).shape)) * 8
+    return varMem
+
+
+def btch_pre(strPathNiiMask, lstPathNiiFunc, varPar, strPathTmp):
+    """
+    Load and preprocess the functional data of a subject, in the background.
+
+    Parameters
+    ----------
+    strPathNiiMask : str
+        Path of the mask.
+    lstPathNiiFunc : list
+        Paths of the functional runs.
+    varPar : int
+        Number of parallel processes for the preprocessing.
+    strPathTmp : str
+        Path of the file with the preprocessed data (npz), which is loaded by
+        `btch_get` when the subject is fitted.
+    """
+    aryLgcMsk, _, aryAff, aryLgcVar, aryFunc, tplNiiShp = \
+        ppl_func(strPathNiiMask, lstPathNiiFunc, varPar=varPar)
+    ckp_save(strPathTmp, {'aryLgcMsk': aryLgcMsk,
+                          'aryAff': aryAff,
+                          'aryLgcVar': aryLgcVar,
+                          'aryFunc': aryFunc,
+                          'tplNiiShp': np.array(tplNiiShp)})
+
+
+def btch_get(strPathNiiMask, strPathTmp):
+    """
+    Load the data of a subject that has been preprocessed by `btch_pre`.
+
+    Parameters
+    ----------
+    strPathNiiMask : str
+        Path of the mask (the header of the mask is not stored with the
+        preprocessed data).
+    strPathTmp : str
+        Path of the file with the preprocessed data (npz), which is removed.
+
+    Returns
+    -------
+    tplFunc : tuple
+        Preprocessed functional data, in the same form as returned by
+        `ppl_func`.
+    """
+    _, hdrMsk, _ = load_nii(strPathNiiMask)
+    with np.load(strPathTmp) as objNpz:
+        tplFunc = (objNpz['aryLgcMsk'],
+                   hdrMsk,
+                   objNpz['aryAff'],
+                   objNpz['aryLgcVar'],
+                   objNpz['aryFunc'],
+                   tuple([int(varTmp) for varTmp in objNpz['tplNiiShp']]))
+    os.remove(strPathTmp)
+    return tplFunc
+
+
+def btch_run(dicMdl, lstSub, varPar, varParPre=None, varMem=None):
+    """
+    Fit a batch of subjects with the same pRF models.
+
+    Parameters
+    ----------
+    dicMdl : dict
+        pRF models, which have been prepared once for all subjects (see
+        `ppl_models`).
+    lstSub : list
+        Subjects of the batch (see `btch_load`).
+    varPar : int
+        Number of parallel processes (for all subjects that are in progress
+        at the same time).
+    varParPre : int or None
+        Number of the parallel processes (out of `varPar`) that preprocess
+        the next subject while the current subject is fitted. If None, a
+        quarter of `varPar` (at least one).
+    varMem : float or None
+        Memory budget [GB] for the data of the subjects that are in progress
+        at the same time (see `btch_mem`). If None, no limit.
+
+    Returns
+    -------
+    lstSts : list
+        Status of each subject ('done' or 'failed').
+
+    Notes
+    -----
+    While a subject is fitted, the functional data of the next subject are
+    loaded and preprocessed in a separate process (forked from this process,
+    so that it shares the pRF models). The next subject is only preprocessed
+    in advance if the processes can be split between the two subjects (i.e.
+    `varPar` > 1), and if the data of both subjects fit into the memory
+    budget. Otherwise, the subjects are processed one after the other. A
+    failed subject does not stop the batch.
+    """
+    varNumSub = len(lstSub)
+
+    if varParPre is None:
+        varParPre = max(1, varPar // 4)
+    varParPre = int(min(max(varParPre, 1), max(varPar - 1, 1)))
+
+    # Estimated memory of the data of each subject:
+    vecMem = np.array([btch_mem(dicSub['func']) for dicSub in lstSub],
+                      dtype=np.float64)
+    if varMem is not None:
+        varMem = float(varMem) * (1024.0 ** 3)
+        for idxSub in np.where(np.greater(vecMem, varMem))[0]:
+            print('---------Warning: The data of subject ' + str(idxSub)
+                  + ' (about ' + str(np.around(vecMem[idxSub]
+                                               / (1024.0 ** 3), 2))
+                  + ' GB) exceed the memory budget, the subject is '
+                  + 'processed on its own.')
+
+    lstSts = [None] * varNumSub
+
+    # Preprocessed data of the next subject are exchanged via a temporary
+    # file (which is removed after loading):
+    strDirTmp = tempfile.mkdtemp(prefix='pRF_batch_')
+
+    # Process that preprocesses the next subject (if any), and path of its
+    # output:
+    objPrcPre = None
+    strPathPre = None
+
+    try:
+        for idxSub in range(varNumSub):
+
+            dicSub = lstSub[idxSub]
+            varTme01 = time.time()
+
+            print('------Subject ' + str(idxSub + 1) + ' of '
+                  + str(varNumSub) + ': ' + dicSub['out'])
+
+            # Preprocessed data of this subject (if they have been prepared
+            # while the previous subject was fitted):
+            tplFunc = None
+            if objPrcPre is not None:
+                objPrcPre.join()
+                if (objPrcPre.exitcode == 0) and os.path.isfile(strPathPre):
+                    tplFunc = btch_get(dicSub['mask'], strPathPre)
+                else:
+                    print('---------Preprocessing in advance failed, '
+                          + 'preprocess again')
+                objPrcPre = None
+
+            # Preprocess the next subject while this subject is fitted, if
+            # the processes and memory can be split between them:
+            varParFit = varPar
+            if ((idxSub + 1) < varNumSub) and (varPar > 1) and (
+                    (varMem is None)
+                    or ((vecMem[idxSub] + vecMem[idxSub + 1]) <= varMem)):
+
+                varParFit = varPar - varParPre
+                strPathPre = os.path.join(strDirTmp,
+                                          ('func_' + str(idxSub + 1)
+                                           + '.npz'))
+                objPrcPre = mp.Process(target=btch_pre,
+                                       args=(lstSub[idxSub + 1]['mask'],
+                                             lstSub[idxSub + 1]['func'],
+                                             varParPre,
+                                             strPathPre))
+                objPrcPre.Daemon = True
+                objPrcPre.start()
+
+                print('---------Preprocess subject ' + str(idxSub + 2)
+                      + ' in advance (' + str(varParPre) + ' of '
+                      + str(varPar) + ' processes)')
+
+            try:
+                ppl_fit(dicMdl, dicSub['mask'], dicSub['func'],
+                        dicSub['out'], tplFunc=tplFunc, varPar=varParFit)
+                lstSts[idxSub] = 'done'
+            except Exception:
+                traceback.print_exc()
+                lstSts[idxSub] = 'failed'
+            del(tplFunc)
+
+            print('------Subject ' + str(idxSub + 1) + ' '
+                  + lstSts[idxSub] + ' (' + str(time.time() - varTme01)
+                  + ' s)')
+
+    finally:
+        # Stop the preprocessing of the next subject if the batch has been
+        # interrupted:
+        if (objPrcPre is not None) and objPrcPre.is_alive():
+            objPrcPre.terminate()
+            objPrcPre.join()
+        shutil.rmtree(strDirTmp, ignore_errors=True)
+
+    return lstSts
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed on-disk cache for results of pipeline stages."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import pickle
+import hashlib
+import inspect
+import numpy as np
+
+
+def cch_hash(objHsh, objIn):
+    """
+    Update hash object with the content of a stage input.
+
+    Parameters
+    ----------
+    objHsh : hashlib hash object
+        Hash object to be updated (in place).
+    objIn : object
+        Input of a pipeline stage. Numpy arrays are hashed by their content
+        (data type, shape, and data). Strings that are paths of existing files
+        are hashed by path, size, and modification time (so that the cache is
+        invalidated if the file changes). Lists, tuples and dictionaries are
+        hashed element by element. All other objects are hashed by their
+        string representation.
+    """
+    if isinstance(objIn, np.ndarray):
+        objHsh.update(('ndarray' + str(objIn.dtype)
+                       + str(objIn.shape)).encode('utf-8'))
+        objHsh.update(
+            np.ascontiguousarray(objIn).reshape(-1).view(np.uint8).data)
+
+    elif isinstance(objIn, (list, tuple)):
+        objHsh.update((type(objIn).__name__ + str(len(objIn))).encode('utf-8'))
+        for objTmp in objIn:
+            cch_hash(objHsh, objTmp)
+
+    elif isinstance(objIn, dict):
+        objHsh.update(('dict' + str(len(objIn))).encode('utf-8'))
+        for strTmp in sorted(objIn.keys()):
+            cch_hash(objHsh, strTmp)
+            cch_hash(objHsh, objIn[strTmp])
+
+    elif (isinstance(objIn, str)
+          and os.path.isfile(os.path.expanduser(objIn))):
+        objStt = os.stat(os.path.expanduser(objIn))
+        objHsh.update(('file' + objIn + str(objStt.st_size)
+                       + str(objStt.st_mtime)).encode('utf-8'))
+
+    else:
+        objHsh.update((type(objIn).__name__ + repr(objIn)).encode('utf-8'))
+
+
+def cch_src(lstFnc):
+    """
+    Source code of the modules that a computation depends on.
+
+    Parameters
+    ----------
+    lstFnc : list
+        Functions that perform the computation.
+
+    Returns
+    -------
+    lstSrc : list
+        Source code of the modules that define the functions, and of all
+        modules of this library that they use, directly or indirectly (e.g.
+        the modules of the parallel processes, the convolution, or the HRF),
+        sorted by module name. The configuration module is not included (its
+        parameters are passed to the computation explicitly).
+
+    Notes
+    -----
+    The modules of this library are the modules in the same directory as this
+    module. A module is used by another one if it, or one of its functions or
+    classes, is imported into the namespace of the other module.
+    """
+    # Directory of the modules of this library:
+    strDirLib = os.path.dirname(os.path.abspath(__file__))
+
+    # Modules that have been found, by name:
+    dicMdl = {}
+
+    lstQue = [inspect.getmodule(fncTmp) for fncTmp in lstFnc]
+    while len(lstQue) > 0:
+        objMdl = lstQue.pop()
+        if (objMdl is None) or (objMdl.__name__ in dicMdl) or (
+                objMdl.__name__ == 'config'):
+            continue
+        strPth = getattr(objMdl, '__file__', None)
+        if ((strPth is None)
+                or (os.path.dirname(os.path.abspath(strPth)) != strDirLib)):
+            continue
+        dicMdl[objMdl.__name__] = objMdl
+        # Modules, functions and classes that the module imports:
+        for objTmp in list(vars(objMdl).values()):
+            if inspect.ismodule(objTmp):
+                lstQue.append(objTmp)
+            elif inspect.isfunction(objTmp) or inspect.isclass(objTmp):
+                lstQue.append(inspect.getmodule(objTmp))
+
+    lstSrc = []
+    for strTmp in sorted(dicMdl.keys()):
+        # Compiled extensions (e.g. cython) have no source code:
+        try:
+            lstSrc.append(inspect.getsource(dicMdl[strTmp]))
+        except (TypeError, IOError):
+            pass
+    return lstSrc
+
+
+def cch_key(strStg, fnc, lstArgs, dicKwargs, lstFls, lstIgn=()):
+    """
+    Create cache key of a pipeline stage.
+
+    Parameters
+    ----------
+    strStg : str
+        Name of the pipeline stage.
+    fnc : function
+        Function that computes the result of the stage.
+    lstArgs : list
+        Positional arguments of `fnc`.
+    dicKwargs : dict
+        Keyword arguments of `fnc`.
+    lstFls : list
+        Paths of additional files that the result depends on (e.g. PNG files
+        that are loaded by `fnc`, but are not passed as arguments).
+    lstIgn : list
+        Names of keyword arguments that do not affect the result (e.g. number
+        of parallel processes), and are therefore not part of the key.
+
+    Returns
+    -------
+    strKey : str
+        Hexadecimal hash of the stage name, the source code of the modules
+        that `fnc` depends on (see `cch_src`), the arguments, and the
+        additional files.
+    """
+    objHsh = hashlib.sha1()
+
+    # Name of the stage & function:
+    cch_hash(objHsh, [strStg, fnc.__name__])
+
+    # Source code of the module that defines the function, and of the modules
+    # that it uses (so that results are recomputed if the implementation
+    # changes):
+    cch_hash(objHsh, cch_src([fnc]))
+
+    # Inputs of the stage:
+    cch_hash(objHsh, list(lstArgs))
+    cch_hash(objHsh, dict([(strTmp, dicKwargs[strTmp]) for strTmp in dicKwargs
+                           if strTmp not in lstIgn]))
+    cch_hash(objHsh, list(lstFls))
+
+    return strStg + '_' + objHsh.hexdigest()
+
+
+def cch_evict(strDirCch, varCchMax, strKeyKeep=None):
+    """
+    Remove least recently used cache entries until the size limit is met.
+
+    Parameters
+    ----------
+    strDirCch : str
+        Cache directory.
+    varCchMax : float
+        Maximum size of the cache in GB.
+    strKeyKeep : str or None
+        Key of a cache entry that is not removed (e.g. the one that has just
+        been created).
+    """
+    # List of cache entries, with their size & time of last access:
+    lstEnt = []
+    for strKey in os.listdir(strDirCch):
+        strDirEnt = os.path.join(strDirCch, strKey)
+        strPathMta = os.path.join(strDirEnt, 'meta.pickle')
+        # Skip incomplete entries (e.g. of a stage that is being written):
+        if not os.path.isfile(strPathMta):
+            continue
+        varSze = np.sum([os.path.getsize(os.path.join(strDirEnt, strTmp))
+                         for strTmp in os.listdir(strDirEnt)])
+        lstEnt.append((os.path.getmtime(strPathMta), varSze, strKey))
+
+    # Total size of the cache:
+    varSzeTtl = np.sum([tplTmp[1] for tplTmp in lstEnt])
+
+    # Remove least recently used entries first:
+    for varTme, varSze, strKey in sorted(lstEnt):
+        if varSzeTtl <= (varCchMax * (1024.0 ** 3)):
+            break
+        if strKey == strKeyKeep:
+            continue
+        print('---------Remove cache entry ' + strKey)
+        shutil.rmtree(os.path.join(strDirCch, strKey), ignore_errors=True)
+        varSzeTtl -= varSze
+
+
+def cch_call(strDirCch, strStg, fnc, lstArgs, dicKwargs=None, lstFls=(),
+             varCchMax=50.0, lgcHit=False, lstIgn=('varPar',)):
+    """
+    Return result of a pipeline stage from the cache, or compute it.
+
+    Parameters
+    ----------
+    strDirCch : str or None
+        Cache directory. If None, the cache is disabled and the stage is always
+        computed.
+    strStg : str
+        Name of the pipeline stage (used as prefix of the cache entry).
+    fnc : function
+        Function that computes the result of the stage.
+    lstArgs : list
+        Positional arguments of `fnc`.
+    dicKwargs : dict or None
+        Keyword arguments of `fnc`.
+    lstFls : list
+        Paths of additional files that the result depends on.
+    varCchMax : float
+        Maximum size of the cache in GB. If the cache grows beyond this size,
+        the least recently used entries are removed.
+    lgcHit : bool
+        Whether to also return whether the result was taken from the cache.
+    lstIgn : list
+        Names of keyword arguments that do not affect the result, and are
+        therefore ignored when looking up the cache (by default the number of
+        parallel processes).
+
+    Returns
+    -------
+    objOut : object
+        Return value(s) of `fnc`, either computed or loaded from the cache.
+    lgcHit : bool
+        Whether the result was loaded from the cache (only returned if
+        `lgcHit` is True).
+
+    Notes
+    -----
+    The cache is content-addressed: The key of a cache entry is a hash of the
+    inputs of the stage (see `cch_key`). Thus, if any input, parameter or
+    input file changes, the key changes and the stage is recomputed, while
+    stages whose inputs have not changed are loaded from disk. Numpy arrays
+    are stored as npy files, all other return values are pickled. The time
+    of last access of each entry is updated on every cache hit, so that the
+    least recently used entries can be removed first.
+    """
+    if dicKwargs is None:
+        dicKwargs = {}
+
+    # Cache disabled:
+    if strDirCch is None:
+        objOut = fnc(*lstArgs, **dicKwargs)
+        if lgcHit:
+            return objOut, False
+        return objOut
+
+    strDirCch = os.path.expanduser(strDirCch)
+    if not os.path.isdir(strDirCch):
+        os.makedirs(strDirCch)
+
+    # Cache key & directory of the cache entry:
+    strKey = cch_key(strStg, fnc, lstArgs, dicKwargs, lstFls, lstIgn=lstIgn)
+    strDirEnt = os.path.join(strDirCch, strKey)
+    strPathMta = os.path.join(strDirEnt, 'meta.pickle')
+
+    if os.path.isfile(strPathMta):
+
+        print('---------Load ' + strStg + ' from cache')
+
+        # Information on the stored return values:
+        with open(strPathMta, 'rb') as objFle:
+            dicMta = pickle.load(objFle)
+
+        # Load return values:
+        lstOut = [None] * dicMta['varNumOut']
+        for idxOut in range(dicMta['varNumOut']):
+            strPathOut = os.path.join(strDirEnt, 'out_' + str(idxOut))
+            if os.path.isfile(strPathOut + '.npy'):
+                # Arrays are memory-mapped (copy-on-write), so that they are
+                # only read from disk when they are accessed, and can be
+                # modified without changing the cache entry:
+                lstOut[idxOut] = np.load(strPathOut + '.npy', mmap_mode='c')
+            else:
+                with open(strPathOut + '.pickle', 'rb') as objFle:
+                    lstOut[idxOut] = pickle.load(objFle)
+
+        # Update time of last access (for the eviction of least recently used
+        # entries):
+        os.utime(strPathMta, None)
+
+        if dicMta['lgcTpl']:
+            objOut = tuple(lstOut)
+        else:
+            objOut = lstOut[0]
+
+        if lgcHit:
+            return objOut, True
+        return objOut
+
+    # Compute the result of the stage:
+    objOut = fnc(*lstArgs, **dicKwargs)
+
+    # Return values are stored in a temporary directory, which is renamed
+    # once it is complete (so that an interrupted run does not leave an
+    # incomplete entry):
+    strDirTmp = strDirEnt + '_tmp' + str(os.getpid())
+    if os.path.isdir(strDirTmp):
+        shutil.rmtree(strDirTmp)
+    os.makedirs(strDirTmp)
+
+    lgcTpl = isinstance(objOut, tuple)
+    if lgcTpl:
+        lstOut = list(objOut)
+    else:
+        lstOut = [objOut]
+
+    for idxOut in range(len(lstOut)):
+        strPathOut = os.path.join(strDirTmp, 'out_' + str(idxOut))
+        if isinstance(lstOut[idxOut], np.ndarray):
+            np.save(strPathOut + '.npy', lstOut[idxOut])
+        else:
+            with open(strPathOut + '.pickle', 'wb') as objFle:
+                pickle.dump(lstOut[idxOut], objFle, protocol=2)
+
+    with open(os.path.join(strDirTmp, 'meta.pickle'), 'wb') as objFle:
+        pickle.dump({'varNumOut': len(lstOut), 'lgcTpl': lgcTpl}, objFle,
+                    protocol=2)
+
+    # Another process may have created the same entry in the meantime:
+    if os.path.isdir(strDirEnt):
+        shutil.rmtree(strDirTmp)
+    else:
+        os.rename(strDirTmp, strDirEnt)
+
+    # Remove least recently used entries if the cache is too large:
+    cch_evict(strDirCch, varCchMax, strKeyKeep=strKey)
+
+    if lgcHit:
+        return objOut, False
+    return objOut
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Check that the CPU versions of the pRF finding give the same results.
+
+The 'numpy' and 'cython' versions (one model at a time, see `find_prf_cpu`),
+the 'gemm' version (blocks of models, see `find_prf_cpu_gemm`) and the
+'gemm_motion' version (with a single feature, see `find_prf_cpu_motion`) are
+run on a small synthetic dataset, which is scaled in the same way as the
+functional data in `pipeline.py` (z-scored and multiplied by 1000). The
+parameters, R2 and betas of the best fitting models, and the best k models
+of each voxel (see `top_k.py`), need to agree between the versions. Run with
+`python check_versions.py`. If the cython extension has not been compiled,
+its numpy implementation is checked instead (see `find_prf_cpu`).
+"""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# *****************************************************************************
+# *** Import modules
+
+import config as cfg
+
+import numpy as np
+
+from utilities import crt_mdl_prms
+
+# The cython function is only imported by `find_prf_cpu` for the 'cython'
+# version:
+cfg.strVersion = 'cython'
+
+from find_prf_cpu import find_prf_cpu  # noqa: E402
+from find_prf_cpu_gemm import find_prf_cpu_gemm  # noqa: E402
+from find_prf_cpu_motion import find_prf_cpu_motion  # noqa: E402
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Synthetic data
+
+print('---Check CPU versions of pRF finding')
+
+# Number of x-positions, y-positions, pRF sizes, volumes and voxels:
+varNumX = 6
+varNumY = 6
+varNumPrfSizes = 3
+varNumVol = 300
+varNumVox = 40
+
+# Number of best models that are retained per voxel:
+varTopK = 3
+
+objRnd = np.random.RandomState(0)
+
+vecMdlXpos = np.linspace(-5.0, 5.0, varNumX)
+vecMdlYpos = np.linspace(-5.0, 5.0, varNumY)
+vecMdlSd = np.linspace(0.5, 2.0, varNumPrfSizes)
+
+# Model time courses, with shape aryPrfTc[x-pos, y-pos, SD, time]. The
+# 'gemm_motion' version does not fit a constant term, so the model time
+# courses are de-meaned (the functional data are de-meaned below), and it
+# ignores models with a variance below one, so they are scaled up:
+aryPrfTc = np.multiply(objRnd.randn(varNumX, varNumY, varNumPrfSizes,
+                                    varNumVol), 10.0).astype(np.float32)
+aryPrfTc = np.subtract(aryPrfTc, np.mean(aryPrfTc, axis=3)[:, :, :, None])
+
+# Voxel time courses, each a scaled model time course plus noise and an
+# offset (with an R2 between about 0.2 and 0.5), with shape aryFunc[voxel,
+# time]:
+vecIdxMdl = objRnd.randint(0, (varNumX * varNumY * varNumPrfSizes),
+                           varNumVox)
+aryFunc = np.add(np.multiply(
+    np.reshape(aryPrfTc, (-1, varNumVol))[vecIdxMdl, :],
+    objRnd.uniform(0.05, 0.1, varNumVox)[:, None]),
+    np.add(objRnd.randn(varNumVox, varNumVol), 100.0))
+
+# Z-score and scale up, as in `ppl_fit` (the residual sum of squares of the
+# voxels is then above 1e8, as for real data):
+aryFunc = np.subtract(aryFunc, np.mean(aryFunc, axis=1)[:, None])
+aryFunc = np.divide(aryFunc, np.std(aryFunc, axis=1)[:, None])
+aryFunc = np.multiply(aryFunc, 1000.0).astype(np.float32)
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Model fitting
+
+dicOut = {}
+dicTpk = {}
+
+for strTmp in ['gemm', 'gemm_motion', 'numpy', 'cython']:
+
+    print('------Version: ' + strTmp)
+
+    # Output array with x-position, y-position, SD, R2 and beta:
+    dicOut[strTmp] = np.zeros((varNumVox, 5), dtype=np.float32)
+    dicTpk[strTmp] = np.zeros((varNumVox, varTopK, 2), dtype=np.float32)
+
+    if strTmp == 'gemm':
+        find_prf_cpu_gemm(1, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,
+                          aryPrfTc, dicOut[strTmp], varMdlBlk=20,
+                          aryTpk=dicTpk[strTmp])
+    elif strTmp == 'gemm_motion':
+        find_prf_cpu_motion(1, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,
+                            aryPrfTc[:, :, :, :, None], 0.0, dicOut[strTmp],
+                            varMdlBlk=20, aryTpk=dicTpk[strTmp])
+    else:
+        find_prf_cpu(1, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc, aryPrfTc,
+                     strTmp, dicOut[strTmp], aryTpk=dicTpk[strTmp])
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Compare results
+
+for strTmp in ['gemm_motion', 'numpy', 'cython']:
+
+    # The model parameters, and the indices of the best k models, need to be
+    # identical. R2 and betas may differ due to float32 precision:
+    lgcTmp = (np.array_equal(dicOut[strTmp][:, 0:3], dicOut['gemm'][:, 0:3])
+              and np.array_equal(dicTpk[strTmp][:, :, 0],
+                                 dicTpk['gemm'][:, :, 0])
+              and np.allclose(dicOut[strTmp][:, 3:5], dicOut['gemm'][:, 3:5],
+                              rtol=1e-3, atol=1e-4)
+              and np.allclose(dicTpk[strTmp][:, :, 1],
+                              dicTpk['gemm'][:, :, 1],
+                              rtol=1e-3, atol=1e-4))
+
+    if not lgcTmp:
+        # Error message:
+        strErrMsg = ('---Error: Results of the \'' + strTmp + '\' version '
+                     + 'differ from the \'gemm\' version.')
+        raise ValueError(strErrMsg)
+
+# The models that were used to create the voxel time courses are found:
+aryTmp = crt_mdl_prms(vecMdlXpos, vecMdlYpos, vecMdlSd)
+varNumHit = np.sum(np.all(np.equal(dicOut['gemm'][:, 0:3],
+                                   aryTmp[vecIdxMdl, :]), axis=1))
+print('------Models recovered: ' + str(varNumHit) + ' of ' + str(varNumVox)
+      + ' voxels')
+if varNumHit < varNumVox:
+    # Error message:
+    strErrMsg = ('---Error: The models of the synthetic voxel time courses '
+                 + 'were not recovered.')
+    raise ValueError(strErrMsg)
+
+print('---Done, all versions agree.')
+# *****************************************************************************
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""Checkpoints of the pRF fitting, and resumption of interrupted runs."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import types
+import hashlib
+import numpy as np
+from cache import cch_hash
+from shared_arrays import shm_get
+from scheduler import sch_run
+
+
+def ckp_cfg(objCfg):
+    """
+    Collect the parameters of the analysis from the configuration module.
+
+    Parameters
+    ----------
+    objCfg : module
+        Configuration module (`config.py`).
+
+    Returns
+    -------
+    dicCfg : dict
+        All public parameters of the configuration module that are numbers,
+        strings, booleans, tuples, lists or None.
+    """
+    tplTyp = (int, float, str, bool, tuple, list, type(None), np.number)
+    return dict([(strTmp, getattr(objCfg, strTmp)) for strTmp in dir(objCfg)
+                 if ((not strTmp.startswith('_'))
+                     and (not isinstance(getattr(objCfg, strTmp),
+                                         types.ModuleType))
+                     and isinstance(getattr(objCfg, strTmp), tplTyp))])
+
+
+def ckp_init(strDirCkp, lstKey):
+    """
+    Prepare the checkpoint directory for the current run.
+
+    Parameters
+    ----------
+    strDirCkp : str
+        Checkpoint directory.
+    lstKey : list
+        Inputs that identify the run (e.g. parameters of the analysis, the
+        functional data, and a sample of the pRF model time courses). They
+        are hashed in the same way as the inputs of the cache (see
+        `cache.py`).
+
+    Notes
+    -----
+    The key of the run is stored in the checkpoint directory (`key.txt`). If
+    the directory contains the checkpoints of a different run (i.e. the key
+    has changed), these checkpoints are removed, so that the run starts from
+    the beginning.
+    """
+    objHsh = hashlib.sha1()
+    cch_hash(objHsh, list(lstKey))
+    strKey = objHsh.hexdigest()
+
+    strDirCkp = os.path.expanduser(strDirCkp)
+    if not os.path.isdir(strDirCkp):
+        os.makedirs(strDirCkp)
+
+    strPathKey = os.path.join(strDirCkp, 'key.txt')
+    strKeyOld = None
+    if os.path.isfile(strPathKey):
+        with open(strPathKey, 'r') as objFle:
+            strKeyOld = objFle.read().strip()
+
+    if strKeyOld != strKey:
+        if strKeyOld is not None:
+            print('---------Checkpoints of a different run are removed')
+        # Only checkpoint files are removed (not other files that may have
+        # been placed into the directory):
+        for strTmp in os.listdir(strDirCkp):
+            if strTmp.startswith('ckp_') and strTmp.endswith('.npz'):
+                os.remove(os.path.join(strDirCkp, strTmp))
+        with open(strPathKey, 'w') as objFle:
+            objFle.write(strKey)
+
+
+def ckp_path(strDirCkp, strStg, idxChnk, strSfx=''):
+    """
+    Path of the checkpoint of a task of the fitting.
+
+    Parameters
+    ----------
+    strDirCkp : str or None
+        Checkpoint directory.
+    strStg : str
+        Name of the stage of the fitting (e.g. 'fit').
+    idxChnk : int
+        Index of the task (e.g. a chunk of voxels).
+    strSfx : str
+        Suffix of the checkpoint (e.g. '_blk' for the progress within the
+        task).
+
+    Returns
+    -------
+    strPath : str or None
+        Path of the checkpoint file, or None if no checkpoint directory is
+        given.
+    """
+    if strDirCkp is None:
+        return None
+    return os.path.join(os.path.expanduser(strDirCkp),
+                        ('ckp_' + strStg + '_' + str(idxChnk) + strSfx
+                         + '.npz'))
+
+
+def ckp_save(strPath, dicAry):
+    """
+    Save arrays to a checkpoint file.
+
+    Parameters
+    ----------
+    strPath : str
+        Path of the checkpoint file.
+    dicAry : dict
+        Arrays to be saved.
+
+    Notes
+    -----
+    The arrays are written into a temporary file first, which then replaces
+    the checkpoint file, so that an interruption while writing does not
+    leave an incomplete checkpoint.
+    """
+    strPathTmp = strPath + '.tmp'
+    with open(strPathTmp, 'wb') as objFle:
+        np.savez(objFle, **dicAry)
+    # On Windows, an existing file is not replaced by `os.rename`:
+    if (os.name == 'nt') and os.path.isfile(strPath):
+        os.remove(strPath)
+    os.rename(strPathTmp, strPath)
+
+
+def ckp_load(strPath, dicAry):
+    """
+    Load arrays from a checkpoint file.
+
+    Parameters
+    ----------
+    strPath : str or None
+        Path of the checkpoint file.
+    dicAry : dict
+        Arrays into which the saved arrays are copied (in place). The saved
+        arrays need to have the same names and shapes.
+
+    Returns
+    -------
+    lgcLoad : bool
+        Whether the checkpoint exists and has been loaded. If not (or if the
+        checkpoint does not match the arrays), the arrays are not changed.
+    """
+    if (strPath is None) or (not os.path.isfile(strPath)):
+        return False
+    with np.load(strPath) as objNpz:
+        lgcMtch = all([((strTmp in objNpz.files)
+                        and (objNpz[strTmp].shape == dicAry[strTmp].shape))
+                       for strTmp in dicAry])
+        if lgcMtch:
+            for strTmp in dicAry:
+                dicAry[strTmp][...] = objNpz[strTmp]
+    return lgcMtch
+
+
+def ckp_blk_load(strPathCkp, dicSte, varBlkSrt=0):
+    """
+    Load the progress of a fitting process within its task.
+
+    Parameters
+    ----------
+    strPathCkp : str or None
+        Path of the checkpoint of the process (see `ckp_path`).
+    dicSte : dict
+        State of the process at the beginning of the model loop (e.g. the
+        best explained sum of squares and the indices of the best models so
+        far), which is replaced (in place) by the saved state.
+    varBlkSrt : int
+        Index of the first model of the model loop.
+
+    Returns
+    -------
+    varBlkSrt : int
+        Index of the first model that has not been fitted yet (`varBlkSrt` if
+        there is no checkpoint).
+    """
+    dicTmp = dict(dicSte)
+    dicTmp['varBlkSrt'] = np.zeros(1, dtype=np.int64)
+    if ckp_load(strPathCkp, dicTmp):
+        return int(dicTmp['varBlkSrt'][0])
+    return varBlkSrt
+
+
+def ckp_blk_save(strPathCkp, varBlkSrt, dicSte):
+    """
+    Save the progress of a fitting process within its task.
+
+    Parameters
+    ----------
+    strPathCkp : str
+        Path of the checkpoint of the process (see `ckp_path`).
+    varBlkSrt : int
+        Index of the first model that has not been fitted yet.
+    dicSte : dict
+        State of the process (see `ckp_blk_load`).
+    """
+    dicTmp = dict(dicSte)
+    dicTmp['varBlkSrt'] = np.array([varBlkSrt], dtype=np.int64)
+    ckp_save(strPathCkp, dicTmp)
+
+
+def ckp_run(strDirCkp, strStg, fncTrg, lstArgs, lstOut, varPar,
+            varNumRtr=2):
+    """
+    Run tasks of the fitting on parallel processes, with checkpoints.
+
+    Parameters
+    ----------
+    strDirCkp : str or None
+        Checkpoint directory. If None, no checkpoints are saved, but failed
+        tasks are still started again.
+    strStg : str
+        Name of the stage of the fitting (e.g. 'fit', 'c2f', 'rfn').
+    fncTrg : function
+        Function that is run for each task.
+    lstArgs : list
+        Arguments of `fncTrg` for each task (tuples).
+    lstOut : list
+        Shared output arrays (ShmArray or None) of each task (tuples), into
+        which the results of the task are written.
+    varPar : int
+        Number of parallel processes.
+    varNumRtr : int
+        Number of times that a task is started again if it fails.
+
+    Notes
+    -----
+    Tasks for which a checkpoint exists (i.e. that have been completed in an
+    earlier, interrupted run) are loaded into the output arrays, and are not
+    processed again. All other tasks are run on a pool of processes (see
+    `sch_run`). When a task has been completed, its output is saved as a
+    checkpoint. If a process fails (e.g. because it has been killed), only
+    its task is started again (if the fitting function saves its progress
+    within the task, it continues from there).
+    """
+    varNumTsk = len(lstArgs)
+
+    # Output arrays of each task, by name:
+    lstDicOut = [dict([('ary' + str(idxOut), shm_get(aryTmp))
+                       for idxOut, aryTmp in enumerate(lstOut[idxTsk])
+                       if aryTmp is not None])
+                 for idxTsk in range(varNumTsk)]
+
+    # Tasks that have been completed in an earlier run:
+    lstPnd = [idxTsk for idxTsk in range(varNumTsk)
+              if not ckp_load(ckp_path(strDirCkp, strStg, idxTsk),
+                              lstDicOut[idxTsk])]
+    if len(lstPnd) < varNumTsk:
+        print('---------Resume from checkpoint: '
+              + str(varNumTsk - len(lstPnd)) + ' out of '
+              + str(varNumTsk) + ' tasks already completed')
+
+    def ckp_dne(idxPnd):
+        """Save the output of a completed task."""
+        if strDirCkp is None:
+            return
+        idxTsk = lstPnd[idxPnd]
+        ckp_save(ckp_path(strDirCkp, strStg, idxTsk), lstDicOut[idxTsk])
+        # The progress within the task is not needed anymore:
+        strTmp = ckp_path(strDirCkp, strStg, idxTsk, '_blk')
+        if os.path.isfile(strTmp):
+            os.remove(strTmp)
+
+    sch_run(fncTrg, [lstArgs[idxTsk] for idxTsk in lstPnd], varPar,
+            fncDne=ckp_dne, varNumRtr=varNumRtr)
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""Coarse-to-fine search of the pRF model grid."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from shared_arrays import shm_get
+from model_bank import bnk_get
+from find_prf_cpu_gemm import find_prf_cpu_gemm
+from find_prf_cpu_motion import find_prf_cpu_motion
+
+
+def c2f_grid(vecMdlXpos, vecMdlYpos, vecMdlSd, aryPrfTc, tplC2fStp):
+    """
+    Subsample the pRF model grid for the coarse search.
+
+    Parameters
+    ----------
+    vecMdlXpos : np.array
+        1D array with pRF model x positions (full grid).
+    vecMdlYpos : np.array
+        1D array with pRF model y positions (full grid).
+    vecMdlSd : np.array
+        1D array with pRF model sizes (full grid).
+    aryPrfTc : np.array or ShmArray or MdlBnk
+        pRF model time courses of the full grid (or handle), with shape
+        aryPrfTc[x-position, y-position, SD, time, feature].
+    tplC2fStp : tuple
+        Step size of the coarse grid along x-position, y-position and SD (in
+        steps of the full grid).
+
+    Returns
+    -------
+    vecMdlXpos : np.array
+        1D array with pRF model x positions (coarse grid).
+    vecMdlYpos : np.array
+        1D array with pRF model y positions (coarse grid).
+    vecMdlSd : np.array
+        1D array with pRF model sizes (coarse grid).
+    aryPrfTc : np.array
+        pRF model time courses of the coarse grid (a copy, in memory).
+    """
+    varStpX, varStpY, varStpSd = [max(int(varTmp), 1)
+                                  for varTmp in tplC2fStp]
+
+    aryPrfTc = np.ascontiguousarray(
+        bnk_get(aryPrfTc)[::varStpX, ::varStpY, ::varStpSd, ...])
+
+    return (vecMdlXpos[::varStpX], vecMdlYpos[::varStpY],
+            vecMdlSd[::varStpSd], aryPrfTc)
+
+
+def c2f_fit(vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc, aryPrfTc, strVersion,
+            varL2reg, varMdlBlk):
+    """
+    Fit pRF models to voxels within the calling process.
+
+    Parameters
+    ----------
+    vecMdlXpos : np.array
+        1D array with pRF model x positions.
+    vecMdlYpos : np.array
+        1D array with pRF model y positions.
+    vecMdlSd : np.array
+        1D array with pRF model sizes.
+    aryFunc : np.array
+        Functional data, with shape aryFunc[voxel, time].
+    aryPrfTc : np.array or ShmArray or MdlBnk
+        pRF model time courses (or handle).
+    strVersion : str
+        Version used for pRF finding (see `config.py`).
+    varL2reg : float
+        L2 regularisation factor (only for models with several predictors).
+    varMdlBlk : int
+        Number of pRF models that are fitted at once.
+
+    Returns
+    -------
+    aryBstPrm : np.array
+        Parameters of the best fitting models, with shape
+        aryBstPrm[voxel, parameter] (x-position, y-position, SD, R2, and the
+        betas of the best fitting models, one per feature).
+
+    Notes
+    -----
+    The fitting is always done with one of the CPU versions that fits blocks
+    of models at once: 'gemm' for the versions with one predictor per model
+    ('numpy', 'cython', 'gemm'), which fits the same model (one predictor and
+    a constant term), and 'gemm_motion' for the versions with several
+    predictors ('gemm_motion', 'gpu').
+    """
+    # Number of features (betas per model):
+    tplShp = tuple(aryPrfTc.shape)
+    if len(tplShp) == 5:
+        varNumFtr = tplShp[4]
+    else:
+        varNumFtr = 1
+
+    aryBstPrm = np.zeros((aryFunc.shape[0], (4 + varNumFtr)),
+                         dtype=np.float32)
+
+    if strVersion in ['gemm_motion', 'gpu']:
+        find_prf_cpu_motion(-1, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,
+                            aryPrfTc, varL2reg, aryBstPrm,
+                            varMdlBlk=varMdlBlk)
+    else:
+        find_prf_cpu_gemm(-1, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,
+                          aryPrfTc, aryBstPrm, varMdlBlk=varMdlBlk)
+
+    return aryBstPrm
+
+
+def c2f_refine(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
+               aryPrfTc, strVersion, varL2reg, aryOut, tplC2fNgb,
+               varMdlBlk=500):
+    """
+    Refine the results of the coarse search on the full pRF model grid.
+
+    Parameters
+    ----------
+    idxPrc : int
+        Process ID of the process calling this function (for CPU
+        multi-threading).
+    vecMdlXpos : np.array
+        1D array with pRF model x positions (full grid).
+    vecMdlYpos : np.array
+        1D array with pRF model y positions (full grid).
+    vecMdlSd : np.array
+        1D array with pRF model sizes (full grid).
+    aryFuncChnk : np.array or ShmArray
+        2D array with functional MRI data, with shape aryFunc[voxel, time].
+        Can be placed in shared memory (see `shared_arrays.py`).
+    aryPrfTc : np.array or ShmArray or MdlBnk
+        pRF model time courses of the full grid, with shape
+        aryPrfTc[x-position, y-position, SD, time, feature]. Can be placed in
+        shared memory (see `shared_arrays.py`), or be the handle of a model
+        bank file (see `model_bank.py`).
+    strVersion : str
+        Version used for pRF finding (see `c2f_fit`).
+    varL2reg : float
+        L2 regularisation factor (only for models with several predictors).
+    aryOut : ShmArray
+        Shared output array (chunk corresponding to the functional data), with
+        shape aryOut[voxel, parameter], containing the results of the coarse
+        search. The results of the refinement are written into the same array
+        (columns (0) x-position, (1) y-position, (2) SD, and (3) R2, and the
+        betas into the columns (4) and following, if the array has more
+        columns).
+    tplC2fNgb : tuple
+        Size of the neighbourhood of the winning model of the coarse search,
+        in which the models of the full grid are fitted, along x-position,
+        y-position and SD (in steps of the full grid, on either side).
+    varMdlBlk : int
+        Number of pRF models that are fitted at once.
+
+    Notes
+    -----
+    The results are not returned, but written into the shared output array.
+    Voxels whose coarse search resulted in the same winning model have the
+    same neighbourhood, and are refined together. The neighbourhood contains
+    the winning model of the coarse search, so the refined model always
+    explains at least as much variance.
+    """
+    # The functional data and the results of the coarse search are in shared
+    # memory:
+    aryFuncChnk = shm_get(aryFuncChnk)
+    aryOut = shm_get(aryOut)
+    aryPrfTc = bnk_get(aryPrfTc)
+
+    # Number of voxels to be refined in this chunk:
+    varNumVoxChnk = aryFuncChnk.shape[0]
+
+    # Indices of the winning models of the coarse search on the full grid:
+    aryCrs = np.zeros((varNumVoxChnk, 3), dtype=np.int64)
+    for idxDim, vecTmp in enumerate([vecMdlXpos, vecMdlYpos, vecMdlSd]):
+        aryCrs[:, idxDim] = np.argmin(
+            np.absolute(np.subtract(aryOut[:, idxDim][:, None],
+                                    vecTmp[None, :])), axis=1)
+
+    # Voxels are grouped by winning model of the coarse search:
+    aryGrp, vecGrp = np.unique(aryCrs, axis=0, return_inverse=True)
+    vecGrp = np.reshape(vecGrp, -1)
+    varNumGrp = aryGrp.shape[0]
+
+    # Size of the full grid:
+    tplShp = (vecMdlXpos.shape[0], vecMdlYpos.shape[0], vecMdlSd.shape[0])
+
+    # Prepare status indicator if this is the first of the parallel processes:
+    if idxPrc == 0:
+
+        # Number of steps of the status indicator:
+        varStsStpSze = 20
+
+        # Vector with group counts at which to give status feedback:
+        vecStatGrp = np.linspace(0,
+                                 varNumGrp,
+                                 num=(varStsStpSze+1),
+                                 endpoint=True)
+        vecStatGrp = np.ceil(vecStatGrp)
+        vecStatGrp = vecStatGrp.astype(int)
+
+        # Vector with corresponding percentage values at which to give status
+        # feedback:
+        vecStatPrc = np.linspace(0,
+                                 100,
+                                 num=(varStsStpSze+1),
+                                 endpoint=True)
+        vecStatPrc = np.ceil(vecStatPrc)
+        vecStatPrc = vecStatPrc.astype(int)
+
+        # Counter for status indicator:
+        varCntSts01 = 0
+
+    # Loop through groups of voxels:
+    for idxGrp in range(varNumGrp):
+
+        # Status indicator (only used in the first of the parallel processes):
+        if idxPrc == 0:
+            while ((varCntSts01 <= varStsStpSze)
+                   and (vecStatGrp[varCntSts01] <= idxGrp)):
+                # Prepare status message:
+                strStsMsg = ('------------Progress: ' +
+                             str(vecStatPrc[varCntSts01]) +
+                             ' % --- ' +
+                             str(vecStatGrp[varCntSts01]) +
+                             ' neighbourhoods out of ' +
+                             str(varNumGrp))
+                print(strStsMsg)
+                varCntSts01 = varCntSts01 + int(1)
+
+        # Neighbourhood of the winning model on the full grid:
+        lstSlc = [slice(max((aryGrp[idxGrp, idxDim] - tplC2fNgb[idxDim]), 0),
+                        min((aryGrp[idxGrp, idxDim] + tplC2fNgb[idxDim] + 1),
+                            tplShp[idxDim]))
+                  for idxDim in range(3)]
+
+        # Voxels of the current group:
+        vecIdxVox = np.nonzero(np.equal(vecGrp, idxGrp))[0]
+
+        # Fit the models of the neighbourhood:
+        aryTmp = c2f_fit(
+            vecMdlXpos[lstSlc[0]],
+            vecMdlYpos[lstSlc[1]],
+            vecMdlSd[lstSlc[2]],
+            aryFuncChnk[vecIdxVox, :],
+            np.array(aryPrfTc[lstSlc[0], lstSlc[1], lstSlc[2], ...]),
+            strVersion,
+            varL2reg,
+            varMdlBlk)
+        aryOut[vecIdxVox, :] = aryTmp[:, 0:aryOut.shape[1]]
+
+
+def c2f_chk(vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc, aryPrfTc, aryBstPrm,
+            strVersion, varL2reg, varMdlBlk=500):
+    """
+    Compare results of the coarse-to-fine search with an exhaustive search.
+
+    Parameters
+    ----------
+    vecMdlXpos : np.array
+        1D array with pRF model x positions (full grid).
+    vecMdlYpos : np.array
+        1D array with pRF model y positions (full grid).
+    vecMdlSd : np.array
+        1D array with pRF model sizes (full grid).
+    aryFunc : np.array
+        Functional data of the voxels to be compared, with shape
+        aryFunc[voxel, time].
+    aryPrfTc : np.array or ShmArray or MdlBnk
+        pRF model time courses of the full grid (or handle).
+    aryBstPrm : np.array
+        Results of the coarse-to-fine search for the same voxels, with shape
+        aryBstPrm[voxel, parameter] (x-position, y-position, SD, R2).
+    strVersion : str
+        Version used for pRF finding (see `c2f_fit`).
+    varL2reg : float
+        L2 regularisation factor (only for models with several predictors).
+    varMdlBlk : int
+        Number of pRF models that are fitted at once in the exhaustive search.
+
+    Returns
+    -------
+    varAgr : float
+        Fraction of voxels for which the coarse-to-fine search finds the same
+        model as the exhaustive search.
+    vecR2Dff : np.array
+        Difference in R2 between exhaustive search and coarse-to-fine search,
+        for each voxel (zero or positive).
+    """
+    aryExh = c2f_fit(vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc, aryPrfTc,
+                     strVersion, varL2reg, varMdlBlk)
+
+    # Same model (all parameters identical), or model that explains the same
+    # variance (e.g. models with identical time courses):
+    lgcAgr = np.logical_or(np.all(np.equal(aryExh[:, 0:3],
+                                           aryBstPrm[:, 0:3]), axis=1),
+                           np.less_equal(aryExh[:, 3], aryBstPrm[:, 3]))
+    varAgr = np.mean(lgcAgr)
+    vecR2Dff = np.maximum(np.subtract(aryExh[:, 3], aryBstPrm[:, 3]), 0.0)
+
+    return varAgr, vecR2Dff
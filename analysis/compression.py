@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""Temporal low-rank compression of pRF models and functional data."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from model_bank import MdlCmp
+from model_bank import bnk_tile
+
+
+def cmp_basis(objBnk, lgcDmn=True, varCmpEng=0.9999, varCmpNum=None,
+              varMdlBlk=1000):
+    """
+    Find temporal basis that spans the pRF model time courses.
+
+    Parameters
+    ----------
+    objBnk : np.array or ShmArray or MdlBnk or MdlLzy
+        pRF model time courses (or handle), with shape aryPrfTc[x-position,
+        y-position, SD, time, feature].
+    lgcDmn : bool
+        Whether the model time courses are de-meaned before fitting (as in the
+        'gemm' version). If False, the first component of the basis is the
+        constant time course.
+    varCmpEng : float
+        Fraction of the energy (sum of squares) of the de-meaned model time
+        courses that is retained by the basis. Only used if `varCmpNum` is
+        None.
+    varCmpNum : int or None
+        Number of components of the basis. If None, the number of components
+        is chosen according to `varCmpEng`.
+    varMdlBlk : int
+        Number of models that are read (or created) at once.
+
+    Returns
+    -------
+    aryBss : np.array
+        Orthonormal temporal basis, with shape aryBss[time, component].
+    vecEig : np.array
+        Energy of the de-meaned model time courses along all principal
+        directions (in descending order), with shape vecEig[time].
+
+    Notes
+    -----
+    The basis consists of the leading eigenvectors of the sum of outer
+    products of all de-meaned model time courses (i.e. the right singular
+    vectors of the matrix of all de-meaned model time courses). The models
+    are read one tile at a time, so that only a matrix of size time by time
+    is held in memory. If the models are not de-meaned before fitting, the
+    constant time course is added as first component, so that the mean of a
+    time course can be recovered from its first coordinate (needed for the
+    total sum of squares in the 'gemm_motion' version).
+    """
+    # Shape of the pRF model time courses:
+    tplShp = tuple(objBnk.shape)
+    varNumVol = tplShp[3]
+
+    # Number of pRF models (x-pos * y-pos * SD):
+    varNumMdls = tplShp[0] * tplShp[1] * tplShp[2]
+
+    # Sum of outer products of the model time courses:
+    aryCov = np.zeros((varNumVol, varNumVol), dtype=np.float64)
+
+    for varBlkSrt in range(0, varNumMdls, varMdlBlk):
+
+        # Index of last model in current block (plus one):
+        varBlkEnd = min((varBlkSrt + varMdlBlk), varNumMdls)
+
+        # Model time courses of all features, with shape aryBlk[model *
+        # feature, time]:
+        aryBlk = np.swapaxes(bnk_tile(objBnk, varBlkSrt, varBlkEnd), 1, 2)
+        aryBlk = np.reshape(aryBlk, (-1, varNumVol))
+        aryBlk = np.subtract(aryBlk,
+                             np.mean(aryBlk, axis=1,
+                                     dtype=np.float32)[:, None])
+
+        aryCov += np.dot(aryBlk.T, aryBlk)
+
+    # Principal directions, sorted by energy:
+    vecEig, aryBss = np.linalg.eigh(aryCov)
+    vecEig = np.maximum(vecEig[::-1], 0.0)
+    aryBss = aryBss[:, ::-1]
+
+    # Number of components:
+    if varCmpNum is None:
+        vecEngCum = np.divide(np.cumsum(vecEig),
+                              max(np.sum(vecEig), np.finfo(np.float64).tiny))
+        varCmpNum = int(np.searchsorted(vecEngCum, varCmpEng) + 1)
+    varCmpNum = max(min(int(varCmpNum), (varNumVol - 1)), 1)
+    aryBss = aryBss[:, 0:varCmpNum]
+
+    if not lgcDmn:
+        # Constant time course (unit norm):
+        vecCnst = np.divide(np.ones((varNumVol, 1)), np.sqrt(varNumVol))
+        # The principal directions of de-meaned time courses are orthogonal to
+        # the constant time course (up to numerical precision):
+        aryBss = np.subtract(aryBss, np.dot(vecCnst, np.dot(vecCnst.T,
+                                                            aryBss)))
+        aryBss = np.linalg.qr(aryBss)[0]
+        aryBss = np.hstack((vecCnst, aryBss))
+
+    return aryBss, vecEig
+
+
+def cmp_models(objBnk, aryBss, lgcDmn=True, varMdlBlk=1000):
+    """
+    Project pRF model time courses onto temporal basis.
+
+    Parameters
+    ----------
+    objBnk : np.array or ShmArray or MdlBnk or MdlLzy
+        pRF model time courses (or handle), with shape aryPrfTc[x-position,
+        y-position, SD, time, feature].
+    aryBss : np.array
+        Orthonormal temporal basis, with shape aryBss[time, component].
+    lgcDmn : bool
+        Whether the model time courses are de-meaned before projection.
+    varMdlBlk : int
+        Number of models that are read (or created) at once.
+
+    Returns
+    -------
+    objCmp : MdlCmp
+        Handle of compressed models, with shape aryPrfTc[x-position,
+        y-position, SD, component, feature]. The last component is zero
+        (placeholder for the residual of the functional data, see
+        `cmp_func`).
+    vecRes : np.array
+        Fraction of the energy of each model time course (maximum across
+        features) that is not captured by the basis, with shape
+        vecRes[model].
+    """
+    # Shape of the pRF model time courses:
+    tplShp = tuple(objBnk.shape)
+    varNumVol = tplShp[3]
+    varNumFtr = tplShp[4] if (len(tplShp) == 5) else 1
+
+    # Number of pRF models (x-pos * y-pos * SD) & components:
+    varNumMdls = tplShp[0] * tplShp[1] * tplShp[2]
+    varNumCmp = aryBss.shape[1]
+    aryBss = aryBss.astype(np.float32)
+
+    # Arrays for compressed models (with an additional component for the
+    # residual), norms, validity mask & residual energy:
+    aryPrfTc = np.zeros((varNumMdls, (varNumCmp + 1), varNumFtr),
+                        dtype=np.float32)
+    aryNrm = np.zeros((varNumMdls, varNumFtr), dtype=np.float32)
+    vecVld = np.zeros(varNumMdls, dtype=np.bool_)
+    vecRes = np.zeros(varNumMdls, dtype=np.float32)
+
+    for varBlkSrt in range(0, varNumMdls, varMdlBlk):
+
+        # Index of last model in current block (plus one):
+        varBlkEnd = min((varBlkSrt + varMdlBlk), varNumMdls)
+
+        # Model time courses, with shape aryBlk[model, feature, time]:
+        aryBlk = np.swapaxes(bnk_tile(objBnk, varBlkSrt, varBlkEnd), 1, 2)
+
+        # Validity of the models is determined from the full time courses
+        # (same criterion as in the 'gemm_motion' and GPU versions):
+        vecVld[varBlkSrt:varBlkEnd] = np.max(
+            np.greater(np.var(aryBlk, axis=2, dtype=np.float32),
+                       np.array([1.0], dtype=np.float32)[0]),
+            axis=1)
+
+        if lgcDmn:
+            aryBlk = np.subtract(aryBlk,
+                                 np.mean(aryBlk, axis=2,
+                                         dtype=np.float32)[:, :, None])
+
+        # Coordinates of the models in the basis, with shape aryCrd[model,
+        # feature, component]:
+        aryCrd = np.dot(aryBlk, aryBss)
+
+        # Energy of the full & compressed model time courses:
+        arySs = np.sum(np.square(aryBlk), axis=2, dtype=np.float32)
+        aryRes = np.sum(np.square(np.subtract(aryBlk,
+                                              np.dot(aryCrd, aryBss.T))),
+                        axis=2, dtype=np.float32)
+
+        aryPrfTc[varBlkSrt:varBlkEnd, 0:varNumCmp, :] = np.swapaxes(aryCrd,
+                                                                    1, 2)
+
+        # Models with a variance of zero keep a norm of zero (so that they
+        # are never selected, as in the 'gemm' version):
+        aryNrm[varBlkSrt:varBlkEnd, :] = np.sum(np.square(aryCrd), axis=2)
+        aryNrm[varBlkSrt:varBlkEnd, :][np.less_equal(arySs, 0.0)] = 0.0
+
+        vecRes[varBlkSrt:varBlkEnd] = np.max(
+            np.divide(aryRes, np.maximum(arySs, np.finfo(np.float32).tiny)),
+            axis=1)
+
+    aryPrfTc = np.reshape(aryPrfTc, (tplShp[0], tplShp[1], tplShp[2],
+                                     (varNumCmp + 1), varNumFtr))
+
+    return MdlCmp(aryPrfTc, aryNrm, vecVld), vecRes
+
+
+def cmp_func(aryFunc, aryBss, lgcDmn=True):
+    """
+    Project functional time courses onto temporal basis.
+
+    Parameters
+    ----------
+    aryFunc : np.array
+        Functional time courses, with shape aryFunc[voxel, time].
+    aryBss : np.array
+        Orthonormal temporal basis, with shape aryBss[time, component].
+    lgcDmn : bool
+        Whether the time courses are de-meaned before projection.
+
+    Returns
+    -------
+    aryFuncCmp : np.array
+        Compressed time courses, with shape aryFuncCmp[voxel, component]. The
+        last component is the norm of the residual (the part of the time
+        course that is not captured by the basis), so that the sum of squares
+        of each compressed time course equals the sum of squares of the full
+        (de-meaned) time course.
+    vecRes : np.array
+        Fraction of the energy of each time course that is not captured by the
+        basis, with shape vecRes[voxel].
+
+    Notes
+    -----
+    The residual is orthogonal to all compressed models, so it does not
+    change the fit of any model, but it is needed for the total sum of squares
+    (and thus the R2) to be exact.
+    """
+    aryFunc = aryFunc.astype(np.float32)
+    aryBss = aryBss.astype(np.float32)
+    if lgcDmn:
+        aryFunc = np.subtract(aryFunc,
+                              np.mean(aryFunc, axis=1,
+                                      dtype=np.float32)[:, None])
+
+    # Coordinates in the basis, and energy of the residual:
+    aryCrd = np.dot(aryFunc, aryBss)
+    vecRes = np.sum(np.square(np.subtract(aryFunc, np.dot(aryCrd, aryBss.T))),
+                    axis=1, dtype=np.float32)
+
+    aryFuncCmp = np.hstack((aryCrd, np.sqrt(vecRes)[:, None]))
+
+    vecRes = np.divide(vecRes,
+                       np.maximum(np.sum(np.square(aryFunc), axis=1,
+                                         dtype=np.float32),
+                                  np.finfo(np.float32).tiny))
+
+    return aryFuncCmp, vecRes
+
+
+def crt_cmp(objBnk, aryFunc, lgcDmn=True, varCmpEng=0.9999, varCmpNum=None,
+            varMdlBlk=1000):
+    """
+    Compress pRF models and functional data for model fitting.
+
+    Parameters
+    ----------
+    objBnk : np.array or ShmArray or MdlBnk or MdlLzy
+        pRF model time courses (or handle), with shape aryPrfTc[x-position,
+        y-position, SD, time, feature].
+    aryFunc : np.array
+        Functional time courses, with shape aryFunc[voxel, time].
+    lgcDmn : bool
+        Whether models and data are de-meaned before fitting (True for the
+        'gemm' version, False for the 'gemm_motion' version).
+    varCmpEng : float
+        Fraction of the energy of the model time courses that is retained.
+    varCmpNum : int or None
+        Number of components (overrides `varCmpEng`).
+    varMdlBlk : int
+        Number of models that are read (or created) at once.
+
+    Returns
+    -------
+    objCmp : MdlCmp
+        Handle of compressed models, to be passed to the fitting functions
+        instead of the model time courses.
+    aryFuncCmp : np.array
+        Compressed functional data, with shape aryFuncCmp[voxel, component].
+
+    Notes
+    -----
+    The pRF model time courses are smooth (HRF-convolved), and span a
+    subspace of much lower dimension than the number of volumes. Models and
+    data are projected onto the leading principal directions of the models,
+    so that the cost of model fitting scales with the number of components
+    instead of the number of volumes. Fitting the compressed models to the
+    compressed data is exactly the same as fitting the projections of the
+    models onto the basis to the full data. The approximation error therefore
+    only depends on the part of the model time courses that is not captured
+    by the basis, which is reported.
+
+    The basis only depends on the models, so that the models can be
+    compressed once (`crt_cmp_mdl`) for several sets of functional data
+    (`crt_cmp_func`).
+    """
+    objCmp, aryBss = crt_cmp_mdl(objBnk, lgcDmn=lgcDmn, varCmpEng=varCmpEng,
+                                 varCmpNum=varCmpNum, varMdlBlk=varMdlBlk)
+
+    aryFuncCmp = crt_cmp_func(aryFunc, aryBss, lgcDmn=lgcDmn)
+
+    return objCmp, aryFuncCmp
+
+
+def crt_cmp_mdl(objBnk, lgcDmn=True, varCmpEng=0.9999, varCmpNum=None,
+                varMdlBlk=1000):
+    """
+    Compress pRF models for model fitting.
+
+    Parameters
+    ----------
+    objBnk, lgcDmn, varCmpEng, varCmpNum, varMdlBlk
+        See `crt_cmp`.
+
+    Returns
+    -------
+    objCmp : MdlCmp
+        Handle of compressed models.
+    aryBss : np.array
+        Temporal basis, with shape aryBss[time, component], which is needed to
+        compress the functional data (see `crt_cmp_func`).
+    """
+    print('---------Temporal compression of models')
+
+    aryBss, vecEig = cmp_basis(objBnk, lgcDmn=lgcDmn, varCmpEng=varCmpEng,
+                               varCmpNum=varCmpNum, varMdlBlk=varMdlBlk)
+
+    objCmp, vecResMdl = cmp_models(objBnk, aryBss, lgcDmn=lgcDmn,
+                                   varMdlBlk=varMdlBlk)
+
+    # Report approximation error:
+    varNumCmp = aryBss.shape[1]
+    print('------------Number of components: ' + str(varNumCmp)
+          + ' (number of volumes: ' + str(aryBss.shape[0]) + ')')
+    print('------------Energy of de-meaned models retained: '
+          + str(np.sum(vecEig[0:(varNumCmp - int(not lgcDmn))])
+                / max(np.sum(vecEig), np.finfo(np.float64).tiny)))
+    print('------------Residual energy of models (fraction), mean: '
+          + str(np.mean(vecResMdl)) + ', max: ' + str(np.max(vecResMdl)))
+
+    return objCmp, aryBss
+
+
+def crt_cmp_func(aryFunc, aryBss, lgcDmn=True):
+    """
+    Compress functional data for model fitting.
+
+    Parameters
+    ----------
+    aryFunc : np.array
+        Functional time courses, with shape aryFunc[voxel, time].
+    aryBss : np.array
+        Temporal basis of the compressed models (see `crt_cmp_mdl`).
+    lgcDmn : bool
+        See `crt_cmp`.
+
+    Returns
+    -------
+    aryFuncCmp : np.array
+        Compressed functional data, with shape aryFuncCmp[voxel, component].
+    """
+    print('---------Temporal compression of data')
+
+    aryFuncCmp, vecResFunc = cmp_func(aryFunc, aryBss, lgcDmn=lgcDmn)
+
+    # Report approximation error:
+    print('------------Residual energy of data (fraction), mean: '
+          + str(np.mean(vecResFunc)) + ', max: ' + str(np.max(vecResFunc)))
+
+    return aryFuncCmp
@@ -65,6 +65,12 @@ lgcLinTrnd = True
 # Number of fMRI volumes and png files to load:
 varNumVol = 4 * 172
 
+# Number of volumes of each run. If provided, the HRF convolution during model
+# creation is restarted at the beginning of each run (so that the response to
+# stimuli at the end of a run does not spill over into the next run). If None,
+# all volumes are treated as one continuous run.
+lstRunLen = None
+
 # Number of processes to run in parallel:
 varPar = 11
 
@@ -89,16 +95,209 @@ strPathNiiMask = '/media/john/DATADRIVE1/MRI_Data_PhD/05_PacMan/20161221/nii_dis
 # Output basename:
 strPathOut = '/media/john/DATADRIVE1/MRI_Data_PhD/05_PacMan/20161221/nii_distcor/retinotopy/pRF_results/pRF_results'  #noqa
 
+# Variants of the functional data that are fitted in the same sweep through
+# the pRF models (e.g. odd and even runs for split-half reliability, or single
+# runs). List of tuples, each with the suffix of the output images of the
+# variant and the paths of its functional runs, e.g. [('_odd', [<run 1>,
+# <run 3>]), ('_even', [<run 2>, <run 4>])]. All variants have the same mask
+# and the same design (i.e. the number of volumes of the pRF models), and
+# their results are saved separately (e.g. `<strPathOut>_odd_R2.nii`). Each
+# task of the model fitting contains a part of every variant, so that each
+# block of models is scored against all variants while it is in memory (the
+# models are read once per task, not once per variant; with varVoxTsk, a task
+# contains up to varVoxTsk voxels of each variant). If None, lstPathNiiFunc is
+# fitted.
+lstVar = None
+
 # Which version to use for pRF finding. 'numpy' or 'cython' for pRF finding on
-# CPU, 'gpu' for using GPU.
+# CPU, 'gemm' for fitting blocks of models at once on CPU (only one predictor
+# per model), 'gemm_motion' for fitting blocks of models with several
+# predictors (e.g. motion directions) at once on CPU, 'ann' for searching
+# an index of the models on CPU (only one predictor per model, approximate),
+# 'gpu' for using GPU.
 strVersion = 'gpu'
 
+# Number of pRF models that are fitted at once (i.e. with one matrix
+# multiplication) in the 'gemm' version:
+varMdlBlk = 500
+
+# Number of pRF models that are fitted at once in the 'gemm_motion' version.
+# Each model has one predictor per feature, so this should be lower than for
+# the 'gemm' version:
+varMdlBlkMtn = 100
+
+# Number of clusters of the model index in the 'ann' version (if None, the
+# square root of the number of models). The index is stored with the model
+# bank (if strPathBnk is not None), and only created once per model bank.
+varAnnClst = None
+
+# Number of clusters of the model index whose models are fitted to each voxel
+# in the 'ann' version (more clusters are slower, but closer to the exhaustive
+# search):
+varAnnPrb = 8
+
+# Fraction of voxels for which the result of the 'ann' version is compared
+# with an exhaustive search (the agreement is reported):
+varAnnChk = 0.01
+
+# Coarse-to-fine search of the model grid? If True, the pRF models are first
+# fitted on a subsampled grid (see tplC2fStp), and each voxel is then refined
+# on the full grid, within a neighbourhood of the winning model of the coarse
+# search (see tplC2fNgb). Makes dense grids (large varNumX, varNumY,
+# varNumPrfSizes) affordable. The refinement is done on CPU (also for the
+# 'gpu' version). Not for the 'ann' version, and not together with lgcMdlLzy
+# or lgcCmp.
+lgcC2f = False
+
+# Step size of the coarse grid along x-position, y-position and SD (in steps
+# of the full grid):
+tplC2fStp = (3, 3, 2)
+
+# Size of the neighbourhood of the winning model of the coarse search that is
+# searched on the full grid, along x-position, y-position and SD (in steps of
+# the full grid, on either side of the winning model):
+tplC2fNgb = (3, 3, 2)
+
+# Fraction of voxels for which the result of the coarse-to-fine search is
+# compared with an exhaustive search (the agreement is reported):
+varC2fChk = 0.01
+
+# Continuous refinement of the pRF parameters? If True, the x-position,
+# y-position and SD of the best fitting model of the grid search are
+# optimised continuously for all voxels (Levenberg-Marquardt steps with
+# analytic derivatives of the Gaussian pRF model, for a batch of voxels at
+# once), so that the results are not restricted to the grid. Requires
+# lgcCrteMdl = True and strMdlCrt = 'aperture'. Not together with lgcCmp.
+lgcRfn = False
+
+# Number of iterations of the refinement:
+varRfnIter = 10
+
+# Number of voxels that are refined at once (memory usage per process is
+# roughly `varRfnBtch * number of apertures * tplVslSpcSze[0] * 24` bytes):
+varRfnBtch = 200
+
+# Number of best fitting models that are retained for each voxel during the
+# model fitting (if None, only the best model). The model indices, parameters
+# and R2 of the best models are saved as 4D images (one volume per rank,
+# e.g. `<strPathOut>_topk_R2.nii`). Not together with lgcC2f.
+varTopK = None
+
+# Number of voxels per task of the model fitting. The voxels are split into
+# tasks, which are handed to the parallel processes one at a time, so that
+# processes that are faster (e.g. on a shared machine) take on more tasks. If
+# None, the voxels are split into four tasks per process.
+varVoxTsk = None
+
+# Number of pRF models per task of the model fitting (only for the 'gemm' and
+# 'gemm_motion' versions, rounded up to a multiple of varMdlBlk or
+# varMdlBlkMtn). The results of the ranges of models are merged after the
+# fitting. If None, the models are not split.
+varMdlTsk = None
+
+# Number of shards into which the model fitting is split (e.g. to fit one
+# subject on several cluster nodes that share a file system). If None, all
+# voxels and models are fitted in one run. Each shard only fits its part of
+# the voxels or of the models (see strShrdAxs), and saves its partial results
+# (`<strPathOut>_shard_<index>.npz`) instead of the output images. The output
+# images are created from the partial results of all shards by
+# `merge_shards.py`.
+varNumShrd = None
+
+# Index of the shard that is fitted in this run (from 0 to varNumShrd - 1).
+# Can also be given on the command line (`python main.py <index>`), so that
+# all nodes can use the same configuration.
+varIdxShrd = None
+
+# Whether the voxels ('voxels') or the pRF models ('models', only for the
+# 'gemm' and 'gemm_motion' versions, and not together with lgcC2f or lgcRfn)
+# are split into shards:
+strShrdAxs = 'voxels'
+
+# Port of the local HTTP interface of the fitting daemon (`main_daemon.py`),
+# which prepares the pRF models once and fits the jobs (mask, functional runs
+# and output prefix) that are submitted to it:
+varDmnPort = 8765
+
+# Manifest of the batch runner (`main_batch.py`), which prepares the pRF models
+# once and fits several subjects that share the same stimulus design. JSON
+# file with a list of subjects, each with the path of the mask ("mask"), the
+# paths of the functional runs ("func") and the path (prefix) of the output
+# images ("out"). Can also be given on the command line (`python main_batch.py
+# <manifest>`).
+strPathMnf = None
+
+# Number of the parallel processes (out of varPar) of the batch runner that
+# load and preprocess the next subject while the current subject is fitted
+# (with the remaining processes). If None, a quarter of varPar (at least one).
+varBtchPar = None
+
+# Memory budget of the batch runner [GB], for the data of the subjects that
+# are preprocessed and fitted at the same time. The next subject is only
+# preprocessed in advance if the data of both subjects fit into the budget
+# (estimated from the size of the functional runs). If None, no limit.
+varBtchMem = None
+
+# Directory for checkpoints of the model fitting (if None, no checkpoints are
+# saved). The results of each chunk of voxels (and, for the 'gemm' and
+# 'gemm_motion' versions, the progress within each chunk) are saved there, so
+# that an interrupted run continues where it stopped when it is started again
+# (with the same parameters and data).
+strDirCkp = None
+
+# Minimum time (in seconds) between two checkpoints of the progress within a
+# chunk of voxels:
+varCkpIntv = 300.0
+
+# Number of times that a parallel process is restarted if it fails (only the
+# chunk of voxels of the failed process is fitted again):
+varCkpRtr = 2
+
 # L2 regularisation factor:
 varL2reg = 0.0
 
+# Motion directions (in degrees) of the stimulus features, in the order of the
+# features of the pRF models, used for the motion direction tuning maps
+# (preferred direction, tuning width and direction selectivity index, e.g.
+# `<strPathOut>_mtn_pref_dir.nii`), which are saved for models with more than
+# one feature. If None, the directions are assumed to be evenly spaced around
+# the circle (360 / number of features degrees apart, starting at zero).
+lstMtnDir = None
+
 # Create pRF time course models?
 lgcCrteMdl = False
 
+# Directory of the on-disk cache for intermediate results (e.g. stimulus
+# design matrix, pRF time course models, preprocessed functional data). The
+# results of each stage are stored under a hash of their inputs and
+# parameters, so that only stages whose inputs have changed are recomputed.
+# If None, the cache is disabled.
+strDirCch = '/home/john/Documents/20161221/retinotopy/cache/'
+
+# Maximum size of the cache [GB]. If the cache grows larger, the least recently
+# used results are removed.
+varCchMax = 50.0
+
+# Save maximum of pRF time course models across features as nii file (for
+# debugging purposes)?
+lgcMdlNii = False
+
+# Method for the creation of pRF time course models. 'separable' creates the
+# models for all x- and y-positions of a pRF size at once (with two matrix
+# multiplications, making use of the fact that a 2D Gaussian is the product of
+# two 1D Gaussians), 'pixelwise' creates a 2D Gaussian for each model. Both
+# methods use the PNG files (see `strPathPng`). 'aperture' does not use the
+# PNG files, but computes the overlap of each pRF model with each unique
+# stimulus aperture once (the apertures are loaded from `strShpe`, and their
+# order from the pickles in `lstDsgn`). All methods give the same models.
+strMdlCrt = 'separable'
+
+# Order of HRF convolution and spatial integration for the 'separable' method:
+# 'pixels' (convolve pixel time courses, then integrate), 'models' (integrate
+# binary stimulus, then convolve model time courses), or 'auto' (whichever
+# order requires fewer convolutions for the given pixel and model grid).
+strConvOrd = 'auto'
+
 # If we create new pRF time course models, the following parameters have to
 # be provided:
 
@@ -121,6 +320,41 @@ varZfill = 3
 # extension.
 strPathMdl = '/media/john/DATADRIVE1/MRI_Data_PhD/05_PacMan/20161221/nii_distcor/retinotopy/design_matrix/pRF_timecourses'  #noqa
 
+# Basename of model bank file (without file extension). The preprocessed pRF
+# time course models are written into this file (model-major, i.e. the time
+# courses of consecutive models are stored together), and the model fitting
+# reads one tile of models at a time from it, so that the models do not need
+# to fit into memory. Should be on a fast SSD drive. The model parameters,
+# norms and validity mask of the models are stored with the bank. The bank is
+# reused by subsequent runs (without model creation and preprocessing), unless
+# any parameter or input file of model creation or preprocessing has changed.
+# If None, the models are held in (shared) memory.
+strPathBnk = '/media/john/DATADRIVE1/MRI_Data_PhD/05_PacMan/20161221/nii_distcor/retinotopy/design_matrix/pRF_bank'  #noqa
+
+# Create pRF model time courses on demand during model fitting? If True, the
+# full set of model time courses is never created (neither in memory nor in a
+# model bank file). Instead, each fitting process creates one tile of models
+# at a time from the unique stimulus apertures and the parameter grid, fits it
+# to its voxels and discards it. Allows denser model grids at the cost of
+# computation time (every process creates all models). Requires lgcCrteMdl =
+# True, strMdlCrt = 'aperture', and strVersion 'gemm' or 'gemm_motion'.
+lgcMdlLzy = False
+
+# Temporal compression of models and data? If True, the pRF model time courses
+# and the functional data are projected onto the leading principal directions
+# of the model time courses before fitting, so that the cost of fitting scales
+# with the number of components instead of the number of volumes. The
+# approximation error is reported. Only for strVersion 'gemm' and
+# 'gemm_motion'.
+lgcCmp = False
+
+# Fraction of the energy of the (de-meaned) model time courses that is retained
+# by the compression:
+varCmpEng = 0.9999
+
+# Number of components of the compression (if not None, overrides varCmpEng):
+varCmpNum = None
+
 # List with paths of pickles with information about experimental design (order
 # of stimuli). Only needed for motion_log.py (in order to create PNGs for
 # static component of motion pRF mapping).
@@ -134,7 +368,3 @@ lstDsgn = ['/home/john/Documents/20161221/retinotopy/design_matrix/Conditions_ru
 # motion_log.py (in order to create PNGs for static component of motion pRF
 # mapping).
 strShpe = '~/mskBar.npz'
-
-# Directory at which hdf5 files with design matrix and functional data will be
-# stored (in order to avoid memory overflow). Should be on a fast SSD drive.
-strDirHdf = '/home/john/Documents/20161221/retinotopy/hdf5/'
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Batched convolution of time courses with HRF models."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module only depends on numpy, so that it can also be imported by the
+# simulation scripts.
+import numpy as np
+
+
+def conv_tc(aryTc, aryHrf, vecRunLen=None, varBlk=1000):
+    """
+    Convolve a block of time courses with one or more HRF models.
+
+    Parameters
+    ----------
+    aryTc : np.array
+        2D numpy array with time courses (e.g. pixel-wise design matrix or
+        neural model time courses), with shape `aryTc[time course, time]`.
+        Can be of any numeric type (e.g. binary design matrix at np.int8
+        precision).
+    aryHrf : np.array
+        HRF time course model(s), either a 1D array with shape `aryHrf[time]`,
+        or a 2D array with shape `aryHrf[kernel, time]` (e.g. canonical HRF
+        and its derivatives).
+    vecRunLen : list or np.array or None
+        Number of volumes of each run. If provided, each run is convolved
+        separately, so that the response to stimuli at the end of a run does
+        not spill over into the next run. If None, the time courses are
+        treated as one continuous run.
+    varBlk : int
+        Number of time courses that are convolved at once. The FFT is computed
+        at double precision, so memory usage increases with the block size.
+
+    Returns
+    -------
+    aryConv : np.array
+        Convolved time courses (float32). Shape `aryConv[time course, time]`
+        if `aryHrf` is 1D, or `aryConv[time course, kernel, time]` if `aryHrf`
+        is 2D.
+
+    Notes
+    -----
+    For each run, the result is the same as `np.convolve(vecTc,
+    vecHrf)[0:varNumVolRun]`, i.e. the part of the convolution that extends
+    beyond the end of the run is discarded. Instead of looping over time
+    courses, all time courses of a block are transformed with one FFT call,
+    and multiplied with the Fourier transforms of all kernels at once. The
+    Fourier transforms of the kernels are only computed once. If the kernels are short compared to the runs, the time courses are
+    cut into segments that are convolved separately and then added
+    (overlap-add), so that the FFT length only depends on the kernel length.
+    """
+    # Remember whether a single kernel was provided:
+    lgcSngl = (aryHrf.ndim == 1)
+    aryHrf = np.atleast_2d(aryHrf).astype(np.float64)
+
+    # Number of time courses, volumes, and kernels:
+    varNumTc = aryTc.shape[0]
+    varNumVol = aryTc.shape[1]
+    varNumKrn = aryHrf.shape[0]
+
+    # Without information on runs, the time courses are treated as one run:
+    if vecRunLen is None:
+        vecRunLen = [varNumVol]
+    vecRunLen = np.array(vecRunLen, dtype=np.int64)
+
+    # Check whether the run lengths agree with the time courses:
+    if np.sum(vecRunLen) != varNumVol:
+        # Error message:
+        strErrMsg = ('---Error: Sum of run lengths (' + str(np.sum(vecRunLen))
+                     + ') does not agree with number of volumes ('
+                     + str(varNumVol) + ').')
+        raise ValueError(strErrMsg)
+
+    # Array for output:
+    aryConv = np.zeros((varNumTc, varNumKrn, varNumVol), dtype=np.float32)
+
+    # Index of the first volume of each run:
+    vecRunSrt = np.hstack((0, np.cumsum(vecRunLen)[:-1]))
+
+    # Loop through runs:
+    for idxRun in range(vecRunLen.shape[0]):
+
+        # First volume, number of volumes & last volume (plus one) of current
+        # run:
+        varRunSrt = vecRunSrt[idxRun]
+        varRunLen = vecRunLen[idxRun]
+        varRunEnd = varRunSrt + varRunLen
+
+        # Only the first `varRunLen` samples of the kernels can affect the
+        # output within the run:
+        aryHrfRun = aryHrf[:, 0:varRunLen]
+        varLenKrn = aryHrfRun.shape[1]
+
+        # The FFT length needs to be at least the length of the full
+        # convolution of a segment, so that the circular convolution does not
+        # wrap around. If the kernels are much shorter than the run, the run
+        # is split into segments (overlap-add), otherwise the whole run is
+        # transformed at once.
+        if (4 * varLenKrn) < varRunLen:
+            varNumFft = int(2 ** np.ceil(np.log2(4 * varLenKrn)))
+        else:
+            varNumFft = int(2 ** np.ceil(np.log2(varRunLen + varLenKrn - 1)))
+
+        # Length of the segments (the convolution of a segment fits into the
+        # FFT length, and overlaps with the next segment by at most one
+        # segment length):
+        varLenSeg = varNumFft - varLenKrn + 1
+
+        # Number of segments:
+        varNumSeg = int(np.ceil(float(varRunLen) / float(varLenSeg)))
+
+        # Fourier transform of the kernels, with shape aryHrfFft[kernel,
+        # frequency]:
+        aryHrfFft = np.fft.rfft(aryHrfRun, n=varNumFft, axis=1)
+
+        # Loop through blocks of time courses:
+        for varBlkSrt in range(0, varNumTc, varBlk):
+
+            # Index of last time course in current block (plus one):
+            varBlkEnd = min((varBlkSrt + varBlk), varNumTc)
+            varNumBlk = varBlkEnd - varBlkSrt
+
+            # Time courses of current run, zero padded to a multiple of the
+            # segment length, with shape aryTmp[time course, segment, time]:
+            aryTmp = np.zeros((varNumBlk, (varNumSeg * varLenSeg)))
+            aryTmp[:, 0:varRunLen] = aryTc[varBlkSrt:varBlkEnd,
+                                           varRunSrt:varRunEnd]
+            aryTmp = np.reshape(aryTmp, (varNumBlk, varNumSeg, varLenSeg))
+
+            # Convolution of all segments with all kernels (multiplication in
+            # the frequency domain), with shape aryTmp[time course, kernel,
+            # segment, time]:
+            aryTmp = np.fft.irfft(
+                np.multiply(np.fft.rfft(aryTmp, n=varNumFft, axis=2)[:, None],
+                            aryHrfFft[None, :, None, :]),
+                n=varNumFft,
+                axis=3)
+
+            # The convolution of a segment extends into the next segment
+            # (overlap-add). The first `varLenSeg` samples belong to the
+            # segment itself, the remaining ones (at most `varLenSeg`) are
+            # added to the next segment:
+            aryOla = np.zeros((varNumBlk,
+                               varNumKrn,
+                               (varNumSeg + 1),
+                               varLenSeg))
+            aryOla[:, :, 0:varNumSeg, :] = aryTmp[:, :, :, 0:varLenSeg]
+            aryOla[:, :, 1:, 0:(varNumFft - varLenSeg)] += \
+                aryTmp[:, :, :, varLenSeg:]
+
+            # Discard the part of the convolution that extends beyond the end
+            # of the run:
+            aryConv[varBlkSrt:varBlkEnd, :, varRunSrt:varRunEnd] = \
+                np.reshape(aryOla,
+                           (varNumBlk, varNumKrn, -1))[:, :, 0:varRunLen]
+
+    if lgcSngl:
+        aryConv = aryConv[:, 0, :]
+
+    return aryConv
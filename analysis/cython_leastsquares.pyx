@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Cythonised least squares GLM model fitting."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# *****************************************************************************
+# *** Import modules & adjust cython settings for speedup
+
+import numpy as np
+cimport numpy as np
+cimport cython
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Main function least squares solution, 1 predictor
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef np.ndarray cy_lst_sq(object vecPrfTc, object aryFuncChnk):
+    """
+    Cythonised least squares GLM model fitting.
+
+    Parameters
+    ----------
+    vecPrfTc : np.array
+        1D numpy array, at float32 precision, containing a single pRF model
+        time course (along time dimension).
+    aryFuncChnk : np.array
+        2D numpy array, at float32 precision, containing a chunk of functional
+        data (i.e. voxel time courses). Dimensionality: aryFuncChnk[time,
+        voxel].
+
+    Returns
+    -------
+    vecRes : np.array
+        1D numpy array with model residuals for all voxels in the chunk of
+        functional data. Dimensionality: vecRes[voxel]
+
+    Notes
+    -----
+    Computes the residual sum of squares of a GLM with one predictor (the pRF
+    model time course) and a constant term. The constant term is not fitted
+    explicitly; instead, model and data are de-meaned. The de-meaning is fused
+    into a single pass over the data, in which the sums of the voxel time
+    courses, of their squares, and of their products with the model time
+    course are accumulated (at double precision). Apart from the conversion
+    of the inputs (see below), no temporary arrays of the size of the
+    functional data are created, and the computation is performed without
+    the global interpreter lock, so that several threads can call this
+    function in parallel within one process.
+
+    The functional data are expected as C-contiguous float32 array (as
+    prepared by `find_prf_cpu`). Other arrays (e.g. a transposed view, or
+    double precision) are accepted, but copied into a C-contiguous float32
+    array first, on every call.
+    """
+    # Memory views on input arrays (needed to release the GIL). The
+    # functional data need to be C-contiguous, so that the innermost loop
+    # (over voxels) accesses memory sequentially. Read-only arrays are
+    # accepted.
+    vecPrfTc = np.ascontiguousarray(vecPrfTc, dtype=np.float32)
+    aryFuncChnk = np.ascontiguousarray(aryFuncChnk, dtype=np.float32)
+    cdef const float[:] vecPrfTc_view = vecPrfTc
+    cdef const float[:, ::1] aryFuncChnk_view = aryFuncChnk
+
+    # Number of volumes and voxels:
+    cdef Py_ssize_t varNumVol = aryFuncChnk_view.shape[0]
+    cdef Py_ssize_t varNumVoxChnk = aryFuncChnk_view.shape[1]
+
+    # Accumulators for the sum, the sum of squares, and the sum of products
+    # with the model, of each voxel time course:
+    cdef double[:] vecSumY_view = np.zeros(varNumVoxChnk, dtype=np.float64)
+    cdef double[:] vecSumYy_view = np.zeros(varNumVoxChnk, dtype=np.float64)
+    cdef double[:] vecSumXy_view = np.zeros(varNumVoxChnk, dtype=np.float64)
+
+    # Vector for residuals (output):
+    cdef np.ndarray[np.float32_t, ndim=1] vecRes = np.zeros(varNumVoxChnk,
+                                                            dtype=np.float32)
+    cdef float[:] vecRes_view = vecRes
+
+    cdef Py_ssize_t idxVol, idxVox
+    cdef double varSumX = 0.0
+    cdef double varSumXx = 0.0
+    cdef double varX, varY, varSxx, varSxy, varSyy
+
+    with nogil:
+
+        # Sum and sum of squares of the model time course:
+        for idxVol in range(varNumVol):
+            varX = vecPrfTc_view[idxVol]
+            varSumX += varX
+            varSumXx += varX * varX
+
+        # Centred sum of squares of the model time course:
+        varSxx = varSumXx - (varSumX * varSumX) / varNumVol
+
+        # Single pass over the functional data:
+        for idxVol in range(varNumVol):
+            varX = vecPrfTc_view[idxVol]
+            for idxVox in range(varNumVoxChnk):
+                varY = aryFuncChnk_view[idxVol, idxVox]
+                vecSumY_view[idxVox] += varY
+                vecSumYy_view[idxVox] += varY * varY
+                vecSumXy_view[idxVox] += varX * varY
+
+        # Residual sum of squares (centred sum of squares of the data minus
+        # the sum of squares explained by the model):
+        for idxVox in range(varNumVoxChnk):
+            varSyy = (vecSumYy_view[idxVox]
+                      - (vecSumY_view[idxVox] * vecSumY_view[idxVox])
+                      / varNumVol)
+            varSxy = (vecSumXy_view[idxVox]
+                      - (varSumX * vecSumY_view[idxVox]) / varNumVol)
+            if varSxx > 0.0:
+                vecRes_view[idxVox] = varSyy - (varSxy * varSxy) / varSxx
+            else:
+                vecRes_view[idxVox] = varSyy
+
+    return vecRes
+# *****************************************************************************
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Numpy least squares GLM model fitting (fallback for cython extension)."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+def cy_lst_sq(vecPrfTc, aryFuncChnk):
+    """
+    Least squares GLM model fitting, numpy version of the cython function.
+
+    Parameters
+    ----------
+    vecPrfTc : np.array
+        1D numpy array, at float32 precision, containing a single pRF model
+        time course (along time dimension).
+    aryFuncChnk : np.array
+        2D numpy array, at float32 precision, containing a chunk of functional
+        data (i.e. voxel time courses). Dimensionality: aryFuncChnk[time,
+        voxel].
+
+    Returns
+    -------
+    vecRes : np.array
+        1D numpy array with model residuals for all voxels in the chunk of
+        functional data. Dimensionality: vecRes[voxel]
+
+    Notes
+    -----
+    Same interface and results as `cy_lst_sq` in `cython_leastsquares.pyx`,
+    which is used if the compiled extension is not available. The sums are
+    obtained with matrix-vector products, which also release the global
+    interpreter lock.
+    """
+    # Number of volumes:
+    varNumVol = aryFuncChnk.shape[0]
+
+    # Model time course at double precision:
+    vecPrfTc = vecPrfTc.astype(np.float64)
+
+    # Sum and centred sum of squares of the model time course:
+    varSumX = np.sum(vecPrfTc)
+    varSxx = np.dot(vecPrfTc, vecPrfTc) - (varSumX * varSumX) / varNumVol
+
+    # Sum of each voxel time course:
+    vecSumY = np.sum(aryFuncChnk, axis=0, dtype=np.float64)
+
+    # Centred sum of squares of each voxel time course:
+    vecSyy = np.subtract(np.einsum('ij,ij->j', aryFuncChnk, aryFuncChnk,
+                                   dtype=np.float64),
+                         np.divide(np.square(vecSumY), varNumVol))
+
+    # Centred sum of products of model and voxel time courses:
+    vecSxy = np.subtract(np.dot(vecPrfTc, aryFuncChnk),
+                         np.multiply((varSumX / varNumVol), vecSumY))
+
+    # Residual sum of squares (centred sum of squares of the data minus the
+    # sum of squares explained by the model):
+    if 0.0 < varSxx:
+        vecRes = np.subtract(vecSyy, np.divide(np.square(vecSxy), varSxx))
+    else:
+        vecRes = vecSyy
+
+    return vecRes.astype(np.float32)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Build the cython extension for least squares model fitting.
+
+Compile the extension by running the following command from within the
+analysis directory:
+
+    python cython_leastsquares_setup.py build_ext --inplace
+
+The compiled module is optional. If it is not available, the 'cython' version
+of pRF finding falls back to a numpy implementation of the same function (see
+`cython_leastsquares_numpy.py`).
+"""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from setuptools import setup
+from setuptools import Extension
+from Cython.Build import cythonize
+
+setup(ext_modules=cythonize(
+    Extension('cython_leastsquares',
+              ['cython_leastsquares.pyx'],
+              include_dirs=[np.get_include()],
+              extra_compile_args=['-O3'])))
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""Queue of model fitting jobs, submitted over a local HTTP interface."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import signal
+import threading
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+def dmn_job(dicReq):
+    """
+    Check the parameters of a fitting job.
+
+    Parameters
+    ----------
+    dicReq : dict
+        Parameters of the job, with the path of the mask ('mask'), the paths
+        of the functional runs ('func'), and the path (prefix) of the output
+        images ('out').
+
+    Returns
+    -------
+    strErr : str or None
+        Description of the problem, or None if the job can be run.
+    """
+    if not isinstance(dicReq, dict):
+        return 'The job needs to be a JSON object.'
+    for strKey in ['mask', 'func', 'out']:
+        if strKey not in dicReq:
+            return 'Missing parameter: ' + strKey
+    lstPth = dicReq['func']
+    if ((not isinstance(lstPth, list)) or (len(lstPth) == 0)
+            or (not all([isinstance(strTmp, (str, type(u'')))
+                         for strTmp in lstPth]))):
+        return 'Parameter \'func\' needs to be a list of paths.'
+    for strTmp in [dicReq['mask']] + lstPth:
+        if not os.path.isfile(strTmp):
+            return 'File not found: ' + str(strTmp)
+    strDirOut = os.path.dirname(os.path.abspath(dicReq['out']))
+    if not os.path.isdir(strDirOut):
+        return 'Output directory not found: ' + strDirOut
+    return None
+
+
+def dmn_handler(dicJob, lstJob, objLck, queJob):
+    """
+    Create the handler of the HTTP requests.
+
+    Parameters
+    ----------
+    dicJob : dict
+        Status of all jobs, by job ID (shared with the fitting loop).
+    lstJob : list
+        IDs of all jobs, in the order of submission.
+    objLck : threading.Lock
+        Lock for `dicJob` and `lstJob`.
+    queJob : queue.Queue
+        Queue of the IDs of the jobs that are waiting to be fitted.
+
+    Returns
+    -------
+    DmnHandler : class
+        Handler of the HTTP requests (see `dmn_run`).
+    """
+    class DmnHandler(BaseHTTPRequestHandler):
+        """Handler of the HTTP requests of the fitting daemon."""
+
+        def dmn_send(self, varSts, objOut):
+            """Send a JSON response."""
+            strOut = json.dumps(objOut).encode('utf-8')
+            self.send_response(varSts)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(strOut)))
+            self.end_headers()
+            self.wfile.write(strOut)
+
+        def do_GET(self):
+            """Status of all jobs (/jobs) or of one job (/jobs/<id>)."""
+            lstPrt = [strTmp for strTmp in self.path.split('/') if strTmp]
+            with objLck:
+                if lstPrt == ['jobs']:
+                    self.dmn_send(200, [dict(dicJob[idxJob])
+                                        for idxJob in lstJob])
+                elif ((len(lstPrt) == 2) and (lstPrt[0] == 'jobs')
+                      and lstPrt[1].isdigit()
+                      and (int(lstPrt[1]) in dicJob)):
+                    self.dmn_send(200, dict(dicJob[int(lstPrt[1])]))
+                else:
+                    self.dmn_send(404, {'error': 'Not found: ' + self.path})
+
+        def do_POST(self):
+            """Submit a job (/jobs), with the parameters as JSON object."""
+            lstPrt = [strTmp for strTmp in self.path.split('/') if strTmp]
+            if lstPrt != ['jobs']:
+                self.dmn_send(404, {'error': 'Not found: ' + self.path})
+                return
+            varLen = int(self.headers.get('Content-Length', 0))
+            try:
+                dicReq = json.loads(self.rfile.read(varLen).decode('utf-8'))
+            except ValueError:
+                self.dmn_send(400, {'error': 'Invalid JSON.'})
+                return
+            strErr = dmn_job(dicReq)
+            if strErr is not None:
+                self.dmn_send(400, {'error': strErr})
+                return
+            with objLck:
+                idxJob = len(lstJob)
+                dicJob[idxJob] = {'id': idxJob,
+                                  'status': 'queued',
+                                  'mask': dicReq['mask'],
+                                  'func': list(dicReq['func']),
+                                  'out': dicReq['out'],
+                                  'submitted': time.time(),
+                                  'started': None,
+                                  'finished': None,
+                                  'error': None}
+                lstJob.append(idxJob)
+                queJob.put(idxJob)
+                dicOut = dict(dicJob[idxJob])
+            self.dmn_send(201, dicOut)
+
+        def log_message(self, *args):
+            """Requests are not logged (status queries are frequent)."""
+            pass
+
+    return DmnHandler
+
+
+def dmn_run(fncFit, varPort=8765):
+    """
+    Fit the jobs that are submitted over a local HTTP interface.
+
+    Parameters
+    ----------
+    fncFit : function
+        Function that fits a job, called with the path of the mask, the
+        paths of the functional runs and the path (prefix) of the output
+        images (e.g. `ppl_fit` with the pRF models that have been prepared
+        once, see `main_daemon.py`).
+    varPort : int
+        Port of the HTTP interface (only on the local machine, 127.0.0.1).
+
+    Notes
+    -----
+    The HTTP interface accepts the following requests (JSON):
+
+    - `POST /jobs` with `{"mask": <path>, "func": [<path>, ...], "out":
+      <path prefix>}`: submit a job, returns the status of the job (with the
+      job ID).
+    - `GET /jobs`: status of all jobs.
+    - `GET /jobs/<id>`: status of one job ('queued', 'running', 'done' or
+      'failed', with the error message).
+
+    The jobs are fitted one after the other, in the order of submission. The
+    requests are handled in a separate thread, so that the status can be
+    queried while a job is fitted. A failed job does not stop the daemon.
+    The daemon is stopped with Ctrl+C (SIGINT) or SIGTERM.
+    """
+    # SIGTERM stops the daemon in the same way as Ctrl+C:
+    def dmn_stop(varSig, objFrm):
+        """Stop the daemon."""
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, dmn_stop)
+
+    dicJob = {}
+    lstJob = []
+    objLck = threading.Lock()
+    queJob = queue.Queue()
+
+    objSrv = HTTPServer(('127.0.0.1', int(varPort)),
+                        dmn_handler(dicJob, lstJob, objLck, queJob))
+    objThr = threading.Thread(target=objSrv.serve_forever)
+    objThr.daemon = True
+    objThr.start()
+
+    print('---Fitting daemon listening on http://127.0.0.1:'
+          + str(varPort) + '/jobs')
+
+    try:
+        while True:
+
+            # Wait for the next job (with a timeout, so that the loop can be
+            # interrupted):
+            try:
+                idxJob = queJob.get(True, 0.5)
+            except queue.Empty:
+                continue
+
+            with objLck:
+                dicJob[idxJob]['status'] = 'running'
+                dicJob[idxJob]['started'] = time.time()
+                dicTmp = dict(dicJob[idxJob])
+
+            print('------Job ' + str(idxJob) + ': ' + dicTmp['out'])
+
+            try:
+                fncFit(dicTmp['mask'], dicTmp['func'], dicTmp['out'])
+                strSts = 'done'
+                strErr = None
+            except Exception as objErr:
+                traceback.print_exc()
+                strSts = 'failed'
+                strErr = str(objErr)
+
+            with objLck:
+                dicJob[idxJob]['status'] = strSts
+                dicJob[idxJob]['error'] = strErr
+                dicJob[idxJob]['finished'] = time.time()
+
+            print('------Job ' + str(idxJob) + ' ' + strSts + ' ('
+                  + str(dicJob[idxJob]['finished']
+                        - dicJob[idxJob]['started']) + ' s)')
+
+    except KeyboardInterrupt:
+        print('---Fitting daemon stopped')
+
+    finally:
+        objSrv.shutdown()
+        objSrv.server_close()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""Export the results of the pRF model fitting as nii images."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import nibabel as nb
+from utilities import crt_mdl_prms
+from motion_tuning import mtn_tuning
+
+
+def exp_prf(aryBstPrm, aryLgcMsk, aryLgcVar, aryAff, hdrMsk, tplNiiShp,
+            strPathOut, aryTpk=None, tplMdlGrd=None, lstMtnDir=None):
+    """
+    Export the parameters of the best fitting pRF models as nii images.
+
+    Parameters
+    ----------
+    aryBstPrm : np.array
+        Parameters of the best fitting pRF models, with shape
+        aryBstPrm[voxel, parameter], where the 2nd dimension contains (0)
+        pRF-x-pos, (1) pRF-y-pos, (2) pRF-SD, (3) pRF-R2, and (4) and
+        following the betas of the model (one per feature), for the voxels
+        that were included in the fitting.
+    aryLgcMsk : np.array
+        Logical vector of the voxels of the image that are within the mask.
+    aryLgcVar : np.array
+        Logical vector of the voxels within the mask that were included in
+        the fitting (i.e. that were not excluded because of low variance).
+    aryAff : np.array
+        Affine of the mask image.
+    hdrMsk : nibabel-header-object
+        Header of the mask image.
+    tplNiiShp : tuple
+        Spatial dimensions of the input images.
+    strPathOut : str
+        Path (prefix) of the output images, e.g. `<strPathOut>_R2.nii`.
+    aryTpk : np.array or None
+        Best k models of each voxel (if retained), with shape aryTpk[voxel, k,
+        2], with the model indices in aryTpk[:, :, 0] and their R2 in
+        aryTpk[:, :, 1] (see `top_k.py`).
+    tplMdlGrd : tuple or None
+        Modelled x-positions, y-positions and SDs of the pRF models (needed
+        for the parameters of the best k models).
+    lstMtnDir : list or None
+        Motion directions (in degrees) of the features, for the motion
+        direction tuning maps (see `mtn_tuning`).
+    """
+    aryBstXpos = aryBstPrm[:, 0]
+    aryBstYpos = aryBstPrm[:, 1]
+    aryBstSd = aryBstPrm[:, 2]
+    aryBstR2 = aryBstPrm[:, 3]
+    aryBstBeta = aryBstPrm[:, 4:]
+
+    # Number of features of the pRF models:
+    varNumFtr = aryBstBeta.shape[1]
+
+    # Number of voxels that were included in the fitting:
+    varNumVoxInc = aryBstPrm.shape[0]
+
+    # Put results form pRF finding into array (they originally needed to be
+    # saved in a list due to parallelisation). Voxels were selected for pRF
+    # model finding in two stages: First, a mask was applied. Second, voxels
+    # with low variance were removed. Voxels are put back into the original
+    # format accordingly.
+
+    # Number of voxels that were included in the mask:
+    varNumVoxMsk = np.sum(aryLgcMsk)
+
+    # Array for pRF finding results, of the form aryPrfRes[voxel-count, 0:3],
+    # where the 2nd dimension contains the parameters of the best-fitting pRF
+    # model for the voxel, in the order (0) pRF-x-pos, (1) pRF-y-pos, (2)
+    # pRF-SD, (3) pRF-R2. At this step, only the voxels included in the mask
+    # are represented.
+    aryPrfRes01 = np.zeros((varNumVoxMsk, 6), dtype=np.float32)
+
+    # Place voxels based on low-variance exlusion:
+    aryPrfRes01[aryLgcVar, 0] = aryBstXpos
+    aryPrfRes01[aryLgcVar, 1] = aryBstYpos
+    aryPrfRes01[aryLgcVar, 2] = aryBstSd
+    aryPrfRes01[aryLgcVar, 3] = aryBstR2
+
+    # Total number of voxels:
+    varNumVoxTlt = (tplNiiShp[0] * tplNiiShp[1] * tplNiiShp[2])
+
+    # Place voxels based on mask-exclusion:
+    aryPrfRes02 = np.zeros((varNumVoxTlt, 6), dtype=np.float32)
+    aryPrfRes02[aryLgcMsk, 0] = aryPrfRes01[:, 0]
+    aryPrfRes02[aryLgcMsk, 1] = aryPrfRes01[:, 1]
+    aryPrfRes02[aryLgcMsk, 2] = aryPrfRes01[:, 2]
+    aryPrfRes02[aryLgcMsk, 3] = aryPrfRes01[:, 3]
+
+    # Reshape pRF finding results into original image dimensions:
+    aryPrfRes = np.reshape(aryPrfRes02,
+                           [tplNiiShp[0],
+                            tplNiiShp[1],
+                            tplNiiShp[2],
+                            6])
+
+    del(aryPrfRes01)
+    del(aryPrfRes02)
+
+    # Calculate polar angle map:
+    aryPrfRes[:, :, :, 4] = np.arctan2(aryPrfRes[:, :, :, 1],
+                                       aryPrfRes[:, :, :, 0])
+
+    # Calculate eccentricity map (r = sqrt( x^2 + y^2 ) ):
+    aryPrfRes[:, :, :, 5] = np.sqrt(np.add(np.power(aryPrfRes[:, :, :, 0],
+                                                    2.0),
+                                           np.power(aryPrfRes[:, :, :, 1],
+                                                    2.0)))
+
+    # List with name suffices of output images:
+    lstNiiNames = ['_x_pos',
+                   '_y_pos',
+                   '_SD',
+                   '_R2',
+                   '_polar_angle',
+                   '_eccentricity']
+
+    print('---------Exporting results')
+
+    # Save nii results:
+    for idxOut in range(0, 6):
+        # Create nii object for results:
+        niiOut = nb.Nifti1Image(aryPrfRes[:, :, :, idxOut],
+                                aryAff,
+                                header=hdrMsk
+                                )
+        # Save nii:
+        strTmp = (strPathOut + lstNiiNames[idxOut] + '.nii')
+        nb.save(niiOut, strTmp)
+
+    # Betas of the best fitting models (4D image with one volume per feature),
+    # and motion direction tuning derived from the betas (for models with more
+    # than one feature):
+    lstBetaOut = [('_betas', aryBstBeta)]
+    if varNumFtr > 1:
+        print('---------Calculate motion direction tuning')
+        vecMtnDir, vecMtnWdth, vecMtnDsi = mtn_tuning(aryBstBeta,
+                                                      vecDir=lstMtnDir)
+        lstBetaOut = lstBetaOut + [('_mtn_pref_dir', vecMtnDir[:, None]),
+                                   ('_mtn_width', vecMtnWdth[:, None]),
+                                   ('_mtn_dsi', vecMtnDsi[:, None])]
+
+    for strTmp, aryTmp in lstBetaOut:
+        # Voxels are put back into the original format (see above):
+        varNumVolOut = aryTmp.shape[1]
+        aryTmp01 = np.zeros((varNumVoxMsk, varNumVolOut), dtype=np.float32)
+        aryTmp01[aryLgcVar, :] = aryTmp
+        aryTmp02 = np.zeros((varNumVoxTlt, varNumVolOut), dtype=np.float32)
+        aryTmp02[aryLgcMsk, :] = aryTmp01
+        aryTmp02 = np.reshape(aryTmp02, [tplNiiShp[0],
+                                         tplNiiShp[1],
+                                         tplNiiShp[2],
+                                         varNumVolOut])
+        # Single volumes are saved as 3D images:
+        if varNumVolOut == 1:
+            aryTmp02 = aryTmp02[:, :, :, 0]
+        niiOut = nb.Nifti1Image(aryTmp02,
+                                aryAff,
+                                header=hdrMsk
+                                )
+        nb.save(niiOut, (strPathOut + strTmp + '.nii'))
+
+    # Best k models of each voxel (4D images with one volume per rank):
+    if aryTpk is not None:
+
+        varNumK = aryTpk.shape[1]
+
+        print('---------Exporting best ' + str(varNumK)
+              + ' models per voxel')
+
+        # Model indices (-1 if fewer than k models were evaluated):
+        aryTpkIdx = aryTpk[:, :, 0].astype(np.int64)
+        lgcTpkEmpty = np.less(aryTpkIdx, 0)
+        aryTpkIdx[lgcTpkEmpty] = 0
+
+        # Parameters of the models, with shape aryTpkRes[voxel, k, parameter],
+        # in the order (0) pRF-x-pos, (1) pRF-y-pos, (2) pRF-SD, (3) pRF-R2:
+        aryTpkRes = np.zeros((varNumVoxInc, varNumK, 4), dtype=np.float32)
+        aryTpkRes[:, :, 0:3] = crt_mdl_prms(tplMdlGrd[0],
+                                            tplMdlGrd[1],
+                                            tplMdlGrd[2])[aryTpkIdx, :]
+        aryTpkRes[:, :, 3] = aryTpk[:, :, 1]
+        aryTpkRes[lgcTpkEmpty, :] = 0.0
+
+        # Name suffices of output images, results, and value outside of the
+        # mask (the model indices are saved as integers, -1 if empty):
+        lstTpkOut = [('_topk_idx', aryTpk[:, :, 0].astype(np.int32), -1),
+                     ('_topk_x_pos', aryTpkRes[:, :, 0], 0),
+                     ('_topk_y_pos', aryTpkRes[:, :, 1], 0),
+                     ('_topk_SD', aryTpkRes[:, :, 2], 0),
+                     ('_topk_R2', aryTpkRes[:, :, 3], 0)]
+
+        for strTmp, aryTmp, varTmpFll in lstTpkOut:
+            # Voxels are put back into the original format (see above):
+            aryTmp01 = np.full((varNumVoxMsk, varNumK), varTmpFll,
+                               dtype=aryTmp.dtype)
+            aryTmp01[aryLgcVar, :] = aryTmp
+            aryTmp02 = np.full((varNumVoxTlt, varNumK), varTmpFll,
+                               dtype=aryTmp.dtype)
+            aryTmp02[aryLgcMsk, :] = aryTmp01
+            aryTmp02 = np.reshape(aryTmp02, [tplNiiShp[0],
+                                             tplNiiShp[1],
+                                             tplNiiShp[2],
+                                             varNumK])
+            niiOut = nb.Nifti1Image(aryTmp02,
+                                    aryAff,
+                                    header=hdrMsk
+                                    )
+            niiOut.set_data_dtype(aryTmp02.dtype)
+            nb.save(niiOut, (strPathOut + strTmp + '.nii'))
@@ -19,12 +19,26 @@
 
 import numpy as np
 import config as cfg
+from shared_arrays import shm_get
+from model_bank import bnk_get
+from model_bank import bnk_extra
+from top_k import tpk_init
+from top_k import tpk_update
+from top_k import tpk_out
 if cfg.strVersion == 'cython':
-    from cython_leastsquares import cy_lst_sq
+    # The cython extension needs to be compiled before it can be used (see
+    # `cython_leastsquares_setup.py`). Otherwise, a numpy implementation of
+    # the same function is used.
+    try:
+        from cython_leastsquares import cy_lst_sq
+    except ImportError:
+        print('---Warning: Compiled cython extension not found, using numpy '
+              + 'implementation of cy_lst_sq instead.')
+        from cython_leastsquares_numpy import cy_lst_sq
 
 
 def find_prf_cpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
-                 aryPrfTc, strVersion, queOut):
+                 aryPrfTc, strVersion, aryOut, aryTpk=None):
     """
     Find best fitting pRF model for voxel time course, using the CPU.
 
@@ -40,42 +54,53 @@ def find_prf_cpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
         1D array with pRF model y positions.
     vecMdlSd : np.array
         1D array with pRF model sizes (SD of Gaussian).
-    aryFunc : np.array
+    aryFunc : np.array or ShmArray
         2D array with functional MRI data, with shape aryFunc[voxel, time].
-    aryPrfTc : np.array
+        Can be placed in shared memory (see `shared_arrays.py`).
+    aryPrfTc : np.array or ShmArray or MdlBnk
         Array with pRF model time courses, with shape
-        aryPrfTc[x-pos, y-pos, SD, motion-direction, time]
+        aryPrfTc[x-pos, y-pos, SD, time], or with shape
+        aryPrfTc[x-pos, y-pos, SD, time, feature] if there is only one
+        feature. Can be placed in shared memory (see `shared_arrays.py`), or
+        be the handle of a model bank file (see `model_bank.py`).
     strVersion : str
         Which version to use for pRF finding; 'numpy' or 'cython'.
-    queOut : multiprocessing.queues.Queue
-        Queue to put the results on.
-
-    Returns
-    -------
-    lstOut : list
-        List containing the following objects:
-        idxPrc : int
-            Process ID of the process calling this function (for CPU
-            multi-threading). In GPU version, this parameter is 0.
-        vecBstXpos : np.array
-            1D array with best fitting x-position for each voxel, with shape
-            vecBstXpos[voxel].
-        vecBstYpos : np.array
-            1D array with best fitting y-position for each voxel, with shape
-            vecBstYpos[voxel].
-        vecBstSd : np.array
-            1D array with best fitting pRF size for each voxel, with shape
-            vecBstSd[voxel].
-        vecBstR2 : np.array
-            1D array with R2 value of 'winning' pRF model for each voxel, with
-            shape vecBstR2[voxel].
+    aryOut : ShmArray
+        Shared output array (chunk corresponding to the functional data), with
+        shape aryOut[voxel, parameter]. The parameters of the best fitting pRF
+        model are written into the columns (0) x-position, (1) y-position,
+        (2) SD, and (3) R2. If the array has more columns, the beta of the
+        best fitting model is written into column (4).
+    aryTpk : ShmArray or None
+        Shared output array for the best k models of each voxel (chunk
+        corresponding to the functional data), with shape aryTpk[voxel, k, 2]
+        (see `tpk_out`). If None, only the best model is retained.
 
     Notes
     -----
-    The list with results is not returned directly, but placed on a
-    multiprocessing queue. This version performs the model finding on the CPU,
-    using numpy or cython (depending on the value of `strVersion`).
+    The results are not returned, but written into the shared output array.
+    This version performs the model finding on the CPU, using numpy or cython
+    (depending on the value of `strVersion`).
     """
+    # The pRF model time courses and the functional data may have been placed
+    # in shared memory (the model time courses may also be memory-mapped from a
+    # model bank file, in which case only the accessed models are read):
+    objBnk = aryPrfTc
+    aryPrfTc = bnk_get(objBnk)
+    aryFuncChnk = shm_get(aryFuncChnk)
+
+    # The model creation produces a feature dimension (e.g. motion direction).
+    # This version can only fit one predictor per model:
+    if aryPrfTc.ndim == 5:
+        if aryPrfTc.shape[4] != 1:
+            # Error message:
+            strErrMsg = ('---Error: The ' + strVersion + ' version can only '
+                         + 'fit one predictor per model, but the pRF time '
+                         + 'course models have ' + str(aryPrfTc.shape[4])
+                         + ' features.')
+            raise ValueError(strErrMsg)
+        aryPrfTc = aryPrfTc[:, :, :, :, 0]
+
     # Number of modelled x-positions in the visual space:
     varNumX = aryPrfTc.shape[0]
     # Number of modelled y-positions in the visual space:
@@ -93,12 +118,16 @@ def find_prf_cpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
     vecBstXpos = np.zeros(varNumVoxChnk)
     vecBstYpos = np.zeros(varNumVoxChnk)
     vecBstSd = np.zeros(varNumVoxChnk)
+    vecBstBeta = np.zeros(varNumVoxChnk)
     # vecBstR2 = np.zeros(varNumVoxChnk)
 
-    # Vector for best R-square value. For each model fit, the R-square value is
-    # compared to this, and updated if it is lower than the best-fitting
-    # solution so far. We initialise with an arbitrary, high value
-    vecBstRes = np.add(np.zeros(varNumVoxChnk), 100000000.0).astype(np.float32)
+    # Vector for best residual sum of squares. For each model fit, the
+    # residuals are compared to this, and updated if they are lower than the
+    # best-fitting solution so far. We initialise with infinity, so that the
+    # first model with a variance above zero is always accepted (the residuals
+    # of the scaled functional data are far above any fixed value):
+    vecBstRes = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecBstRes[:] = np.inf
 
     # Vector that will hold the temporary residuals from the model fitting:
     # vecTmpRes = np.zeros(varNumVoxChnk).astype(np.float32)
@@ -114,19 +143,18 @@ def find_prf_cpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
         # over time from the data:
         aryFuncChnkTmean = np.array(np.mean(aryFuncChnk, axis=0), ndmin=2)
         aryFuncChnk = np.subtract(aryFuncChnk, aryFuncChnkTmean[0, None])
-        # Secondly, we subtract the mean over time form the pRF model time
-        # courses. The array has four dimensions, the 4th is time (one to three
-        # are x-position, y-position, and pRF size (SD)).
-        aryPrfTcTmean = np.mean(aryPrfTc, axis=3)
-        aryPrfTc = np.subtract(aryPrfTc, aryPrfTcTmean[:, :, :, None])
+        # The mean over time of the pRF model time courses is removed within
+        # the cython function (the pRF model time courses may be shared with
+        # other processes, and are not copied here).
     # Otherwise, create constant term for numpy least squares finding:
     elif strVersion == 'numpy':
         # Constant term for the model:
         vecConst = np.ones((varNumVol), dtype=np.float32)
 
-    # Change type to float 32:
-    aryFuncChnk = aryFuncChnk.astype(np.float32)
-    aryPrfTc = aryPrfTc.astype(np.float32)
+    # Change type to float 32. The functional data are stored in C-order (time
+    # along the first dimension), as expected by the cython function:
+    aryFuncChnk = np.ascontiguousarray(aryFuncChnk, dtype=np.float32)
+    aryPrfTc = aryPrfTc.astype(np.float32, copy=False)
 
     # Prepare status indicator if this is the first of the parallel processes:
     if idxPrc == 0:
@@ -162,12 +190,24 @@ def find_prf_cpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
     # There can be pRF model time courses with a variance of zero (i.e. pRF
     # models that are not actually responsive to the stimuli). For time
     # efficiency, and in order to avoid division by zero, we ignore these
-    # model time courses.
-    aryPrfTcVar = np.var(aryPrfTc, axis=3)
+    # model time courses (the variance is calculated separately for each model
+    # below, in order to avoid a temporary copy of all model time courses).
+    # If the model bank is finalised, the sums of squares of the de-meaned
+    # model time courses have been stored with it, with shape
+    # aryNrm[x-position, y-position, SD].
+    aryNrm = bnk_extra(objBnk, 'nrm')
+    if aryNrm is not None:
+        aryNrm = np.reshape(aryNrm[:, 0], (varNumX, varNumY, varNumPrfSizes))
 
     # Zero with float32 precision for comparison:
     varZero32 = np.array(([0.0])).astype(np.float32)[0]
 
+    # Best k models of each voxel so far (only if requested). The residuals
+    # are retained with negative sign (higher is better):
+    if aryTpk is not None:
+        aryTpk = shm_get(aryTpk)
+        aryTpkVal, aryTpkIdx = tpk_init(aryTpk.shape[1], varNumVoxChnk)
+
     # Loop through pRF models:
     for idxX in range(0, varNumX):
 
@@ -197,8 +237,15 @@ def find_prf_cpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
                         if varCntSts01 < varStsStpSze:
                             varCntSts01 = varCntSts01 + int(1)
 
+                # Current pRF time course model:
+                vecMdlTc = aryPrfTc[idxX, idxY, idxSd, :]
+
                 # Only fit pRF model if variance is not zero:
-                if np.greater(aryPrfTcVar[idxX, idxY, idxSd], varZero32):
+                if aryNrm is None:
+                    lgcVar = np.greater(np.var(vecMdlTc), varZero32)
+                else:
+                    lgcVar = np.greater(aryNrm[idxX, idxY, idxSd], varZero32)
+                if lgcVar:
 
                     # Calculation of the ratio of the explained variance (R
                     # square) for the current model for all voxel time courses.
@@ -208,16 +255,11 @@ def find_prf_cpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
 
                         # A cython function is used to calculate the residuals
                         # of the current model:
-                        vecTmpRes = cy_lst_sq(
-                            aryPrfTc[idxX, idxY, idxSd, :].flatten(),
-                            aryFuncChnk)
+                        vecTmpRes = cy_lst_sq(vecMdlTc, aryFuncChnk)
 
                     # Numpy version:
                     elif strVersion == 'numpy':
 
-                        # Current pRF time course model:
-                        vecMdlTc = aryPrfTc[idxX, idxY, idxSd, :].flatten()
-
                         # We create a design matrix including the current pRF
                         # time course model, and a constant term:
                         aryDsgn = np.vstack([vecMdlTc,
@@ -227,7 +269,8 @@ def find_prf_cpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
                         aryDsgn = aryDsgn.astype(np.float32)
 
                         # Calculate the least-squares solution for all voxels:
-                        vecTmpRes = np.linalg.lstsq(aryDsgn, aryFuncChnk)[1]
+                        aryTmpBeta, vecTmpRes = np.linalg.lstsq(
+                            aryDsgn, aryFuncChnk)[0:2]
 
                     # Check whether current residuals are lower than previously
                     # calculated ones:
@@ -241,6 +284,26 @@ def find_prf_cpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
                     # Replace best residual values:
                     vecBstRes[vecLgcTmpRes] = vecTmpRes[vecLgcTmpRes]
 
+                    # Replace betas (the cython function only returns the
+                    # residuals, so the betas are calculated for the voxels
+                    # with improved fit, from the de-meaned model time course
+                    # and the de-meaned data):
+                    if strVersion == 'cython':
+                        vecTmpDmn = np.subtract(vecMdlTc, np.mean(vecMdlTc))
+                        vecBstBeta[vecLgcTmpRes] = np.divide(
+                            np.dot(vecTmpDmn, aryFuncChnk[:, vecLgcTmpRes]),
+                            np.dot(vecTmpDmn, vecTmpDmn))
+                    else:
+                        vecBstBeta[vecLgcTmpRes] = aryTmpBeta[0, vecLgcTmpRes]
+
+                    # Merge the current model into the best k models (index
+                    # of the model in the order of `crt_mdl_prms`):
+                    if aryTpk is not None:
+                        aryTpkVal, aryTpkIdx = tpk_update(
+                            aryTpkVal, aryTpkIdx, -vecTmpRes[None, :],
+                            [((idxX * varNumY + idxY) * varNumPrfSizes
+                              + idxSd)])
+
                 # Status indicator (only used in the first of the parallel
                 # processes):
                 if idxPrc == 0:
@@ -259,16 +322,25 @@ def find_prf_cpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
     vecSsTot = np.sum(np.power(vecFuncDev,
                                2.0),
                       axis=0)
+    # Voxels for which no model has been fitted (i.e. all models have a
+    # variance of zero) do not have an explained variance:
+    vecLgcTmp = np.isinf(vecBstRes)
+    vecBstRes[vecLgcTmp] = vecSsTot[vecLgcTmp]
     # Coefficient of determination:
     vecBstR2 = np.subtract(1.0,
                            np.divide(vecBstRes,
                                      vecSsTot))
 
-    # Output list:
-    lstOut = [idxPrc,
-              vecBstXpos,
-              vecBstYpos,
-              vecBstSd,
-              vecBstR2]
-
-    queOut.put(lstOut)
+    # Write parameters of 'winning' model into shared output array:
+    aryOut = shm_get(aryOut)
+    aryOut[:, 0] = vecBstXpos
+    aryOut[:, 1] = vecBstYpos
+    aryOut[:, 2] = vecBstSd
+    aryOut[:, 3] = vecBstR2
+    if aryOut.shape[1] > 4:
+        aryOut[:, 4] = vecBstBeta
+
+    # Write best k models into shared output array:
+    if aryTpk is not None:
+        tpk_out(aryTpkVal, aryTpkIdx, aryTpk, vecSsTot,
+                vecSsOff=np.zeros(varNumVoxChnk))
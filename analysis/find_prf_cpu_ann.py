@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""Main function for pRF finding, using an index of the pRF models."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from utilities import crt_mdl_prms
+from shared_arrays import shm_get
+from model_bank import bnk_get
+from model_bank import bnk_extra
+from ann_index import ann_nrm
+from top_k import tpk_init
+from top_k import tpk_update
+from top_k import tpk_out
+
+
+def find_prf_cpu_ann(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
+                     aryFuncChnk, aryPrfTc, aryCtr, vecIdx, vecPtr, aryOut,
+                     varNumPrb=8, aryTpk=None):
+    """
+    Find best fitting pRF model for voxel time course, using a model index.
+
+    Parameters
+    ----------
+    idxPrc : int
+        Process ID of the process calling this function (for CPU
+        multi-threading).
+    vecMdlXpos : np.array
+        1D array with pRF model x positions.
+    vecMdlYpos : np.array
+        1D array with pRF model y positions.
+    vecMdlSd : np.array
+        1D array with pRF model sizes (SD of Gaussian).
+    aryFuncChnk : np.array or ShmArray
+        2D array with functional MRI data, with shape aryFunc[voxel, time].
+        Can be placed in shared memory (see `shared_arrays.py`).
+    aryPrfTc : np.array or ShmArray or MdlBnk
+        Array with pRF model time courses, with shape
+        aryPrfTc[x-pos, y-pos, SD, time, feature] (with only one feature). Can
+        be placed in shared memory (see `shared_arrays.py`), or be the handle
+        of a model bank file (see `model_bank.py`).
+    aryCtr : np.array or ShmArray
+        Cluster centres of the model index, with shape aryCtr[cluster, time]
+        (see `crt_ann`).
+    vecIdx : np.array or ShmArray
+        Indices of all models, sorted by cluster.
+    vecPtr : np.array or ShmArray
+        Position of the first model of each cluster in `vecIdx`.
+    aryOut : ShmArray
+        Shared output array (chunk corresponding to the functional data), with
+        shape aryOut[voxel, parameter]. The parameters of the best fitting pRF
+        model are written into the columns (0) x-position, (1) y-position,
+        (2) SD, and (3) R2. If the array has more columns, the beta of the
+        best fitting model is written into column (4).
+    varNumPrb : int
+        Number of clusters that are searched for each voxel.
+    aryTpk : ShmArray or None
+        Shared output array for the best k models of each voxel (chunk
+        corresponding to the functional data), with shape aryTpk[voxel, k, 2]
+        (see `tpk_out`). Only the candidate models of a voxel are considered.
+        If None, only the best model is retained.
+
+    Notes
+    -----
+    The results are not returned, but written into the shared output array.
+    Same model as the 'gemm' version (one predictor, de-meaned models and
+    data). Instead of evaluating all models, each voxel is only compared with
+    the cluster centres of the model index, and the models in the
+    `varNumPrb` clusters whose centres have the highest squared correlation
+    with the voxel time course are candidates. The candidates are then
+    rescored exactly (explained sum of squares, as in the 'gemm' version).
+    The models of each cluster are read once, and fitted to all voxels for
+    which the cluster is a candidate.
+    """
+    # -------------------------------------------------------------------------
+    # *** Prepare pRF model time courses & index
+
+    # The pRF model time courses and the functional data may have been placed
+    # in shared memory (the model time courses may also be memory-mapped from a
+    # model bank file, in which case only the candidate models are read):
+    objBnk = aryPrfTc
+    aryPrfTc = bnk_get(objBnk)
+    aryFuncChnk = shm_get(aryFuncChnk)
+    aryCtr = shm_get(aryCtr)
+    vecIdx = shm_get(vecIdx)
+    vecPtr = shm_get(vecPtr)
+
+    # Number of volumes:
+    varNumVol = aryPrfTc.shape[3]
+
+    # Number of pRF models (x-pos * y-pos * SD):
+    varNumMdls = aryPrfTc.shape[0] * aryPrfTc.shape[1] * aryPrfTc.shape[2]
+
+    # Reshape pRF model time courses, to the form aryPrfTc[model, time] (this
+    # version can only fit one predictor per model, see `crt_ann`):
+    aryPrfTc = np.reshape(aryPrfTc, (varNumMdls, varNumVol, -1))[:, :, 0]
+
+    # Number of clusters:
+    varNumClst = aryCtr.shape[0]
+    varNumPrb = max(min(int(varNumPrb), varNumClst), 1)
+
+    # Array with model parameters (x-position, y-position, and SD), with the
+    # same order of models as the pRF time course array (stored with a
+    # finalised model bank):
+    aryMdl = bnk_extra(objBnk, 'prm')
+    if aryMdl is None:
+        aryMdl = crt_mdl_prms(vecMdlXpos, vecMdlYpos, vecMdlSd)
+
+    # Sums of squares of the de-meaned model time courses, if they have been
+    # stored with the model bank (otherwise they are computed per cluster):
+    aryNrm = bnk_extra(objBnk, 'nrm')
+
+    # -------------------------------------------------------------------------
+    # *** Prepare functional data
+
+    # Number of voxels to be fitted in this chunk:
+    varNumVoxChnk = aryFuncChnk.shape[0]
+
+    # De-meaned voxel time courses, with shape aryFuncChnk[time, voxel]:
+    aryFuncChnk = aryFuncChnk.T.astype(np.float32)
+    aryFuncChnk = np.subtract(aryFuncChnk,
+                              np.mean(aryFuncChnk, axis=0,
+                                      dtype=np.float32)[None, :])
+
+    # Total sum of squares of the voxel time courses (needed for calculation
+    # of residuals and R2):
+    vecSsTot = np.sum(np.square(aryFuncChnk), axis=0, dtype=np.float32)
+
+    # Candidate clusters for each voxel, i.e. those whose centres have the
+    # highest squared correlation with the voxel time course, with shape
+    # aryPrb[voxel, probe]:
+    arySim = np.absolute(np.dot(ann_nrm(aryFuncChnk.T), aryCtr.T))
+    aryPrb = np.argpartition(-arySim, (varNumPrb - 1), axis=1)[:, 0:varNumPrb]
+    del(arySim)
+
+    # Voxels for which each cluster is a candidate:
+    aryLgcPrb = np.zeros((varNumClst, varNumVoxChnk), dtype=np.bool_)
+    aryLgcPrb[aryPrb, np.arange(varNumVoxChnk)[:, None]] = True
+
+    # -------------------------------------------------------------------------
+    # *** Prepare status indicator
+
+    # Prepare status indicator if this is the first of the parallel processes:
+    if idxPrc == 0:
+
+        # Number of steps of the status indicator:
+        varStsStpSze = 20
+
+        # Vector with cluster counts at which to give status feedback:
+        vecStatClst = np.linspace(0,
+                                  varNumClst,
+                                  num=(varStsStpSze+1),
+                                  endpoint=True)
+        vecStatClst = np.ceil(vecStatClst)
+        vecStatClst = vecStatClst.astype(int)
+
+        # Vector with corresponding percentage values at which to give status
+        # feedback:
+        vecStatPrc = np.linspace(0,
+                                 100,
+                                 num=(varStsStpSze+1),
+                                 endpoint=True)
+        vecStatPrc = np.ceil(vecStatPrc)
+        vecStatPrc = vecStatPrc.astype(int)
+
+        # Counter for status indicator:
+        varCntSts01 = 0
+
+    # -------------------------------------------------------------------------
+    # *** Loop through clusters
+
+    # Vector for the explained sum of squares of the best fitting model so far
+    # (for each voxel):
+    vecBstSsExp = np.zeros(varNumVoxChnk, dtype=np.float32)
+
+    # Vector for indices of best fitting models:
+    vecBstIdx = np.zeros(varNumVoxChnk, dtype=np.int64)
+
+    # Vector for betas of best fitting models:
+    vecBstBeta = np.zeros(varNumVoxChnk, dtype=np.float32)
+
+    # Best k models of each voxel so far (only if requested):
+    if aryTpk is not None:
+        aryTpk = shm_get(aryTpk)
+        aryTpkVal, aryTpkIdx = tpk_init(aryTpk.shape[1], varNumVoxChnk)
+
+    for idxClst in range(varNumClst):
+
+        # Status indicator (only used in the first of the parallel processes):
+        if idxPrc == 0:
+            while ((varCntSts01 <= varStsStpSze)
+                   and (vecStatClst[varCntSts01] <= idxClst)):
+                # Prepare status message:
+                strStsMsg = ('------------Progress: ' +
+                             str(vecStatPrc[varCntSts01]) +
+                             ' % --- ' +
+                             str(vecStatClst[varCntSts01]) +
+                             ' model clusters out of ' +
+                             str(varNumClst))
+                print(strStsMsg)
+                varCntSts01 = varCntSts01 + int(1)
+
+        # Voxels for which the current cluster is a candidate:
+        vecIdxVox = np.nonzero(aryLgcPrb[idxClst, :])[0]
+
+        # Models of the current cluster:
+        vecIdxMdl = vecIdx[vecPtr[idxClst]:vecPtr[idxClst + 1]]
+
+        if (vecIdxVox.shape[0] == 0) or (vecIdxMdl.shape[0] == 0):
+            continue
+
+        # De-meaned time courses of the models of the current cluster:
+        aryBlk = aryPrfTc[vecIdxMdl, :].astype(np.float32)
+        aryBlk = np.subtract(aryBlk,
+                             np.mean(aryBlk, axis=1,
+                                     dtype=np.float32)[:, None])
+
+        # Sum of squares of the (de-meaned) model time courses:
+        if aryNrm is None:
+            vecMdlSs = np.sum(np.square(aryBlk), axis=1, dtype=np.float32)
+        else:
+            vecMdlSs = np.array(aryNrm[vecIdxMdl, 0], dtype=np.float32)
+
+        # Models with a variance of zero never explain any variance:
+        vecMdlSs[np.less_equal(vecMdlSs,
+                               np.array([0.0], dtype=np.float32)[0])] = np.inf
+
+        # Explained sum of squares of the candidate models for the voxels,
+        # with shape aryXy[model, voxel] (exact rescoring):
+        aryXy = np.dot(aryBlk, aryFuncChnk[:, vecIdxVox])
+        aryBeta = np.divide(aryXy, vecMdlSs[:, None])
+        aryXy = np.multiply(aryXy, aryBeta)
+
+        # Best model of the current cluster for each voxel:
+        vecTmpIdx = np.argmax(aryXy, axis=0)
+        vecTmpSsExp = aryXy[vecTmpIdx, np.arange(vecIdxVox.shape[0])]
+
+        # Check whether the current models explain more variance than the
+        # previously found ones:
+        vecLgcTmp = np.greater(vecTmpSsExp, vecBstSsExp[vecIdxVox])
+
+        # Replace best explained sum of squares and model indices:
+        vecBstSsExp[vecIdxVox[vecLgcTmp]] = vecTmpSsExp[vecLgcTmp]
+        vecBstIdx[vecIdxVox[vecLgcTmp]] = vecIdxMdl[vecTmpIdx[vecLgcTmp]]
+        vecBstBeta[vecIdxVox[vecLgcTmp]] = aryBeta[
+            vecTmpIdx, np.arange(vecIdxVox.shape[0])][vecLgcTmp]
+
+        # Merge the current models into the best k models of the voxels:
+        if aryTpk is not None:
+            aryTpkVal[:, vecIdxVox], aryTpkIdx[:, vecIdxVox] = tpk_update(
+                aryTpkVal[:, vecIdxVox], aryTpkIdx[:, vecIdxVox], aryXy,
+                vecIdxMdl)
+
+    # -------------------------------------------------------------------------
+    # *** Post-process results
+
+    # Retrieve model parameters of 'winning' model for all voxels:
+    vecBstXpos = aryMdl[vecBstIdx, 0]
+    vecBstYpos = aryMdl[vecBstIdx, 1]
+    vecBstSd = aryMdl[vecBstIdx, 2]
+
+    # Coefficient of determination (ratio of explained to total sum of
+    # squares, as in the 'gemm' version):
+    vecBstR2 = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecLgcTmp = np.greater(vecSsTot, np.array([0.0], dtype=np.float32)[0])
+    vecBstR2[vecLgcTmp] = np.divide(vecBstSsExp[vecLgcTmp],
+                                    vecSsTot[vecLgcTmp])
+
+    # Write parameters of 'winning' model into shared output array:
+    aryOut = shm_get(aryOut)
+    aryOut[:, 0] = vecBstXpos
+    aryOut[:, 1] = vecBstYpos
+    aryOut[:, 2] = vecBstSd
+    aryOut[:, 3] = vecBstR2
+    if aryOut.shape[1] > 4:
+        aryOut[:, 4] = vecBstBeta
+
+    # Write best k models into shared output array:
+    if aryTpk is not None:
+        tpk_out(aryTpkVal, aryTpkIdx, aryTpk, vecSsTot)
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""Main function for pRF finding, using blocks of models on the CPU."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+from utilities import crt_mdl_prms
+from shared_arrays import shm_get
+from top_k import tpk_init
+from top_k import tpk_update
+from top_k import tpk_out
+from model_bank import MdlCmp
+from model_bank import bnk_tile
+from model_bank import bnk_extra
+from checkpoint import ckp_blk_load
+from checkpoint import ckp_blk_save
+
+
+def find_prf_cpu_gemm(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
+                      aryFuncChnk, aryPrfTc, aryOut, varMdlBlk=500,
+                      aryTpk=None, strPathCkp=None, varCkpIntv=300.0,
+                      tplMdlRng=None):
+    """
+    Find best fitting pRF model for voxel time course, using the CPU.
+
+    Parameters
+    ----------
+    idxPrc : int
+        Process ID of the process calling this function (for CPU
+        multi-threading).
+    vecMdlXpos : np.array
+        1D array with pRF model x positions.
+    vecMdlYpos : np.array
+        1D array with pRF model y positions.
+    vecMdlSd : np.array
+        1D array with pRF model sizes (SD of Gaussian).
+    aryFuncChnk : np.array or ShmArray
+        2D array with functional MRI data, with shape aryFunc[voxel, time].
+        Can be placed in shared memory (see `shared_arrays.py`).
+    aryPrfTc : np.array or ShmArray or MdlBnk or MdlLzy
+        Array with pRF model time courses, with shape
+        aryPrfTc[x-pos, y-pos, SD, time], or with shape
+        aryPrfTc[x-pos, y-pos, SD, time, feature] if there is only one
+        feature. Can be placed in shared memory (see `shared_arrays.py`), be
+        the handle of a model bank file (see `model_bank.py`), the handle of
+        models that are created on demand (see `model_creation_lazy.py`), or
+        the handle of compressed models (see `compression.py`, in which case
+        `aryFuncChnk` needs to be compressed in the same way).
+    aryOut : ShmArray
+        Shared output array (chunk corresponding to the functional data), with
+        shape aryOut[voxel, parameter]. The parameters of the best fitting pRF
+        model are written into the columns (0) x-position, (1) y-position,
+        (2) SD, and (3) R2. If the array has more columns, the beta of the
+        best fitting model is written into column (4).
+    varMdlBlk : int
+        Number of pRF models that are fitted at once (i.e. number of model time
+        courses that are multiplied with the functional data in one matrix
+        multiplication).
+    aryTpk : ShmArray or None
+        Shared output array for the best k models of each voxel (chunk
+        corresponding to the functional data), with shape aryTpk[voxel, k, 2]
+        (see `tpk_out`). If None, only the best model is retained.
+    strPathCkp : str or None
+        Path of the checkpoint file of this process (see `checkpoint.py`).
+        If not None, the progress of the model loop (best models so far) is
+        saved there at regular intervals, and the loop continues from the
+        saved progress if the file exists.
+    varCkpIntv : float
+        Minimum time (in seconds) between two checkpoints.
+    tplMdlRng : tuple or None
+        Range of pRF models that are fitted (index of the first model, and of
+        the last model plus one, in the order of `crt_mdl_prms`), so that the
+        models can be split into several tasks (see `scheduler.py`). The
+        results are those of the best model within the range. If None, all
+        models are fitted.
+
+    Notes
+    -----
+    The results are not returned, but written into the shared output array.
+    This version gives the same results as the 'numpy' version of
+    `find_prf_cpu` (i.e. a GLM with one pRF model time course and a constant
+    term), but instead of solving the least squares problem separately for each
+    model, the residuals of a whole block of models are obtained with one
+    matrix multiplication. Because data and models are de-meaned, the residual
+    sum of squares of a model is the total sum of squares of the voxel time
+    course minus the squared dot product of model and voxel time course,
+    divided by the sum of squares of the model. The best model for a voxel is
+    therefore the one that maximises this explained sum of squares.
+    """
+    # -------------------------------------------------------------------------
+    # *** Prepare pRF model time courses
+
+    # The pRF model time courses and the functional data may have been placed
+    # in shared memory (the model time courses may also be memory-mapped from a
+    # model bank file, in which case only the accessed models are read, or be
+    # created on demand). The model time courses are only accessed block by
+    # block (see `bnk_tile`), so they are never copied as a whole:
+    objBnk = aryPrfTc
+    aryFuncChnk = shm_get(aryFuncChnk)
+
+    # Shape of the pRF model time courses:
+    tplShp = tuple(objBnk.shape)
+
+    # Number of pRF models (x-pos * y-pos * SD):
+    varNumMdls = tplShp[0] * tplShp[1] * tplShp[2]
+
+    # The model creation produces a feature dimension (e.g. motion direction);
+    # this version can only fit one predictor per model.
+    if (len(tplShp) == 5) and (tplShp[4] != 1):
+        # Error message:
+        strErrMsg = ('---Error: The gemm version can only fit one '
+                     + 'predictor per model, but the pRF time course '
+                     + 'models have ' + str(tplShp[4]) + ' features.')
+        raise ValueError(strErrMsg)
+
+    # Array with model parameters (x-position, y-position, and SD), with the
+    # same order of models as the pRF time course array (stored with a
+    # finalised model bank):
+    aryMdl = bnk_extra(objBnk, 'prm')
+    if aryMdl is None:
+        aryMdl = crt_mdl_prms(vecMdlXpos, vecMdlYpos, vecMdlSd)
+
+    # Sums of squares of the de-meaned model time courses, if they have been
+    # stored with the model bank (otherwise they are computed block by
+    # block):
+    aryNrm = bnk_extra(objBnk, 'nrm')
+
+    # -------------------------------------------------------------------------
+    # *** Prepare functional data
+
+    # Number of voxels to be fitted in this chunk:
+    varNumVoxChnk = aryFuncChnk.shape[0]
+
+    # We reshape the voxel time courses, so that time goes down the column,
+    # i.e. from top to bottom.
+    aryFuncChnk = aryFuncChnk.T.astype(np.float32)
+
+    # Compressed models and data (see `compression.py`) have been de-meaned
+    # before the projection onto the temporal basis:
+    lgcDmn = not isinstance(objBnk, MdlCmp)
+
+    # Subtract the mean over time from the data:
+    if lgcDmn:
+        aryFuncChnk = np.subtract(aryFuncChnk,
+                                  np.mean(aryFuncChnk, axis=0,
+                                          dtype=np.float32)[None, :])
+
+    # Total sum of squares of the voxel time courses (needed for calculation
+    # of residuals and R2):
+    vecSsTot = np.sum(np.square(aryFuncChnk), axis=0, dtype=np.float32)
+
+    # Range of models that are fitted in this task:
+    if tplMdlRng is None:
+        tplMdlRng = (0, varNumMdls)
+
+    # -------------------------------------------------------------------------
+    # *** Prepare status indicator
+
+    # Prepare status indicator if this is the first of the parallel processes:
+    if idxPrc == 0:
+
+        # Number of steps of the status indicator:
+        varStsStpSze = 20
+
+        # Vector with pRF values at which to give status feedback (counted
+        # from the start of the range of models of this task):
+        vecStatPrf = np.linspace(0,
+                                 (tplMdlRng[1] - tplMdlRng[0]),
+                                 num=(varStsStpSze+1),
+                                 endpoint=True)
+        vecStatPrf = np.ceil(vecStatPrf)
+        vecStatPrf = vecStatPrf.astype(int)
+
+        # Vector with corresponding percentage values at which to give status
+        # feedback:
+        vecStatPrc = np.linspace(0,
+                                 100,
+                                 num=(varStsStpSze+1),
+                                 endpoint=True)
+        vecStatPrc = np.ceil(vecStatPrc)
+        vecStatPrc = vecStatPrc.astype(int)
+
+        # Counter for status indicator:
+        varCntSts01 = 0
+
+    # -------------------------------------------------------------------------
+    # *** Loop through blocks of models
+
+    # Vector for the explained sum of squares of the best fitting model so far
+    # (for each voxel):
+    vecBstSsExp = np.zeros(varNumVoxChnk, dtype=np.float32)
+
+    # Vector for indices of best fitting models (-1 for voxels for which no
+    # model explains any variance):
+    vecBstIdx = np.zeros(varNumVoxChnk, dtype=np.int32)
+    vecBstIdx[:] = -1
+
+    # Vector for betas of best fitting models:
+    vecBstBeta = np.zeros(varNumVoxChnk, dtype=np.float32)
+
+    # Index vector for voxels (needed to retrieve values at the index of the
+    # best model for each voxel):
+    vecIdxVox = np.arange(varNumVoxChnk)
+
+    # Best k models of each voxel so far (only if requested):
+    if aryTpk is not None:
+        aryTpk = shm_get(aryTpk)
+        aryTpkVal, aryTpkIdx = tpk_init(aryTpk.shape[1], varNumVoxChnk)
+
+    # State of the model loop (best models so far), which is saved in the
+    # checkpoint of this process:
+    dicSte = {'vecBstSsExp': vecBstSsExp,
+              'vecBstIdx': vecBstIdx,
+              'vecBstBeta': vecBstBeta}
+    if aryTpk is not None:
+        dicSte['aryTpkVal'] = aryTpkVal
+        dicSte['aryTpkIdx'] = aryTpkIdx
+
+    # Continue from the checkpoint of this process (if there is one):
+    varBlkNxt = ckp_blk_load(strPathCkp, dicSte, varBlkSrt=tplMdlRng[0])
+    varTmeCkp = time.time()
+
+    for varBlkSrt in range(varBlkNxt, tplMdlRng[1], varMdlBlk):
+
+        # Index of last model in current block (plus one):
+        varBlkEnd = min((varBlkSrt + varMdlBlk), tplMdlRng[1])
+
+        # Status indicator (only used in the first of the parallel processes):
+        if idxPrc == 0:
+            while ((varCntSts01 <= varStsStpSze)
+                   and (vecStatPrf[varCntSts01]
+                        <= (varBlkSrt - tplMdlRng[0]))):
+                # Prepare status message:
+                strStsMsg = ('------------Progress: ' +
+                             str(vecStatPrc[varCntSts01]) +
+                             ' % --- ' +
+                             str(vecStatPrf[varCntSts01]) +
+                             ' pRF models out of ' +
+                             str(tplMdlRng[1] - tplMdlRng[0]))
+                print(strStsMsg)
+                varCntSts01 = varCntSts01 + int(1)
+
+        # Model time courses of current block. Instead of fitting a constant
+        # term, we subtract the mean from the models (and from the data, see
+        # above):
+        aryBlk = bnk_tile(objBnk, varBlkSrt, varBlkEnd)[:, :, 0]
+        if lgcDmn:
+            aryBlk = np.subtract(aryBlk,
+                                 np.mean(aryBlk, axis=1,
+                                         dtype=np.float32)[:, None])
+
+        # Sum of squares of the (de-meaned) model time courses:
+        if aryNrm is None:
+            vecMdlSs = np.sum(np.square(aryBlk), axis=1, dtype=np.float32)
+        else:
+            vecMdlSs = np.array(aryNrm[varBlkSrt:varBlkEnd, 0],
+                                dtype=np.float32)
+
+        # There can be pRF model time courses with a variance of zero (i.e.
+        # pRF models that are not actually responsive to the stimuli). In
+        # order to avoid division by zero, we set their sum of squares to
+        # infinity, so that they never explain any variance.
+        vecMdlSs[np.less_equal(vecMdlSs,
+                               np.array([0.0], dtype=np.float32)[0])] = np.inf
+
+        # Dot product of all models in the current block with all voxel time
+        # courses, with shape aryXy[model, voxel]:
+        aryXy = np.dot(aryBlk, aryFuncChnk)
+
+        # Betas for all models in the current block (models without variance
+        # get a beta of zero):
+        aryBeta = np.divide(aryXy, vecMdlSs[:, None])
+
+        # Explained sum of squares for all models in the current block:
+        aryXy = np.multiply(aryXy, aryBeta)
+
+        # Best model in current block for each voxel:
+        vecTmpIdx = np.argmax(aryXy, axis=0)
+        vecTmpSsExp = aryXy[vecTmpIdx, vecIdxVox]
+
+        # Check whether the current models explain more variance than the
+        # previously found ones:
+        vecLgcTmp = np.greater(vecTmpSsExp, vecBstSsExp)
+
+        # Replace best explained sum of squares and model indices:
+        vecBstSsExp[vecLgcTmp] = vecTmpSsExp[vecLgcTmp]
+        vecBstIdx[vecLgcTmp] = vecTmpIdx[vecLgcTmp] + varBlkSrt
+        vecBstBeta[vecLgcTmp] = aryBeta[vecTmpIdx, vecIdxVox][vecLgcTmp]
+
+        # Merge the current models into the best k models:
+        if aryTpk is not None:
+            aryTpkVal, aryTpkIdx = tpk_update(aryTpkVal, aryTpkIdx, aryXy,
+                                              np.arange(varBlkSrt, varBlkEnd))
+
+        # Save the progress of the model loop:
+        if ((strPathCkp is not None)
+                and ((time.time() - varTmeCkp) > varCkpIntv)):
+            if aryTpk is not None:
+                dicSte['aryTpkVal'] = aryTpkVal
+                dicSte['aryTpkIdx'] = aryTpkIdx
+            ckp_blk_save(strPathCkp, varBlkEnd, dicSte)
+            varTmeCkp = time.time()
+
+    # -------------------------------------------------------------------------
+    # *** Post-process results
+
+    # Retrieve model parameters of 'winning' model for all voxels (zero for
+    # voxels without a model that explains any variance):
+    vecLgcTmp = np.greater_equal(vecBstIdx, 0)
+    vecBstXpos = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecBstYpos = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecBstSd = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecBstXpos[vecLgcTmp] = aryMdl[vecBstIdx[vecLgcTmp], 0]
+    vecBstYpos[vecLgcTmp] = aryMdl[vecBstIdx[vecLgcTmp], 1]
+    vecBstSd[vecLgcTmp] = aryMdl[vecBstIdx[vecLgcTmp], 2]
+
+    # Coefficient of determination (1 - ratio of (residual sum of squares by
+    # total sum of squares)). Because the residual sum of squares is the total
+    # minus the explained sum of squares, this is the ratio of explained to
+    # total sum of squares:
+    vecBstR2 = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecLgcTmp = np.greater(vecSsTot, np.array([0.0], dtype=np.float32)[0])
+    vecBstR2[vecLgcTmp] = np.divide(vecBstSsExp[vecLgcTmp],
+                                    vecSsTot[vecLgcTmp])
+
+    # Write parameters of 'winning' model into shared output array:
+    aryOut = shm_get(aryOut)
+    aryOut[:, 0] = vecBstXpos
+    aryOut[:, 1] = vecBstYpos
+    aryOut[:, 2] = vecBstSd
+    aryOut[:, 3] = vecBstR2
+    if aryOut.shape[1] > 4:
+        aryOut[:, 4] = vecBstBeta
+
+    # Write best k models into shared output array:
+    if aryTpk is not None:
+        tpk_out(aryTpkVal, aryTpkIdx, aryTpk, vecSsTot)
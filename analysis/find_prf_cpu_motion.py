@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""Main function for pRF finding with several predictors, on the CPU."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+from utilities import crt_mdl_prms
+from shared_arrays import shm_get
+from top_k import tpk_init
+from top_k import tpk_update
+from top_k import tpk_out
+from model_bank import MdlCmp
+from model_bank import bnk_tile
+from model_bank import bnk_extra
+from checkpoint import ckp_blk_load
+from checkpoint import ckp_blk_save
+
+
+def find_prf_cpu_motion(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
+                        aryFuncChnk, aryPrfTc, varL2reg, aryOut,
+                        varMdlBlk=100, aryGramInv=None, aryTpk=None,
+                        strPathCkp=None, varCkpIntv=300.0,
+                        tplMdlRng=None):
+    """
+    Find best pRF model (with several predictors) for voxel time course.
+
+    Parameters
+    ----------
+    idxPrc : int
+        Process ID of the process calling this function (for CPU
+        multi-threading).
+    vecMdlXpos : np.array
+        1D array with pRF model x positions.
+    vecMdlYpos : np.array
+        1D array with pRF model y positions.
+    vecMdlSd : np.array
+        1D array with pRF model sizes (SD of Gaussian).
+    aryFuncChnk : np.array or ShmArray
+        2D array with functional MRI data, with shape aryFunc[voxel, time].
+        Can be placed in shared memory (see `shared_arrays.py`).
+    aryPrfTc : np.array or ShmArray or MdlBnk or MdlLzy
+        Array with pRF model time courses, with shape
+        aryPrfTc[x-pos, y-pos, SD, time, feature]. Can be placed in shared
+        memory (see `shared_arrays.py`), be the handle of a model bank file
+        (see `model_bank.py`), the handle of models that are created on
+        demand (see `model_creation_lazy.py`), or the handle of compressed
+        models (see `compression.py`, in which case `aryFuncChnk` needs to be
+        compressed in the same way).
+    varL2reg : float
+        L2 regularisation factor for ridge regression.
+    aryOut : ShmArray
+        Shared output array (chunk corresponding to the functional data), with
+        shape aryOut[voxel, parameter]. The parameters of the best fitting pRF
+        model are written into the columns (0) x-position, (1) y-position,
+        (2) SD, and (3) R2. If the array has more columns, the betas of the
+        best fitting model (one per feature) are written into the columns
+        (4) and following.
+    varMdlBlk : int
+        Number of pRF models that are fitted at once. Memory usage per process
+        is roughly `varMdlBlk * number of features * number of voxels * 4`
+        bytes.
+    aryGramInv : np.array or ShmArray or None
+        Inverted Gram matrices of all pRF models, with shape
+        aryGramInv[model, feature, feature], as returned by `crt_gram_inv`.
+        Can be placed in shared memory (see `shared_arrays.py`). If None, the
+        Gram matrices are inverted block by block in this process.
+    aryTpk : ShmArray or None
+        Shared output array for the best k models of each voxel (chunk
+        corresponding to the functional data), with shape aryTpk[voxel, k, 2]
+        (see `tpk_out`). If None, only the best model is retained.
+    strPathCkp : str or None
+        Path of the checkpoint file of this process (see `checkpoint.py`).
+        If not None, the progress of the model loop (best models so far) is
+        saved there at regular intervals, and the loop continues from the
+        saved progress if the file exists.
+    varCkpIntv : float
+        Minimum time (in seconds) between two checkpoints.
+    tplMdlRng : tuple or None
+        Range of pRF models that are fitted (index of the first model, and of
+        the last model plus one, in the order of `crt_mdl_prms`), so that the
+        models can be split into several tasks (see `scheduler.py`). The
+        results are those of the best model within the range. If None, all
+        models are fitted.
+
+    Notes
+    -----
+    The results are not returned, but written into the shared output array.
+    This is the CPU equivalent of `find_prf_gpu`, i.e. all features (e.g.
+    motion directions) of a pRF model are fitted jointly (ridge regression
+    without constant term). Instead of solving the least squares problem
+    separately for each model, the normal equations of a block of models are
+    solved at once: The Gram matrices (X'X + L2) of all models in the block are
+    inverted as a stack, the products of the model time courses with all voxel
+    time courses (X'y) are obtained with one matrix multiplication, and the
+    betas are obtained with a stacked matrix multiplication. The residual sum
+    of squares is then given by y'y - b'X'y - L2 * b'b, so that the fitted time
+    courses never need to be computed explicitly.
+    """
+    # -------------------------------------------------------------------------
+    # *** Prepare pRF model time courses
+
+    # The pRF model time courses and the functional data may have been placed
+    # in shared memory (the model time courses may also be memory-mapped from a
+    # model bank file, in which case only the accessed models are read, or be
+    # created on demand). The model time courses are only accessed block by
+    # block (see `bnk_tile`), so they are never copied as a whole:
+    objBnk = aryPrfTc
+    aryFuncChnk = shm_get(aryFuncChnk)
+
+    # Number of volumes:
+    varNumVol = objBnk.shape[3]
+
+    # Number of predictors (betas):
+    varNumBeta = objBnk.shape[4]
+
+    # Number of pRF models (x-pos * y-pos * SD):
+    varNumMdls = objBnk.shape[0] * objBnk.shape[1] * objBnk.shape[2]
+
+    # Array with model parameters (x-position, y-position, and SD), with the
+    # same order of models as the pRF time course array (stored with a
+    # finalised model bank):
+    aryMdl = bnk_extra(objBnk, 'prm')
+    if aryMdl is None:
+        aryMdl = crt_mdl_prms(vecMdlXpos, vecMdlYpos, vecMdlSd)
+
+    # Validity mask of the models, if it has been stored with the model bank
+    # (otherwise it is computed block by block):
+    vecVld = bnk_extra(objBnk, 'vld')
+
+    # Multiply L2 regularization factor with identity matrix:
+    aryL2reg = np.multiply(np.eye(varNumBeta), varL2reg)
+
+    # The inverted Gram matrices may have been computed before (and placed in
+    # shared memory):
+    if aryGramInv is not None:
+        aryGramInv = shm_get(aryGramInv)
+
+    # -------------------------------------------------------------------------
+    # *** Prepare functional data
+
+    # Number of voxels to be fitted in this chunk:
+    varNumVoxChnk = aryFuncChnk.shape[0]
+
+    # We reshape the voxel time courses, so that time goes down the column,
+    # i.e. from top to bottom.
+    aryFuncChnk = aryFuncChnk.T.astype(np.float32)
+
+    # Sum of squares of the voxel time courses (no constant term is fitted, so
+    # the data are not de-meaned here):
+    vecYy = np.sum(np.square(aryFuncChnk), axis=0, dtype=np.float32)
+
+    # Total sum of squares (i.e. the deviation of the data from the mean),
+    # needed for the calculation of R2. For compressed data, the first
+    # component is the (scaled) mean (see `cmp_basis`):
+    if isinstance(objBnk, MdlCmp):
+        vecSsTot = np.subtract(vecYy, np.square(aryFuncChnk[0, :]))
+    else:
+        vecSsTot = np.sum(
+            np.square(np.subtract(aryFuncChnk,
+                                  np.mean(aryFuncChnk, axis=0,
+                                          dtype=np.float32)[None, :])),
+            axis=0, dtype=np.float32)
+
+    # Range of models that are fitted in this task:
+    if tplMdlRng is None:
+        tplMdlRng = (0, varNumMdls)
+
+    # -------------------------------------------------------------------------
+    # *** Prepare status indicator
+
+    # Prepare status indicator if this is the first of the parallel processes:
+    if idxPrc == 0:
+
+        # Number of steps of the status indicator:
+        varStsStpSze = 20
+
+        # Vector with pRF values at which to give status feedback (counted
+        # from the start of the range of models of this task):
+        vecStatPrf = np.linspace(0,
+                                 (tplMdlRng[1] - tplMdlRng[0]),
+                                 num=(varStsStpSze+1),
+                                 endpoint=True)
+        vecStatPrf = np.ceil(vecStatPrf)
+        vecStatPrf = vecStatPrf.astype(int)
+
+        # Vector with corresponding percentage values at which to give status
+        # feedback:
+        vecStatPrc = np.linspace(0,
+                                 100,
+                                 num=(varStsStpSze+1),
+                                 endpoint=True)
+        vecStatPrc = np.ceil(vecStatPrc)
+        vecStatPrc = vecStatPrc.astype(int)
+
+        # Counter for status indicator:
+        varCntSts01 = 0
+
+    # -------------------------------------------------------------------------
+    # *** Loop through blocks of models
+
+    # Vector for the explained sum of squares of the best fitting model so far
+    # (for each voxel):
+    vecBstSsExp = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecBstSsExp[:] = -np.inf
+
+    # Vector for indices of best fitting models (-1 for voxels for which no
+    # model has been accepted, i.e. all models have low variance):
+    vecBstIdx = np.zeros(varNumVoxChnk, dtype=np.int32)
+    vecBstIdx[:] = -1
+
+    # Array for betas of best fitting models, with shape aryBstBeta[voxel,
+    # feature]:
+    aryBstBeta = np.zeros((varNumVoxChnk, varNumBeta), dtype=np.float32)
+
+    # Index vector for voxels (needed to retrieve values at the index of the
+    # best model for each voxel):
+    vecIdxVox = np.arange(varNumVoxChnk)
+
+    # Best k models of each voxel so far (only if requested):
+    if aryTpk is not None:
+        aryTpk = shm_get(aryTpk)
+        aryTpkVal, aryTpkIdx = tpk_init(aryTpk.shape[1], varNumVoxChnk)
+
+    # State of the model loop (best models so far), which is saved in the
+    # checkpoint of this process:
+    dicSte = {'vecBstSsExp': vecBstSsExp,
+              'vecBstIdx': vecBstIdx,
+              'aryBstBeta': aryBstBeta}
+    if aryTpk is not None:
+        dicSte['aryTpkVal'] = aryTpkVal
+        dicSte['aryTpkIdx'] = aryTpkIdx
+
+    # Continue from the checkpoint of this process (if there is one):
+    varBlkNxt = ckp_blk_load(strPathCkp, dicSte, varBlkSrt=tplMdlRng[0])
+    varTmeCkp = time.time()
+
+    for varBlkSrt in range(varBlkNxt, tplMdlRng[1], varMdlBlk):
+
+        # Index of last model in current block (plus one):
+        varBlkEnd = min((varBlkSrt + varMdlBlk), tplMdlRng[1])
+
+        # Number of models in current block:
+        varNumMdlsBlk = varBlkEnd - varBlkSrt
+
+        # Status indicator (only used in the first of the parallel processes):
+        if idxPrc == 0:
+            while ((varCntSts01 <= varStsStpSze)
+                   and (vecStatPrf[varCntSts01]
+                        <= (varBlkSrt - tplMdlRng[0]))):
+                # Prepare status message:
+                strStsMsg = ('------------Progress: ' +
+                             str(vecStatPrc[varCntSts01]) +
+                             ' % --- ' +
+                             str(vecStatPrf[varCntSts01]) +
+                             ' pRF models out of ' +
+                             str(tplMdlRng[1] - tplMdlRng[0]))
+                print(strStsMsg)
+                varCntSts01 = varCntSts01 + int(1)
+
+        # Model time courses of current block, with order of axes changed to
+        # aryBlk[model, feature, time], so that the model time courses of all
+        # features can be multiplied with the functional data at once:
+        aryBlk = np.ascontiguousarray(
+            np.swapaxes(bnk_tile(objBnk, varBlkSrt, varBlkEnd), 1, 2))
+
+        # The pRF model is fitted only if variance along time dimension is not
+        # very low for at least one feature (same criterion as in the GPU
+        # version):
+        if vecVld is None:
+            vecLgcVar = np.max(
+                np.greater(np.var(aryBlk, axis=2, dtype=np.float32),
+                           np.array([1.0], dtype=np.float32)[0]),
+                axis=1)
+        else:
+            vecLgcVar = np.array(vecVld[varBlkSrt:varBlkEnd])
+
+        # Stack of inverted Gram matrices (X'X) of all models in the current
+        # block, with shape aryGram[model, feature, feature]:
+        if aryGramInv is None:
+            aryGram = gram_inv(aryBlk, aryL2reg)
+        else:
+            aryGram = aryGramInv[varBlkSrt:varBlkEnd, :, :]
+
+        # Products of the model time courses with all voxel time courses (X'y),
+        # with shape aryXy[model, feature, voxel]:
+        aryXy = np.reshape(
+            np.dot(np.reshape(aryBlk, ((varNumMdlsBlk * varNumBeta),
+                                       varNumVol)),
+                   aryFuncChnk),
+            (varNumMdlsBlk, varNumBeta, varNumVoxChnk))
+
+        # Betas for all models and voxels, with shape aryBeta[model, feature,
+        # voxel]:
+        aryBeta = np.matmul(aryGram, aryXy)
+
+        # Explained sum of squares (the residual sum of squares is y'y minus
+        # this quantity), with shape arySsExp[model, voxel]:
+        arySsExp = np.sum(np.multiply(aryBeta, aryXy), axis=1)
+        if 0.0 < varL2reg:
+            arySsExp = np.add(arySsExp,
+                              np.multiply(varL2reg,
+                                          np.sum(np.square(aryBeta),
+                                                 axis=1)))
+
+        # Models with low variance are never selected:
+        arySsExp[np.logical_not(vecLgcVar), :] = -np.inf
+
+        # Best model in current block for each voxel:
+        vecTmpIdx = np.argmax(arySsExp, axis=0)
+        vecTmpSsExp = arySsExp[vecTmpIdx, vecIdxVox]
+
+        # Check whether the current models explain more variance than the
+        # previously found ones:
+        vecLgcTmp = np.greater(vecTmpSsExp, vecBstSsExp)
+
+        # Replace best explained sum of squares and model indices:
+        vecBstSsExp[vecLgcTmp] = vecTmpSsExp[vecLgcTmp]
+        vecBstIdx[vecLgcTmp] = vecTmpIdx[vecLgcTmp] + varBlkSrt
+        aryBstBeta[vecLgcTmp, :] = aryBeta[vecTmpIdx, :, vecIdxVox][vecLgcTmp]
+
+        # Merge the current models into the best k models (models with low
+        # variance are given an index of -1, so that they are treated as
+        # empty entries):
+        if aryTpk is not None:
+            aryTpkVal, aryTpkIdx = tpk_update(
+                aryTpkVal, aryTpkIdx, arySsExp,
+                np.where(vecLgcVar, np.arange(varBlkSrt, varBlkEnd), -1))
+
+        # Save the progress of the model loop:
+        if ((strPathCkp is not None)
+                and ((time.time() - varTmeCkp) > varCkpIntv)):
+            if aryTpk is not None:
+                dicSte['aryTpkVal'] = aryTpkVal
+                dicSte['aryTpkIdx'] = aryTpkIdx
+            ckp_blk_save(strPathCkp, varBlkEnd, dicSte)
+            varTmeCkp = time.time()
+
+    # -------------------------------------------------------------------------
+    # *** Post-process results
+
+    # Retrieve model parameters of 'winning' model for all voxels (zero for
+    # voxels without an accepted model, whose betas are zero as well):
+    vecLgcTmp = np.greater_equal(vecBstIdx, 0)
+    vecBstXpos = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecBstYpos = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecBstSd = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecBstXpos[vecLgcTmp] = aryMdl[vecBstIdx[vecLgcTmp], 0]
+    vecBstYpos[vecLgcTmp] = aryMdl[vecBstIdx[vecLgcTmp], 1]
+    vecBstSd[vecLgcTmp] = aryMdl[vecBstIdx[vecLgcTmp], 2]
+
+    # Residual sum of squares of the 'winning' models:
+    vecResSsMin = np.subtract(vecYy[vecLgcTmp], vecBstSsExp[vecLgcTmp])
+
+    # Coefficient of determination (1 - ratio of (residual sum of squares by
+    # total sum of squares)), zero for voxels without an accepted model:
+    vecBstR2 = np.zeros(varNumVoxChnk, dtype=np.float32)
+    vecBstR2[vecLgcTmp] = np.subtract(1.0,
+                                      np.divide(vecResSsMin,
+                                                vecSsTot[vecLgcTmp])
+                                      )
+
+    # Write parameters of 'winning' model into shared output array:
+    aryOut = shm_get(aryOut)
+    aryOut[:, 0] = vecBstXpos
+    aryOut[:, 1] = vecBstYpos
+    aryOut[:, 2] = vecBstSd
+    aryOut[:, 3] = vecBstR2
+    if aryOut.shape[1] > 4:
+        aryOut[:, 4:] = aryBstBeta
+
+    # Write best k models into shared output array (the residual sum of
+    # squares is y'y minus the score):
+    if aryTpk is not None:
+        tpk_out(aryTpkVal, aryTpkIdx, aryTpk, vecSsTot, vecSsOff=vecYy)
+
+
+def gram_inv(aryBlk, aryL2reg):
+    """
+    Invert Gram matrices of a block of pRF models.
+
+    Parameters
+    ----------
+    aryBlk : np.array
+        Model time courses, with shape aryBlk[model, feature, time].
+    aryL2reg : np.array
+        L2 regularisation factor multiplied with identity matrix, with shape
+        aryL2reg[feature, feature].
+
+    Returns
+    -------
+    aryGram : np.array
+        Stack of inverted Gram matrices (X'X + L2) at float32 precision, with
+        shape aryGram[model, feature, feature].
+
+    Notes
+    -----
+    The inversion is performed at double precision; the pseudo-inverse also
+    handles models where one of the features does not have any variance.
+    """
+    aryGram = np.matmul(aryBlk, np.swapaxes(aryBlk, 1, 2))
+    aryGram = np.add(aryGram.astype(np.float64), aryL2reg[None, :, :])
+    aryGram = np.linalg.pinv(aryGram).astype(np.float32)
+
+    return aryGram
+
+
+def crt_gram_inv(aryPrfTc, varL2reg, varMdlBlk=1000):
+    """
+    Invert Gram matrices of all pRF models.
+
+    Parameters
+    ----------
+    aryPrfTc : np.array
+        Array with pRF model time courses, with shape
+        aryPrfTc[x-pos, y-pos, SD, time, feature].
+    varL2reg : float
+        L2 regularisation factor for ridge regression.
+    varMdlBlk : int
+        Number of pRF models that are processed at once.
+
+    Returns
+    -------
+    aryGramInv : np.array
+        Stack of inverted Gram matrices (X'X + L2) of all models, with shape
+        aryGramInv[model, feature, feature], in the same order of models as
+        `crt_mdl_prms`.
+
+    Notes
+    -----
+    The inverted Gram matrices only depend on the model time courses and the
+    regularisation, not on the functional data. They can therefore be computed
+    once (and cached), instead of being computed by every parallel process.
+    """
+    # Number of volumes & predictors:
+    varNumVol = aryPrfTc.shape[3]
+    varNumBeta = aryPrfTc.shape[4]
+
+    # Number of pRF models (x-pos * y-pos * SD):
+    varNumMdls = aryPrfTc.shape[0] * aryPrfTc.shape[1] * aryPrfTc.shape[2]
+
+    # Reshape pRF model time courses, to the form aryPrfTc[model, time,
+    # feature]:
+    aryPrfTc = np.reshape(aryPrfTc, (varNumMdls, varNumVol, varNumBeta))
+
+    # Multiply L2 regularization factor with identity matrix:
+    aryL2reg = np.multiply(np.eye(varNumBeta), varL2reg)
+
+    # Array for inverted Gram matrices:
+    aryGramInv = np.zeros((varNumMdls, varNumBeta, varNumBeta),
+                          dtype=np.float32)
+
+    for varBlkSrt in range(0, varNumMdls, varMdlBlk):
+
+        # Index of last model in current block (plus one):
+        varBlkEnd = min((varBlkSrt + varMdlBlk), varNumMdls)
+
+        # Model time courses of current block, with shape aryBlk[model,
+        # feature, time] (as in `find_prf_cpu_motion`):
+        aryBlk = np.ascontiguousarray(
+            np.swapaxes(aryPrfTc[varBlkSrt:varBlkEnd, :, :], 1, 2),
+            dtype=np.float32)
+
+        aryGramInv[varBlkSrt:varBlkEnd, :, :] = gram_inv(aryBlk, aryL2reg)
+
+    return aryGramInv
@@ -21,10 +21,16 @@ import os
 import numpy as np
 import threading
 import tensorflow as tf
+from shared_arrays import shm_get
+from model_bank import bnk_get
+from model_bank import bnk_extra
+from top_k import tpk_init
+from top_k import tpk_update
+from top_k import tpk_out
 
 
 def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  # noqa
-                 aryPrfTc, varL2reg, queOut):
+                 aryPrfTc, varL2reg, aryOut, aryTpk=None):
     """
     Find best pRF model for voxel time course.
 
@@ -40,44 +46,33 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  # noqa
         1D array with pRF model y positions.
     vecMdlSd : np.array
         1D array with pRF model sizes (SD of Gaussian).
-    aryFunc : np.array
+    aryFunc : np.array or ShmArray
         2D array with functional MRI data, with shape aryFunc[voxel, time].
-    aryPrfTc : np.array
+        Can be placed in shared memory (see `shared_arrays.py`).
+    aryPrfTc : np.array or ShmArray or MdlBnk
         Array with pRF model time courses, with shape
-        aryPrfTc[x-pos, y-pos, SD, time, feature]
+        aryPrfTc[x-pos, y-pos, SD, time, feature]. Can be placed in shared
+        memory (see `shared_arrays.py`), or be the handle of a model bank file
+        (see `model_bank.py`).
     varL2reg : float
         L2 regularisation factor for ridge regression.
-    queOut : multiprocessing.queues.Queue
-        Queue to put the results on.
-
-    Returns
-    -------
-    lstOut : list
-        List containing the following objects:
-        idxPrc : int
-            Process ID of the process calling this function (for CPU
-            multi-threading). In GPU version, this parameter is 0.
-        vecBstXpos : np.array
-            1D array with best fitting x-position for each voxel, with shape
-            vecBstXpos[voxel].
-        vecBstYpos : np.array
-            1D array with best fitting y-position for each voxel, with shape
-            vecBstYpos[voxel].
-        vecBstSd : np.array
-            1D array with best fitting pRF size for each voxel, with shape
-            vecBstSd[voxel].
-        vecBstR2 : np.array
-            1D array with R2 value of 'winning' pRF model for each voxel, with
-            shape vecBstR2[voxel].
-        dummy : np.array
-            2D array that is supposed to contain the beta values of 'winning'
-            pRF models for each voxel, with shape aryBeta[voxel, beta]. AT THE
-            MOMENT, CONTAINS EMPTY DUMMY ARRAY (np.zeros).
+    aryOut : ShmArray
+        Shared output array (chunk corresponding to the functional data), with
+        shape aryOut[voxel, parameter]. The parameters of the best fitting pRF
+        model are written into the columns (0) x-position, (1) y-position,
+        (2) SD, and (3) R2. If the array has more columns, the betas of the
+        best fitting model (one per feature) are written into the columns
+        (4) and following.
+    aryTpk : ShmArray or None
+        Shared output array for the best k models of each voxel (chunk
+        corresponding to the functional data), with shape aryTpk[voxel, k, 2]
+        (see `tpk_out`). If None, only the best model is retained.
 
     Notes
     -----
     Uses a queue that runs in a separate thread to put model time courses on
-    the computational graph.
+    the computational graph. The results are not returned, but written into
+    the shared output array.
     """
     # -------------------------------------------------------------------------
     # *** Queue-feeding-function that will run in extra thread
@@ -111,6 +106,13 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  # noqa
 
     print('------Prepare pRF model time courses for graph')
 
+    # The pRF model time courses and the functional data may have been placed
+    # in shared memory (the model time courses may also be memory-mapped from a
+    # model bank file, in which case only the accessed models are read):
+    objBnk = aryPrfTc
+    aryPrfTc = bnk_get(objBnk)
+    aryFunc = shm_get(aryFunc)
+
     # Information about pRF model parameters:
     varNumX = np.shape(vecMdlXpos)[0]
     varNumY = np.shape(vecMdlYpos)[0]
@@ -137,26 +139,36 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  # noqa
     # with zero variance):
     varNumMdlsTtl = aryPrfTc.shape[0]
 
-    # Change type to float 32:
-    aryPrfTc = aryPrfTc.astype(np.float32)
+    # The validity mask may have been stored with the model bank. In that
+    # case, only the valid models are read from the bank file.
+    vecLgcVar = bnk_extra(objBnk, 'vld')
+
+    if vecLgcVar is None:
+
+        # Change type to float 32:
+        aryPrfTc = aryPrfTc.astype(np.float32)
+
+        # The pRF model is fitted only if variance along time dimension is not
+        # very low. Get variance along time dimension:
+        vecVarPrfTc = np.var(aryPrfTc, axis=1)
+
+        # Low value with float32 precision for comparison:
+        varZero32 = np.array(([1.0])).astype(np.float32)[0]
 
-    # The pRF model is fitted only if variance along time dimension is not
-    # very low. Get variance along time dimension:
-    vecVarPrfTc = np.var(aryPrfTc, axis=1)
+        # Boolean array for models with variance greater than zero for at
+        # least one motion direction:
+        vecLgcVar = np.max(
+                           np.greater(vecVarPrfTc,
+                                      varZero32),
+                           axis=1
+                           )
 
-    # Low value with float32 precision for comparison:
-    varZero32 = np.array(([1.0])).astype(np.float32)[0]
+    else:
 
-    # Boolean array for models with variance greater than zero for at least
-    # one motion direction:
-    vecLgcVar = np.max(
-                       np.greater(vecVarPrfTc,
-                                  varZero32),
-                       axis=1
-                       )
+        vecLgcVar = np.array(vecLgcVar)
 
     # Take models with variance less than zero out of the array:
-    aryPrfTc = aryPrfTc[vecLgcVar, :, :]
+    aryPrfTc = aryPrfTc[vecLgcVar, :, :].astype(np.float32)
 
     # Add constant term (ones):
     # aryPrfTc = np.concatenate((aryPrfTc,
@@ -271,6 +283,10 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  # noqa
     # Vector for indices of models with minimum residuals:
     vecResSsMinIdx = np.zeros((varNumVox), dtype=np.int32)
 
+    # Array for betas of models with minimum residuals, with shape
+    # aryBstBeta[voxel, feature]:
+    aryBstBeta = np.zeros((varNumVox, varNumBeta), dtype=np.float32)
+
     # Multiply L2 regularization factor with identity matrix:
     aryL2reg = np.multiply(np.eye(varNumBeta),
                            varL2reg).astype(np.float32)
@@ -397,69 +413,65 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  # noqa
             # dimension. There are two versions: (1) The number of measurements
             # (e.g. volumes) is greater than or equal to the number of
             # predictors (betas). (2) The number of measurements is less than
-            # the number of predictors.
+            # the number of predictors. The betas are a separate operation, so
+            # that they can be retrieved together with the residuals (in the
+            # same run of the graph, i.e. for the same model).
 
             # (1) Number of measurements greater/equal to number of predictors:
             if np.greater_equal(varNumVol, varNumBeta):
-                objMatSlve = tf.reduce_sum(
-                                           tf.squared_difference(
-                                                                 objFunc,
-                                                                 tf.matmul(
-                                                                           objDsng,
-                                                                           tf.matmul(
-                                                                                     tf.matmul(
-                                                                                               tf.matrix_inverse(
-                                                                                                                 tf.add(
-                                                                                                                        tf.matmul(
-                                                                                                                                   objDsng,
-                                                                                                                                   objDsng,
-                                                                                                                                   transpose_a=True,
-                                                                                                                                   transpose_b=False
-                                                                                                                                   ),
-                                                                                                                        objL2reg
-                                                                                                                        )
-                                                                                                                 ),
-                                                                                               objDsng,
-                                                                                               transpose_a=False,
-                                                                                               transpose_b=True
-                                                                                               ),
-                                                                                     objFunc
-                                                                                     )
-                                                                           ),
-                                                                 ),
-                                           axis=0
-                                           )
+                objBeta = tf.matmul(
+                                    tf.matmul(
+                                              tf.matrix_inverse(
+                                                                tf.add(
+                                                                       tf.matmul(
+                                                                                 objDsng,
+                                                                                 objDsng,
+                                                                                 transpose_a=True,
+                                                                                 transpose_b=False
+                                                                                 ),
+                                                                       objL2reg
+                                                                       )
+                                                                ),
+                                              objDsng,
+                                              transpose_a=False,
+                                              transpose_b=True
+                                              ),
+                                    objFunc
+                                    )
 
             # (2) Number of measurements less than number of predictors:
             else:
-                objMatSlve = tf.reduce_sum(
-                                           tf.squared_difference(
-                                                                 objFunc,
-                                                                 tf.matmul(
-                                                                           objDsng,
-                                                                           tf.matmul(
-                                                                                     tf.matmul(
-                                                                                               objDsng,
-                                                                                               tf.matrix_inverse(
-                                                                                                                 tf.add(
-                                                                                                                        tf.matmul(
-                                                                                                                                   objDsng,
-                                                                                                                                   objDsng,
-                                                                                                                                   transpose_a=False,
-                                                                                                                                   transpose_b=True
-                                                                                                                                   ),
-                                                                                                                        objL2reg
-                                                                                                                        )
-                                                                                                                 ),
-                                                                                               transpose_a=True,
-                                                                                               transpose_b=False
-                                                                                               ),
-                                                                                     objFunc
-                                                                                     )
-                                                                           ),
-                                                                 ),
-                                           axis=0
-                                           )
+                objBeta = tf.matmul(
+                                    tf.matmul(
+                                              objDsng,
+                                              tf.matrix_inverse(
+                                                                tf.add(
+                                                                       tf.matmul(
+                                                                                 objDsng,
+                                                                                 objDsng,
+                                                                                 transpose_a=False,
+                                                                                 transpose_b=True
+                                                                                 ),
+                                                                       objL2reg
+                                                                       )
+                                                                ),
+                                              transpose_a=True,
+                                              transpose_b=False
+                                              ),
+                                    objFunc
+                                    )
+
+            # Residuals along time dimension:
+            objMatSlve = tf.reduce_sum(
+                                       tf.squared_difference(
+                                                             objFunc,
+                                                             tf.matmul(
+                                                                       objDsng,
+                                                                       objBeta
+                                                                       ),
+                                                             ),
+                                       axis=0
+                                       )
 
             # Variables need to be (re-)initialised:
             objSess.run(tf.global_variables_initializer())
@@ -479,13 +491,27 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  # noqa
                                   lstFunc[idxChnk].shape[1]),
                                  dtype=np.float32)
 
+            # Minimum residuals so far, and betas of the corresponding models,
+            # for the voxels of the current chunk:
+            vecTmpResMin = np.zeros(lstFunc[idxChnk].shape[1],
+                                    dtype=np.float32)
+            vecTmpResMin[:] = np.inf
+            aryTmpBeta = np.zeros((varNumBeta, lstFunc[idxChnk].shape[1]),
+                                  dtype=np.float32)
+
             # Loop through models:
             for idxMdl in range(varNumMdls):
 
                 # Run main computational graph and put results in list:
                 # varTme01 = time.time()
 
-                aryTmpRes[idxMdl, :] = objSess.run(objMatSlve)
+                aryTmpRes[idxMdl, :], aryTmpMdlBeta = objSess.run(
+                    [objMatSlve, objBeta])
+
+                # Keep the betas of the models with minimum residuals:
+                vecLgcTmp = np.less(aryTmpRes[idxMdl, :], vecTmpResMin)
+                vecTmpResMin[vecLgcTmp] = aryTmpRes[idxMdl, vecLgcTmp]
+                aryTmpBeta[:, vecLgcTmp] = aryTmpMdlBeta[:, vecLgcTmp]
 
                 # print(('---------Time for graph call: '
                 #        + str(time.time() - varTme01)))
@@ -517,6 +543,24 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  # noqa
         # Get minimum residuals of those models:
         vecResSsMin[varChnkStr:varChnkEnd] = np.min(aryTmpRes, axis=0)
 
+        # Betas of those models:
+        aryBstBeta[varChnkStr:varChnkEnd, :] = aryTmpBeta.T
+
+        # Best k models of the voxels in the current chunk (residuals with
+        # negative sign, indices of the models before removing models with
+        # a variance of zero):
+        if aryTpk is not None:
+            aryTpkVal, aryTpkIdx = tpk_init(shm_get(aryTpk).shape[1],
+                                            aryTmpRes.shape[1])
+            aryTpkVal, aryTpkIdx = tpk_update(aryTpkVal, aryTpkIdx,
+                                              -aryTmpRes,
+                                              np.nonzero(vecLgcVar)[0])
+            tpk_out(aryTpkVal,
+                    aryTpkIdx,
+                    shm_get(aryTpk)[varChnkStr:varChnkEnd],
+                    vecSsTot[varChnkStr:varChnkEnd],
+                    vecSsOff=np.zeros(aryTmpRes.shape[1]))
+
     # -------------------------------------------------------------------------
     # *** Post-process results
 
@@ -562,12 +606,11 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  # noqa
                                      vecSsTot)
                            )
 
-    # Output list:
-    lstOut = [idxPrc,
-              vecBstXpos,
-              vecBstYpos,
-              vecBstSd,
-              vecBstR2,
-              np.zeros((varNumVox, (varNumBeta))).astype(np.float32)]
-
-    queOut.put(lstOut)
+    # Write parameters of 'winning' model into shared output array:
+    aryOut = shm_get(aryOut)
+    aryOut[:, 0] = vecBstXpos
+    aryOut[:, 1] = vecBstYpos
+    aryOut[:, 2] = vecBstSd
+    aryOut[:, 3] = vecBstR2
+    if aryOut.shape[1] > 4:
+        aryOut[:, 4:] = aryBstBeta
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Batch runner: prepare the pRF models once, and fit several subjects.
+
+The subjects of the batch share the same stimulus design, and are listed in a
+manifest (JSON file, see `strPathMnf` in `config.py`):
+
+    [{"mask": "/path/sub_01/mask.nii",
+      "func": ["/path/sub_01/run_01.nii", "/path/sub_01/run_02.nii"],
+      "out": "/path/sub_01/pRF_results"},
+     {"mask": "/path/sub_02/mask.nii",
+      "func": ["/path/sub_02/run_01.nii", "/path/sub_02/run_02.nii"],
+      "out": "/path/sub_02/pRF_results"}]
+
+Run with `python main_batch.py <manifest>`. The pRF models are created or
+loaded (and preprocessed) once, as in `main.py`. While a subject is fitted,
+the next subject is loaded and preprocessed (see `btch_run` in `batch.py`).
+All other parameters of the analysis are taken from config.py.
+"""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# *****************************************************************************
+# *** Import modules
+
+import config as cfg
+
+import sys
+import time
+
+from pipeline import ppl_cfg
+from pipeline import ppl_models
+from batch import btch_load
+from batch import btch_run
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Check time
+print('---pRF analysis: batch of subjects')
+varTme01 = time.time()
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Preparations
+
+# Convert preprocessing parameters (for temporal and spatial smoothing) from
+# SI units (i.e. [s] and [mm]) into units of data array (volumes and voxels):
+ppl_cfg()
+
+if cfg.varNumShrd is not None:
+    # Error message:
+    strErrMsg = ('---Error: The batch runner does not support shards '
+                 + '(varNumShrd needs to be None).')
+    raise ValueError(strErrMsg)
+
+if cfg.lstVar is not None:
+    # Error message:
+    strErrMsg = ('---Error: The batch runner does not support variants of '
+                 + 'the functional data (lstVar needs to be None).')
+    raise ValueError(strErrMsg)
+
+# Manifest of the subjects (can be given on the command line):
+if len(sys.argv) > 1:
+    cfg.strPathMnf = sys.argv[1]
+if cfg.strPathMnf is None:
+    # Error message:
+    strErrMsg = ('---Error: No manifest of subjects (strPathMnf, or '
+                 + '`python main_batch.py <manifest>`).')
+    raise ValueError(strErrMsg)
+
+lstSub = btch_load(cfg.strPathMnf)
+
+print('---Number of subjects: ' + str(len(lstSub)))
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Create or load pRF time course models & preprocessing
+
+# The pRF models, and the arrays that only depend on the models, are prepared
+# once for all subjects (see `pipeline.py`):
+dicMdl = ppl_models()
+
+print('---Models prepared, elapsed time: ' + str(time.time() - varTme01)
+      + ' s')
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Fit subjects
+
+lstSts = btch_run(dicMdl, lstSub, cfg.varPar, varParPre=cfg.varBtchPar,
+                  varMem=cfg.varBtchMem)
+
+varNumFld = lstSts.count('failed')
+if varNumFld > 0:
+    # Error message:
+    strErrMsg = ('---Error: ' + str(varNumFld) + ' of ' + str(len(lstSub))
+                 + ' subjects failed: '
+                 + ', '.join([lstSub[idxSub]['out']
+                              for idxSub in range(len(lstSub))
+                              if lstSts[idxSub] == 'failed']))
+    raise ValueError(strErrMsg)
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Report time
+
+varTme02 = time.time()
+varTme03 = varTme02 - varTme01
+print('---Elapsed time: ' + str(varTme03) + ' s')
+print('---Done.')
+# *****************************************************************************
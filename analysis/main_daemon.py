@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Fitting daemon: prepare the pRF models once, and fit many subjects.
+
+The pRF models are created or loaded (and preprocessed) once, as in
+`main.py`. Then, fitting jobs (mask, functional runs and output prefix of a
+subject) are accepted over a local HTTP interface (see `dmn_run` in
+`daemon.py`), and are fitted one after the other with the same models, e.g.:
+
+    curl -X POST http://127.0.0.1:8765/jobs -d '{"mask": "/path/mask.nii",
+        "func": ["/path/run_01.nii", "/path/run_02.nii"],
+        "out": "/path/pRF_results"}'
+    curl http://127.0.0.1:8765/jobs/0
+
+All other parameters of the analysis are taken from config.py.
+"""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# *****************************************************************************
+# *** Import modules
+
+import config as cfg
+
+import time
+
+from pipeline import ppl_cfg
+from pipeline import ppl_models
+from pipeline import ppl_fit
+from daemon import dmn_run
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Check time
+print('---pRF analysis: fitting daemon')
+varTme01 = time.time()
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Preparations
+
+# Convert preprocessing parameters (for temporal and spatial smoothing) from
+# SI units (i.e. [s] and [mm]) into units of data array (volumes and voxels):
+ppl_cfg()
+
+if cfg.varNumShrd is not None:
+    # Error message:
+    strErrMsg = ('---Error: The fitting daemon does not support shards '
+                 + '(varNumShrd needs to be None).')
+    raise ValueError(strErrMsg)
+
+if cfg.lstVar is not None:
+    # Error message:
+    strErrMsg = ('---Error: The fitting daemon does not support variants of '
+                 + 'the functional data (lstVar needs to be None).')
+    raise ValueError(strErrMsg)
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Create or load pRF time course models & preprocessing
+
+# The pRF models, and the arrays that only depend on the models, are kept in
+# memory for all jobs (see `pipeline.py`):
+dicMdl = ppl_models()
+
+print('---Models prepared, elapsed time: ' + str(time.time() - varTme01)
+      + ' s')
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Fit jobs
+
+
+def dmn_fit(strPathNiiMask, lstPathNiiFunc, strPathOut):
+    """Fit one job with the prepared pRF models."""
+    ppl_fit(dicMdl, strPathNiiMask, lstPathNiiFunc, strPathOut)
+
+
+# The parallel processes of each job are started from this process, so that
+# they share the prepared pRF models (which are not copied):
+dmn_run(dmn_fit, varPort=cfg.varDmnPort)
+# *****************************************************************************
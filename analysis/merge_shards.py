@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Create the output images from the partial results of all shards.
+
+If the model fitting is split into shards (see `varNumShrd` in `config.py`),
+each shard saves its partial results. After all shards have finished, this
+script (`python merge_shards.py`, with the same configuration) merges them
+and exports the results as nii images, in the same way as `main.py`.
+"""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# *****************************************************************************
+# *** Import modules
+
+import config as cfg
+
+import time
+
+from utilities import load_nii
+from shards import shrd_merge
+from export import exp_prf
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Check time
+print('---Merge shards of pRF analysis')
+varTme01 = time.time()
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Merge & export results
+
+if cfg.varNumShrd is None:
+    # Error message:
+    strErrMsg = ('---Error: The model fitting is not split into shards '
+                 + '(varNumShrd = None).')
+    raise ValueError(strErrMsg)
+
+print('------Load results of ' + str(cfg.varNumShrd) + ' shards')
+
+dicRes = shrd_merge(cfg.strPathOut, cfg.varNumShrd)
+
+# Header of the mask (the output images have the same header as the mask):
+_, hdrMsk, _ = load_nii(cfg.strPathNiiMask)
+
+exp_prf(dicRes['aryBstPrm'],
+        dicRes['aryLgcMsk'],
+        dicRes['aryLgcVar'],
+        dicRes['aryAff'],
+        hdrMsk,
+        dicRes['tplNiiShp'],
+        cfg.strPathOut,
+        aryTpk=dicRes['aryTpk'],
+        tplMdlGrd=dicRes['tplMdlGrd'],
+        lstMtnDir=cfg.lstMtnDir)
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Report time
+
+varTme02 = time.time()
+varTme03 = varTme02 - varTme01
+print('---Elapsed time: ' + str(varTme03) + ' s')
+print('---Done.')
+# *****************************************************************************
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""On-disk bank of pRF model time courses, accessed by memory mapping."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import numpy as np
+from shared_arrays import shm_put
+from shared_arrays import shm_get
+from utilities import crt_mdl_prms
+from model_creation_lazy import MdlLzy
+from model_creation_lazy import lzy_tile
+
+
+class MdlBnk(object):
+    """
+    Handle of a model bank file, that can be passed to parallel processes.
+
+    Notes
+    -----
+    A model bank consists of two files: A raw data file (`<basename>.dat`)
+    containing the model time courses, and an index file (`<basename>.json`)
+    with the shape and data type of the array. The model time courses are
+    stored model-major, i.e. with shape `aryPrfTc[x-position, y-position, SD,
+    time, feature]` in C order, so that the time courses of a tile of
+    consecutive models (in the order of `crt_mdl_prms`) are one contiguous
+    range of bytes. The fitting functions only read one tile of models at a
+    time (see `bnk_get`), so that the bank does not need to fit into memory.
+
+    Only the path of the bank is passed to child processes (not the data);
+    each process maps the file separately, and the operating system shares the
+    file cache between processes.
+
+    A finalised bank (see `bnk_finalise`) additionally contains the model
+    parameters, the sums of squares of the de-meaned model time courses
+    ('norms'), and a validity mask, each as an npy file (`<basename>_prm.npy`,
+    `<basename>_nrm.npy`, `<basename>_vld.npy`), and its index contains a key
+    of the inputs from which the bank was created (see `bnk_chk`).
+    """
+
+    def __init__(self, strPathBnk):
+        """Read index file of model bank."""
+        self.path = os.path.expanduser(strPathBnk)
+        with open(self.path + '.json', 'r') as objFle:
+            dicIdx = json.load(objFle)
+        self.shape = tuple(dicIdx['shape'])
+        self.dtype = np.dtype(str(dicIdx['dtype']))
+
+
+class MdlCmp(object):
+    """
+    Handle of temporally compressed pRF models in shared memory.
+
+    Notes
+    -----
+    Instead of time courses, the models are represented by their coordinates
+    in a low-dimensional temporal basis (see `compression.py`), with shape
+    `aryPrfTc[x-position, y-position, SD, component, feature]`. The handle
+    behaves like a model bank handle in the fitting functions (see `bnk_get`,
+    `bnk_tile`, and `bnk_extra`). Because the variance of a time course cannot
+    be computed from its coordinates, the norms and the validity mask of the
+    models (computed from the full time courses) are passed along.
+    """
+
+    def __init__(self, aryPrfTc, aryNrm, vecVld):
+        """
+        Initialise handle of compressed pRF models.
+
+        Parameters
+        ----------
+        aryPrfTc : np.array
+            Compressed models, with shape aryPrfTc[x-position, y-position, SD,
+            component, feature].
+        aryNrm : np.array
+            Sums of squares of the compressed models (zero for models whose
+            time course has a variance of zero), with shape aryNrm[model,
+            feature].
+        vecVld : np.array
+            Validity mask of the models (variance of the time course greater
+            than one for at least one feature), with shape vecVld[model].
+        """
+        self.mdl = shm_put(aryPrfTc.astype(np.float32))
+        self.extra = {'nrm': shm_put(aryNrm.astype(np.float32)),
+                      'vld': shm_put(vecVld.astype(np.bool_))}
+        self.shape = tuple(aryPrfTc.shape)
+        self.dtype = np.dtype(np.float32)
+
+
+def bnk_create(strPathBnk, tplShp, varDtype=np.float32):
+    """
+    Create new model bank file.
+
+    Parameters
+    ----------
+    strPathBnk : str
+        Basename of the model bank (without file extension).
+    tplShp : tuple
+        Shape of the model bank, (x-positions, y-positions, SDs, volumes,
+        features).
+    varDtype : np.dtype
+        Data type of model time courses.
+
+    Returns
+    -------
+    aryBnk : np.memmap
+        Writeable memory map of the model bank, with shape `aryBnk[x-position,
+        y-position, SD, time, feature]`. Needs to be flushed (or deleted) after
+        writing.
+    """
+    strPathBnk = os.path.expanduser(strPathBnk)
+
+    # Write index file:
+    with open(strPathBnk + '.json', 'w') as objFle:
+        json.dump({'shape': [int(varTmp) for varTmp in tplShp],
+                   'dtype': np.dtype(varDtype).name,
+                   'layout': 'model-major'},
+                  objFle)
+
+    # Create data file:
+    aryBnk = np.memmap(strPathBnk + '.dat',
+                       dtype=varDtype,
+                       mode='w+',
+                       shape=tuple(tplShp))
+
+    return aryBnk
+
+
+def bnk_get(objBnk, strMode='r'):
+    """
+    Access model time courses.
+
+    Parameters
+    ----------
+    objBnk : MdlBnk or MdlCmp or ShmArray or np.array
+        Model bank handle, handle of compressed models, shared array, or numpy
+        array.
+    strMode : str
+        Access mode of the memory map ('r' for read-only, 'r+' for read and
+        write). Only relevant for model bank handles.
+
+    Returns
+    -------
+    aryPrfTc : np.array
+        Model time courses. If `objBnk` is a model bank handle, a memory map of
+        the model bank file (the data are only read from disk when they are
+        accessed). If `objBnk` is a handle of compressed models, the shared
+        array with the compressed models. Otherwise, the result of `shm_get`.
+    """
+    if isinstance(objBnk, MdlBnk):
+        return np.memmap(objBnk.path + '.dat',
+                         dtype=objBnk.dtype,
+                         mode=strMode,
+                         shape=objBnk.shape)
+    if isinstance(objBnk, MdlCmp):
+        return shm_get(objBnk.mdl)
+    return shm_get(objBnk)
+
+
+def bnk_tile(objBnk, varBlkSrt, varBlkEnd):
+    """
+    Read (or create) the time courses of a tile of consecutive pRF models.
+
+    Parameters
+    ----------
+    objBnk : MdlBnk or MdlLzy or MdlCmp or ShmArray or np.array
+        Model bank handle, handle of models that are created on demand,
+        handle of compressed models, shared array, or numpy array, with shape
+        aryPrfTc[x-position, y-position, SD, time, feature] (the feature
+        dimension may be missing if there is only one feature).
+    varBlkSrt : int
+        Index of the first model of the tile (in the order of
+        `crt_mdl_prms`).
+    varBlkEnd : int
+        Index of the last model of the tile (plus one).
+
+    Returns
+    -------
+    aryBlk : np.array
+        Model time courses of the tile (float32 copy), with shape
+        aryBlk[model, time, feature].
+    """
+    # Models that are created on demand (see `model_creation_lazy.py`):
+    if isinstance(objBnk, MdlLzy):
+        return lzy_tile(objBnk, varBlkSrt, varBlkEnd)
+
+    aryPrfTc = bnk_get(objBnk)
+
+    # Number of pRF models (x-pos * y-pos * SD):
+    varNumMdls = aryPrfTc.shape[0] * aryPrfTc.shape[1] * aryPrfTc.shape[2]
+
+    # Reshape to aryPrfTc[model, time, feature] (without copying the model
+    # time courses, which may be shared with other processes or memory-mapped
+    # from a file):
+    aryPrfTc = np.reshape(aryPrfTc, (varNumMdls, aryPrfTc.shape[3], -1))
+
+    return aryPrfTc[varBlkSrt:varBlkEnd, :, :].astype(np.float32)
+
+
+def bnk_extra(objBnk, strName):
+    """
+    Access additional information stored with a finalised model bank.
+
+    Parameters
+    ----------
+    objBnk : MdlBnk or MdlCmp or ShmArray or np.array
+        Model bank handle, handle of compressed models (only 'nrm' and 'vld'
+        are available), or array with model time courses.
+    strName : str
+        Name of the information: 'prm' (model parameters, with shape
+        aryPrm[model, 3], columns x-position, y-position, SD), 'nrm' (sum of
+        squares of de-meaned model time courses, with shape aryNrm[model,
+        feature]), or 'vld' (validity mask, with shape vecVld[model]).
+
+    Returns
+    -------
+    aryExt : np.array or None
+        Memory-mapped (or shared) array with the requested information, or
+        None if it is not available for `objBnk`.
+    """
+    if isinstance(objBnk, MdlBnk):
+        return np.load(objBnk.path + '_' + strName + '.npy', mmap_mode='r')
+    if isinstance(objBnk, MdlCmp) and (strName in objBnk.extra):
+        return shm_get(objBnk.extra[strName])
+    return None
+
+
+def bnk_finalise(strPathBnk, vecMdlXpos, vecMdlYpos, vecMdlSd, strKey,
+                 varMdlBlk=1000):
+    """
+    Compute and store additional information needed for model fitting.
+
+    Parameters
+    ----------
+    strPathBnk : str
+        Basename of the model bank (without file extension). The model time
+        courses need to have been written (see `bnk_create`).
+    vecMdlXpos : np.array
+        1D array with pRF model x positions.
+    vecMdlYpos : np.array
+        1D array with pRF model y positions.
+    vecMdlSd : np.array
+        1D array with pRF model sizes (SD of Gaussian).
+    strKey : str
+        Key of the inputs from which the model bank was created (e.g. hash of
+        the parameters of model creation and preprocessing).
+    varMdlBlk : int
+        Number of models that are read from the bank at once.
+
+    Notes
+    -----
+    The model parameters (in the order of `crt_mdl_prms`), the sums of
+    squares of the de-meaned model time courses, and a validity mask are
+    stored next to the bank, so that the fitting functions do not need to
+    compute them. A model is valid if the variance of its time course is
+    greater than one for at least one feature (same criterion as in the GPU
+    version). The key is written into the index file last, so that an
+    incomplete bank (e.g. after an interrupted run) is never considered to be
+    up to date.
+    """
+    strPathBnk = os.path.expanduser(strPathBnk)
+    objBnk = MdlBnk(strPathBnk)
+
+    # Number of volumes & features:
+    varNumVol = objBnk.shape[3]
+    varNumFtr = objBnk.shape[4]
+
+    # Number of pRF models (x-pos * y-pos * SD):
+    varNumMdls = objBnk.shape[0] * objBnk.shape[1] * objBnk.shape[2]
+
+    # Model time courses, with shape aryPrfTc[model, time, feature] (memory
+    # map, the models are only read one block at a time):
+    aryPrfTc = np.reshape(bnk_get(objBnk), (varNumMdls, varNumVol, varNumFtr))
+
+    # Sums of squares of de-meaned model time courses:
+    aryNrm = np.zeros((varNumMdls, varNumFtr), dtype=np.float32)
+
+    for varBlkSrt in range(0, varNumMdls, varMdlBlk):
+
+        # Index of last model in current block (plus one):
+        varBlkEnd = min((varBlkSrt + varMdlBlk), varNumMdls)
+
+        aryBlk = aryPrfTc[varBlkSrt:varBlkEnd, :, :].astype(np.float32)
+        aryBlk = np.subtract(aryBlk,
+                             np.mean(aryBlk, axis=1,
+                                     dtype=np.float32)[:, None, :])
+        aryNrm[varBlkSrt:varBlkEnd, :] = np.sum(np.square(aryBlk), axis=1,
+                                                dtype=np.float32)
+
+    # Validity mask (variance greater than one for at least one feature):
+    vecVld = np.max(np.greater(np.divide(aryNrm, float(varNumVol)), 1.0),
+                    axis=1)
+
+    # Store additional information:
+    np.save(strPathBnk + '_prm.npy',
+            crt_mdl_prms(vecMdlXpos, vecMdlYpos, vecMdlSd))
+    np.save(strPathBnk + '_nrm.npy', aryNrm)
+    np.save(strPathBnk + '_vld.npy', vecVld)
+
+    # Add key to index file:
+    with open(strPathBnk + '.json', 'r') as objFle:
+        dicIdx = json.load(objFle)
+    dicIdx['key'] = strKey
+    with open(strPathBnk + '.json', 'w') as objFle:
+        json.dump(dicIdx, objFle)
+
+
+def bnk_chk(strPathBnk, strKey):
+    """
+    Check whether a finalised model bank with the given key exists.
+
+    Parameters
+    ----------
+    strPathBnk : str
+        Basename of the model bank (without file extension).
+    strKey : str
+        Key of the inputs from which the model bank should have been created.
+
+    Returns
+    -------
+    lgcBnk : bool
+        True if the model bank exists, is complete, and was created from the
+        same inputs.
+    """
+    strPathBnk = os.path.expanduser(strPathBnk)
+
+    # All files need to exist:
+    for strTmp in ['.json', '.dat', '_prm.npy', '_nrm.npy', '_vld.npy']:
+        if not os.path.isfile(strPathBnk + strTmp):
+            return False
+
+    with open(strPathBnk + '.json', 'r') as objFle:
+        dicIdx = json.load(objFle)
+
+    # Size of data file needs to agree with index:
+    varSze = (int(np.prod(dicIdx['shape']))
+              * np.dtype(str(dicIdx['dtype'])).itemsize)
+    if os.path.getsize(strPathBnk + '.dat') != varSze:
+        return False
+
+    return dicIdx.get('key') == strKey
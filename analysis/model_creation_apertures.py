@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""Load unique stimulus apertures and create aperture-wise design matrix."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import pickle
+from PIL import Image
+from utilities import crt_hrf
+from convolution import conv_tc
+
+
+def load_apertures(strPathMsk, lstDsgn, tplVslSpcSze=(200, 200)):
+    """
+    Load the stimulus apertures that were presented during the experiment.
+
+    Parameters
+    ----------
+    strPathMsk : str
+        Path to npz file containing numpy array that defines stimulus shapes,
+        created with `~/py_pRF_motion/stimuli/Code/CreateMasks.py`, with shape
+        aryMsk[x-position, y-position, aperture].
+    lstDsgn : list
+        List containing paths of pickles files with information about
+        experimental design (order of stimuli). The first column of the design
+        matrix contains the aperture index, the second column the motion
+        direction (where zero codes for the absence of a stimulus).
+    tplVslSpcSze : tuple
+        Pixel size (x, y) at which apertures are sampled.
+
+    Returns
+    -------
+    aryApt : np.array
+        3D numpy array with the unique apertures that were presented together
+        with a stimulus feature, at np.int8 precision, with shape
+        aryApt[aperture, x-position, y-position].
+    vecApt : np.array
+        1D array with the index of the aperture (in `aryApt`) presented on each
+        volume, with shape vecApt[volume]. Not defined (zero) for volumes
+        without stimulus.
+    vecFtr : np.array
+        1D array with the stimulus feature (e.g. motion direction) presented on
+        each volume, with shape vecFtr[volume]. Zero codes for the absence of a
+        stimulus.
+
+    Notes
+    -----
+    The apertures are oriented and resampled in the same way as the frames
+    that are created with `motion_log.py` and loaded with `load_png`, so that
+    the design matrix `aryApt[vecApt[t], :, :] * (vecFtr[t] == idxFtr)` is the
+    same as the pixel-wise design matrix created with `load_png` and
+    `append_features`. However, each aperture is only represented once (and
+    not once per volume).
+    """
+    # List for arrays with design matrices of all runs:
+    lstCnd = []
+
+    # Load design matrices (aperture index and motion direction) from pickle
+    # files:
+    for strTmp in lstDsgn:
+        with open(strTmp, 'rb') as objPckl:
+            try:
+                # The pickles were created with python 2. When loading them
+                # with python 3, the encoding needs to be specified:
+                dicDsgn = pickle.load(objPckl, encoding='latin1')
+            except TypeError:
+                # Python 2:
+                dicDsgn = pickle.load(objPckl)
+        lstCnd.append(dicDsgn['Conditions'])
+
+    # Concatenate design matrices from all runs:
+    aryCnd = np.vstack(lstCnd)
+
+    # It is assumed that apertures and features are coded in integer format:
+    vecAptAll = aryCnd[:, 0].astype(np.int32)
+    vecFtr = aryCnd[:, 1].astype(np.int32)
+
+    # Only apertures that were presented together with a stimulus feature are
+    # relevant (zero codes for absence of stimulus):
+    vecLgcStim = np.greater(vecFtr, 0)
+
+    # Indices of unique apertures (with respect to the mask array), and index
+    # of the unique aperture on each volume:
+    vecAptUnq, vecAptInv = np.unique(vecAptAll[vecLgcStim],
+                                     return_inverse=True)
+
+    # Aperture index on each volume, with respect to the unique apertures:
+    vecApt = np.zeros(vecFtr.shape, dtype=np.int32)
+    vecApt[vecLgcStim] = vecAptInv
+
+    # Load mask array (as in `MotionLog.loadMsk`, the last array in the npz
+    # file is used):
+    with np.load(strPathMsk) as objMsks:
+        aryMsk = objMsks[objMsks.files[-1]].astype(np.int8)
+
+    # As in `motion_log.py`, the mask array needs to be flipped in order to
+    # have the same orientation as the stimuli on the screen during the
+    # experiment:
+    aryMsk = np.flipud(aryMsk)
+
+    # Array for unique apertures:
+    aryApt = np.zeros((vecAptUnq.shape[0],
+                       tplVslSpcSze[0],
+                       tplVslSpcSze[1]), dtype=np.int8)
+
+    # Loop through unique apertures:
+    for idxApt in range(vecAptUnq.shape[0]):
+
+        # Resize aperture in the same way as the PNG files in `load_png`:
+        objIm = Image.fromarray(
+            np.multiply(aryMsk[:, :, vecAptUnq[idxApt]].astype(np.uint8),
+                        255).astype(np.uint8))
+        objIm = objIm.resize((tplVslSpcSze[0],
+                              tplVslSpcSze[1]),
+                             resample=Image.NEAREST)
+        aryTmp = np.array(objIm.getdata()).reshape(objIm.size[0],
+                                                   objIm.size[1])
+
+        # Convert RGB values (0 to 255) to integer ones and zeros:
+        aryApt[idxApt, :, :] = (aryTmp > 200).astype(np.int8)
+
+    return aryApt, vecApt, vecFtr
+
+
+def crt_dsgn_apt(vecApt, vecFtr, varNumApt, varTr, vecRunLen=None):
+    """
+    Create HRF-convolved design matrix for each aperture and feature.
+
+    Parameters
+    ----------
+    vecApt : np.array
+        1D array with the index of the aperture presented on each volume, with
+        shape vecApt[volume].
+    vecFtr : np.array
+        1D array with the stimulus feature (e.g. motion direction) presented on
+        each volume, with shape vecFtr[volume]. Zero codes for the absence of a
+        stimulus.
+    varNumApt : int
+        Number of unique apertures.
+    varTr : float
+        Volume TR of functional data (needed for convolution of timecourses
+        with haemodynamic response function).
+    vecRunLen : list or None
+        Number of volumes of each run. If provided, the HRF convolution is
+        restarted at the beginning of each run. If None, all volumes are
+        treated as one run.
+
+    Returns
+    -------
+    aryDsgnConv : np.array
+        3D numpy array with HRF-convolved time courses of the occurence of each
+        combination of feature and aperture, with shape aryDsgnConv[feature,
+        aperture, time].
+
+    Notes
+    -----
+    The time course of a pRF model for a given feature is the overlap of the
+    pRF with each aperture, multiplied with the time course of the occurence
+    of the aperture together with the feature, summed over apertures. Because
+    the convolution with the HRF is linear, it can be applied to the
+    aperture time courses (instead of the pixel time courses). As in
+    `append_features`, the features are numbered from one, i.e. feature code
+    `idxFtr` corresponds to `aryDsgnConv[(idxFtr - 1), :, :]`.
+    """
+    # Number of volumes:
+    varNumVol = vecFtr.shape[0]
+
+    # Get number of non-zero unique values in feature-design-matrix (non-zeros
+    # because zero represents the absence of a sitmulus).
+    varNumFtr = np.nonzero(np.unique(vecFtr))[0].shape[0]
+
+    # Boxcar time courses of the occurence of each combination of feature and
+    # aperture. Each volume with a stimulus is represented by a one at the
+    # position given by its feature code and aperture index (as in
+    # `append_features`, features are assumed to be coded from one to the
+    # number of features):
+    aryBox = np.zeros((varNumFtr, varNumApt, varNumVol), dtype=np.float32)
+    vecLgcStim = np.logical_and(np.greater(vecFtr, 0),
+                                np.less_equal(vecFtr, varNumFtr))
+    aryBox[(vecFtr[vecLgcStim] - 1),
+           vecApt[vecLgcStim],
+           np.arange(varNumVol)[vecLgcStim]] = 1.0
+
+    # Create 'canonical' HRF time course model:
+    vecHrf = crt_hrf(varNumVol, varTr)
+
+    # Convolve time courses with HRF model (all combinations of feature and
+    # aperture at once):
+    aryDsgnConv = np.reshape(
+        conv_tc(np.reshape(aryBox, ((varNumFtr * varNumApt), varNumVol)),
+                vecHrf,
+                vecRunLen=vecRunLen),
+        aryBox.shape)
+
+    return aryDsgnConv
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Create tiles of pRF model time courses on demand during model fitting."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from utilities import crt_gauss_1d
+from shared_arrays import shm_put
+from shared_arrays import shm_get
+
+
+class MdlLzy(object):
+    """
+    Handle of pRF models that are created on demand, one tile at a time.
+
+    Notes
+    -----
+    Instead of the pRF model time courses, only the compact representation of
+    the stimulus (the unique stimulus apertures, and the preprocessed time
+    courses of the apertures) and the parameter grid are stored. The handle
+    can be passed to the fitting functions instead of the model time courses;
+    the fitting functions create one tile of models at a time (see
+    `lzy_tile`), fit it to their voxels, and discard it. Thus, the full array
+    of model time courses is never created, neither in memory nor on disk.
+
+    The apertures and aperture time courses are placed in shared memory, so
+    that they are not copied into each parallel process.
+    """
+
+    def __init__(self, aryApt, aryDsgnPre, vecX, vecY, vecPrfSd):
+        """
+        Initialise handle of pRF models that are created on demand.
+
+        Parameters
+        ----------
+        aryApt : np.array
+            3D numpy array with unique apertures, with shape aryApt[aperture,
+            x-position, y-position] (see `load_apertures`).
+        aryDsgnPre : np.array
+            3D numpy array with HRF-convolved and preprocessed time courses of
+            the occurence of each combination of feature and aperture (scaled
+            in the same way as the model time courses used for fitting), with
+            shape aryDsgnPre[feature, aperture, time].
+        vecX : np.array
+            1D array with x-positions of the pRF models (in pixels of the
+            upsampled visual space, rounded to integers).
+        vecY : np.array
+            1D array with y-positions of the pRF models (in pixels of the
+            upsampled visual space, rounded to integers).
+        vecPrfSd : np.array
+            1D array with sizes of the pRF models (in pixels of the upsampled
+            visual space, rounded to integers).
+        """
+        # Apertures & aperture time courses (in shared memory):
+        self.apt = shm_put(aryApt.astype(np.float32))
+        self.dsgn = shm_put(aryDsgnPre.astype(np.float32))
+
+        # Parameter grid (in pixels):
+        self.x = np.array(vecX, dtype=np.float64)
+        self.y = np.array(vecY, dtype=np.float64)
+        self.sd = np.array(vecPrfSd, dtype=np.float64)
+
+        # Shape of the (virtual) array of model time courses, aryPrfTc[
+        # x-position, y-position, SD, time, feature], as for a model bank:
+        self.shape = (self.x.shape[0],
+                      self.y.shape[0],
+                      self.sd.shape[0],
+                      aryDsgnPre.shape[2],
+                      aryDsgnPre.shape[0])
+
+        # Overlaps of the Gaussians along the second pixel dimension with the
+        # apertures, for the x-position of the most recently created tile
+        # (only used within the process that creates the tiles):
+        self.cache = (None, {})
+
+
+def lzy_tile(objLzy, varBlkSrt, varBlkEnd):
+    """
+    Create the time courses of a tile of consecutive pRF models.
+
+    Parameters
+    ----------
+    objLzy : MdlLzy
+        Handle of pRF models that are created on demand.
+    varBlkSrt : int
+        Index of the first model of the tile.
+    varBlkEnd : int
+        Index of the last model of the tile (plus one).
+
+    Returns
+    -------
+    aryBlk : np.array
+        Model time courses of the tile (float32), with shape aryBlk[model,
+        time, feature]. The order of the models is the same as in
+        `crt_mdl_prms` (and in a model bank).
+
+    Notes
+    -----
+    The overlap of a pRF model with an aperture is computed with separable
+    Gaussians (as in `prf_apt_par`): The aperture is first multiplied with the
+    1D Gaussian along the second pixel dimension (x-position), and then with
+    the 1D Gaussian along the first pixel dimension (y-position). The first
+    product only depends on x-position and pRF size, and is kept for the
+    x-position of the previous tile (models are ordered by x-position first,
+    so that consecutive tiles mostly share the same x-position). The model
+    time courses are the sums of the aperture time courses, weighted by the
+    overlaps. Because temporal smoothing and scaling are linear, applying them
+    to the aperture time courses gives the same result as applying them to the
+    model time courses.
+    """
+    # Apertures & aperture time courses (mapping the shared memory):
+    aryApt = shm_get(objLzy.apt)
+    aryDsgn = shm_get(objLzy.dsgn)
+
+    # Number of apertures & size of the upsampled visual space:
+    varNumApt = aryApt.shape[0]
+    varSzeDim0 = aryApt.shape[1]
+    varSzeDim1 = aryApt.shape[2]
+
+    # Number of volumes & features:
+    varNumVol = objLzy.shape[3]
+    varNumFtr = objLzy.shape[4]
+
+    # Indices of x-position, y-position and size of the models in the tile:
+    vecIdxX, vecIdxY, vecIdxSd = np.unravel_index(
+        np.arange(varBlkSrt, varBlkEnd), objLzy.shape[0:3])
+
+    # Overlap of the models in the tile with all apertures:
+    aryOvl = np.zeros(((varBlkEnd - varBlkSrt), varNumApt), dtype=np.float32)
+
+    # Loop through x-positions in the tile:
+    for idxX in np.unique(vecIdxX):
+
+        # Products of the apertures with the 1D Gaussians along the second
+        # pixel dimension are only kept for one x-position at a time:
+        if objLzy.cache[0] != idxX:
+            objLzy.cache = (idxX, {})
+        dicApt = objLzy.cache[1]
+
+        # Loop through pRF sizes at the current x-position:
+        lgcX = np.equal(vecIdxX, idxX)
+        for idxSd in np.unique(vecIdxSd[lgcX]):
+
+            # Current pRF size:
+            varTmpSd = objLzy.sd[idxSd]
+
+            # Product of all apertures with the 1D Gaussian along the second
+            # pixel dimension, with shape aryAptX[aperture, pixel]:
+            if idxSd not in dicApt:
+                vecGaussX = crt_gauss_1d(varSzeDim1,
+                                         objLzy.x[idxX:(idxX + 1)],
+                                         varTmpSd)[0, :].astype(np.float32)
+                dicApt[idxSd] = np.dot(aryApt, vecGaussX)
+
+            # Models at the current x-position and pRF size:
+            lgcTmp = np.logical_and(lgcX, np.equal(vecIdxSd, idxSd))
+
+            # 1D Gaussians along the first pixel dimension (one per
+            # y-position), including the normalisation factor of the 2D
+            # Gaussian, with shape aryGaussY[model, pixel]:
+            aryGaussY = np.divide(crt_gauss_1d(varSzeDim0,
+                                               objLzy.y[vecIdxY[lgcTmp]],
+                                               varTmpSd),
+                                  (2.0 * np.pi * np.square(varTmpSd)))
+
+            aryOvl[lgcTmp, :] = np.dot(aryGaussY.astype(np.float32),
+                                       dicApt[idxSd].T)
+
+    # Model time courses, with shape aryBlk[model, time, feature]:
+    aryBlk = np.zeros(((varBlkEnd - varBlkSrt), varNumVol, varNumFtr),
+                      dtype=np.float32)
+    for idxFtr in range(varNumFtr):
+        aryBlk[:, :, idxFtr] = np.dot(aryOvl, aryDsgn[idxFtr, :, :])
+
+    return aryBlk
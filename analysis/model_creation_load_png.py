@@ -21,6 +21,35 @@ import numpy as np
 from PIL import Image
 
 
+def lst_png(varNumVol, strPathPng, varStrtIdx=0, varZfill=3):
+    """
+    Create list of paths of PNG files.
+
+    Parameters
+    ----------
+    varNumVol : int
+        Number of PNG files.
+    strPathPng : str
+        Parent directory of PNG files (see `load_png`).
+    varStrtIdx : int
+        Start index of PNG files.
+    varZfill : int
+        Zero padding of PNG file names.
+
+    Returns
+    -------
+    lstPngPaths : list
+        List with paths of PNG files, in the order of their presentation.
+    """
+    lstPngPaths = [None] * varNumVol
+    for idx01 in range(0, varNumVol):
+        lstPngPaths[idx01] = (strPathPng
+                              + str(idx01 + varStrtIdx).zfill(varZfill)
+                              + '.png')
+
+    return lstPngPaths
+
+
 def load_png(varNumVol, strPathPng, tplVslSpcSze=(200, 200), varStrtIdx=0,
              varZfill=3):
     """
@@ -57,11 +86,8 @@ def load_png(varNumVol, strPathPng, tplVslSpcSze=(200, 200), varStrtIdx=0,
     Part of py_pRF_mapping library.
     """
     # Create list of png files to load:
-    lstPngPaths = [None] * varNumVol
-    for idx01 in range(0, varNumVol):
-        lstPngPaths[idx01] = (strPathPng
-                              + str(idx01 + varStrtIdx).zfill(varZfill)
-                              + '.png')
+    lstPngPaths = lst_png(varNumVol, strPathPng, varStrtIdx=varStrtIdx,
+                          varZfill=varZfill)
 
     # The png data will be saved in a numpy array of the following order:
     # aryPngData[x-pixel, y-pixel, PngNumber].
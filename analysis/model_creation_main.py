@@ -17,12 +17,29 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import hashlib
 import numpy as np
 import nibabel as nb
+from model_creation_load_png import lst_png
 from model_creation_load_png import load_png
 from model_creation_pixelwise import conv_dsgn_mat
 from model_creation_timecourses import crt_prf_tcmdl
+from model_creation_timecourses_sep import crt_prf_tcmdl_sep
 from model_creation_features import append_features
+from model_creation_apertures import load_apertures
+from model_creation_apertures import crt_dsgn_apt
+from model_creation_timecourses_apt import crt_prf_tcmdl_apt
+from model_creation_timecourses import crt_prf_grid
+from model_creation_lazy import MdlLzy
+from preprocessing_main import pre_pro_models
+from cache import cch_call
+from cache import cch_hash
+from cache import cch_src
+from model_bank import MdlBnk
+from model_bank import bnk_create
+from model_bank import bnk_finalise
+from model_bank import bnk_chk
 
 import config as cfg
 
@@ -41,18 +58,103 @@ def model_creation():
         4D numpy array with pRF time course models, with following dimensions:
         `aryPrfTc[x-position, y-position, SD, volume]`.
     """
-    if cfg.lgcCrteMdl:  #noqa
+    # Parameters of the pRF model grid (the same for all methods of model
+    # creation):
+    dicGrd = {'tplVslSpcSze': cfg.tplVslSpcSze,
+              'varNumX': cfg.varNumX,
+              'varNumY': cfg.varNumY,
+              'varExtXmin': cfg.varExtXmin,
+              'varExtXmax': cfg.varExtXmax,
+              'varExtYmin': cfg.varExtYmin,
+              'varExtYmax': cfg.varExtYmax,
+              'varPrfStdMin': cfg.varPrfStdMin,
+              'varPrfStdMax': cfg.varPrfStdMax,
+              'varNumPrfSizes': cfg.varNumPrfSizes,
+              'varPar': cfg.varPar}
+
+    # The results of all stages of model creation are stored in an on-disk
+    # cache (if `cfg.strDirCch` is not None), keyed by a hash of the inputs
+    # and parameters of the stage. Only stages whose inputs have changed since
+    # a previous run are recomputed (see `cch_call`).
+
+    if cfg.lgcCrteMdl and (cfg.strMdlCrt == 'aperture'):  #noqa
+
+        # *********************************************************************
+        # *** Load unique stimulus apertures
+
+        print('------Load unique stimulus apertures')
+
+        # Unique apertures (aryApt[aperture, x-position, y-position]), and
+        # index of aperture and stimulus feature (e.g. motion direction) on
+        # each volume:
+        aryApt, vecApt, vecFtr = cch_call(cfg.strDirCch,
+                                          'apertures',
+                                          load_apertures,
+                                          (cfg.strShpe,
+                                           cfg.lstDsgn,
+                                           cfg.tplVslSpcSze),
+                                          varCchMax=cfg.varCchMax)
+
+        # The design matrix needs to have the same number of volumes as the
+        # functional data:
+        if vecFtr.shape[0] != cfg.varNumVol:
+            # Error message:
+            strErrMsg = ('---Error: Number of volumes in design matrix ('
+                         + str(vecFtr.shape[0]) + ') does not agree with '
+                         + 'specified number of volumes.')
+            raise ValueError(strErrMsg)
+        # *********************************************************************
+
+        # *********************************************************************
+        # *** Convolve aperture time courses with HRF model
+
+        print('------Convolve aperture time courses with HRF model')
+
+        aryDsgnConv = crt_dsgn_apt(vecApt,
+                                   vecFtr,
+                                   aryApt.shape[0],
+                                   cfg.varTr,
+                                   vecRunLen=cfg.lstRunLen)
+        # *********************************************************************
+
+        # *********************************************************************
+        # *** Create pRF time courses models
+
+        print('------Create pRF time course models')
+
+        aryPrfTc, lgcHit = cch_call(cfg.strDirCch,
+                                    'models_aperture',
+                                    crt_prf_tcmdl_apt,
+                                    (aryApt, aryDsgnConv),
+                                    dicGrd,
+                                    varCchMax=cfg.varCchMax,
+                                    lgcHit=True)
+        # *********************************************************************
+
+    elif cfg.lgcCrteMdl:
 
         # *********************************************************************
         # *** Load stimulus information from PNG files
 
         print('------Load stimulus information from PNG files')
 
-        aryPngData = load_png(cfg.varNumVol,
+        # The PNG files are not passed as arguments, so they are passed to the
+        # cache separately (in order to detect changes of the files):
+        lstPngPaths = lst_png(cfg.varNumVol,
                               cfg.strPathPng,
-                              cfg.tplVslSpcSze,
                               varStrtIdx=cfg.varStrtIdx,
                               varZfill=cfg.varZfill)
+
+        aryPngData = cch_call(cfg.strDirCch,
+                              'png',
+                              load_png,
+                              (cfg.varNumVol,
+                               cfg.strPathPng,
+                               cfg.tplVslSpcSze),
+                              {'varStrtIdx': cfg.varStrtIdx,
+                               'varZfill': cfg.varZfill},
+                              lstFls=lstPngPaths,
+                              varCchMax=cfg.varCchMax)
         # *********************************************************************
 
         # *********************************************************************
@@ -63,57 +165,101 @@ def model_creation():
         # Additional stimulus feature dimension is added to the pixel-wise
         # design matrix, now of shape aryPngDataFtr[feature, x-position,
         # y-position, time] at int8 precision.
-        aryPngData = append_features(aryPngData,
-                                     cfg.lstDsgn)
-        # *********************************************************************
-
-        # *********************************************************************
-        # *** Convolve pixel-wise design matrix with HRF model
-
-        print('------Convolve pixel-wise design matrix with HRF model')
-
-        aryPixConv = conv_dsgn_mat(aryPngData,
-                                   cfg.varTr,
-                                   cfg.varPar)
-
-        del(aryPngData)
-
-        # Debugging feature:
-        # np.save('/home/john/Desktop/aryPixConv.npy', aryPixConv)
+        aryPngData = cch_call(cfg.strDirCch,
+                              'features',
+                              append_features,
+                              (aryPngData,
+                               cfg.lstDsgn),
+                              varCchMax=cfg.varCchMax)
         # *********************************************************************
 
         # *********************************************************************
         # *** Create pRF time courses models
 
-        print('------Create pRF time course models')
-
-        aryPrfTc = crt_prf_tcmdl(aryPixConv,
-                                 cfg.strDirHdf,
-                                 tplVslSpcSze=cfg.tplVslSpcSze,
-                                 varNumX=cfg.varNumX,
-                                 varNumY=cfg.varNumY,
-                                 varExtXmin=cfg.varExtXmin,
-                                 varExtXmax=cfg.varExtXmax,
-                                 varExtYmin=cfg.varExtYmin,
-                                 varExtYmax=cfg.varExtYmax,
-                                 varPrfStdMin=cfg.varPrfStdMin,
-                                 varPrfStdMax=cfg.varPrfStdMax,
-                                 varNumPrfSizes=cfg.varNumPrfSizes,
-                                 varPar=cfg.varPar)
+        if cfg.strMdlCrt == 'separable':
+
+            print('------Create pRF time course models')
+
+            # All x- and y-positions of a pRF size at once, using separable
+            # Gaussians. The HRF convolution is applied within the model
+            # creation (either to the pixel time courses of one feature at a
+            # time, or to the model time courses), so that the float32
+            # HRF-convolved design matrix of all features is never created:
+            dicTmp = dict(dicGrd)
+            dicTmp.update({'varTr': cfg.varTr,
+                           'strConvOrd': cfg.strConvOrd,
+                           'vecRunLen': cfg.lstRunLen})
+            aryPrfTc, lgcHit = cch_call(cfg.strDirCch,
+                                        'models_separable',
+                                        crt_prf_tcmdl_sep,
+                                        (aryPngData,),
+                                        dicTmp,
+                                        varCchMax=cfg.varCchMax,
+                                        lgcHit=True,
+                                        lstIgn=('varPar', 'strConvOrd'))
+
+            del(aryPngData)
+
+        elif cfg.strMdlCrt == 'pixelwise':
+
+            # *****************************************************************
+            # *** Convolve pixel-wise design matrix with HRF model
+
+            print('------Convolve pixel-wise design matrix with HRF model')
+
+            aryPixConv = cch_call(cfg.strDirCch,
+                                  'pixconv',
+                                  conv_dsgn_mat,
+                                  (aryPngData,
+                                   cfg.varTr),
+                                  {'varPar': cfg.varPar,
+                                   'vecRunLen': cfg.lstRunLen},
+                                  varCchMax=cfg.varCchMax)
+
+            del(aryPngData)
+
+            # Debugging feature:
+            # np.save('/home/john/Desktop/aryPixConv.npy', aryPixConv)
+            # *****************************************************************
+
+            print('------Create pRF time course models')
+
+            # One 2D Gaussian per model:
+            aryPrfTc, lgcHit = cch_call(cfg.strDirCch,
+                                        'models_pixelwise',
+                                        crt_prf_tcmdl,
+                                        (aryPixConv,),
+                                        dicGrd,
+                                        varCchMax=cfg.varCchMax,
+                                        lgcHit=True)
+
+        else:
+            # Error message:
+            strErrMsg = ('---Error: Unknown method for pRF time course model '
+                         + 'creation: ' + str(cfg.strMdlCrt))
+            raise ValueError(strErrMsg)
         # *********************************************************************
 
+    if cfg.lgcCrteMdl:
+
         # *********************************************************************
         # *** Save pRF time course models
 
-        print('------Save pRF time course models to disk')
+        # If the models were loaded from the cache, they have been saved
+        # before (unless the file has been removed in the meantime):
+        if (not lgcHit) or (not os.path.isfile(cfg.strPathMdl + '.npy')):
 
-        # Save the 4D array as '*.npy' file:
-        np.save(cfg.strPathMdl,
-                aryPrfTc)
+            print('------Save pRF time course models to disk')
 
-        # Save 4D array as '*.nii' file (for debugging purposes):
-        niiPrfTc = nb.Nifti1Image(np.max(aryPrfTc, axis=0), np.eye(4))
-        nb.save(niiPrfTc, cfg.strPathMdl)
+            # Save the 4D array as '*.npy' file:
+            np.save(cfg.strPathMdl,
+                    aryPrfTc)
+
+            # Save 4D array as '*.nii' file (for debugging purposes):
+            if cfg.lgcMdlNii:
+                niiPrfTc = nb.Nifti1Image(np.max(aryPrfTc, axis=0),
+                                          np.eye(4))
+                nb.save(niiPrfTc, cfg.strPathMdl)
         # *********************************************************************
 
     else:
@@ -123,8 +269,11 @@ def model_creation():
 
         print('------Load pRF time course models from disk')
 
-        # Load the file:
-        aryPrfTc = np.load((cfg.strPathMdl + '.npy'))
+        # Load the file. The file is memory-mapped (copy-on-write), so that
+        # only the parts of the models that are accessed are read into memory
+        # (e.g. if the preprocessed models are written into a model bank file
+        # one feature at a time, see `model_bank.py`):
+        aryPrfTc = np.load((cfg.strPathMdl + '.npy'), mmap_mode='c')
 
         # Check whether pRF time course model matrix has the expected
         # dimensions:
@@ -149,3 +298,247 @@ def model_creation():
     # *************************************************************************
 
     return aryPrfTc
+
+
+def mdl_key():
+    """
+    Create key of the inputs from which the pRF model bank is created.
+
+    Parameters
+    ----------
+    Parameters for pRF model creation and preprocessing are imported from
+    config.py file.
+
+    Returns
+    -------
+    strKey : str
+        Hexadecimal hash of all parameters and input files that affect the
+        preprocessed pRF model time courses, and of the source code of the
+        modules that create and preprocess them.
+    """
+    objHsh = hashlib.sha1()
+
+    # Parameters of model creation & preprocessing (the number of parallel
+    # processes does not affect the models):
+    dicPrm = {'lgcCrteMdl': cfg.lgcCrteMdl,
+              'tplVslSpcSze': cfg.tplVslSpcSze,
+              'varNumX': cfg.varNumX,
+              'varNumY': cfg.varNumY,
+              'varExtXmin': cfg.varExtXmin,
+              'varExtXmax': cfg.varExtXmax,
+              'varExtYmin': cfg.varExtYmin,
+              'varExtYmax': cfg.varExtYmax,
+              'varPrfStdMin': cfg.varPrfStdMin,
+              'varPrfStdMax': cfg.varPrfStdMax,
+              'varNumPrfSizes': cfg.varNumPrfSizes,
+              'varNumVol': cfg.varNumVol,
+              'varSdSmthTmp': float(cfg.varSdSmthTmp)}
+
+    if cfg.lgcCrteMdl:
+        dicPrm.update({'strMdlCrt': cfg.strMdlCrt,
+                       'varTr': cfg.varTr,
+                       'lstRunLen': cfg.lstRunLen,
+                       'lstDsgn': cfg.lstDsgn})
+        if cfg.strMdlCrt == 'aperture':
+            dicPrm['strShpe'] = cfg.strShpe
+        else:
+            dicPrm['lstPngPaths'] = lst_png(cfg.varNumVol,
+                                            cfg.strPathPng,
+                                            varStrtIdx=cfg.varStrtIdx,
+                                            varZfill=cfg.varZfill)
+    else:
+        # Existing models are hashed by path, size & modification time:
+        dicPrm['strPathMdl'] = cfg.strPathMdl + '.npy'
+
+    cch_hash(objHsh, dicPrm)
+
+    # Source code of the modules that create and preprocess the models, and
+    # of the modules that they use (e.g. the parallel processes, the
+    # convolution & the HRF), so that the models are recreated if the
+    # implementation changes:
+    cch_hash(objHsh, cch_src([load_png, append_features, conv_dsgn_mat,
+                              crt_prf_tcmdl, crt_prf_tcmdl_sep,
+                              load_apertures, crt_prf_tcmdl_apt,
+                              pre_pro_models, bnk_finalise]))
+
+    return objHsh.hexdigest()
+
+
+def model_bank():
+    """
+    Create fitting-ready pRF model bank, or reuse an existing one.
+
+    Parameters
+    ----------
+    Parameters for pRF model creation and preprocessing are imported from
+    config.py file.
+
+    Returns
+    -------
+    objBnk : MdlBnk
+        Handle of the model bank file (`cfg.strPathBnk`), with the
+        preprocessed pRF model time courses (scaled by 1000, float32), with
+        shape `aryPrfTc[x-position, y-position, SD, time, feature]`, and the
+        model parameters, norms and validity mask (see `bnk_finalise`).
+
+    Notes
+    -----
+    The model bank is only created if it does not exist yet, or if any of
+    the inputs from which it was created has changed (see `mdl_key`).
+    Otherwise, model fitting only needs to memory-map the existing bank, and
+    model creation, preprocessing, reordering of axes and the computation of
+    norms and validity mask are skipped.
+    """
+    # Key of the inputs of the model bank:
+    strKey = mdl_key()
+
+    if bnk_chk(cfg.strPathBnk, strKey):
+        print('------Model bank is up to date, skip model creation')
+        return MdlBnk(cfg.strPathBnk)
+
+    # Create or load pRF time course models, with shape aryPrfTc[feature,
+    # x-position, y-position, SD, time]:
+    aryPrfTc = model_creation()
+
+    print('------Write pRF time course models to model bank file')
+
+    # Number of features (e.g. motion directions):
+    varNumFtr = aryPrfTc.shape[0]
+
+    # The preprocessed pRF model time courses are written into the model bank
+    # file, one feature at a time, with the order of axes needed for model
+    # fitting (aryBnk[x-position, y-position, SD, time, feature]). Thus, the
+    # reordered and scaled model time courses are never held in memory, and
+    # the fitting functions read one tile of models at a time from the file
+    # (see `model_bank.py`).
+    aryBnk = bnk_create(cfg.strPathBnk,
+                        (aryPrfTc.shape[1],
+                         aryPrfTc.shape[2],
+                         aryPrfTc.shape[3],
+                         aryPrfTc.shape[4],
+                         varNumFtr),
+                        varDtype=np.float32)
+
+    # Loop through features:
+    for idxFtr in range(varNumFtr):
+
+        # At this point, the pRF model time course have been z-scored. In
+        # order to avoid precision problems during GLM fitting, we scale them
+        # up.
+        aryBnk[:, :, :, :, idxFtr] = np.multiply(
+            pre_pro_models(aryPrfTc[idxFtr, :],
+                           varSdSmthTmp=cfg.varSdSmthTmp,
+                           varPar=cfg.varPar),
+            1000.0)
+
+    # Write model bank to disk, and release memory:
+    aryBnk.flush()
+    del(aryBnk)
+    del(aryPrfTc)
+
+    print('------Compute norms and validity mask of models')
+
+    # Model parameters, norms & validity mask are stored with the bank, and
+    # the key is added to the index of the bank (last, so that an incomplete
+    # bank is not reused):
+    bnk_finalise(cfg.strPathBnk,
+                 np.linspace(cfg.varExtXmin, cfg.varExtXmax, cfg.varNumX,
+                             endpoint=True),
+                 np.linspace(cfg.varExtYmin, cfg.varExtYmax, cfg.varNumY,
+                             endpoint=True),
+                 np.linspace(cfg.varPrfStdMin, cfg.varPrfStdMax,
+                             cfg.varNumPrfSizes, endpoint=True),
+                 strKey)
+
+    return MdlBnk(cfg.strPathBnk)
+
+
+def model_lazy():
+    """
+    Prepare pRF models that are created on demand during model fitting.
+
+    Parameters
+    ----------
+    Parameters for pRF model creation and preprocessing are imported from
+    config.py file.
+
+    Returns
+    -------
+    objLzy : MdlLzy
+        Handle of the pRF models, that can be passed to the fitting functions
+        instead of the model time courses (see `model_creation_lazy.py`).
+
+    Notes
+    -----
+    Only the unique stimulus apertures and the time courses of the apertures
+    are created here. The time courses of the apertures are convolved with
+    the HRF, preprocessed (temporal smoothing) and scaled in the same way as
+    the pRF model time courses, so that the models that are created from them
+    during fitting are the same as the models in a model bank.
+    """
+    # The models are created from the unique stimulus apertures:
+    if (not cfg.lgcCrteMdl) or (cfg.strMdlCrt != 'aperture'):
+        # Error message:
+        strErrMsg = ('---Error: Creating pRF models on demand requires '
+                     + 'lgcCrteMdl = True and strMdlCrt = \'aperture\'.')
+        raise ValueError(strErrMsg)
+
+    print('------Load unique stimulus apertures')
+
+    aryApt, vecApt, vecFtr = cch_call(cfg.strDirCch,
+                                      'apertures',
+                                      load_apertures,
+                                      (cfg.strShpe,
+                                       cfg.lstDsgn,
+                                       cfg.tplVslSpcSze),
+                                      varCchMax=cfg.varCchMax)
+
+    # The design matrix needs to have the same number of volumes as the
+    # functional data:
+    if vecFtr.shape[0] != cfg.varNumVol:
+        # Error message:
+        strErrMsg = ('---Error: Number of volumes in design matrix ('
+                     + str(vecFtr.shape[0]) + ') does not agree with '
+                     + 'specified number of volumes.')
+        raise ValueError(strErrMsg)
+
+    print('------Convolve & preprocess aperture time courses')
+
+    # HRF-convolved aperture time courses, with shape aryDsgnConv[feature,
+    # aperture, time]:
+    aryDsgnConv = crt_dsgn_apt(vecApt,
+                               vecFtr,
+                               aryApt.shape[0],
+                               cfg.varTr,
+                               vecRunLen=cfg.lstRunLen)
+
+    # Temporal smoothing and scaling are linear, so they can be applied to
+    # the aperture time courses instead of the model time courses (the
+    # preprocessing function expects a 4D array):
+    tplShp = aryDsgnConv.shape
+    aryDsgnConv = np.multiply(
+        pre_pro_models(np.reshape(aryDsgnConv,
+                                  ((tplShp[0] * tplShp[1]), 1, 1, tplShp[2])),
+                       varSdSmthTmp=cfg.varSdSmthTmp,
+                       varPar=1),
+        1000.0)
+    aryDsgnConv = np.reshape(aryDsgnConv, tplShp)
+
+    # Positions and sizes of the pRF models, in units of the upsampled visual
+    # space (rounded to integer pixels, as in `crt_prf_tcmdl_apt`):
+    vecX, vecY, vecPrfSd = crt_prf_grid(tplVslSpcSze=cfg.tplVslSpcSze,
+                                        varNumX=cfg.varNumX,
+                                        varNumY=cfg.varNumY,
+                                        varExtXmin=cfg.varExtXmin,
+                                        varExtXmax=cfg.varExtXmax,
+                                        varExtYmin=cfg.varExtYmin,
+                                        varExtYmax=cfg.varExtYmax,
+                                        varPrfStdMin=cfg.varPrfStdMin,
+                                        varPrfStdMax=cfg.varPrfStdMax,
+                                        varNumPrfSizes=cfg.varNumPrfSizes)
+
+    return MdlLzy(aryApt,
+                  aryDsgnConv,
+                  np.around(vecX, 0),
+                  np.around(vecY, 0),
+                  np.around(vecPrfSd, 0))
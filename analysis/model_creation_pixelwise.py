@@ -21,9 +21,13 @@ import numpy as np
 import multiprocessing as mp
 from model_creation_pixelwise_par import conv_par
 from utilities import crt_hrf
+from shared_arrays import shm_put
+from shared_arrays import shm_get
+from shared_arrays import shm_alloc
+from shared_arrays import shm_chunk
 
 
-def conv_dsgn_mat(aryPngData, varTr, varPar=10):
+def conv_dsgn_mat(aryPngData, varTr, varPar=10, vecRunLen=None):
     """
     Convolve pixel-wise design matrix.
 
@@ -38,6 +42,11 @@ def conv_dsgn_mat(aryPngData, varTr, varPar=10):
         with haemodynamic response function).
     varPar : int
         Number of processes to run in parallel (multiprocessing).
+    vecRunLen : list or None
+        Number of volumes of each run. If provided, the HRF convolution is
+        restarted at the beginning of each run, so that the response to
+        stimuli at the end of a run does not spill over into the next run. If
+        None, all volumes are treated as one run.
 
     Returns
     -------
@@ -67,6 +76,10 @@ def conv_dsgn_mat(aryPngData, varTr, varPar=10):
     # be put:
     lstParData = [None] * varPar
 
+    # List into which the corresponding chunks of the output array will be
+    # put:
+    lstParOut = [None] * varPar
+
     # Number of data points (features * pixels):
     varNumPnt = aryPngData.shape[0] * aryPngData.shape[1] * aryPngData.shape[2]
 
@@ -82,27 +95,33 @@ def conv_dsgn_mat(aryPngData, varTr, varPar=10):
                               endpoint=False)
     vecIdxChnks = np.hstack((vecIdxChnks, varNumPnt))
 
-    # Put input data into chunks:
+    # Place input data in shared memory:
+    aryPngData = shm_put(aryPngData)
+
+    # Shared output array, into which the parallel processes write the
+    # convolved pixel time courses:
+    aryPixConv = shm_alloc((varNumPnt, varNumVol), np.float32)
+
+    # Put input data into chunks (the chunks refer to the shared memory, the
+    # data is not copied):
     for idxChnk in range(0, varPar):
         # Index of first voxel to be included in current chunk:
         varTmpChnkSrt = int(vecIdxChnks[idxChnk])
         # Index of last voxel to be included in current chunk:
         varTmpChnkEnd = int(vecIdxChnks[(idxChnk+1)])
         # Put voxel array into list:
-        lstParData[idxChnk] = aryPngData[varTmpChnkSrt:varTmpChnkEnd, :]
+        lstParData[idxChnk] = shm_chunk(aryPngData, varTmpChnkSrt,
+                                        varTmpChnkEnd)
+        # Corresponding chunk of the output array:
+        lstParOut[idxChnk] = shm_chunk(aryPixConv, varTmpChnkSrt,
+                                       varTmpChnkEnd)
 
     # We don't need the original array with the input data anymore:
     del(aryPngData)
 
-    # Create a queue to put the results in:
-    queOut = mp.Queue()
-
     # Empty list for processes:
     lstPrcs = [None] * varPar
 
-    # Empty list for results of parallel processes:
-    lstRes = [None] * varPar
-
     # print('---------Creating parallel processes')
 
     # Create processes:
@@ -111,7 +130,8 @@ def conv_dsgn_mat(aryPngData, varTr, varPar=10):
                                      args=(idxPrc,
                                            lstParData[idxPrc],
                                            vecHrf,
-                                           queOut)
+                                           lstParOut[idxPrc],
+                                           vecRunLen)
                                      )
 
         # Daemon (kills processes when exiting):
@@ -121,41 +141,24 @@ def conv_dsgn_mat(aryPngData, varTr, varPar=10):
     for idxPrc in range(0, varPar):
         lstPrcs[idxPrc].start()
 
-    # Collect results from queue:
-    for idxPrc in range(0, varPar):
-        lstRes[idxPrc] = queOut.get(True)
-
     # Join processes:
     for idxPrc in range(0, varPar):
         lstPrcs[idxPrc].join()
 
-    # print('---------Collecting results from parallel processes')
-
-    # Create list for vectors with results from parallel processes, in order to
-    # put the results into the correct order:
-    lstPixConv = [None] * varPar
-
-    # Put output into correct order:
-    for idxRes in range(0, varPar):
-
-        # Index of results (first item in output list):
-        varTmpIdx = lstRes[idxRes][0]
-
-        # Put fitting results into list, in correct order:
-        lstPixConv[varTmpIdx] = lstRes[idxRes][1]
-
-    # Concatenate convolved pixel time courses (into the same order as they
-    # were entered into the analysis):
-    aryPixConv = np.zeros(0)
-    for idxRes in range(0, varPar):
-        aryPixConv = np.append(aryPixConv, lstPixConv[idxRes])
-
-    # Delete unneeded large objects:
-    # del(lstRes)
-    # del(lstPixConv)
-
+    # The results are only complete if all processes have finished
+    # successfully:
+    for idxPrc in range(0, varPar):
+        if lstPrcs[idxPrc].exitcode != 0:
+            # Error message:
+            strErrMsg = ('---Error: Parallel process ' + str(idxPrc)
+                         + ' did not finish successfully (exit code '
+                         + str(lstPrcs[idxPrc].exitcode) + ').')
+            raise ValueError(strErrMsg)
+
+    # The convolved pixel time courses have been written into the shared
+    # output array (in the same order as they were entered into the analysis).
     # Reshape results:
-    aryPixConv = np.reshape(aryPixConv, tplSze)
+    aryPixConv = np.reshape(shm_get(aryPixConv), tplSze)
 
     # Return:
     return aryPixConv
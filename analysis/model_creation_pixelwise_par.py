@@ -17,10 +17,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import numpy as np
+from shared_arrays import shm_get
+from convolution import conv_tc
 
 
-def conv_par(idxPrc, aryPngData, vecHrf, queOut):
+def conv_par(idxPrc, aryPngData, vecHrf, aryOut, vecRunLen=None):
     """
     Parallelised convolution of pixel-wise design matrix.
 
@@ -30,68 +31,33 @@ def conv_par(idxPrc, aryPngData, vecHrf, queOut):
         Process index (this function can be called in parallel, and the process
         index can be used to identify which return value belongs to which
         process).
-    aryPngData : np.array
+    aryPngData : np.array or ShmArray
         2D numpy array with the following structure: `aryPngData[(feature
-        * x-pixel-index * y-pixel-index), PngNumber]`
+        * x-pixel-index * y-pixel-index), PngNumber]`. Can be placed in shared
+        memory (see `shared_arrays.py`).
     vecHrf : np.array
         1D numpy array with HRF time course model.
-    queOut : multiprocessing.queues.Queue
-        Queue to put the results on.
-
-    Returns
-    -------
-    lstOut : list
-        List containing the following objects:
-        idxPrc : int
-            Process ID of the process calling this function (for CPU
-            multi-threading). In GPU version, this parameter is 0.
-        aryPixConv : np.array
-            Numpy array containing convolved design matrix. Dimensionality:
-            `aryPixConv[(feature * x-pixel-index * y-pixel-index), PngNumber]`.
-            Same shape as input (`aryPngData`).
+    aryOut : ShmArray
+        Shared output array (chunk corresponding to `aryPngData`), into which
+        the convolved design matrix is written. Dimensionality:
+        `aryOut[(feature * x-pixel-index * y-pixel-index), PngNumber]`.
+    vecRunLen : list or None
+        Number of volumes of each run. If provided, the HRF convolution is
+        restarted at the beginning of each run. If None, all volumes are
+        treated as one run.
 
     Notes
     -----
-    The list with results is not returned directly, but placed on a
-    multiprocessing queue.
-
-    Notes
-    ---
-    The pixel-wise design matrix is convolved with an HRF model.
+    The pixel-wise design matrix is convolved with an HRF model. The results
+    are not returned, but written into the shared output array.
     """
-    # Array for function output (convolved pixel-wise time courses):
-    aryPixConv = np.zeros(np.shape(aryPngData), dtype=np.float32)
-
-    # Explicity typing:
-    vecHrf = vecHrf.astype(np.float32)
-
-    # Number of volumes:
-    varNumVol = aryPngData.shape[1]
-
-    # Each pixel time course is convolved with the HRF separately, because the
-    # numpy convolution function can only be used on one-dimensional data.
-    # Thus, we have to loop through pixels:
-    for idxPix in range(0, aryPngData.shape[0]):
-
-        # Extract the current pixel time course:
-        vecDm = aryPngData[idxPix, :].astype(np.float32)
-
-        # In order to avoid an artefact at the end of the time series, we have
-        # to concatenate an empty array to both the design matrix and the HRF
-        # model before convolution.
-        vecZeros = np.zeros([100, 1], dtype=np.float32).flatten()
-        vecDm = np.concatenate((vecDm, vecZeros))
-        vecHrf = np.concatenate((vecHrf, vecZeros))
-
-        # Convolve design matrix with HRF model:
-        aryPixConv[idxPix, :] = np.convolve(vecDm,
-                                            vecHrf,
-                                            mode='full'
-                                            )[0:varNumVol].astype(np.float32)
+    # The input data may have been placed in shared memory:
+    aryPngData = shm_get(aryPngData)
 
-    # Create list containing the convolved pixel-wise timecourses, and the
-    # process ID:
-    lstOut = [idxPrc, aryPixConv]
+    # Array for function output (convolved pixel-wise time courses), mapping
+    # the shared memory:
+    aryPixConv = shm_get(aryOut)
 
-    # Put output to queue:
-    queOut.put(lstOut)
+    # Convolve all pixel time courses of this chunk with the HRF model (see
+    # `conv_tc`):
+    aryPixConv[:, :] = conv_tc(aryPngData, vecHrf, vecRunLen=vecRunLen)
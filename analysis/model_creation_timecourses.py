@@ -18,32 +18,31 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
-import multiprocessing as mp
 from model_creation_timecourses_par import prf_par
-
-
-def crt_prf_tcmdl(aryPixConv, strDirHdf, tplVslSpcSze=(200, 200), varNumX=40,  #noqa
-                  varNumY=40, varExtXmin=-5.19, varExtXmax=5.19,
-                  varExtYmin=-5.19, varExtYmax=5.19, varPrfStdMin=0.1,
-                  varPrfStdMax=7.0, varNumPrfSizes=40, varPar=10):
+from shared_arrays import shm_put
+from shared_arrays import shm_get
+from shared_arrays import shm_alloc
+from shared_arrays import shm_chunk
+from scheduler import sch_chunks
+from scheduler import sch_run
+
+
+def crt_prf_grid(tplVslSpcSze=(200, 200), varNumX=40, varNumY=40,  #noqa
+                 varExtXmin=-5.19, varExtXmax=5.19, varExtYmin=-5.19,
+                 varExtYmax=5.19, varPrfStdMin=0.1, varPrfStdMax=7.0,
+                 varNumPrfSizes=40):
     """
-    Create pRF time courses models.
+    Create positions and sizes of pRF models in the upsampled visual space.
 
     Parameters
     ----------
-    aryPixConv : np.array
-        4D numpy array containing HRF-convolved pixel-wise design matrix, with
-        shape `aryPixConv[feature, x-position, y-position, time]`.
-    strDirHdf : string
-        Path for storing hdf5 file with pRF time course models. [Ignored,
-        included for future development.]
     tplVslSpcSze : tuple
         Pixel size of visual space model in which the pRF models are created
         (x- and y-dimension).
     varNumX : int
-        Number of x-positions in the visual space to model.
+        Number of x-positions to model.
     varNumY : int
-        Number of y-positions in the visual space to model.
+        Number of y-positions to model.
     varExtXmin : float
         Extent of visual space from centre of the screen in negative
         x-direction (i.e. from the fixation point to the left end of the
@@ -68,26 +67,19 @@ def crt_prf_tcmdl(aryPixConv, strDirHdf, tplVslSpcSze=(200, 200), varNumX=40,  #
         of visual angle.
     varNumPrfSizes : int
         Number of pRF sizes to model.
-    varPar : int
-        Number of processes to run in parallel (multiprocessing).
 
     Returns
     -------
-    aryPrfTc4D : np.array
-        4D numpy array with pRF time course models, with following dimensions:
-        `aryPrfTc4D[feature, x-position, y-position, SD, volume]`.
-
-    Notes
-    -----
-    This function creates the pRF time course models, from which the best-
-    fitting model for each voxel will be selected.
+    vecX : np.array
+        1D array with x-positions of the pRF models (in pixels of the
+        upsampled visual space).
+    vecY : np.array
+        1D array with y-positions of the pRF models (in pixels of the
+        upsampled visual space).
+    vecPrfSd : np.array
+        1D array with sizes of the pRF models (standard deviation of the
+        Gaussian, in pixels of the upsampled visual space).
     """
-    # Number of volumes:
-    varNumVol = aryPixConv.shape[3]
-
-    # Number of features (e.g. motion directions):
-    varNumFtr = aryPixConv.shape[0]
-
     # Only fit pRF models if dimensions of pRF time course models are
     # correct:
     if not((tplVslSpcSze[0] / varNumX) == (tplVslSpcSze[1] / varNumY)):
@@ -141,6 +133,85 @@ def crt_prf_tcmdl(aryPixConv, strDirHdf, tplVslSpcSze=(200, 200), varNumX=40,  #
     # space.
     vecPrfSd = np.multiply(vecPrfSd, varDgr2PixUpX)
 
+    return vecX, vecY, vecPrfSd
+
+
+def crt_prf_tcmdl(aryPixConv, tplVslSpcSze=(200, 200), varNumX=40,  #noqa
+                  varNumY=40, varExtXmin=-5.19, varExtXmax=5.19,
+                  varExtYmin=-5.19, varExtYmax=5.19, varPrfStdMin=0.1,
+                  varPrfStdMax=7.0, varNumPrfSizes=40, varPar=10):
+    """
+    Create pRF time courses models.
+
+    Parameters
+    ----------
+    aryPixConv : np.array
+        4D numpy array containing HRF-convolved pixel-wise design matrix, with
+        shape `aryPixConv[feature, x-position, y-position, time]`.
+    tplVslSpcSze : tuple
+        Pixel size of visual space model in which the pRF models are created
+        (x- and y-dimension).
+    varNumX : int
+        Number of x-positions in the visual space to model.
+    varNumY : int
+        Number of y-positions in the visual space to model.
+    varExtXmin : float
+        Extent of visual space from centre of the screen in negative
+        x-direction (i.e. from the fixation point to the left end of the
+        screen) in degrees of visual angle.
+    varExtXmax : float
+        Extent of visual space from centre of the screen in positive
+        x-direction (i.e. from the fixation point to the right end of the
+        screen) in degrees of visual angle.
+    varExtYmin : float
+        Extent of visual space from centre of the screen in negative
+        y-direction (i.e. from the fixation point to the lower end of the
+        screen) in degrees of visual angle.
+    varExtYmax : float
+        Extent of visual space from centre of the screen in positive
+        y-direction (i.e. from the fixation point to the upper end of the
+        screen) in degrees of visual angle.
+    varPrfStdMin : float
+        Minimum pRF model size (standard deviation of 2D Gaussian) in  degrees
+        of visual angle.
+    varPrfStdMax : float
+        Maximum pRF model size (standard deviation of 2D Gaussian) in  degrees
+        of visual angle.
+    varNumPrfSizes : int
+        Number of pRF sizes to model.
+    varPar : int
+        Number of processes to run in parallel (multiprocessing).
+
+    Returns
+    -------
+    aryPrfTc4D : np.array
+        4D numpy array with pRF time course models, with following dimensions:
+        `aryPrfTc4D[feature, x-position, y-position, SD, volume]`.
+
+    Notes
+    -----
+    This function creates the pRF time course models, from which the best-
+    fitting model for each voxel will be selected.
+    """
+    # Number of volumes:
+    varNumVol = aryPixConv.shape[3]
+
+    # Number of features (e.g. motion directions):
+    varNumFtr = aryPixConv.shape[0]
+
+    # Positions and sizes of the pRF models, in units of the upsampled visual
+    # space:
+    vecX, vecY, vecPrfSd = crt_prf_grid(tplVslSpcSze=tplVslSpcSze,
+                                        varNumX=varNumX,
+                                        varNumY=varNumY,
+                                        varExtXmin=varExtXmin,
+                                        varExtXmax=varExtXmax,
+                                        varExtYmin=varExtYmin,
+                                        varExtYmax=varExtYmax,
+                                        varPrfStdMin=varPrfStdMin,
+                                        varPrfStdMax=varPrfStdMax,
+                                        varNumPrfSizes=varNumPrfSizes)
+
     # Number of pRF models to be created (i.e. number of possible combinations
     # of x-position, y-position, and standard deviation):
     varNumMdls = varNumFtr * varNumX * varNumY * varNumPrfSizes
@@ -182,19 +253,26 @@ def crt_prf_tcmdl(aryPixConv, strDirHdf, tplVslSpcSze=(200, 200), varNumX=40,  #
                     varCntMdlPrms = varCntMdlPrms + 1
 
     # The long array with all the combinations of model parameters is put into
-    # separate chunks for parallelisation, using a list of arrays.
-    lstMdlParams = [None] * varPar
-
-    # Vector with the indicies at which the functional data will be separated
-    # in order to be chunked up for the parallel processes:
-    vecIdxChnks = np.linspace(0,
-                              varNumMdls,
-                              num=varPar,
-                              endpoint=False)
-    vecIdxChnks = np.hstack((vecIdxChnks, varNumMdls))
+    # separate chunks (tasks) for parallelisation, using a list of arrays.
+    # There are more tasks than parallel processes, and the processes take on
+    # tasks one at a time (see `scheduler.py`):
+    vecIdxChnks = sch_chunks(varNumMdls, varPar)
+    varNumChnk = vecIdxChnks.shape[0] - 1
+    lstMdlParams = [None] * varNumChnk
+
+    # Shared output array for the pRF model time courses, with one row per
+    # combination of model parameters (in the same order as the parameter
+    # array). Because the parameter array was created with the loop order
+    # feature, x-position, y-position, SD, this array can be reshaped to
+    # aryPrfTc4D[feature, x-position, y-position, SD, volume] without
+    # reordering.
+    aryPrfTc = shm_alloc((varNumMdls, varNumVol), np.float32)
+
+    # List for the corresponding chunks of the output array:
+    lstPrfTc = [None] * varNumChnk
 
     # Put model parameters into chunks:
-    for idxChnk in range(0, varPar):
+    for idxChnk in range(0, varNumChnk):
         # Index of first combination of model parameters to be included in
         # current chunk:
         varTmpChnkSrt = int(vecIdxChnks[idxChnk])
@@ -203,98 +281,43 @@ def crt_prf_tcmdl(aryPixConv, strDirHdf, tplVslSpcSze=(200, 200), varNumX=40,  #
         varTmpChnkEnd = int(vecIdxChnks[(idxChnk+1)])
         # Put voxel array into list:
         lstMdlParams[idxChnk] = aryMdlParams[varTmpChnkSrt:varTmpChnkEnd, :]
+        # Corresponding chunk of the output array:
+        lstPrfTc[idxChnk] = shm_chunk(aryPrfTc, varTmpChnkSrt, varTmpChnkEnd)
 
-    # Empty list for results from parallel processes (for pRF model time course
-    # results):
-    lstPrfTc = [None] * varPar
-
-    # Empty list for processes:
-    lstPrcs = [None] * varPar
-
-    # Create a queue to put the results in:
-    queOut = mp.Queue()
+    # Place the convolved design matrix in shared memory, so that all parallel
+    # processes access the same copy (instead of copying the array into each
+    # process):
+    aryPixConv = shm_put(aryPixConv.astype(np.float32, copy=False))
 
     # print('---------Creating parallel processes')
 
-    # Create processes:
-    for idxPrc in range(0, varPar):
-        lstPrcs[idxPrc] = mp.Process(target=prf_par,
-                                     args=(lstMdlParams[idxPrc],
-                                           tplVslSpcSze,
-                                           varNumVol,
-                                           aryPixConv,
-                                           queOut)
-                                     )
-        # Daemon (kills processes when exiting):
-        lstPrcs[idxPrc].Daemon = True
-
-    # Start processes:
-    for idxPrc in range(0, varPar):
-        lstPrcs[idxPrc].start()
-
-    # Collect results from queue:
-    for idxPrc in range(0, varPar):
-        lstPrfTc[idxPrc] = queOut.get(True)
-
-    # Join processes:
-    for idxPrc in range(0, varPar):
-        lstPrcs[idxPrc].join()
-
-    # print('---------Collecting results from parallel processes')
-
-    # Put output arrays from parallel process into one big array (where each
-    # row corresponds to one model time course, the first column corresponds to
-    # the index number of the model time course, and the remaining columns
-    # correspond to time points):
-    aryPrfTc = np.vstack(lstPrfTc)
+    # Run the tasks on the parallel processes. The results are only complete
+    # if all tasks have finished successfully (failed tasks are started
+    # again):
+    sch_run(prf_par,
+            [(lstMdlParams[idxChnk],
+              tplVslSpcSze,
+              varNumVol,
+              aryPixConv,
+              lstPrfTc[idxChnk])
+             for idxChnk in range(0, varNumChnk)],
+            varPar,
+            lgcStts=False)
 
     # Clean up:
     del(aryMdlParams)
     del(lstMdlParams)
     del(lstPrfTc)
 
-    # Sort output along the first column (which contains the indicies), so that
-    # the output is in the same order as the list of combination of model
-    # parameters which we created before the parallelisation:
-    aryPrfTc = aryPrfTc[np.argsort(aryPrfTc[:, 0])]
-
-    # Array representing the low-resolution visual space, of the form
-    # aryPrfTc[x-position, y-position, pRF-size, varNum Vol], which will hold
-    # the pRF model time courses.
-    aryPrfTc4D = np.zeros((varNumFtr,
-                           varNumX,
-                           varNumY,
-                           varNumPrfSizes,
-                           varNumVol),
-                          dtype=np.float32)
-
-    # We use the same loop structure for organising the pRF model time courses
-    # that we used for creating the parameter array. Counter:
-    varCntMdlPrms = 0
-
-    # Put all combinations of x-position, y-position, and standard deviations
-    # into the array:
-
-    # Loop through features (e.g. motion direction):
-    for idxFtr in range(varNumFtr):
-
-        # Loop through x-positions:
-        for idxX in range(varNumX):
-
-            # Loop through y-positions:
-            for idxY in range(varNumY):
-
-                # Loop through standard deviations (of Gaussian pRF models):
-                for idxSd in range(varNumPrfSizes):
-
-                    # Put the pRF model time course into its correct position
-                    # in the 4D array, leaving out the first column (which
-                    # contains the index):
-                    aryPrfTc4D[idxFtr, idxX, idxY, idxSd, :] = \
-                        aryPrfTc[varCntMdlPrms, 1:].astype(np.float32)
-
-                    # Increment parameter index:
-                    varCntMdlPrms = varCntMdlPrms + 1
+    # The parallel processes have written the pRF model time courses into the
+    # shared output array, in the order of the parameter array. Reshape into
+    # the form aryPrfTc4D[feature, x-position, y-position, SD, volume]:
+    aryPrfTc4D = np.reshape(shm_get(aryPrfTc),
+                            (varNumFtr,
+                             varNumX,
+                             varNumY,
+                             varNumPrfSizes,
+                             varNumVol))
 
     # Return
     return aryPrfTc4D
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Create pRF time courses models from unique stimulus apertures."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from model_creation_timecourses import crt_prf_grid
+from model_creation_timecourses_apt_par import prf_apt_par
+from shared_arrays import shm_get
+from shared_arrays import shm_alloc
+from scheduler import sch_chunks
+from scheduler import sch_run
+
+
+def crt_prf_tcmdl_apt(aryApt, aryDsgnConv, tplVslSpcSze=(200, 200),  #noqa
+                      varNumX=40, varNumY=40, varExtXmin=-5.19,
+                      varExtXmax=5.19, varExtYmin=-5.19, varExtYmax=5.19,
+                      varPrfStdMin=0.1, varPrfStdMax=7.0, varNumPrfSizes=40,
+                      varPar=10):
+    """
+    Create pRF time courses models from the overlap with unique apertures.
+
+    Parameters
+    ----------
+    aryApt : np.array
+        3D numpy array with unique apertures, with shape aryApt[aperture,
+        x-position, y-position] (see `load_apertures`).
+    aryDsgnConv : np.array
+        3D numpy array with HRF-convolved time courses of the occurence of each
+        combination of feature and aperture, with shape aryDsgnConv[feature,
+        aperture, time] (see `crt_dsgn_apt`).
+    tplVslSpcSze : tuple
+        Pixel size of visual space model in which the pRF models are created
+        (x- and y-dimension).
+    varNumX : int
+        Number of x-positions to model.
+    varNumY : int
+        Number of y-positions to model.
+    varExtXmin : float
+        Extent of visual space from centre of the screen in negative
+        x-direction (i.e. from the fixation point to the left end of the
+        screen) in degrees of visual angle.
+    varExtXmax : float
+        Extent of visual space from centre of the screen in positive
+        x-direction (i.e. from the fixation point to the right end of the
+        screen) in degrees of visual angle.
+    varExtYmin : float
+        Extent of visual space from centre of the screen in negative
+        y-direction (i.e. from the fixation point to the lower end of the
+        screen) in degrees of visual angle.
+    varExtYmax : float
+        Extent of visual space from centre of the screen in positive
+        y-direction (i.e. from the fixation point to the upper end of the
+        screen) in degrees of visual angle.
+    varPrfStdMin : float
+        Minimum pRF model size (standard deviation of 2D Gaussian) in  degrees
+        of visual angle.
+    varPrfStdMax : float
+        Maximum pRF model size (standard deviation of 2D Gaussian) in  degrees
+        of visual angle.
+    varNumPrfSizes : int
+        Number of pRF sizes to model.
+    varPar : int
+        Number of processes to run in parallel (multiprocessing).
+
+    Returns
+    -------
+    aryPrfTc5D : np.array
+        5D numpy array with pRF time course models, with following dimensions:
+        `aryPrfTc5D[feature, x-position, y-position, SD, volume]`.
+
+    Notes
+    -----
+    The stimulus consists of a small number of aperture shapes. Instead of
+    integrating the pRF models over every frame of the pixel-wise design
+    matrix, the overlap of each pRF model with each unique aperture is
+    computed once. The model time courses are then obtained by weighting the
+    (HRF-convolved) time courses of the apertures with these overlaps. Gives
+    the same pRF time course models as `crt_prf_tcmdl` with the pixel-wise
+    design matrix created from the same stimuli. The parallelisation is over
+    pRF sizes, which are handed to the parallel processes in small tasks (see
+    `scheduler.py`). The models of all features are created in the same task,
+    because they share the overlaps of the pRF models with the apertures.
+    """
+    # Number of volumes:
+    varNumVol = aryDsgnConv.shape[2]
+
+    # Number of features (e.g. motion directions):
+    varNumFtr = aryDsgnConv.shape[0]
+
+    # Positions and sizes of the pRF models, in units of the upsampled visual
+    # space:
+    vecX, vecY, vecPrfSd = crt_prf_grid(tplVslSpcSze=tplVslSpcSze,
+                                        varNumX=varNumX,
+                                        varNumY=varNumY,
+                                        varExtXmin=varExtXmin,
+                                        varExtXmax=varExtXmax,
+                                        varExtYmin=varExtYmin,
+                                        varExtYmax=varExtYmax,
+                                        varPrfStdMin=varPrfStdMin,
+                                        varPrfStdMax=varPrfStdMax,
+                                        varNumPrfSizes=varNumPrfSizes)
+
+    # In the pixel-wise model creation (see `prf_par`), the positions and
+    # sizes of the pRF models are rounded to integer pixels. We do the same,
+    # so that the resulting models are identical:
+    vecX = np.around(vecX, 0)
+    vecY = np.around(vecY, 0)
+    vecPrfSd = np.around(vecPrfSd, 0)
+
+    # Indices of pRF sizes, chunked up into tasks for the parallel processes.
+    # There are more tasks than parallel processes, and the processes take on
+    # tasks one at a time (see `scheduler.py`):
+    vecIdxChnks = sch_chunks(varNumPrfSizes, varPar)
+    varNumChnk = vecIdxChnks.shape[0] - 1
+    lstIdx = [np.arange(vecIdxChnks[idxChnk], vecIdxChnks[(idxChnk + 1)])
+              for idxChnk in range(0, varNumChnk)]
+
+    # Shared output array for the pRF model time courses. Each task writes
+    # the models of its pRF sizes:
+    aryPrfTc = shm_alloc((varNumFtr,
+                          varNumX,
+                          varNumY,
+                          varNumPrfSizes,
+                          varNumVol),
+                         np.float32)
+
+    # Run the tasks on the parallel processes. The results are only complete
+    # if all tasks have finished successfully:
+    sch_run(prf_apt_par,
+            [(lstIdx[idxChnk],
+              vecX,
+              vecY,
+              vecPrfSd,
+              aryApt,
+              aryDsgnConv,
+              aryPrfTc)
+             for idxChnk in range(0, varNumChnk)],
+            varPar,
+            varNumRtr=0,
+            lgcStts=False)
+
+    # Return
+    return shm_get(aryPrfTc)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Parallelisation function for crt_prf_tcmdl_apt."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from utilities import crt_gauss_1d
+from shared_arrays import shm_get
+
+
+def prf_apt_par(vecIdxSd, vecX, vecY, vecPrfSd, aryApt, aryDsgnConv, aryOut):
+    """
+    Create pRF time course models from the overlap with unique apertures.
+
+    Parameters
+    ----------
+    vecIdxSd : np.array
+        1D array with the indices of the pRF sizes for which models are created
+        in this task.
+    vecX : np.array
+        1D array with x-positions of the pRF models (in pixels of the
+        upsampled visual space).
+    vecY : np.array
+        1D array with y-positions of the pRF models (in pixels of the
+        upsampled visual space).
+    vecPrfSd : np.array
+        1D array with sizes of the pRF models (in pixels of the upsampled
+        visual space).
+    aryApt : np.array
+        3D numpy array with unique apertures, with shape aryApt[aperture,
+        x-position, y-position].
+    aryDsgnConv : np.array
+        3D numpy array with HRF-convolved time courses of the occurence of each
+        combination of feature and aperture, with shape aryDsgnConv[feature,
+        aperture, time].
+    aryOut : ShmArray
+        Shared output array, with shape `aryOut[feature, x-position,
+        y-position, SD, time]`. Only the pRF sizes in `vecIdxSd` are written
+        by this task.
+
+    Notes
+    -----
+    For each pRF size, the overlap of all pRF models (x- and y-positions) with
+    all apertures is computed at once, using separable Gaussians (see
+    `prf_sep_par`). The model time courses of each feature are then obtained
+    by multiplying the overlaps with the aperture time courses.
+    """
+    # Output array with pRF model time courses (mapping the shared memory):
+    aryOut = shm_get(aryOut)
+
+    # Number of apertures & size of the upsampled visual space:
+    varNumApt = aryApt.shape[0]
+    varSzeDim0 = aryApt.shape[1]
+    varSzeDim1 = aryApt.shape[2]
+
+    # Number of features & volumes:
+    varNumFtr = aryDsgnConv.shape[0]
+    varNumVol = aryDsgnConv.shape[2]
+
+    # Number of modelled positions:
+    varNumX = vecX.shape[0]
+    varNumY = vecY.shape[0]
+
+    # The overlaps are calculated at single precision:
+    aryApt = aryApt.astype(np.float32)
+
+    # Loop through pRF sizes:
+    for idxSd in vecIdxSd:
+
+        # Current pRF size:
+        varTmpSd = vecPrfSd[idxSd]
+
+        # 1D Gaussians along the first pixel dimension (one per y-position),
+        # including the normalisation factor of the 2D Gaussian, with shape
+        # aryGaussY[y-position, pixel]:
+        aryGaussY = np.divide(crt_gauss_1d(varSzeDim0, vecY, varTmpSd),
+                              (2.0 * np.pi * np.square(varTmpSd)))
+        aryGaussY = aryGaussY.astype(np.float32)
+
+        # 1D Gaussians along the second pixel dimension (one per x-position),
+        # with shape aryGaussX[x-position, pixel]:
+        aryGaussX = crt_gauss_1d(varSzeDim1, vecX, varTmpSd).astype(np.float32)
+
+        # Overlap of all pRF models with all apertures, with shape
+        # aryOvl[aperture, y-position, x-position]:
+        aryOvl = np.matmul(np.matmul(aryGaussY[None, :, :], aryApt),
+                           aryGaussX.T[None, :, :])
+
+        # Change order of axes to aryOvl[x-position, y-position, aperture], and
+        # flatten the positions:
+        aryOvl = np.reshape(np.transpose(aryOvl, (2, 1, 0)),
+                            ((varNumX * varNumY), varNumApt))
+
+        # Loop through features:
+        for idxFtr in range(varNumFtr):
+
+            # Model time courses for all positions, i.e. the sum of the
+            # aperture time courses, weighted by the overlap of the pRF model
+            # with the respective aperture:
+            aryOut[idxFtr, :, :, idxSd, :] = np.reshape(
+                np.dot(aryOvl, aryDsgnConv[idxFtr, :, :]),
+                (varNumX, varNumY, varNumVol))
@@ -19,9 +19,10 @@
 
 import numpy as np
 from utilities import crt_gauss
+from shared_arrays import shm_get
 
 
-def prf_par(aryMdlParamsChnk, tplVslSpcSze, varNumVol, aryPixConv, queOut):
+def prf_par(aryMdlParamsChnk, tplVslSpcSze, varNumVol, aryPixConv, aryOut):
     """
     Create pRF time course models.
 
@@ -39,35 +40,32 @@ def prf_par(aryMdlParamsChnk, tplVslSpcSze, varNumVol, aryPixConv, queOut):
         (x- and y-dimension).
     varNumVol : int
         Number of time points (volumes).
-    aryPixConv : np.array
+    aryPixConv : np.array or ShmArray
         4D numpy array containing HRF-convolved pixel-wise design matrix, with
-        shape `aryPixConv[feature, x-position, y-position, time]`.
-    queOut : multiprocessing.queues.Queue
-        Queue to put the results on.
-
-    Returns
-    -------
-    lstOut : list
-        List containing the following object:
-        aryOut : np.array
-            2D numpy array, where each row corresponds to one model time
-            course, the first column corresponds to the index number of the
-            model time course, and the remaining columns correspond to time
-            points).
+        shape `aryPixConv[feature, x-position, y-position, time]`. Can be
+        placed in shared memory (see `shared_arrays.py`).
+    aryOut : ShmArray
+        Shared output array (chunk corresponding to `aryMdlParamsChnk`), with
+        shape `aryOut[model-ID, time]`, into which the pRF model time courses
+        are written.
 
     Notes
     -----
-    The list with results is not returned directly, but placed on a
-    multiprocessing queue.
+    The results are not returned, but written into the shared output array,
+    in the same order as the model parameters (so that they do not need to be
+    sorted afterwards).
     """
+    # The convolved design matrix may have been placed in shared memory:
+    aryPixConv = shm_get(aryPixConv)
+
     # Number of combinations of model parameters in the current chunk:
     varChnkSze = np.size(aryMdlParamsChnk, axis=0)
 
     # Number of features (e.g. motion directions):
     # varNumFtr = aryPixConv.shape[0]
 
-    # Output array with pRF model time courses:
-    aryOut = np.zeros([varChnkSze, varNumVol], dtype=np.float32)
+    # Output array with pRF model time courses (mapping the shared memory):
+    aryOut = shm_get(aryOut)
 
     # Loop through combinations of model parameters:
     for idxMdl in range(varChnkSze):
@@ -108,14 +106,3 @@ def prf_par(aryMdlParamsChnk, tplVslSpcSze, varNumVol, aryPixConv, queOut):
 
         # Put model time courses into the function's output array:
         aryOut[idxMdl, :] = aryPrfTcTmp
-
-    # Put column with the indicies of model-parameter-combinations into the
-    # output array (in order to be able to put the pRF model time courses into
-    # the correct order after the parallelised function):
-    aryOut = np.hstack((np.array(aryMdlParamsChnk[:, 0],
-                                 ndmin=2,
-                                 dtype=np.float32).T,
-                        aryOut)).astype(np.float32)
-
-    # Put output to queue:
-    queOut.put(aryOut)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Create pRF time courses models with separable Gaussians."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from model_creation_timecourses import crt_prf_grid
+from model_creation_timecourses_sep_par import prf_sep_par
+from utilities import crt_hrf
+from shared_arrays import shm_put
+from shared_arrays import shm_get
+from shared_arrays import shm_alloc
+from scheduler import sch_chunks
+from scheduler import sch_run
+
+
+def crt_prf_tcmdl_sep(aryPixConv, tplVslSpcSze=(200, 200), varNumX=40,  #noqa
+                      varNumY=40, varExtXmin=-5.19, varExtXmax=5.19,
+                      varExtYmin=-5.19, varExtYmax=5.19, varPrfStdMin=0.1,
+                      varPrfStdMax=7.0, varNumPrfSizes=40, varPar=10,
+                      varTr=None, strConvOrd='auto', vecRunLen=None):
+    """
+    Create pRF time courses models, using separable Gaussians.
+
+    Parameters
+    ----------
+    aryPixConv : np.array
+        4D numpy array containing HRF-convolved pixel-wise design matrix, with
+        shape `aryPixConv[feature, x-position, y-position, time]`. If `varTr`
+        is provided, the binary (not convolved) pixel-wise design matrix at
+        np.int8 precision (as returned by `append_features`).
+    tplVslSpcSze : tuple
+        Pixel size of visual space model in which the pRF models are created
+        (x- and y-dimension).
+    varNumX : int
+        Number of x-positions to model.
+    varNumY : int
+        Number of y-positions to model.
+    varExtXmin : float
+        Extent of visual space from centre of the screen in negative
+        x-direction (i.e. from the fixation point to the left end of the
+        screen) in degrees of visual angle.
+    varExtXmax : float
+        Extent of visual space from centre of the screen in positive
+        x-direction (i.e. from the fixation point to the right end of the
+        screen) in degrees of visual angle.
+    varExtYmin : float
+        Extent of visual space from centre of the screen in negative
+        y-direction (i.e. from the fixation point to the lower end of the
+        screen) in degrees of visual angle.
+    varExtYmax : float
+        Extent of visual space from centre of the screen in positive
+        y-direction (i.e. from the fixation point to the upper end of the
+        screen) in degrees of visual angle.
+    varPrfStdMin : float
+        Minimum pRF model size (standard deviation of 2D Gaussian) in  degrees
+        of visual angle.
+    varPrfStdMax : float
+        Maximum pRF model size (standard deviation of 2D Gaussian) in  degrees
+        of visual angle.
+    varNumPrfSizes : int
+        Number of pRF sizes to model.
+    varPar : int
+        Number of processes to run in parallel (multiprocessing).
+    varTr : float or None
+        Volume TR of functional data. If provided, the design matrix is
+        convolved with the HRF model here (otherwise, it is assumed to be
+        convolved already).
+    strConvOrd : str
+        Only relevant if `varTr` is provided. Order of convolution and spatial
+        integration: 'pixels' (convolve pixel time courses, then integrate),
+        'models' (integrate binary design matrix, then convolve model time
+        courses), or 'auto' (whichever order requires fewer convolutions).
+    vecRunLen : list or None
+        Only relevant if `varTr` is provided. Number of volumes of each run.
+        If provided, the HRF convolution is restarted at the beginning of each
+        run (see `conv_tc`). If None, all volumes are treated as one run.
+
+    Returns
+    -------
+    aryPrfTc5D : np.array
+        5D numpy array with pRF time course models, with following dimensions:
+        `aryPrfTc5D[feature, x-position, y-position, SD, volume]`.
+
+    Notes
+    -----
+    Gives the same pRF time course models as `crt_prf_tcmdl`, but instead of
+    creating a 2D Gaussian for each model and multiplying it with all pixel
+    time courses, the models for all x- and y-positions of a given feature and
+    pRF size are created at once with two matrix multiplications (an
+    isotropic 2D Gaussian is the product of two 1D Gaussians). The
+    parallelisation is over combinations of feature and pRF size, which are
+    handed to the parallel processes in small tasks (see `scheduler.py`).
+
+    Because the convolution with the HRF and the spatial integration are both
+    linear, their order can be swapped. If the binary design matrix is passed
+    (together with `varTr`), the float32 HRF-convolved design matrix of all
+    features (`aryPixConv` as returned by `conv_dsgn_mat`) is never created.
+    Instead, each process either convolves the pixel time courses of one
+    feature at a time, or convolves the model time courses after the spatial
+    integration. The number of convolutions is (number of pixels * number of
+    features accessed by the tasks) in the former and (number of models) in
+    the latter case.
+    """
+    # Number of volumes:
+    varNumVol = aryPixConv.shape[3]
+
+    # Number of features (e.g. motion directions):
+    varNumFtr = aryPixConv.shape[0]
+
+    # Positions and sizes of the pRF models, in units of the upsampled visual
+    # space:
+    vecX, vecY, vecPrfSd = crt_prf_grid(tplVslSpcSze=tplVslSpcSze,
+                                        varNumX=varNumX,
+                                        varNumY=varNumY,
+                                        varExtXmin=varExtXmin,
+                                        varExtXmax=varExtXmax,
+                                        varExtYmin=varExtYmin,
+                                        varExtYmax=varExtYmax,
+                                        varPrfStdMin=varPrfStdMin,
+                                        varPrfStdMax=varPrfStdMax,
+                                        varNumPrfSizes=varNumPrfSizes)
+
+    # In the pixel-wise model creation (see `prf_par`), the positions and
+    # sizes of the pRF models are rounded to integer pixels. We do the same,
+    # so that the resulting models are identical:
+    vecX = np.around(vecX, 0)
+    vecY = np.around(vecY, 0)
+    vecPrfSd = np.around(vecPrfSd, 0)
+
+    # Array with all combinations of features and pRF sizes, where the columns
+    # correspond to (0) the feature index and (1) the index of the pRF size.
+    # Combinations belonging to the same feature are adjacent, so that each
+    # task only needs to access the pixel time courses of few features.
+    aryIdx = np.zeros(((varNumFtr * varNumPrfSizes), 2), dtype=np.int32)
+    aryIdx[:, 0] = np.repeat(np.arange(varNumFtr), varNumPrfSizes)
+    aryIdx[:, 1] = np.tile(np.arange(varNumPrfSizes), varNumFtr)
+
+    # The array with the combinations is put into separate chunks (tasks) for
+    # parallelisation, using a list of arrays. There are more tasks than
+    # parallel processes, and the processes take on tasks one at a time (see
+    # `scheduler.py`):
+    vecIdxChnks = sch_chunks(aryIdx.shape[0], varPar)
+    varNumChnk = vecIdxChnks.shape[0] - 1
+    lstIdx = [None] * varNumChnk
+
+    # Put combinations into chunks:
+    for idxChnk in range(0, varNumChnk):
+        # Index of first combination to be included in current chunk:
+        varTmpChnkSrt = int(vecIdxChnks[idxChnk])
+        # Index of last combination to be included in current chunk:
+        varTmpChnkEnd = int(vecIdxChnks[(idxChnk+1)])
+        # Put combinations into list:
+        lstIdx[idxChnk] = aryIdx[varTmpChnkSrt:varTmpChnkEnd, :]
+
+    if varTr is None:
+
+        # The design matrix has been convolved already:
+        vecHrf = None
+        lgcConvPix = True
+
+    else:
+
+        # Create 'canonical' HRF time course model:
+        vecHrf = crt_hrf(varNumVol, varTr).astype(np.float32)
+
+        # Number of convolutions if the pixel time courses are convolved.
+        # Each task convolves the pixel time courses of each feature it
+        # accesses:
+        varNumConvPix = (aryPixConv.shape[1]
+                         * aryPixConv.shape[2]
+                         * np.sum([np.unique(aryTmp[:, 0]).shape[0]
+                                   for aryTmp in lstIdx]))
+
+        # Number of convolutions if the model time courses are convolved:
+        varNumConvMdl = varNumFtr * varNumX * varNumY * varNumPrfSizes
+
+        if strConvOrd == 'auto':
+            lgcConvPix = (varNumConvPix <= varNumConvMdl)
+        elif strConvOrd == 'pixels':
+            lgcConvPix = True
+        elif strConvOrd == 'models':
+            lgcConvPix = False
+        else:
+            # Error message:
+            strErrMsg = ('---Error: Unknown order of HRF convolution: '
+                         + str(strConvOrd))
+            raise ValueError(strErrMsg)
+
+        if lgcConvPix:
+            print('---------Convolve pixel time courses with HRF model, then '
+                  + 'integrate (' + str(varNumConvPix) + ' convolutions)')
+        else:
+            print('---------Integrate binary design matrix, then convolve '
+                  + 'model time courses with HRF model ('
+                  + str(varNumConvMdl) + ' convolutions)')
+
+    # Place the design matrix in shared memory (at its original precision), so
+    # that all parallel processes access the same copy:
+    aryPixConv = shm_put(aryPixConv)
+
+    # Shared output array for the pRF model time courses. Each task writes
+    # the models of its combinations of feature and pRF size:
+    aryPrfTc = shm_alloc((varNumFtr,
+                          varNumX,
+                          varNumY,
+                          varNumPrfSizes,
+                          varNumVol),
+                         np.float32)
+
+    # Run the tasks on the parallel processes. The results are only complete
+    # if all tasks have finished successfully:
+    sch_run(prf_sep_par,
+            [(lstIdx[idxChnk],
+              vecX,
+              vecY,
+              vecPrfSd,
+              aryPixConv,
+              aryPrfTc,
+              vecHrf,
+              lgcConvPix,
+              vecRunLen)
+             for idxChnk in range(0, varNumChnk)],
+            varPar,
+            varNumRtr=0,
+            lgcStts=False)
+
+    # Return
+    return shm_get(aryPrfTc)
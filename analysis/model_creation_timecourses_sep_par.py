@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Parallelisation function for crt_prf_tcmdl_sep."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from utilities import crt_gauss_1d
+from convolution import conv_tc
+from shared_arrays import shm_get
+
+
+def prf_sep_par(aryIdxChnk, vecX, vecY, vecPrfSd, aryPixConv, aryOut,
+                vecHrf=None, lgcConvPix=True, vecRunLen=None):
+    """
+    Create pRF time course models with separable Gaussians.
+
+    Parameters
+    ----------
+    aryIdxChnk : np.array
+        2D numpy array with the combinations of feature and pRF size for which
+        models are created in this task, with shape `aryIdxChnk[combination,
+        2]`, where the columns contain (0) the feature index and (1) the index
+        of the pRF size.
+    vecX : np.array
+        1D array with x-positions of the pRF models (in pixels of the
+        upsampled visual space).
+    vecY : np.array
+        1D array with y-positions of the pRF models (in pixels of the
+        upsampled visual space).
+    vecPrfSd : np.array
+        1D array with sizes of the pRF models (in pixels of the upsampled
+        visual space).
+    aryPixConv : np.array or ShmArray
+        4D numpy array containing HRF-convolved pixel-wise design matrix, with
+        shape `aryPixConv[feature, x-position, y-position, time]`. If `vecHrf`
+        is provided, the binary (not convolved) design matrix at np.int8
+        precision. Can be placed in shared memory (see `shared_arrays.py`).
+    aryOut : ShmArray
+        Shared output array, with shape `aryOut[feature, x-position,
+        y-position, SD, time]`. Only the combinations of feature and pRF size
+        in `aryIdxChnk` are written by this task.
+    vecHrf : np.array or None
+        1D array with HRF time course model. If None, the design matrix is
+        assumed to be convolved already.
+    lgcConvPix : bool
+        Only relevant if `vecHrf` is provided. If True, the pixel time courses
+        of a feature are convolved with the HRF before the spatial
+        integration, otherwise the model time courses are convolved after the
+        spatial integration.
+    vecRunLen : list or None
+        Number of volumes of each run. If provided, the HRF convolution is
+        restarted at the beginning of each run (see `conv_tc`).
+
+    Notes
+    -----
+    For a given feature and pRF size, the model time courses for all x- and
+    y-positions are obtained with two matrix multiplications: The pixel time
+    courses are first weighted with the 1D Gaussians along the first pixel
+    dimension (for all y-positions at once), and the result is then weighted
+    with the 1D Gaussians along the second pixel dimension (for all
+    x-positions at once). As in `prf_par`, the first pixel dimension is
+    compared with the y-position of the pRF model, and the second pixel
+    dimension with the x-position (see `crt_gauss`).
+
+    The pixel time courses of the current feature are converted to float32
+    (and, if requested, convolved) once per feature. Thus, at most one
+    feature of the design matrix is held at float32 precision by this process.
+    """
+    # The convolved design matrix may have been placed in shared memory:
+    aryPixConv = shm_get(aryPixConv)
+
+    # Output array with pRF model time courses (mapping the shared memory):
+    aryOut = shm_get(aryOut)
+
+    # Size of the upsampled visual space:
+    varSzeDim0 = aryPixConv.shape[1]
+    varSzeDim1 = aryPixConv.shape[2]
+
+    # Number of volumes:
+    varNumVol = aryPixConv.shape[3]
+
+    # Number of modelled x- and y-positions:
+    varNumX = vecX.shape[0]
+    varNumY = vecY.shape[0]
+
+    # Index of the feature whose pixel time courses are currently held in
+    # `aryPixFtr` (none so far):
+    idxFtrCur = -1
+
+    # Loop through combinations of feature and pRF size:
+    for idxCmb in range(aryIdxChnk.shape[0]):
+
+        # Feature index & index of pRF size of current combination:
+        idxFtr = int(aryIdxChnk[idxCmb, 0])
+        idxSd = int(aryIdxChnk[idxCmb, 1])
+
+        # Current pRF size:
+        varTmpSd = vecPrfSd[idxSd]
+
+        # Pixel time courses of the current feature, at float32 precision and
+        # with shape aryPixFtr[pixel along first dimension, (pixel along
+        # second dimension * time)]:
+        if idxFtr != idxFtrCur:
+
+            # Release pixel time courses of previous feature before creating
+            # the new ones:
+            aryPixFtr = None
+
+            # If the design matrix is convolved already and at float32
+            # precision, this is a view (i.e. the data are not copied):
+            aryPixFtr = np.reshape(
+                aryPixConv[idxFtr, :, :, :].astype(np.float32, copy=False),
+                (varSzeDim0, (varSzeDim1 * varNumVol)))
+
+            # Convolve pixel time courses with HRF model:
+            if (vecHrf is not None) and lgcConvPix:
+                aryPixFtr = np.reshape(
+                    conv_tc(np.reshape(aryPixFtr,
+                                       ((varSzeDim0 * varSzeDim1), varNumVol)),
+                            vecHrf,
+                            vecRunLen=vecRunLen),
+                    (varSzeDim0, (varSzeDim1 * varNumVol)))
+
+            idxFtrCur = idxFtr
+
+        # 1D Gaussians along the first pixel dimension (one per y-position),
+        # including the normalisation factor of the 2D Gaussian, with shape
+        # aryGaussY[y-position, pixel]:
+        aryGaussY = np.divide(crt_gauss_1d(varSzeDim0, vecY, varTmpSd),
+                              (2.0 * np.pi * np.square(varTmpSd)))
+        aryGaussY = aryGaussY.astype(np.float32)
+
+        # 1D Gaussians along the second pixel dimension (one per x-position),
+        # with shape aryGaussX[x-position, pixel]:
+        aryGaussX = crt_gauss_1d(varSzeDim1, vecX, varTmpSd).astype(np.float32)
+
+        # Weight the pixel time courses with the Gaussians along the first
+        # pixel dimension, resulting in shape aryTmp[y-position, pixel,
+        # time]:
+        aryTmp = np.dot(aryGaussY, aryPixFtr)
+        aryTmp = np.reshape(aryTmp, (varNumY, varSzeDim1, varNumVol))
+
+        # Weight with the Gaussians along the second pixel dimension, resulting
+        # in shape aryTmp[y-position, x-position, time]:
+        aryTmp = np.matmul(aryGaussX[None, :, :], aryTmp)
+
+        # Convolve model time courses with HRF model (all x- and y-positions
+        # at once):
+        if (vecHrf is not None) and (not lgcConvPix):
+            aryTmp = np.reshape(
+                conv_tc(np.reshape(aryTmp, ((varNumY * varNumX), varNumVol)),
+                        vecHrf,
+                        vecRunLen=vecRunLen),
+                (varNumY, varNumX, varNumVol))
+
+        # Put model time courses into the output array:
+        aryOut[idxFtr, :, :, idxSd, :] = np.swapaxes(aryTmp, 0, 1)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Motion direction tuning of voxels from the betas of the pRF models."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+def mtn_tuning(aryBeta, vecDir=None):
+    """
+    Calculate motion direction tuning of voxels.
+
+    Parameters
+    ----------
+    aryBeta : np.array
+        Betas of the best fitting pRF models, with shape aryBeta[voxel,
+        feature], where each feature corresponds to a motion direction.
+    vecDir : np.array or list or None
+        Motion directions of the features (in degrees). If None, the
+        directions are assumed to be evenly spaced around the circle, starting
+        at zero (i.e. `360 / number of features` degrees apart).
+
+    Returns
+    -------
+    vecPrfDir : np.array
+        Preferred direction of each voxel (in degrees, between 0 and 360).
+    vecWdth : np.array
+        Circular tuning width of each voxel (circular standard deviation, in
+        degrees).
+    vecDsi : np.array
+        Direction selectivity index of each voxel, between 0 (no preference
+        for the preferred over the opposite direction) and 1.
+
+    Notes
+    -----
+    Negative betas are set to zero (a voxel does not respond below baseline
+    to its preferred direction). The preferred direction is the direction of
+    the vector sum of the motion directions, weighted by the betas. The tuning
+    width is the circular standard deviation, sqrt(-2 * ln(R)), where R is the
+    length of the weighted vector sum divided by the sum of the betas. The
+    direction selectivity index is (b_pref - b_opp) / (b_pref + b_opp), where
+    b_pref is the beta of the feature closest to the preferred direction, and
+    b_opp the beta of the feature closest to the opposite direction. For
+    voxels without positive betas, all values are set to zero.
+    """
+    aryBeta = np.maximum(np.asarray(aryBeta, dtype=np.float64), 0.0)
+    varNumFtr = aryBeta.shape[1]
+
+    # Motion directions of the features (in radians):
+    if vecDir is None:
+        vecDir = np.multiply(np.arange(varNumFtr), (360.0 / varNumFtr))
+    vecDir = np.asarray(vecDir, dtype=np.float64)
+    if vecDir.shape[0] != varNumFtr:
+        # Error message:
+        strErrMsg = ('---Error: Number of motion directions ('
+                     + str(vecDir.shape[0]) + ') does not agree with number '
+                     + 'of features (' + str(varNumFtr) + ').')
+        raise ValueError(strErrMsg)
+    vecDir = np.deg2rad(vecDir)
+
+    # Voxels with positive betas:
+    vecSum = np.sum(aryBeta, axis=1)
+    vecLgc = np.greater(vecSum, 0.0)
+    vecSum[np.logical_not(vecLgc)] = 1.0
+
+    # Vector sum of motion directions, weighted by the betas:
+    vecVecX = np.dot(aryBeta, np.cos(vecDir))
+    vecVecY = np.dot(aryBeta, np.sin(vecDir))
+    vecPrfDir = np.mod(np.arctan2(vecVecY, vecVecX), (2.0 * np.pi))
+
+    # Circular standard deviation (the length of the normalised vector sum is
+    # limited, so that the width is finite if the responses to all directions
+    # cancel out):
+    vecLen = np.divide(np.sqrt(np.add(np.square(vecVecX),
+                                      np.square(vecVecY))),
+                       vecSum)
+    vecLen = np.clip(vecLen, 1e-12, 1.0)
+    vecWdth = np.sqrt(np.maximum(np.multiply(-2.0, np.log(vecLen)), 0.0))
+
+    # Features closest to the preferred and to the opposite direction
+    # (angular distance along the circle):
+    aryDst = np.subtract(vecPrfDir[:, None], vecDir[None, :])
+    aryDst = np.absolute(np.angle(np.exp(np.multiply(1j, aryDst))))
+    vecIdxPrf = np.argmin(aryDst, axis=1)
+    vecIdxOpp = np.argmax(aryDst, axis=1)
+    vecIdxVox = np.arange(aryBeta.shape[0])
+    vecBetaPrf = aryBeta[vecIdxVox, vecIdxPrf]
+    vecBetaOpp = aryBeta[vecIdxVox, vecIdxOpp]
+
+    # Direction selectivity index:
+    vecTmp = np.add(vecBetaPrf, vecBetaOpp)
+    vecTmp[np.less_equal(vecTmp, 0.0)] = np.inf
+    vecDsi = np.divide(np.subtract(vecBetaPrf, vecBetaOpp), vecTmp)
+
+    vecPrfDir = np.rad2deg(vecPrfDir)
+    vecWdth = np.rad2deg(vecWdth)
+    for vecTmp in [vecPrfDir, vecWdth, vecDsi]:
+        vecTmp[np.logical_not(vecLgc)] = 0.0
+
+    return (vecPrfDir.astype(np.float32), vecWdth.astype(np.float32),
+            vecDsi.astype(np.float32))
@@ -0,0 +1,938 @@
+# -*- coding: utf-8 -*-
+"""Stages of the pRF analysis: pRF models, and fitting of functional data."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import config as cfg
+
+import numpy as np
+
+from model_creation_main import model_creation
+from model_creation_main import model_bank
+from model_creation_main import model_lazy
+from preprocessing_main import pre_pro_models
+from preprocessing_main import pre_pro_func
+from shared_arrays import shm_put
+from shared_arrays import shm_get
+from shared_arrays import shm_alloc
+from shared_arrays import shm_chunk
+from cache import cch_call
+from compression import crt_cmp_mdl
+from compression import crt_cmp_func
+from coarse_to_fine import c2f_grid
+from coarse_to_fine import c2f_refine
+from coarse_to_fine import c2f_chk
+from refinement import rfn_prf
+from model_bank import bnk_get
+from model_bank import bnk_tile
+from model_creation_lazy import MdlLzy
+from export import exp_prf
+from checkpoint import ckp_cfg
+from checkpoint import ckp_init
+from checkpoint import ckp_path
+from checkpoint import ckp_run
+from scheduler import sch_chunks
+from scheduler import sch_merge
+from top_k import tpk_merge
+from shards import shrd_rng
+from shards import shrd_save
+if cfg.strVersion == 'gpu':
+    from find_prf_gpu_motion import find_prf_gpu
+if ((cfg.strVersion == 'cython') or (cfg.strVersion == 'numpy')):
+    from find_prf_cpu import find_prf_cpu
+if cfg.strVersion == 'gemm':
+    from find_prf_cpu_gemm import find_prf_cpu_gemm
+if cfg.strVersion == 'gemm_motion':
+    from find_prf_cpu_motion import find_prf_cpu_motion
+    from find_prf_cpu_motion import crt_gram_inv
+if cfg.strVersion == 'ann':
+    from find_prf_cpu_ann import find_prf_cpu_ann
+    from ann_index import ann_bnk
+    from ann_index import ann_chk
+
+
+def ppl_cfg():
+    """
+    Prepare the parameters of the analysis (in config.py) for the analysis.
+
+    Notes
+    -----
+    Converts preprocessing parameters (for temporal and spatial smoothing)
+    from SI units (i.e. [s] and [mm]) into units of data array (volumes and
+    voxels). Needs to be called once, before `ppl_models`.
+    """
+    cfg.varSdSmthTmp = np.divide(cfg.varSdSmthTmp, cfg.varTr)
+    cfg.varSdSmthSpt = np.divide(cfg.varSdSmthSpt, cfg.varVoxRes)
+
+
+def ppl_models():
+    """
+    Create or load the pRF models, and prepare them for the model fitting.
+
+    Parameters
+    ----------
+    Parameters for pRF model creation and preprocessing are imported from
+    config.py file.
+
+    Returns
+    -------
+    dicMdl : dict
+        pRF model time courses (in shared memory, or handle of the model
+        bank, of the compressed models, or of the models created on demand),
+        modelled x-positions, y-positions and SDs, and the other arrays that
+        only depend on the models (full grid for the coarse-to-fine search,
+        inverted Gram matrices, index of the 'ann' version, temporal basis of
+        the compression, stimulus representation for the continuous
+        refinement). They are passed to `ppl_fit`.
+
+    Notes
+    -----
+    The models do not depend on the functional data. They can therefore be
+    prepared once, and be used to fit the data of several subjects (see
+    `daemon.py`).
+    """
+    # The continuous refinement of the pRF parameters needs the compact
+    # stimulus representation (see `model_lazy`), and the uncompressed
+    # functional data:
+    if cfg.lgcRfn:
+        if (not cfg.lgcCrteMdl) or (cfg.strMdlCrt != 'aperture') or cfg.lgcCmp:
+            # Error message:
+            strErrMsg = ('---Error: The continuous refinement of pRF '
+                         + 'parameters requires lgcCrteMdl = True and '
+                         + 'strMdlCrt = \'aperture\', and is not supported '
+                         + 'together with temporal compression.')
+            raise ValueError(strErrMsg)
+
+    if cfg.lgcMdlLzy:
+
+        # Only the compact stimulus representation (unique apertures & their
+        # preprocessed time courses) is created; the fitting processes create
+        # the model time courses one tile at a time (see
+        # `model_creation_lazy.py`):
+        if cfg.strVersion not in ['gemm', 'gemm_motion']:
+            # Error message (the 'ann' version reads the models of each
+            # cluster, which are not consecutive):
+            strErrMsg = ('---Error: Creating pRF models on demand is only '
+                         + 'supported by the \'gemm\' and \'gemm_motion\' '
+                         + 'versions.')
+            raise ValueError(strErrMsg)
+        aryPrfTc = model_lazy()
+
+    elif cfg.strPathBnk is None:
+
+        # Create or load pRF time course models:
+        aryPrfTc = model_creation()
+
+        # Preprocessing of pRF model time courses
+
+        # Number of features (e.g. motion directions):
+        varNumFtr = aryPrfTc.shape[0]
+
+        # Loop through features:
+        for idxFtr in range(varNumFtr):
+            aryPrfTc[idxFtr, :] = pre_pro_models(aryPrfTc[idxFtr, :],
+                                                 varSdSmthTmp=cfg.varSdSmthTmp,
+                                                 varPar=cfg.varPar)
+
+        print('---------Swap axes of aryPrfTc')
+
+        # Change order of axes in order to fit with GPU function, from
+        # aryPrfTc[feature, x-position, y-position, SD, time] to
+        # aryPrfTc[x-position, y-position, SD, time, feature].
+        aryPrfTc = np.moveaxis(aryPrfTc,
+                               [0, 1, 2, 3, 4],
+                               [4, 0, 1, 2, 3])
+
+        # At this point, the pRF model time course have been z-scored. In order
+        # to avoid precision problems during GLM fitting, we scale them up.
+        aryPrfTc = np.multiply(aryPrfTc,
+                               1000.0).astype(np.float32)
+
+    else:
+
+        # Handle of the fitting-ready model bank file (preprocessed, reordered
+        # and scaled model time courses, with model parameters, norms and
+        # validity mask), which can be passed to the fitting functions instead
+        # of the model time courses. The bank is only recreated if the inputs
+        # of model creation or preprocessing have changed, otherwise it is
+        # memory-mapped (see `model_bank()`):
+        aryPrfTc = model_bank()
+
+    # Temporal compression of pRF model time courses (the models are replaced
+    # by the handle of the compressed models). The temporal basis is kept for
+    # the compression of the functional data:
+    aryBss = None
+    if cfg.lgcCmp:
+        if cfg.strVersion not in ['gemm', 'gemm_motion']:
+            # Error message:
+            strErrMsg = ('---Error: Temporal compression is only supported by '
+                         + 'the \'gemm\' and \'gemm_motion\' versions.')
+            raise ValueError(strErrMsg)
+        aryPrfTc, aryBss = crt_cmp_mdl(aryPrfTc,
+                                       lgcDmn=(cfg.strVersion == 'gemm'),
+                                       varCmpEng=cfg.varCmpEng,
+                                       varCmpNum=cfg.varCmpNum)
+
+    # Vector with the moddeled x-positions of the pRFs:
+    vecMdlXpos = np.linspace(cfg.varExtXmin,
+                             cfg.varExtXmax,
+                             cfg.varNumX,
+                             endpoint=True)
+
+    # Vector with the moddeled y-positions of the pRFs:
+    vecMdlYpos = np.linspace(cfg.varExtYmin,
+                             cfg.varExtYmax,
+                             cfg.varNumY,
+                             endpoint=True)
+
+    # Vector with the moddeled standard deviations of the pRFs:
+    vecMdlSd = np.linspace(cfg.varPrfStdMin,
+                           cfg.varPrfStdMax,
+                           cfg.varNumPrfSizes,
+                           endpoint=True)
+
+    # For the coarse-to-fine search, the pRF models are first fitted on a
+    # subsampled grid. The full grid is kept for the refinement:
+    vecMdlXposFll = None
+    vecMdlYposFll = None
+    vecMdlSdFll = None
+    aryPrfTcFll = None
+    if cfg.lgcC2f:
+        if ((cfg.strVersion == 'ann') or cfg.lgcMdlLzy or cfg.lgcCmp):
+            # Error message:
+            strErrMsg = ('---Error: The coarse-to-fine search is not '
+                         + 'supported by the \'ann\' version, and not '
+                         + 'together with models created on demand or '
+                         + 'temporal compression.')
+            raise ValueError(strErrMsg)
+        vecMdlXposFll = vecMdlXpos
+        vecMdlYposFll = vecMdlYpos
+        vecMdlSdFll = vecMdlSd
+        aryPrfTcFll = aryPrfTc
+        vecMdlXpos, vecMdlYpos, vecMdlSd, aryPrfTc = c2f_grid(vecMdlXposFll,
+                                                              vecMdlYposFll,
+                                                              vecMdlSdFll,
+                                                              aryPrfTcFll,
+                                                              cfg.tplC2fStp)
+        print('---------Coarse-to-fine search: '
+              + str(aryPrfTc.shape[0] * aryPrfTc.shape[1] * aryPrfTc.shape[2])
+              + ' models on coarse grid')
+        if isinstance(aryPrfTcFll, np.ndarray):
+            aryPrfTcFll = shm_put(aryPrfTcFll)
+
+    # For the 'gemm_motion' version, the inverted Gram matrices of the pRF
+    # models (which do not depend on the functional data) are computed once (or
+    # loaded from the cache), and shared with all parallel processes. If the
+    # models are created on demand, the Gram matrices are computed for each
+    # tile of models by the parallel processes instead:
+    aryGramInv = None
+    if ((cfg.strVersion == 'gemm_motion')
+            and (not isinstance(aryPrfTc, MdlLzy))):
+        print('---------Invert Gram matrices of pRF models')
+        aryGramInv = cch_call(cfg.strDirCch, 'gram_inv', crt_gram_inv,
+                              (bnk_get(aryPrfTc), cfg.varL2reg),
+                              varCchMax=cfg.varCchMax)
+        aryGramInv = shm_put(aryGramInv)
+
+    # Place pRF model time courses in shared memory, so that all parallel
+    # processes access the same copy (instead of copying the array into each
+    # process). This is not necessary if the model time courses are in a model
+    # bank file, which is memory-mapped by each process, if the models are
+    # created on demand, or if they have been compressed (and placed in shared
+    # memory).
+    if isinstance(aryPrfTc, np.ndarray):
+        aryPrfTc = shm_put(aryPrfTc)
+
+    # For the 'ann' version, the index of the pRF models is created (or loaded
+    # with the model bank), and shared with all parallel processes:
+    aryAnnCtr = None
+    vecAnnIdx = None
+    vecAnnPtr = None
+    if cfg.strVersion == 'ann':
+        aryAnnCtr, vecAnnIdx, vecAnnPtr = ann_bnk(aryPrfTc,
+                                                  varNumClst=cfg.varAnnClst)
+        aryAnnCtr = shm_put(aryAnnCtr)
+        vecAnnIdx = shm_put(vecAnnIdx)
+        vecAnnPtr = shm_put(vecAnnPtr)
+
+    # For the continuous refinement of the pRF parameters, the compact stimulus
+    # representation (unique apertures & their preprocessed time courses):
+    objStm = None
+    if cfg.lgcRfn:
+        if isinstance(aryPrfTc, MdlLzy):
+            objStm = aryPrfTc
+        else:
+            objStm = model_lazy()
+
+    return {'aryPrfTc': aryPrfTc,
+            'vecMdlXpos': vecMdlXpos,
+            'vecMdlYpos': vecMdlYpos,
+            'vecMdlSd': vecMdlSd,
+            'aryPrfTcFll': aryPrfTcFll,
+            'vecMdlXposFll': vecMdlXposFll,
+            'vecMdlYposFll': vecMdlYposFll,
+            'vecMdlSdFll': vecMdlSdFll,
+            'aryGramInv': aryGramInv,
+            'aryAnnCtr': aryAnnCtr,
+            'vecAnnIdx': vecAnnIdx,
+            'vecAnnPtr': vecAnnPtr,
+            'aryBss': aryBss,
+            'objStm': objStm}
+
+
+def ppl_func(strPathNiiMask, lstPathNiiFunc, varPar=None):
+    """
+    Load and preprocess the functional data.
+
+    Parameters
+    ----------
+    strPathNiiMask : str
+        Path of the mask (only voxels within the mask are fitted).
+    lstPathNiiFunc : list
+        Paths of the functional runs.
+    varPar : int or None
+        Number of parallel processes (if None, `cfg.varPar`).
+
+    Returns
+    -------
+    tplFunc : tuple
+        Mask, header and affine of the mask, voxels included in the fitting,
+        preprocessed functional data, and shape of the images (see
+        `pre_pro_func`), to be passed to `ppl_fit`.
+
+    Notes
+    -----
+    The result is stored in the on-disk cache, and only recomputed if the
+    input files or preprocessing parameters change.
+    """
+    if varPar is None:
+        varPar = cfg.varPar
+    return cch_call(
+        cfg.strDirCch, 'func', pre_pro_func,
+        (strPathNiiMask, lstPathNiiFunc),
+        {'lgcLinTrnd': cfg.lgcLinTrnd, 'varSdSmthTmp': cfg.varSdSmthTmp,
+         'varSdSmthSpt': cfg.varSdSmthSpt, 'varPar': varPar},
+        varCchMax=cfg.varCchMax)
+
+
+def ppl_fit(dicMdl, strPathNiiMask, lstPathNiiFunc, strPathOut, tplFunc=None,
+            varPar=None, lstVar=None):
+    """
+    Fit the pRF models to functional data, and export the results.
+
+    Parameters
+    ----------
+    dicMdl : dict
+        pRF models (see `ppl_models`).
+    strPathNiiMask : str
+        Path of the mask (only voxels within the mask are fitted).
+    lstPathNiiFunc : list
+        Paths of the functional runs.
+    strPathOut : str
+        Path (prefix) of the output images, e.g. `<strPathOut>_R2.nii`.
+    tplFunc : tuple or None
+        Preprocessed functional data (see `ppl_func`). If None, the data are
+        loaded and preprocessed first.
+    varPar : int or None
+        Number of parallel processes (if None, `cfg.varPar`).
+    lstVar : list or None
+        Variants of the functional data, which are fitted instead of
+        `lstPathNiiFunc` (list of tuples with the suffix of the output images
+        and the paths of the functional runs of each variant, see `lstVar` in
+        config.py).
+
+    Notes
+    -----
+    Other parameters of the analysis are imported from config.py file. If the
+    fitting is split into shards (see `varNumShrd`), the partial results of
+    the shard are saved instead of the output images (see `shards.py`).
+
+    The variants are stacked along the voxel axis, and every task of the
+    model fitting contains a part of each variant, so that the fitting
+    functions score each block of models against the time courses of all
+    variants while the block is in memory (the models are read once per
+    task, instead of once per task and variant). The results are split into
+    the variants again before the export.
+    """
+    # pRF models:
+    aryPrfTc = dicMdl['aryPrfTc']
+    vecMdlXpos = dicMdl['vecMdlXpos']
+    vecMdlYpos = dicMdl['vecMdlYpos']
+    vecMdlSd = dicMdl['vecMdlSd']
+    aryPrfTcFll = dicMdl['aryPrfTcFll']
+    vecMdlXposFll = dicMdl['vecMdlXposFll']
+    vecMdlYposFll = dicMdl['vecMdlYposFll']
+    vecMdlSdFll = dicMdl['vecMdlSdFll']
+    aryGramInv = dicMdl['aryGramInv']
+    aryAnnCtr = dicMdl['aryAnnCtr']
+    vecAnnIdx = dicMdl['vecAnnIdx']
+    vecAnnPtr = dicMdl['vecAnnPtr']
+    objStm = dicMdl['objStm']
+
+    if varPar is None:
+        varPar = cfg.varPar
+
+    # Preprocessing of functional data (of each variant):
+    if lstVar is None:
+        if tplFunc is None:
+            tplFunc = ppl_func(strPathNiiMask, lstPathNiiFunc, varPar=varPar)
+        lstPre = [tplFunc]
+        lstPathOut = [strPathOut]
+    else:
+        lstPre = [ppl_func(strPathNiiMask, lstPthTmp, varPar=varPar)
+                  for _, lstPthTmp in lstVar]
+        lstPathOut = [(strPathOut + strSfx) for strSfx, _ in lstVar]
+    del(tplFunc)
+    aryLgcMsk, hdrMsk, aryAff, _, _, tplNiiShp = lstPre[0]
+
+    # Voxels of each variant that are included in the fitting:
+    lstLgcVar = [tplTmp[3] for tplTmp in lstPre]
+
+    # All variants need to have the same design as the models:
+    if len(set([tplTmp[4].shape[1] for tplTmp in lstPre])) > 1:
+        # Error message:
+        strErrMsg = ('---Error: The variants of the functional data need to '
+                     + 'have the same number of volumes: '
+                     + ', '.join([str(tplTmp[4].shape[1])
+                                  for tplTmp in lstPre]))
+        raise ValueError(strErrMsg)
+
+    # The variants are stacked along the voxel axis (the first voxel of each
+    # variant is at `vecVarPtr[idxVar]`):
+    vecVarPtr = np.cumsum([0] + [tplTmp[4].shape[0] for tplTmp in lstPre])
+    if len(lstPre) == 1:
+        aryFunc = lstPre[0][4]
+    else:
+        aryFunc = np.concatenate([tplTmp[4] for tplTmp in lstPre], axis=0)
+        print('---------Number of variants of the functional data: '
+              + str(len(lstPre)))
+    del(lstPre)
+
+    # For the GPU version, the model fitting is not parallelised over CPU
+    # processes (only the preprocessing):
+    if cfg.strVersion == 'gpu':
+        varPar = 1
+
+    # At this point, the funtional time courses have been z-scored. In order to
+    # avoid precision problems during GLM fitting, we scale them up.
+    aryFunc = np.multiply(aryFunc,
+                          1000.0).astype(np.float32)
+
+    # Temporal compression of functional data (onto the temporal basis of the
+    # compressed models):
+    if dicMdl['aryBss'] is not None:
+        aryFunc = crt_cmp_func(aryFunc,
+                               dicMdl['aryBss'],
+                               lgcDmn=(cfg.strVersion == 'gemm'))
+
+    print('------Find pRF models for voxel time courses')
+
+    # If the voxels are split into shards, only the voxels of this shard are
+    # fitted (the split only depends on the number of voxels that are included
+    # in the fitting, so that all shards use the same split):
+    tplShrdRng = (0, aryFunc.shape[0])
+    if (cfg.varNumShrd is not None) and (cfg.strShrdAxs == 'voxels'):
+        tplShrdRng = shrd_rng(aryFunc.shape[0], cfg.varIdxShrd, cfg.varNumShrd)
+        aryFunc = aryFunc[tplShrdRng[0]:tplShrdRng[1], :]
+        print('---------Voxels of shard: ' + str(tplShrdRng[0]) + ' to '
+              + str(tplShrdRng[1]))
+
+    # Number of voxels for which pRF finding will be performed:
+    varNumVoxInc = aryFunc.shape[0]
+
+    print('---------Number of voxels on which pRF finding will be performed: '
+          + str(varNumVoxInc))
+
+    # Vector with the indicies at which the functional data will be separated
+    # in order to be chunked up into tasks. There are more tasks than parallel
+    # processes, and the processes take on tasks one at a time (see
+    # `scheduler.py`), so that faster processes take on more tasks:
+    varNumVar = vecVarPtr.shape[0] - 1
+    if varNumVar == 1:
+        vecIdxChnks = sch_chunks(varNumVoxInc, varPar,
+                                 varTskSze=cfg.varVoxTsk)
+        vecVoxOrd = None
+    else:
+        # With several variants, the voxels of each variant are split into
+        # the same number of tasks (as many as for the largest variant on its
+        # own), and each task contains one part of every variant. The voxels
+        # are reordered so that the parts of each task are adjacent. Each
+        # block of models is thus scored against all variants while it is in
+        # memory (the models are read once per task, not once per variant).
+        varNumChnk = sch_chunks(np.max(np.diff(vecVarPtr)), varPar,
+                                varTskSze=cfg.varVoxTsk).shape[0] - 1
+        # First voxel of each task within each variant, with shape
+        # aryVarChnk[variant, task + 1]:
+        aryVarChnk = np.array(
+            [np.around(np.linspace(0, varTmp, (varNumChnk + 1)))
+             for varTmp in np.diff(vecVarPtr)], dtype=np.int64)
+        # Order of the voxels (for each task, the parts of all variants):
+        vecVoxOrd = np.concatenate(
+            [np.arange((vecVarPtr[idxVar] + aryVarChnk[idxVar, idxChnk]),
+                       (vecVarPtr[idxVar] + aryVarChnk[idxVar, (idxChnk + 1)]))
+             for idxChnk in range(varNumChnk)
+             for idxVar in range(varNumVar)]).astype(np.int64)
+        aryFunc = aryFunc[vecVoxOrd, :]
+        vecIdxChnks = np.hstack(
+            ([0], np.cumsum(np.sum(np.diff(aryVarChnk, axis=1), axis=0))
+             )).astype(np.int64)
+    varNumChnk = vecIdxChnks.shape[0] - 1
+
+    # For the versions that fit blocks of models, the models can also be split
+    # into tasks, and into shards (the boundaries are aligned with the blocks
+    # of models, so that the results are the same as without splitting):
+    varNumMdls = len(vecMdlXpos) * len(vecMdlYpos) * len(vecMdlSd)
+    if cfg.strVersion == 'gemm':
+        varTmpAln = cfg.varMdlBlk
+    else:
+        varTmpAln = cfg.varMdlBlkMtn
+    tplMdlRng = (0, varNumMdls)
+    if (cfg.varNumShrd is not None) and (cfg.strShrdAxs == 'models'):
+        tplMdlRng = shrd_rng(varNumMdls, cfg.varIdxShrd, cfg.varNumShrd,
+                             varAln=varTmpAln)
+        tplShrdRng = tplMdlRng
+        if tplMdlRng[0] == tplMdlRng[1]:
+            # Error message:
+            strErrMsg = ('---Error: There are more shards than blocks of '
+                         + 'models, shard ' + str(cfg.varIdxShrd)
+                         + ' has no models.')
+            raise ValueError(strErrMsg)
+        print('---------Models of shard: ' + str(tplMdlRng[0]) + ' to '
+              + str(tplMdlRng[1]))
+    if ((cfg.strVersion in ['gemm', 'gemm_motion'])
+            and (cfg.varMdlTsk is not None)):
+        vecIdxMdls = np.add(sch_chunks((tplMdlRng[1] - tplMdlRng[0]), varPar,
+                                       varTskSze=cfg.varMdlTsk,
+                                       varAln=varTmpAln),
+                            tplMdlRng[0])
+    else:
+        vecIdxMdls = np.array(tplMdlRng, dtype=np.int64)
+    varNumSeg = vecIdxMdls.shape[0] - 1
+
+    # List into which the chunks of functional data for the parallel processes
+    # will be put:
+    lstFunc = [None] * varNumChnk
+
+    # Number of features of the pRF models (betas per model):
+    if len(tuple(aryPrfTc.shape)) == 5:
+        varNumFtr = tuple(aryPrfTc.shape)[4]
+    else:
+        varNumFtr = 1
+
+    # Shared output array for the parameters of the best fitting pRF model, of
+    # the form aryBstPrm[voxel, parameter], where the 2nd dimension contains
+    # (0) pRF-x-pos, (1) pRF-y-pos, (2) pRF-SD, (3) pRF-R2, and (4) and
+    # following the betas of the model (one per feature). The parallel
+    # processes write their results directly into their chunk of this array.
+    aryBstPrm = shm_alloc((varNumVoxInc, (4 + varNumFtr)), np.float32)
+
+    # List for the corresponding chunks of the output array:
+    lstBstPrm = [None] * varNumChnk
+
+    # Shared output array for the best k models of each voxel (if requested),
+    # of the form aryTpk[voxel, k, 2], with the model indices (in the order of
+    # `crt_mdl_prms`) in aryTpk[:, :, 0] and their R2 in aryTpk[:, :, 1], and
+    # list for the corresponding chunks:
+    lstTpk = [None] * varNumChnk
+    if cfg.varTopK is not None:
+        if cfg.lgcC2f:
+            # Error message:
+            strErrMsg = ('---Error: Retaining the best k models is not '
+                         + 'supported together with the coarse-to-fine '
+                         + 'search.')
+            raise ValueError(strErrMsg)
+        aryTpk = shm_alloc((varNumVoxInc, int(cfg.varTopK), 2), np.float64)
+
+    # Checkpoints of the fitting (if requested). The run is identified by the
+    # parameters of the analysis, the functional data, and the first block of
+    # pRF model time courses, so that the checkpoints of a different run are
+    # not used:
+    if cfg.strDirCkp is not None:
+        ckp_init(cfg.strDirCkp,
+                 [ckp_cfg(cfg),
+                  aryFunc,
+                  bnk_tile(aryPrfTc, 0, min(cfg.varMdlBlk,
+                                            (aryPrfTc.shape[0]
+                                             * aryPrfTc.shape[1]
+                                             * aryPrfTc.shape[2])))])
+
+    # Place functional data in shared memory:
+    aryFunc = shm_put(aryFunc)
+
+    # Put functional data into chunks (the chunks refer to the shared memory,
+    # the data is not copied):
+    for idxChnk in range(0, varNumChnk):
+        # Index of first voxel to be included in current chunk:
+        varTmpChnkSrt = int(vecIdxChnks[idxChnk])
+        # Index of last voxel to be included in current chunk:
+        varTmpChnkEnd = int(vecIdxChnks[(idxChnk+1)])
+        # Put voxel array into list:
+        lstFunc[idxChnk] = shm_chunk(aryFunc, varTmpChnkSrt, varTmpChnkEnd)
+        # Corresponding chunk of the output array:
+        lstBstPrm[idxChnk] = shm_chunk(aryBstPrm, varTmpChnkSrt, varTmpChnkEnd)
+        if cfg.varTopK is not None:
+            lstTpk[idxChnk] = shm_chunk(aryTpk, varTmpChnkSrt, varTmpChnkEnd)
+
+    # For the 'ann' version, the results for a random sample of voxels are
+    # compared with an exhaustive search (after the pRF finding):
+    if cfg.strVersion == 'ann':
+        vecAnnChk = np.random.RandomState(0).choice(
+            varNumVoxInc,
+            min(int(np.ceil(cfg.varAnnChk * varNumVoxInc)), varNumVoxInc),
+            replace=False)
+        aryAnnChk = np.array(shm_get(aryFunc)[vecAnnChk, :])
+
+    # Same for the coarse-to-fine search:
+    if cfg.lgcC2f:
+        vecC2fChk = np.random.RandomState(0).choice(
+            varNumVoxInc,
+            min(int(np.ceil(cfg.varC2fChk * varNumVoxInc)), varNumVoxInc),
+            replace=False)
+        aryC2fChk = np.array(shm_get(aryFunc)[vecC2fChk, :])
+
+    # We don't need the original array with the functional data anymore:
+    del(aryFunc)
+
+    # Tasks of the model fitting (chunk of voxels, range of models, and output
+    # arrays of each task). If the models are split, each range of models has
+    # its own output arrays, which are merged after the fitting:
+    if varNumSeg > 1:
+        aryBstPrt = shm_alloc(((varNumSeg * varNumVoxInc), (4 + varNumFtr)),
+                              np.float32)
+        if cfg.varTopK is not None:
+            aryTpkPrt = shm_alloc(((varNumSeg * varNumVoxInc),
+                                   int(cfg.varTopK), 2), np.float64)
+    lstTsk = []
+    for idxSeg in range(0, varNumSeg):
+        for idxChnk in range(0, varNumChnk):
+            if varNumSeg == 1:
+                objTmpOut = lstBstPrm[idxChnk]
+                objTmpTpk = lstTpk[idxChnk]
+            else:
+                varTmpChnkSrt = (idxSeg * varNumVoxInc
+                                 + int(vecIdxChnks[idxChnk]))
+                varTmpChnkEnd = (idxSeg * varNumVoxInc
+                                 + int(vecIdxChnks[(idxChnk+1)]))
+                objTmpOut = shm_chunk(aryBstPrt, varTmpChnkSrt, varTmpChnkEnd)
+                objTmpTpk = None
+                if cfg.varTopK is not None:
+                    objTmpTpk = shm_chunk(aryTpkPrt, varTmpChnkSrt,
+                                          varTmpChnkEnd)
+            lstTsk.append((idxChnk,
+                           (int(vecIdxMdls[idxSeg]),
+                            int(vecIdxMdls[(idxSeg+1)])),
+                           objTmpOut,
+                           objTmpTpk,
+                           ckp_path(cfg.strDirCkp, 'fit', len(lstTsk),
+                                    '_blk')))
+
+    print('---------Number of tasks: ' + str(len(lstTsk)) + ' ('
+          + str(varNumChnk) + ' chunks of voxels, ' + str(varNumSeg)
+          + ' ranges of models)')
+
+    # CPU version (using numpy or cython for pRF finding):
+    if ((cfg.strVersion == 'numpy') or (cfg.strVersion == 'cython')):
+
+        print('---------pRF finding on CPU')
+
+        # Function & arguments of the parallel processes:
+        fncFit = find_prf_cpu
+        lstArgs = [(-1,
+                    vecMdlXpos,
+                    vecMdlYpos,
+                    vecMdlSd,
+                    lstFunc[idxChnk],
+                    aryPrfTc,
+                    cfg.strVersion,
+                    objOut,
+                    objTpk)
+                   for idxChnk, tplRng, objOut, objTpk, strCkp in lstTsk]
+
+    # CPU version (fitting blocks of models with one matrix multiplication):
+    elif cfg.strVersion == 'gemm':
+
+        print('---------pRF finding on CPU (gemm)')
+
+        # Function & arguments of the parallel processes:
+        fncFit = find_prf_cpu_gemm
+        lstArgs = [(-1,
+                    vecMdlXpos,
+                    vecMdlYpos,
+                    vecMdlSd,
+                    lstFunc[idxChnk],
+                    aryPrfTc,
+                    objOut,
+                    cfg.varMdlBlk,
+                    objTpk,
+                    strCkp,
+                    cfg.varCkpIntv,
+                    tplRng)
+                   for idxChnk, tplRng, objOut, objTpk, strCkp in lstTsk]
+
+    # CPU version for models with several predictors (e.g. motion directions):
+    elif cfg.strVersion == 'gemm_motion':
+
+        print('---------pRF finding on CPU (gemm_motion)')
+
+        # Function & arguments of the parallel processes:
+        fncFit = find_prf_cpu_motion
+        lstArgs = [(-1,
+                    vecMdlXpos,
+                    vecMdlYpos,
+                    vecMdlSd,
+                    lstFunc[idxChnk],
+                    aryPrfTc,
+                    cfg.varL2reg,
+                    objOut,
+                    cfg.varMdlBlkMtn,
+                    aryGramInv,
+                    objTpk,
+                    strCkp,
+                    cfg.varCkpIntv,
+                    tplRng)
+                   for idxChnk, tplRng, objOut, objTpk, strCkp in lstTsk]
+
+    # CPU version (searching an index of the pRF models):
+    elif cfg.strVersion == 'ann':
+
+        print('---------pRF finding on CPU (ann)')
+
+        # Function & arguments of the parallel processes:
+        fncFit = find_prf_cpu_ann
+        lstArgs = [(-1,
+                    vecMdlXpos,
+                    vecMdlYpos,
+                    vecMdlSd,
+                    lstFunc[idxChnk],
+                    aryPrfTc,
+                    aryAnnCtr,
+                    vecAnnIdx,
+                    vecAnnPtr,
+                    objOut,
+                    cfg.varAnnPrb,
+                    objTpk)
+                   for idxChnk, tplRng, objOut, objTpk, strCkp in lstTsk]
+
+    # GPU version (using tensorflow for pRF finding):
+    elif cfg.strVersion == 'gpu':
+
+        print('---------pRF finding on GPU')
+
+        # Function & arguments of the parallel processes:
+        fncFit = find_prf_gpu
+        lstArgs = [(-1,
+                    vecMdlXpos,
+                    vecMdlYpos,
+                    vecMdlSd,
+                    lstFunc[idxChnk],
+                    aryPrfTc,
+                    cfg.varL2reg,
+                    objOut,
+                    objTpk)
+                   for idxChnk, tplRng, objOut, objTpk, strCkp in lstTsk]
+
+    print('---------Creating parallel processes')
+
+    # Run the tasks on the parallel processes. Tasks that have been completed
+    # in an interrupted run are loaded from the checkpoint directory, and tasks
+    # that fail are started again (see `checkpoint.py`). The results are only
+    # complete if all tasks have finished successfully:
+    ckp_run(cfg.strDirCkp, 'fit', fncFit, lstArgs,
+            [(objOut, objTpk)
+             for idxChnk, tplRng, objOut, objTpk, strCkp in lstTsk],
+            varPar,
+            varNumRtr=cfg.varCkpRtr)
+
+    # Merge the results of the ranges of models (best model, and best k models,
+    # of all ranges):
+    if varNumSeg > 1:
+        shm_get(aryBstPrm)[...] = sch_merge(shm_get(aryBstPrt), varNumSeg)
+        del(aryBstPrt)
+        if cfg.varTopK is not None:
+            shm_get(aryTpk)[...] = tpk_merge(shm_get(aryTpkPrt), varNumSeg)
+            del(aryTpkPrt)
+
+    # Delete reference to list with function data (the data continues to exists
+    # in shared memory). The coarse-to-fine search and the continuous
+    # refinement need the chunks later on:
+    del(lstArgs)
+    del(lstTsk)
+    if not (cfg.lgcC2f or cfg.lgcRfn):
+        del(lstFunc)
+
+    # Coarse-to-fine search: Refine the results of the coarse search on the
+    # full grid (the results in the shared output array are replaced):
+    if cfg.lgcC2f:
+
+        print('---------Coarse-to-fine search: refine on full grid')
+
+        # Number of pRF models that are fitted at once:
+        if cfg.strVersion in ['gemm_motion', 'gpu']:
+            varC2fBlk = cfg.varMdlBlkMtn
+        else:
+            varC2fBlk = cfg.varMdlBlk
+
+        # Arguments of the tasks (one per chunk of voxels):
+        lstArgs = [(-1,
+                    vecMdlXposFll,
+                    vecMdlYposFll,
+                    vecMdlSdFll,
+                    lstFunc[idxChnk],
+                    aryPrfTcFll,
+                    cfg.strVersion,
+                    cfg.varL2reg,
+                    lstBstPrm[idxChnk],
+                    cfg.tplC2fNgb,
+                    varC2fBlk)
+                   for idxChnk in range(0, varNumChnk)]
+
+        ckp_run(cfg.strDirCkp, 'c2f', c2f_refine, lstArgs,
+                [(lstBstPrm[idxChnk],) for idxChnk in range(0, varNumChnk)],
+                varPar,
+                varNumRtr=cfg.varCkpRtr)
+
+        del(lstArgs)
+        if not cfg.lgcRfn:
+            del(lstFunc)
+
+        # Agreement with an exhaustive search on the full grid:
+        if vecC2fChk.shape[0] > 0:
+            print('---------Compare with exhaustive search ('
+                  + str(vecC2fChk.shape[0]) + ' voxels)')
+            varC2fAgr, vecC2fR2Dff = c2f_chk(vecMdlXposFll,
+                                             vecMdlYposFll,
+                                             vecMdlSdFll,
+                                             aryC2fChk,
+                                             aryPrfTcFll,
+                                             shm_get(aryBstPrm)[vecC2fChk, :],
+                                             cfg.strVersion,
+                                             cfg.varL2reg,
+                                             varMdlBlk=varC2fBlk)
+            print('------------Same model as exhaustive search: '
+                  + str(np.around((100.0 * varC2fAgr), decimals=2)) + ' %')
+            print('------------Loss of R2 (mean / max): '
+                  + str(np.mean(vecC2fR2Dff)) + ' / '
+                  + str(np.max(vecC2fR2Dff)))
+
+    # Agreement of the 'ann' version with an exhaustive search:
+    if (cfg.strVersion == 'ann') and (vecAnnChk.shape[0] > 0):
+        print('---------Compare with exhaustive search ('
+              + str(vecAnnChk.shape[0]) + ' voxels)')
+        varAnnAgr, vecAnnR2Dff = ann_chk(vecMdlXpos,
+                                         vecMdlYpos,
+                                         vecMdlSd,
+                                         aryAnnChk,
+                                         aryPrfTc,
+                                         shm_get(aryBstPrm)[vecAnnChk, :],
+                                         varMdlBlk=cfg.varMdlBlk)
+        print('------------Same model as exhaustive search: '
+              + str(np.around((100.0 * varAnnAgr), decimals=2)) + ' %')
+        print('------------Loss of R2 (mean / max): '
+              + str(np.mean(vecAnnR2Dff)) + ' / ' + str(np.max(vecAnnR2Dff)))
+
+    # Continuous refinement of the pRF parameters, starting from the results of
+    # the grid search (the results in the shared output array are replaced):
+    if cfg.lgcRfn:
+
+        print('---------Continuous refinement of pRF parameters')
+
+        # Arguments of the tasks (one per chunk of voxels):
+        lstArgs = [(-1,
+                    lstFunc[idxChnk],
+                    objStm,
+                    (cfg.varExtXmin,
+                     cfg.varExtXmax,
+                     cfg.varExtYmin,
+                     cfg.varExtYmax),
+                    cfg.tplVslSpcSze,
+                    (cfg.varPrfStdMin,
+                     cfg.varPrfStdMax),
+                    (cfg.strVersion not in ['gemm_motion', 'gpu']),
+                    cfg.varL2reg,
+                    lstBstPrm[idxChnk],
+                    cfg.varRfnIter,
+                    cfg.varRfnBtch)
+                   for idxChnk in range(0, varNumChnk)]
+
+        ckp_run(cfg.strDirCkp, 'rfn', rfn_prf, lstArgs,
+                [(lstBstPrm[idxChnk],) for idxChnk in range(0, varNumChnk)],
+                varPar,
+                varNumRtr=cfg.varCkpRtr)
+
+        del(lstArgs)
+        del(lstFunc)
+
+    print('---------Prepare pRF finding results for export')
+
+    # The fitting results have been written into the shared output array (in
+    # the same order as the voxels that were included in the fitting):
+    aryBstPrm = shm_get(aryBstPrm)
+    if cfg.varTopK is not None:
+        aryTpk = shm_get(aryTpk)
+    else:
+        aryTpk = None
+
+    # With several variants, the voxels are put back into the order of the
+    # variants:
+    if vecVoxOrd is not None:
+        aryTmp = np.empty_like(aryBstPrm)
+        aryTmp[vecVoxOrd, :] = aryBstPrm
+        aryBstPrm = aryTmp
+        if aryTpk is not None:
+            aryTmp = np.empty_like(aryTpk)
+            aryTmp[vecVoxOrd, :, :] = aryTpk
+            aryTpk = aryTmp
+        del(aryTmp)
+
+    if cfg.varNumShrd is None:
+
+        # Export the results of each variant as nii images (the voxels are
+        # put back into the original format of the images):
+        for idxVar in range(vecVarPtr.shape[0] - 1):
+            if len(lstPathOut) > 1:
+                print('---------Variant: ' + lstPathOut[idxVar])
+            varTmp01 = vecVarPtr[idxVar]
+            varTmp02 = vecVarPtr[idxVar + 1]
+            exp_prf(aryBstPrm[varTmp01:varTmp02, :],
+                    aryLgcMsk,
+                    lstLgcVar[idxVar],
+                    aryAff,
+                    hdrMsk,
+                    tplNiiShp,
+                    lstPathOut[idxVar],
+                    aryTpk=(None if aryTpk is None
+                            else aryTpk[varTmp01:varTmp02, :, :]),
+                    tplMdlGrd=(vecMdlXpos, vecMdlYpos, vecMdlSd),
+                    lstMtnDir=cfg.lstMtnDir)
+
+    else:
+
+        # The partial results of the shard are saved, and the output images are
+        # created after all shards have finished (see `merge_shards.py`):
+        print('---------Saving results of shard ' + str(cfg.varIdxShrd))
+        shrd_save(strPathOut,
+                  cfg.varIdxShrd,
+                  cfg.varNumShrd,
+                  cfg.strShrdAxs,
+                  tplShrdRng,
+                  aryBstPrm,
+                  aryTpk,
+                  aryLgcMsk,
+                  lstLgcVar[0],
+                  aryAff,
+                  tplNiiShp,
+                  (vecMdlXpos, vecMdlYpos, vecMdlSd))
@@ -22,6 +22,11 @@ import time
 import multiprocessing as mp
 from scipy.ndimage.filters import gaussian_filter
 from scipy.ndimage.filters import gaussian_filter1d
+from shared_arrays import shm_put
+from shared_arrays import shm_get
+from shared_arrays import shm_chunk
+from scheduler import sch_chunks
+from scheduler import sch_run
 
 
 def pre_pro_par(aryFunc, aryMask=np.array([], dtype=np.int16),  #noqa
@@ -74,7 +79,10 @@ def pre_pro_par(aryFunc, aryMask=np.array([], dtype=np.int16),  #noqa
         """
         Parallelize over another function.
 
-        Data is chunked into arrays of one-dimensional voxel time courses.
+        Data is chunked into arrays of one-dimensional voxel time courses,
+        which are handed to the parallel processes one at a time (see
+        `scheduler.py`). The parallel processes write their results back into
+        their chunk of the (shared) input array.
         """
         # Shape of input data:
         vecInShp = aryData.shape
@@ -82,15 +90,6 @@ def pre_pro_par(aryFunc, aryMask=np.array([], dtype=np.int16),  #noqa
         # Number of volumes:
         varNumVol = vecInShp[3]
 
-        # Empty list for results:
-        lstResPar = [None] * varPar
-
-        # Empty list for processes:
-        lstPrcs = [None] * varPar
-
-        # Create a queue to put the results in:
-        queOut = mp.Queue()
-
         # Total number of elements to loop over (voxels):
         varNumEleTlt = (vecInShp[0] * vecInShp[1] * vecInShp[2])
 
@@ -125,89 +124,65 @@ def pre_pro_par(aryFunc, aryMask=np.array([], dtype=np.int16),  #noqa
             print('------------Number of voxels/pRF time courses on which '
                   + 'function will be applied: ' + str(varNumEleInc))
 
+        # Vector with the indicies at which the data will be separated in order
+        # to be chunked up into tasks for the parallel processes:
+        vecIdxChnks = sch_chunks(varNumEleInc, varPar)
+        varNumChnk = vecIdxChnks.shape[0] - 1
+
         # List into which the chunks of data for the parallel processes will be
         # put:
-        lstFunc = [None] * varPar
+        lstFunc = [None] * varNumChnk
 
-        # Vector with the indicies at which the data will be separated in order
-        # to be chunked up for the parallel processes:
-        vecIdxChnks = np.linspace(0,
-                                  varNumEleInc,
-                                  num=varPar,
-                                  endpoint=False)
-        vecIdxChnks = np.hstack((vecIdxChnks, varNumEleInc))
+        # Place data in shared memory, so that the parallel processes can
+        # access their chunk without copying it. The results are written into
+        # the same shared array (each process only reads and writes its own
+        # chunk):
+        aryData = shm_put(aryData)
 
-        # Put data into chunks:
-        for idxChnk in range(0, varPar):
+        # Put data into chunks (the chunks refer to the shared memory, the data
+        # is not copied):
+        for idxChnk in range(0, varNumChnk):
             # Index of first element to be included in current chunk:
             varTmpChnkSrt = int(vecIdxChnks[idxChnk])
             # Index of last element to be included in current chunk:
             varTmpChnkEnd = int(vecIdxChnks[(idxChnk+1)])
             # Put array chunk into list:
-            lstFunc[idxChnk] = aryData[varTmpChnkSrt:varTmpChnkEnd, :]
-
-        # We don't need the original array with the functional data anymore:
-        del(aryData)
+            lstFunc[idxChnk] = shm_chunk(aryData, varTmpChnkSrt,
+                                         varTmpChnkEnd)
 
         if lgcStts:
             print('------------Creating parallel processes')
 
-        # Create processes:
-        for idxPrc in range(0, varPar):
-            lstPrcs[idxPrc] = mp.Process(target=funcIn,
-                                         args=(idxPrc,
-                                               lstFunc[idxPrc],
-                                               varSdSmthTmp,
-                                               queOut))
-            # Daemon (kills processes when exiting):
-            lstPrcs[idxPrc].Daemon = True
-
-        # Start processes:
-        for idxPrc in range(0, varPar):
-            lstPrcs[idxPrc].start()
-
-        # Collect results from queue:
-        for idxPrc in range(0, varPar):
-            lstResPar[idxPrc] = queOut.get(True)
-
-        # Join processes:
-        for idxPrc in range(0, varPar):
-            lstPrcs[idxPrc].join()
+        # Run the tasks on the parallel processes (input and output chunk are
+        # the same). Because the chunks are modified in place, a failed task
+        # cannot be started again, and the results are only complete if all
+        # tasks have finished successfully:
+        sch_run(funcIn,
+                [(idxChnk, lstFunc[idxChnk], varSdSmthTmp, lstFunc[idxChnk])
+                 for idxChnk in range(0, varNumChnk)],
+                varPar,
+                varNumRtr=0,
+                lgcStts=False)
 
         if lgcStts:
             print('------------Post-process data from parallel function')
 
-        # Create list for vectors with results, in order to put the results
-        # into the correct order:
-        lstRes = [None] * varPar
-
-        # Put output into correct order:
-        for idxRes in range(0, varPar):
-
-            # Index of results (first item in output list):
-            varTmpIdx = lstResPar[idxRes][0]
-
-            # Put results into list, in correct order:
-            lstRes[varTmpIdx] = lstResPar[idxRes][1]
-
-        # Merge output vectors (into the same order with which they were put
-        # into this function):
-        aryRes = np.array([], dtype=np.float32).reshape(0, varNumVol)
-        for idxRes in range(0, varPar):
-            aryRes = np.append(aryRes, lstRes[idxRes], axis=0)
+        # The results have been written into the shared array, in the same
+        # order with which the data were put into this function:
+        aryRes = shm_get(aryData)
 
         # Delete unneeded large objects:
-        del(lstRes)
-        del(lstResPar)
-
-        # Array for output, same size as input (i.e. accounting for those
-        # elements that were masked out):
-        aryOut = np.zeros((varNumEleTlt,
-                           vecInShp[3]),
-                          dtype=np.float32)
+        del(lstFunc)
+        del(aryData)
 
         if 0 < aryMask.size:
 
+            # Array for output, same size as input (i.e. accounting for those
+            # elements that were masked out):
+            aryOut = np.zeros((varNumEleTlt,
+                               vecInShp[3]),
+                              dtype=np.float32)
+
             # Put results form pRF finding into array (they originally needed
             # to be saved in a list due to parallelisation). If mask was used,
             # we have to account for leaving out some voxels earlier.
@@ -339,13 +314,17 @@ def pre_pro_par(aryFunc, aryMask=np.array([], dtype=np.int16),  #noqa
     # *************************************************************************
     # *** Linear trend removal for fMRI data
 
-    def funcLnTrRm(idxPrc, aryFuncChnk, varSdSmthSpt, queOut):
+    def funcLnTrRm(idxPrc, aryFuncChnk, varSdSmthSpt, aryOut):
         """
         Perform linear trend removal on the input fMRI data.
 
         The variable varSdSmthSpt is not needed, only included for consistency
-        with other functions using the same parallelisation.
+        with other functions using the same parallelisation. The results are
+        written into the shared output array.
         """
+        # The data may have been placed in shared memory:
+        aryFuncChnk = shm_get(aryFuncChnk)
+
         # Number of voxels in this chunk:
         # varNumVoxChnk = aryFuncChnk.shape[0]
 
@@ -389,14 +368,9 @@ def pre_pro_par(aryFunc, aryMask=np.array([], dtype=np.int16),  #noqa
         # aryFuncChnk = np.subtract(aryFuncChnk,
         #                           aryLstSqFt[1, :])
 
-        # Bring array into original order (time from left to right):
-        aryFuncChnk = aryFuncChnk.T
-
-        # Output list:
-        lstOut = [idxPrc,
-                  aryFuncChnk.astype(np.float32, copy=False)]
-
-        queOut.put(lstOut)
+        # Bring array into original order (time from left to right), and write
+        # results into shared output array:
+        shm_get(aryOut)[...] = aryFuncChnk.T
     # *************************************************************************
 
     # *************************************************************************
@@ -434,12 +408,16 @@ def pre_pro_par(aryFunc, aryMask=np.array([], dtype=np.int16),  #noqa
     # *************************************************************************
     # *** Temporal smoothing of fMRI data & pRF time course models
 
-    def funcSmthTmp(idxPrc, aryFuncChnk, varSdSmthTmp, queOut):
+    def funcSmthTmp(idxPrc, aryFuncChnk, varSdSmthTmp, aryOut):
         """
         Apply temporal smoothing to the input data.
 
         The extend of smoothing needs to be specified as an input parameter.
+        The results are written into the shared output array.
         """
+        # The data may have been placed in shared memory:
+        aryFuncChnk = shm_get(aryFuncChnk)
+
         # For the filtering to perform well at the ends of the time series, we
         # set the method to 'nearest' and place a volume with mean intensity
         # (over time) at the beginning and at the end.
@@ -462,13 +440,8 @@ def pre_pro_par(aryFunc, aryMask=np.array([], dtype=np.int16),  #noqa
                                         truncate=4.0)
 
         # Remove mean-intensity volumes at the beginning and at the end:
-        aryFuncChnk = aryFuncChnk[:, 1:-1]
-
-        # Output list:
-        lstOut = [idxPrc,
-                  aryFuncChnk.astype(np.float32, copy=False)]
-
-        queOut.put(lstOut)
+        # Write results into shared output array:
+        shm_get(aryOut)[...] = aryFuncChnk[:, 1:-1]
     # *************************************************************************
 
     # *************************************************************************
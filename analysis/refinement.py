@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""Continuous refinement of pRF parameters after the grid search."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from shared_arrays import shm_get
+
+
+def rfn_mdl(aryApt, aryDsgn, vecX, vecY, vecSd):
+    """
+    Create pRF model time courses and their derivatives, one per voxel.
+
+    Parameters
+    ----------
+    aryApt : np.array
+        Unique stimulus apertures, with shape aryApt[aperture, pixel, pixel]
+        (see `MdlLzy`).
+    aryDsgn : np.array
+        Preprocessed time courses of the apertures, with shape
+        aryDsgn[feature, aperture, time] (see `MdlLzy`).
+    vecX : np.array
+        x-positions of the pRF models (in pixels, along the second pixel
+        dimension of the apertures), one per voxel.
+    vecY : np.array
+        y-positions of the pRF models (in pixels, along the first pixel
+        dimension of the apertures), one per voxel.
+    vecSd : np.array
+        Sizes of the pRF models (SD of the Gaussian, in pixels), one per
+        voxel.
+
+    Returns
+    -------
+    aryMdl : np.array
+        Model time courses, with shape aryMdl[voxel, time, feature].
+    aryDrv : np.array
+        Derivatives of the model time courses with respect to x-position,
+        y-position and SD, with shape aryDrv[voxel, parameter, time, feature].
+
+    Notes
+    -----
+    The overlap of the 2D Gaussian with an aperture is computed with
+    separable Gaussians, as in `lzy_tile`, but for continuous parameters. The
+    derivatives of the overlaps are computed analytically: the derivative of
+    a 1D Gaussian g(p) = exp(-(p - m)^2 / (2 * s^2)) with respect to the
+    centre m is g(p) * (p - m) / s^2, and with respect to s it is
+    g(p) * (p - m)^2 / s^3 (the normalisation factor 1 / (2 * pi * s^2)
+    contributes -2 / s times the overlap). The model time courses are linear
+    in the overlaps, so their derivatives are the aperture time courses
+    weighted by the derivatives of the overlaps.
+    """
+    # Number of voxels, apertures & pixels:
+    varNumVox = vecX.shape[0]
+    varNumApt, varSzeDim0, varSzeDim1 = aryApt.shape
+    varNumFtr, _, varNumVol = aryDsgn.shape
+
+    # Distances of the pixels from the centres, with shape [voxel, pixel]:
+    aryDstX = np.subtract(np.arange(varSzeDim1)[None, :], vecX[:, None])
+    aryDstY = np.subtract(np.arange(varSzeDim0)[None, :], vecY[:, None])
+    vecVar = np.square(vecSd)[:, None]
+
+    # 1D Gaussians and their derivatives with respect to the centre and the
+    # SD, along the second pixel dimension:
+    aryGssX = np.exp(-np.divide(np.square(aryDstX), (2.0 * vecVar)))
+    aryGssXx = np.multiply(aryGssX, np.divide(aryDstX, vecVar))
+    aryGssXs = np.multiply(aryGssX, np.divide(np.square(aryDstX),
+                                              (vecVar * vecSd[:, None])))
+
+    # Same along the first pixel dimension:
+    aryGssY = np.exp(-np.divide(np.square(aryDstY), (2.0 * vecVar)))
+    aryGssYy = np.multiply(aryGssY, np.divide(aryDstY, vecVar))
+    aryGssYs = np.multiply(aryGssY, np.divide(np.square(aryDstY),
+                                              (vecVar * vecSd[:, None])))
+
+    # Products of the apertures with the Gaussians along the second pixel
+    # dimension (one matrix multiplication for all voxels), with shape
+    # aryAptX[aperture, pixel, gaussian, voxel]:
+    aryAptX = np.dot(np.reshape(aryApt, ((varNumApt * varSzeDim0),
+                                         varSzeDim1)),
+                     np.concatenate((aryGssX, aryGssXx, aryGssXs), axis=0).T)
+    aryAptX = np.reshape(aryAptX, (varNumApt, varSzeDim0, 3, varNumVox))
+
+    # Normalisation factor of the 2D Gaussian:
+    vecNrm = np.divide(1.0, (2.0 * np.pi * np.square(vecSd)))[:, None]
+
+    # Overlaps of the models with the apertures, and their derivatives, with
+    # shape aryOvl[parameter, voxel, aperture] (the first element along the
+    # first dimension holds the overlaps themselves):
+    aryOvl = np.zeros((4, varNumVox, varNumApt))
+    aryOvl[0] = np.einsum('vi,aiv->va', aryGssY, aryAptX[:, :, 0, :])
+    aryOvl[1] = np.einsum('vi,aiv->va', aryGssY, aryAptX[:, :, 1, :])
+    aryOvl[2] = np.einsum('vi,aiv->va', aryGssYy, aryAptX[:, :, 0, :])
+    aryOvl[3] = np.add(np.einsum('vi,aiv->va', aryGssY, aryAptX[:, :, 2, :]),
+                       np.einsum('vi,aiv->va', aryGssYs, aryAptX[:, :, 0, :]))
+    aryOvl = np.multiply(aryOvl, vecNrm[None, :, :])
+    aryOvl[3] = np.subtract(aryOvl[3],
+                            np.multiply(np.divide(2.0, vecSd)[:, None],
+                                        aryOvl[0]))
+
+    # Model time courses and derivatives, with shape aryTc[parameter, voxel,
+    # feature, time]:
+    aryTc = np.dot(np.reshape(aryOvl, ((4 * varNumVox), varNumApt)),
+                   np.reshape(np.transpose(aryDsgn, (1, 0, 2)),
+                              (varNumApt, (varNumFtr * varNumVol))))
+    aryTc = np.reshape(aryTc, (4, varNumVox, varNumFtr, varNumVol))
+    aryTc = np.transpose(aryTc, (1, 0, 3, 2))
+
+    return aryTc[:, 0, :, :], aryTc[:, 1:, :, :]
+
+
+def rfn_beta(aryMdl, aryFunc, varL2reg):
+    """
+    Fit the betas of the models, and compute the cost, for all voxels.
+
+    Parameters
+    ----------
+    aryMdl : np.array
+        Model time courses, with shape aryMdl[voxel, time, feature].
+    aryFunc : np.array
+        Functional data, with shape aryFunc[voxel, time].
+    varL2reg : float
+        L2 regularisation factor for ridge regression.
+
+    Returns
+    -------
+    aryBeta : np.array
+        Betas, with shape aryBeta[voxel, feature].
+    aryRes : np.array
+        Residuals, with shape aryRes[voxel, time].
+    vecCst : np.array
+        Residual sum of squares plus L2 penalty, for each voxel.
+    """
+    varNumFtr = aryMdl.shape[2]
+
+    # Regularised normal equations, one system per voxel:
+    aryGram = np.add(np.matmul(np.transpose(aryMdl, (0, 2, 1)), aryMdl),
+                     np.multiply(np.eye(varNumFtr), varL2reg)[None, :, :])
+    aryXy = np.matmul(np.transpose(aryMdl, (0, 2, 1)), aryFunc[:, :, None])
+
+    # Models without variance (e.g. outside of the stimulated area) get a
+    # beta of zero:
+    vecLgc = np.greater(np.absolute(np.linalg.det(aryGram)), 0.0)
+    aryBeta = np.zeros((aryMdl.shape[0], varNumFtr))
+    aryBeta[vecLgc, :] = np.linalg.solve(aryGram[vecLgc, :, :],
+                                         aryXy[vecLgc, :, :])[:, :, 0]
+
+    aryRes = np.subtract(aryFunc, np.matmul(aryMdl, aryBeta[:, :, None])[:, :,
+                                                                         0])
+    vecCst = np.add(np.sum(np.square(aryRes), axis=1),
+                    np.multiply(varL2reg, np.sum(np.square(aryBeta), axis=1)))
+
+    return aryBeta, aryRes, vecCst
+
+
+def rfn_prf(idxPrc, aryFuncChnk, objStm, tplExt, tplVslSpcSze,  #noqa
+            tplSdExt, lgcDmn, varL2reg, aryOut, varNumIter=10, varRfnBtch=200):
+    """
+    Refine the pRF parameters of the grid search continuously.
+
+    Parameters
+    ----------
+    idxPrc : int
+        Process ID of the process calling this function (for CPU
+        multi-threading).
+    aryFuncChnk : np.array or ShmArray
+        2D array with functional MRI data, with shape aryFunc[voxel, time].
+        Can be placed in shared memory (see `shared_arrays.py`).
+    objStm : MdlLzy
+        Compact representation of the stimulus (unique apertures and their
+        preprocessed time courses, see `model_creation_lazy.py`).
+    tplExt : tuple
+        Extent of the visual space in degrees of visual angle (varExtXmin,
+        varExtXmax, varExtYmin, varExtYmax).
+    tplVslSpcSze : tuple
+        Pixel size of the upsampled visual space (x- and y-dimension).
+    tplSdExt : tuple
+        Minimum and maximum pRF size in degrees of visual angle (the refined
+        sizes are kept within this range).
+    lgcDmn : bool
+        Whether the data and models are de-meaned (i.e. a constant term is
+        fitted, as in the versions with one predictor per model), or not (as
+        in the versions with several predictors).
+    varL2reg : float
+        L2 regularisation factor for ridge regression.
+    aryOut : ShmArray
+        Shared output array (chunk corresponding to the functional data), with
+        shape aryOut[voxel, parameter], containing the results of the grid
+        search. The refined parameters are written into the same array
+        (columns (0) x-position, (1) y-position, (2) SD, and (3) R2, and the
+        betas into the columns (4) and following, if the array has more
+        columns).
+    varNumIter : int
+        Number of iterations.
+    varRfnBtch : int
+        Number of voxels that are refined at once.
+
+    Notes
+    -----
+    The results are not returned, but written into the shared output array.
+    Starting from the winning model of the grid search, x-position,
+    y-position and SD are optimised for all voxels of a batch at once, with
+    Levenberg-Marquardt steps: For each voxel, the Jacobian of the residuals
+    with respect to the betas and the three pRF parameters is formed from
+    the analytic derivatives of the model (see `rfn_mdl`), and the damped
+    normal equations of all voxels are solved at once (one small linear
+    system per voxel). After each step, the betas are fitted again for the
+    new parameters. Steps that do not reduce the cost of a voxel are rejected
+    (and the damping of that voxel is increased). The refined parameters are
+    only kept if they explain more variance than the winning model of the
+    grid search.
+    """
+    # Apertures & aperture time courses (mapping the shared memory):
+    aryApt = shm_get(objStm.apt).astype(np.float64)
+    aryDsgn = shm_get(objStm.dsgn).astype(np.float64)
+    aryFuncChnk = shm_get(aryFuncChnk)
+    aryOut = shm_get(aryOut)
+
+    # Number of voxels to be refined in this chunk:
+    varNumVoxChnk = aryFuncChnk.shape[0]
+
+    # Number of predictors (betas), and number of unknowns per voxel:
+    varNumFtr = aryDsgn.shape[0]
+    varNumPrm = varNumFtr + 3
+
+    # Conversion from degrees of visual angle to pixels of the upsampled
+    # visual space (as in `crt_prf_grid`):
+    varExtXmin, varExtXmax, varExtYmin, varExtYmax = tplExt
+    varSclX = (tplVslSpcSze[0] - 1.0) / (varExtXmax - varExtXmin)
+    varSclY = (tplVslSpcSze[1] - 1.0) / (varExtYmax - varExtYmin)
+    varSclSd = float(tplVslSpcSze[0]) / (varExtXmax - varExtXmin)
+
+    # Range of the parameters (in pixels):
+    aryRng = np.array([[0.0, (tplVslSpcSze[0] - 1.0)],
+                       [0.0, (tplVslSpcSze[1] - 1.0)],
+                       [(tplSdExt[0] * varSclSd), (tplSdExt[1] * varSclSd)]])
+
+    # L2 penalty only applies to the betas:
+    vecL2reg = np.zeros(varNumPrm)
+    vecL2reg[0:varNumFtr] = varL2reg
+
+    # Prepare status indicator if this is the first of the parallel processes:
+    if idxPrc == 0:
+        vecStatBtch = np.arange(0, varNumVoxChnk, varRfnBtch)
+        print('------------Refining ' + str(varNumVoxChnk) + ' voxels in '
+              + str(vecStatBtch.shape[0]) + ' batches (first process)')
+
+    # Loop through batches of voxels:
+    for varBtchSrt in range(0, varNumVoxChnk, varRfnBtch):
+
+        varBtchEnd = min((varBtchSrt + varRfnBtch), varNumVoxChnk)
+
+        # Functional data of the current batch, with shape aryFunc[voxel,
+        # time]:
+        aryFunc = aryFuncChnk[varBtchSrt:varBtchEnd, :].astype(np.float64)
+        aryFuncDmn = np.subtract(aryFunc,
+                                 np.mean(aryFunc, axis=1)[:, None])
+        if lgcDmn:
+            aryFunc = aryFuncDmn
+
+        # Total sum of squares (needed for the calculation of R2):
+        vecSsTot = np.sum(np.square(aryFuncDmn), axis=1)
+        del(aryFuncDmn)
+
+        # Voxels with variance (others are not refined):
+        vecLgcVox = np.greater(vecSsTot, 0.0)
+        vecSsTot[np.logical_not(vecLgcVox)] = np.inf
+
+        # Start values: winning model of the grid search (in pixels), with
+        # shape aryPrm[voxel, parameter]:
+        aryPrm = np.zeros(((varBtchEnd - varBtchSrt), 3))
+        aryPrm[:, 0] = (aryOut[varBtchSrt:varBtchEnd, 0] - varExtXmin) \
+            * varSclX
+        aryPrm[:, 1] = (aryOut[varBtchSrt:varBtchEnd, 1] - varExtYmin) \
+            * varSclY
+        aryPrm[:, 2] = aryOut[varBtchSrt:varBtchEnd, 2] * varSclSd
+        aryPrm = np.clip(aryPrm, aryRng[:, 0], aryRng[:, 1])
+        aryPrm[:, 2] = np.maximum(aryPrm[:, 2], 0.5)
+
+        # Models, betas and cost for the start values:
+        aryMdl, aryDrv = rfn_mdl(aryApt, aryDsgn, aryPrm[:, 0], aryPrm[:, 1],
+                                 aryPrm[:, 2])
+        if lgcDmn:
+            aryMdl = np.subtract(aryMdl, np.mean(aryMdl, axis=1)[:, None, :])
+            aryDrv = np.subtract(aryDrv,
+                                 np.mean(aryDrv, axis=2)[:, :, None, :])
+        aryBeta, aryRes, vecCst = rfn_beta(aryMdl, aryFunc, varL2reg)
+
+        # Damping factor of each voxel:
+        vecDmp = np.multiply(np.ones(aryPrm.shape[0]), 0.001)
+
+        for idxIter in range(varNumIter):
+
+            # Jacobian of the model prediction with respect to the betas and
+            # the pRF parameters, with shape aryJac[voxel, time, unknown]:
+            aryJac = np.concatenate(
+                (aryMdl,
+                 np.transpose(np.sum(np.multiply(aryDrv,
+                                                 aryBeta[:, None, None, :]),
+                                     axis=3), (0, 2, 1))),
+                axis=2)
+
+            # Damped (and regularised) normal equations, one system per
+            # voxel:
+            aryHss = np.matmul(np.transpose(aryJac, (0, 2, 1)), aryJac)
+            aryHss = np.add(aryHss, np.diag(vecL2reg)[None, :, :])
+            aryGrd = np.subtract(
+                np.matmul(np.transpose(aryJac, (0, 2, 1)),
+                          aryRes[:, :, None])[:, :, 0],
+                np.concatenate((np.multiply(varL2reg, aryBeta),
+                                np.zeros((aryBeta.shape[0], 3))), axis=1))
+            aryDmp = np.multiply(
+                np.multiply(vecDmp[:, None],
+                            np.maximum(np.diagonal(aryHss, axis1=1, axis2=2),
+                                       1e-12))[:, :, None],
+                np.eye(varNumPrm)[None, :, :])
+            aryHss = np.add(aryHss, aryDmp)
+
+            # Only voxels with a solvable system are updated:
+            vecLgc = np.logical_and(
+                vecLgcVox, np.greater(np.absolute(np.linalg.det(aryHss)), 0.0))
+            aryStp = np.zeros((aryPrm.shape[0], varNumPrm))
+            aryStp[vecLgc, :] = np.linalg.solve(aryHss[vecLgc, :, :],
+                                                aryGrd[vecLgc, :, None])[:, :,
+                                                                         0]
+
+            # Candidate parameters (within the range of the grid):
+            aryPrmNew = np.add(aryPrm, aryStp[:, varNumFtr:])
+            aryPrmNew = np.clip(aryPrmNew, aryRng[:, 0], aryRng[:, 1])
+            aryPrmNew[:, 2] = np.maximum(aryPrmNew[:, 2], 0.5)
+
+            # Models, betas and cost for the candidate parameters:
+            aryMdlNew, aryDrvNew = rfn_mdl(aryApt, aryDsgn, aryPrmNew[:, 0],
+                                           aryPrmNew[:, 1], aryPrmNew[:, 2])
+            if lgcDmn:
+                aryMdlNew = np.subtract(
+                    aryMdlNew, np.mean(aryMdlNew, axis=1)[:, None, :])
+                aryDrvNew = np.subtract(
+                    aryDrvNew, np.mean(aryDrvNew, axis=2)[:, :, None, :])
+            aryBetaNew, aryResNew, vecCstNew = rfn_beta(aryMdlNew, aryFunc,
+                                                        varL2reg)
+
+            # Accept steps that reduce the cost (and reduce the damping),
+            # reject others (and increase the damping):
+            vecLgcAcc = np.logical_and(vecLgc, np.less(vecCstNew, vecCst))
+            aryPrm[vecLgcAcc, :] = aryPrmNew[vecLgcAcc, :]
+            aryMdl[vecLgcAcc, :, :] = aryMdlNew[vecLgcAcc, :, :]
+            aryDrv[vecLgcAcc, :, :, :] = aryDrvNew[vecLgcAcc, :, :, :]
+            aryBeta[vecLgcAcc, :] = aryBetaNew[vecLgcAcc, :]
+            aryRes[vecLgcAcc, :] = aryResNew[vecLgcAcc, :]
+            vecCst[vecLgcAcc] = vecCstNew[vecLgcAcc]
+            vecDmp[vecLgcAcc] = np.maximum(
+                np.multiply(vecDmp[vecLgcAcc], 0.1), 1e-7)
+            vecDmp[np.logical_not(vecLgcAcc)] = np.minimum(
+                np.multiply(vecDmp[np.logical_not(vecLgcAcc)], 10.0), 1e7)
+
+        # Coefficient of determination of the refined models:
+        vecR2 = np.subtract(1.0, np.divide(np.sum(np.square(aryRes), axis=1),
+                                           vecSsTot))
+
+        # The refined parameters are only kept if they explain more variance
+        # than the winning model of the grid search:
+        vecLgcTmp = np.logical_and(
+            vecLgcVox, np.greater(vecR2, aryOut[varBtchSrt:varBtchEnd, 3]))
+        vecIdxTmp = np.add(np.nonzero(vecLgcTmp)[0], varBtchSrt)
+        aryOut[vecIdxTmp, 0] = np.add(np.divide(aryPrm[vecLgcTmp, 0],
+                                                varSclX), varExtXmin)
+        aryOut[vecIdxTmp, 1] = np.add(np.divide(aryPrm[vecLgcTmp, 1],
+                                                varSclY), varExtYmin)
+        aryOut[vecIdxTmp, 2] = np.divide(aryPrm[vecLgcTmp, 2], varSclSd)
+        aryOut[vecIdxTmp, 3] = vecR2[vecLgcTmp]
+        if aryOut.shape[1] > 4:
+            aryOut[vecIdxTmp, 4:] = aryBeta[vecLgcTmp, :]
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""Pool of parallel processes that take small tasks on demand."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import numpy as np
+import multiprocessing as mp
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def sch_chunks(varNum, varPar, varTskSze=None, varNumTskPrc=4, varAln=1):
+    """
+    Split a range of elements into tasks.
+
+    Parameters
+    ----------
+    varNum : int
+        Number of elements (e.g. voxels or pRF models).
+    varPar : int
+        Number of parallel processes.
+    varTskSze : int or None
+        Number of elements per task. If None, the elements are split into
+        `varNumTskPrc` tasks per process.
+    varNumTskPrc : int
+        Number of tasks per process (if `varTskSze` is None).
+    varAln : int
+        The number of elements per task is rounded up to a multiple of this
+        number (e.g. the number of models that are fitted at once, so that
+        the blocks of models are the same as without splitting).
+
+    Returns
+    -------
+    vecIdxChnks : np.array
+        Indices at which the elements are split (first element of each task,
+        and the number of elements), with shape vecIdxChnks[task + 1].
+    """
+    varNum = int(varNum)
+    if varTskSze is None:
+        varTskSze = int(np.ceil(float(varNum)
+                                / float(max((varPar * varNumTskPrc), 1))))
+    varTskSze = max(int(varTskSze), 1)
+    varTskSze = int(np.ceil(float(varTskSze) / float(varAln))) * int(varAln)
+    return np.hstack((np.arange(0, varNum, varTskSze, dtype=np.int64),
+                      varNum)).astype(np.int64)
+
+
+def sch_wrk(idxWrk, queTsk, queDne, fncTrg, lstArgs):
+    """
+    Work on the tasks that are handed to a process.
+
+    Parameters
+    ----------
+    idxWrk : int
+        Index of the process in the pool.
+    queTsk : multiprocessing.Queue
+        Queue from which the indices of the tasks of this process are taken
+        (None to stop).
+    queDne : multiprocessing.Queue
+        Queue (shared by all processes) into which the index of the process
+        (with its process ID, and the index of the task) is put after each
+        task, to request the next task.
+    fncTrg : function
+        Function that is run for each task.
+    lstArgs : list
+        Arguments of `fncTrg` for all tasks (tuples).
+    """
+    while True:
+        idxTsk = queTsk.get(True)
+        if idxTsk is None:
+            break
+        fncTrg(*lstArgs[idxTsk])
+        queDne.put((idxWrk, os.getpid(), idxTsk))
+
+
+def sch_run(fncTrg, lstArgs, varPar, fncDne=None, varNumRtr=2,
+            lgcStts=True):
+    """
+    Run tasks on a pool of parallel processes.
+
+    Parameters
+    ----------
+    fncTrg : function
+        Function that is run for each task (the results need to be written
+        into shared output arrays, see `shared_arrays.py`).
+    lstArgs : list
+        Arguments of `fncTrg` for each task (tuples).
+    varPar : int
+        Number of parallel processes.
+    fncDne : function or None
+        Function that is called (in this process) with the index of each
+        task that has been completed (e.g. to save a checkpoint).
+    varNumRtr : int
+        Number of times that a task is started again if the process that
+        works on it fails.
+    lgcStts : bool
+        Whether to print the progress.
+
+    Notes
+    -----
+    Instead of splitting the work into one chunk per process (where all
+    processes wait for the slowest one), the work is split into many small
+    tasks. Each process of the pool is handed one task at a time; when it has
+    finished a task, it is handed the next one. Processes that are faster
+    (e.g. because their tasks are cheaper, or because they get more time on
+    a shared machine) therefore take on more tasks. If a process fails (e.g.
+    because it has been killed), the task it was working on is handed out
+    again, and the process is replaced.
+    """
+    varNumTsk = len(lstArgs)
+    if varNumTsk == 0:
+        return
+    varPar = max(min(int(varPar), varNumTsk), 1)
+
+    # Tasks that have not been handed out yet:
+    lstPnd = list(range(varNumTsk))[::-1]
+
+    # Number of restarts of each task, and completed tasks:
+    vecRtr = np.zeros(varNumTsk, dtype=np.int32)
+    vecLgcDne = np.zeros(varNumTsk, dtype=bool)
+
+    # Processes of the pool, their task queues, and the task that each
+    # process is working on (None if idle):
+    lstPrcs = [None] * varPar
+    lstQueTsk = [None] * varPar
+    lstTskPrc = [None] * varPar
+    queDne = mp.Queue()
+
+    def sch_start(idxWrk):
+        """Start a process of the pool (and hand it its first task)."""
+        lstQueTsk[idxWrk] = mp.Queue()
+        lstPrcs[idxWrk] = mp.Process(target=sch_wrk,
+                                     args=(idxWrk,
+                                           lstQueTsk[idxWrk],
+                                           queDne,
+                                           fncTrg,
+                                           lstArgs))
+        # Daemon (kills processes when exiting):
+        lstPrcs[idxWrk].Daemon = True
+        lstPrcs[idxWrk].start()
+        sch_hand(idxWrk)
+
+    def sch_hand(idxWrk):
+        """Hand the next task to a process (or stop the process)."""
+        if len(lstPnd) > 0:
+            lstTskPrc[idxWrk] = lstPnd.pop()
+        else:
+            lstTskPrc[idxWrk] = None
+        lstQueTsk[idxWrk].put(lstTskPrc[idxWrk])
+
+    for idxWrk in range(varPar):
+        sch_start(idxWrk)
+
+    # Status indicator (in steps of 5 %):
+    varCntDne = 0
+    varStsNxt = 0
+
+    try:
+        while varCntDne < varNumTsk:
+
+            # Wait for the next completed task:
+            try:
+                idxWrk, varPid, idxTsk = queDne.get(True, 0.5)
+            except queue.Empty:
+                idxWrk = None
+
+            # Hand the next task to the process (unless the process has failed
+            # after completing the task, and has already been replaced):
+            if (idxWrk is not None) and (varPid == lstPrcs[idxWrk].pid):
+                sch_hand(idxWrk)
+
+            # A task can be completed twice, if the process failed after
+            # completing it (but before this was noticed):
+            if (idxWrk is not None) and (not vecLgcDne[idxTsk]):
+                vecLgcDne[idxTsk] = True
+                varCntDne += 1
+                if fncDne is not None:
+                    fncDne(idxTsk)
+                if lgcStts and (varCntDne >= varStsNxt):
+                    print('------------Progress: '
+                          + str(int(np.floor(100.0 * varCntDne / varNumTsk)))
+                          + ' % --- ' + str(varCntDne) + ' tasks out of '
+                          + str(varNumTsk))
+                    varStsNxt = varCntDne + max((varNumTsk // 20), 1)
+
+            # Processes that have failed while working on a task:
+            for idxWrk in range(varPar):
+                if ((lstTskPrc[idxWrk] is None)
+                        or lstPrcs[idxWrk].is_alive()):
+                    continue
+                idxTsk = lstTskPrc[idxWrk]
+                varExt = lstPrcs[idxWrk].exitcode
+                if vecRtr[idxTsk] >= varNumRtr:
+                    # Error message:
+                    strErrMsg = ('---Error: Parallel process did not finish '
+                                 + 'task ' + str(idxTsk) + ' successfully '
+                                 + '(exit code ' + str(varExt) + ').')
+                    raise ValueError(strErrMsg)
+                vecRtr[idxTsk] += 1
+                print('------------Parallel process did not finish task '
+                      + str(idxTsk) + ' successfully (exit code '
+                      + str(varExt) + '), restart ' + str(vecRtr[idxTsk])
+                      + ' of ' + str(varNumRtr))
+                lstPnd.append(idxTsk)
+                sch_start(idxWrk)
+
+    except BaseException:
+        # Stop all processes of the pool:
+        for objPrc in lstPrcs:
+            if objPrc.is_alive():
+                objPrc.terminate()
+        raise
+
+    # All tasks are done, the processes have been stopped:
+    for objPrc in lstPrcs:
+        objPrc.join()
+
+
+def sch_merge(aryPrt, varNumSeg):
+    """
+    Merge the results of tasks that fitted different ranges of models.
+
+    Parameters
+    ----------
+    aryPrt : np.array
+        Results of all ranges of models, with shape aryPrt[range * voxel,
+        parameter] (i.e. the results of the voxels for the first range of
+        models, followed by those for the second range, etc.), where the
+        parameters are (0) x-position, (1) y-position, (2) SD, (3) R2, and
+        optionally the betas.
+    varNumSeg : int
+        Number of ranges of models.
+
+    Returns
+    -------
+    aryBstPrm : np.array
+        Results of the best fitting model over all ranges, with shape
+        aryBstPrm[voxel, parameter].
+
+    Notes
+    -----
+    For each voxel, the model with the highest R2 over all ranges is selected
+    (the first range in case of equal R2, so that the result is the same as
+    when fitting all models in one task).
+    """
+    aryPrt = np.reshape(aryPrt, (varNumSeg, -1, aryPrt.shape[1]))
+    vecIdxSeg = np.argmax(aryPrt[:, :, 3], axis=0)
+    return aryPrt[vecIdxSeg, np.arange(aryPrt.shape[1]), :]
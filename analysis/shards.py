@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""Split the pRF model fitting into shards (e.g. for several cluster nodes)."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import numpy as np
+from checkpoint import ckp_save
+from scheduler import sch_merge
+from top_k import tpk_merge
+
+
+def shrd_rng(varNum, idxShrd, varNumShrd, varAln=1):
+    """
+    Range of elements of a shard.
+
+    Parameters
+    ----------
+    varNum : int
+        Number of elements (e.g. voxels or pRF models).
+    idxShrd : int
+        Index of the shard.
+    varNumShrd : int
+        Number of shards.
+    varAln : int
+        The boundaries between the shards are multiples of this number (e.g.
+        the number of models that are fitted at once).
+
+    Returns
+    -------
+    tplRng : tuple
+        First element of the shard, and first element of the next shard. The
+        range only depends on the number of elements and of shards, so that
+        every node computes the same split.
+    """
+    varNumAln = int(np.ceil(float(varNum) / float(varAln)))
+    vecIdx = np.around(np.linspace(0, varNumAln, (varNumShrd + 1)))
+    vecIdx = np.minimum((vecIdx.astype(np.int64) * int(varAln)), int(varNum))
+    return (int(vecIdx[idxShrd]), int(vecIdx[(idxShrd + 1)]))
+
+
+def shrd_path(strPathOut, idxShrd):
+    """
+    Path of the partial results of a shard.
+
+    Parameters
+    ----------
+    strPathOut : str
+        Path (prefix) of the output images.
+    idxShrd : int
+        Index of the shard.
+
+    Returns
+    -------
+    strPath : str
+        Path of the partial results (`<strPathOut>_shard_<index>.npz`).
+    """
+    return strPathOut + '_shard_' + str(idxShrd) + '.npz'
+
+
+def shrd_save(strPathOut, idxShrd, varNumShrd, strShrdAxs, tplRng,
+              aryBstPrm, aryTpk, aryLgcMsk, aryLgcVar, aryAff, tplNiiShp,
+              tplMdlGrd):
+    """
+    Save the partial results of a shard.
+
+    Parameters
+    ----------
+    strPathOut : str
+        Path (prefix) of the output images.
+    idxShrd : int
+        Index of the shard.
+    varNumShrd : int
+        Number of shards.
+    strShrdAxs : str
+        Whether the voxels ('voxels') or the pRF models ('models') are split
+        into shards.
+    tplRng : tuple
+        Range of voxels or models of the shard (see `shrd_rng`).
+    aryBstPrm : np.array
+        Parameters of the best fitting pRF models of the shard, with shape
+        aryBstPrm[voxel, parameter] (the voxels of the shard, or all voxels
+        if the models are split).
+    aryTpk : np.array or None
+        Best k models of each voxel (if retained).
+    aryLgcMsk, aryLgcVar, aryAff, tplNiiShp
+        Mask, voxels included in the fitting, affine and shape of the input
+        images (see `pre_pro_func`), which are needed to export the results.
+    tplMdlGrd : tuple
+        Modelled x-positions, y-positions and SDs of the pRF models.
+    """
+    dicShrd = {'vecShrd': np.array([idxShrd, varNumShrd], dtype=np.int64),
+               'strShrdAxs': np.array(strShrdAxs),
+               'vecRng': np.array(tplRng, dtype=np.int64),
+               'aryBstPrm': aryBstPrm,
+               'aryLgcMsk': aryLgcMsk,
+               'aryLgcVar': aryLgcVar,
+               'aryAff': aryAff,
+               'vecNiiShp': np.array(tplNiiShp, dtype=np.int64),
+               'vecMdlXpos': tplMdlGrd[0],
+               'vecMdlYpos': tplMdlGrd[1],
+               'vecMdlSd': tplMdlGrd[2]}
+    if aryTpk is not None:
+        dicShrd['aryTpk'] = aryTpk
+    ckp_save(shrd_path(strPathOut, idxShrd), dicShrd)
+
+
+def shrd_merge(strPathOut, varNumShrd):
+    """
+    Merge the partial results of all shards.
+
+    Parameters
+    ----------
+    strPathOut : str
+        Path (prefix) of the output images (and of the partial results).
+    varNumShrd : int
+        Number of shards.
+
+    Returns
+    -------
+    dicRes : dict
+        Merged results, with the parameters of the best fitting models of all
+        voxels ('aryBstPrm'), the best k models ('aryTpk', None if they were
+        not retained), and the mask, voxels included in the fitting, affine,
+        shape of the input images and model grid from the shards (needed to
+        export the results, see `exp_prf`).
+
+    Notes
+    -----
+    If the voxels were split, the results of the shards are concatenated. If
+    the models were split, the best model of each voxel is the one with the
+    highest R2 (i.e. the lowest residuals) over all shards.
+    """
+    lstShrd = []
+    for idxShrd in range(varNumShrd):
+        strTmp = shrd_path(strPathOut, idxShrd)
+        if not os.path.isfile(strTmp):
+            # Error message:
+            strErrMsg = ('---Error: Results of shard ' + str(idxShrd)
+                         + ' of ' + str(varNumShrd) + ' not found: '
+                         + strTmp)
+            raise ValueError(strErrMsg)
+        with np.load(strTmp) as objNpz:
+            lstShrd.append(dict([(strKey, objNpz[strKey])
+                                 for strKey in objNpz.files]))
+
+    # All shards need to come from the same split of the same run:
+    dicRef = lstShrd[0]
+    for idxShrd, dicTmp in enumerate(lstShrd):
+        lgcMtch = ((int(dicTmp['vecShrd'][0]) == idxShrd)
+                   and (int(dicTmp['vecShrd'][1]) == varNumShrd)
+                   and (str(dicTmp['strShrdAxs'])
+                        == str(dicRef['strShrdAxs']))
+                   and np.array_equal(dicTmp['aryLgcMsk'],
+                                      dicRef['aryLgcMsk'])
+                   and np.array_equal(dicTmp['aryLgcVar'],
+                                      dicRef['aryLgcVar'])
+                   and (('aryTpk' in dicTmp) == ('aryTpk' in dicRef)))
+        if not lgcMtch:
+            # Error message:
+            strErrMsg = ('---Error: Results of shard ' + str(idxShrd)
+                         + ' do not belong to the same run as those of '
+                         + 'shard 0 (or the number of shards has changed).')
+            raise ValueError(strErrMsg)
+
+    lgcTpk = 'aryTpk' in dicRef
+
+    if str(dicRef['strShrdAxs']) == 'voxels':
+        # The shards contain consecutive ranges of voxels:
+        aryBstPrm = np.concatenate([dicTmp['aryBstPrm']
+                                    for dicTmp in lstShrd], axis=0)
+        aryTpk = None
+        if lgcTpk:
+            aryTpk = np.concatenate([dicTmp['aryTpk'] for dicTmp in lstShrd],
+                                    axis=0)
+    else:
+        # The shards contain all voxels, for different ranges of models:
+        aryBstPrm = sch_merge(np.concatenate([dicTmp['aryBstPrm']
+                                              for dicTmp in lstShrd],
+                                             axis=0),
+                              varNumShrd)
+        aryTpk = None
+        if lgcTpk:
+            aryTpk = tpk_merge(np.concatenate([dicTmp['aryTpk']
+                                               for dicTmp in lstShrd],
+                                              axis=0),
+                               varNumShrd)
+
+    if aryBstPrm.shape[0] != int(np.sum(dicRef['aryLgcVar'])):
+        # Error message:
+        strErrMsg = ('---Error: The shards do not contain the results of '
+                     + 'all voxels.')
+        raise ValueError(strErrMsg)
+
+    return {'aryBstPrm': aryBstPrm,
+            'aryTpk': aryTpk,
+            'aryLgcMsk': dicRef['aryLgcMsk'],
+            'aryLgcVar': dicRef['aryLgcVar'],
+            'aryAff': dicRef['aryAff'],
+            'tplNiiShp': tuple(dicRef['vecNiiShp']),
+            'tplMdlGrd': (dicRef['vecMdlXpos'],
+                          dicRef['vecMdlYpos'],
+                          dicRef['vecMdlSd'])}
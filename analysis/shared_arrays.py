@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Share numpy arrays between parallel processes without copying them."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes
+import numpy as np
+import multiprocessing as mp
+
+
+class ShmArray(object):
+    """
+    Numpy array in shared memory.
+
+    Large arrays that are passed as arguments to `mp.Process` are copied into
+    every child process (or pickled, depending on the start method). Instead,
+    an array can be placed in shared memory once (with `shm_put` or
+    `shm_alloc`), and the returned `ShmArray` object can be passed to the
+    child processes. Inside a child process, `shm_get` returns a numpy array
+    that maps the same memory, without copying it.
+
+    An `ShmArray` can be restricted to a range of indices along the first
+    dimension of the array (see `shm_chunk`), so that each child process
+    only sees its own chunk of the data.
+
+    `ShmArray` objects can be passed as arguments to `mp.Process`, but not
+    over a `mp.Queue`.
+    """
+
+    def __init__(self, objRaw, strDtype, tplShp, varSrt=None, varEnd=None):
+        """Initialise instance of ShmArray class.
+
+        Parameters
+        ----------
+        objRaw : multiprocessing.sharedctypes.RawArray
+            Shared memory buffer.
+        strDtype : str
+            Data type of the array (e.g. 'float32').
+        tplShp : tuple
+            Shape of the full array.
+        varSrt : int or None
+            Index of first element along first dimension of the array that is
+            accessible through this object (`None` for the full array).
+        varEnd : int or None
+            Index of last element along first dimension of the array that is
+            accessible through this object, plus one (`None` for the full
+            array).
+        """
+        # The shared memory buffer:
+        self.raw = objRaw
+
+        # Data type & shape of the full array:
+        self.dtype = strDtype
+        self.shape = tuple(tplShp)
+
+        # Range along first dimension:
+        self.start = varSrt
+        self.end = varEnd
+
+
+def shm_alloc(tplShp, varDtype=np.float32):
+    """
+    Allocate array in shared memory.
+
+    Parameters
+    ----------
+    tplShp : tuple
+        Shape of the array.
+    varDtype : numpy dtype
+        Data type of the array.
+
+    Returns
+    -------
+    objShm : ShmArray
+        Handle of shared array (initialised with zeros), can be passed to
+        parallel processes.
+    """
+    # Number of bytes of the array:
+    varNumByte = int(np.prod(tplShp)) * np.dtype(varDtype).itemsize
+
+    # Allocate shared memory (at least one byte, because empty arrays cannot be
+    # shared). Shared ctypes arrays are initialised with zeros.
+    objRaw = mp.RawArray(ctypes.c_char, max(varNumByte, 1))
+
+    return ShmArray(objRaw, np.dtype(varDtype).str, tplShp)
+
+
+def shm_put(aryIn):
+    """
+    Copy array into shared memory.
+
+    Parameters
+    ----------
+    aryIn : np.array
+        Array to be shared with parallel processes.
+
+    Returns
+    -------
+    objShm : ShmArray
+        Handle of shared array, can be passed to parallel processes.
+
+    Notes
+    -----
+    After calling this function, the input array can be deleted, and the data
+    can be accessed with `shm_get(objShm)`.
+    """
+    objShm = shm_alloc(aryIn.shape, aryIn.dtype)
+    shm_get(objShm)[...] = aryIn
+    return objShm
+
+
+def shm_get(objShm):
+    """
+    Get numpy array that maps shared memory.
+
+    Parameters
+    ----------
+    objShm : ShmArray or np.array
+        Handle of shared array. If a numpy array is passed instead, it is
+        returned unchanged (so that functions that are called in parallel
+        processes can accept both).
+
+    Returns
+    -------
+    aryOut : np.array
+        Numpy array that maps the shared memory (i.e. modifications of the
+        array are visible to all processes).
+    """
+    # Return numpy arrays unchanged:
+    if not isinstance(objShm, ShmArray):
+        return objShm
+
+    # Number of elements of the full array:
+    varNumEle = int(np.prod(objShm.shape))
+
+    aryOut = np.frombuffer(objShm.raw,
+                           dtype=np.dtype(objShm.dtype),
+                           count=varNumEle).reshape(objShm.shape)
+
+    # Restrict to range along first dimension:
+    if objShm.start is not None:
+        aryOut = aryOut[objShm.start:objShm.end, ...]
+
+    return aryOut
+
+
+def shm_chunk(objShm, varSrt, varEnd):
+    """
+    Restrict shared array to a range along its first dimension.
+
+    Parameters
+    ----------
+    objShm : ShmArray
+        Handle of shared array.
+    varSrt : int
+        Index of first element along first dimension of the array.
+    varEnd : int
+        Index of last element along first dimension of the array, plus one.
+
+    Returns
+    -------
+    objShmChnk : ShmArray
+        Handle of the chunk of the shared array (the memory is not copied).
+    """
+    # Offset of current range:
+    if objShm.start is None:
+        varOff = 0
+    else:
+        varOff = objShm.start
+
+    return ShmArray(objShm.raw,
+                    objShm.dtype,
+                    objShm.shape,
+                    varSrt=(varOff + int(varSrt)),
+                    varEnd=(varOff + int(varEnd)))
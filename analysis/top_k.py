@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Streaming retention of the best fitting pRF models per voxel."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+def tpk_init(varNumK, varNumVox):
+    """
+    Create empty lists of best fitting models.
+
+    Parameters
+    ----------
+    varNumK : int
+        Number of models that are retained per voxel.
+    varNumVox : int
+        Number of voxels.
+
+    Returns
+    -------
+    aryTpkVal : np.array
+        Scores of the retained models (higher is better), with shape
+        aryTpkVal[k, voxel]. Initialised with -inf.
+    aryTpkIdx : np.array
+        Indices of the retained models, with shape aryTpkIdx[k, voxel].
+        Initialised with -1.
+    """
+    aryTpkVal = np.full((varNumK, varNumVox), -np.inf, dtype=np.float64)
+    aryTpkIdx = np.full((varNumK, varNumVox), -1, dtype=np.int64)
+    return aryTpkVal, aryTpkIdx
+
+
+def tpk_update(aryTpkVal, aryTpkIdx, aryVal, aryIdx):
+    """
+    Merge scores of a block of models into the lists of best fitting models.
+
+    Parameters
+    ----------
+    aryTpkVal : np.array
+        Scores of the retained models, with shape aryTpkVal[k, voxel].
+    aryTpkIdx : np.array
+        Indices of the retained models, with shape aryTpkIdx[k, voxel].
+    aryVal : np.array
+        Scores of the models in the block (higher is better), with shape
+        aryVal[model, voxel].
+    aryIdx : np.array
+        Indices of the models in the block, with shape aryIdx[model] (same
+        models for all voxels), or aryIdx[model, voxel].
+
+    Returns
+    -------
+    aryTpkVal : np.array
+        Updated scores of the retained models (not sorted).
+    aryTpkIdx : np.array
+        Updated indices of the retained models.
+
+    Notes
+    -----
+    Only the best k models of the block are merged with the k retained
+    models (partial sort along the model dimension, with `np.argpartition`),
+    so that the memory needed per voxel does not depend on the size of the
+    block or the total number of models.
+    """
+    varNumK = aryTpkVal.shape[0]
+    aryVal = np.asarray(aryVal, dtype=np.float64)
+    aryIdx = np.broadcast_to(np.asarray(aryIdx, dtype=np.int64).reshape(
+        (aryVal.shape[0], -1)), aryVal.shape)
+
+    # Best k models of the block:
+    if varNumK < aryVal.shape[0]:
+        aryTmp = np.argpartition(-aryVal, (varNumK - 1), axis=0)[0:varNumK, :]
+        aryVal = np.take_along_axis(aryVal, aryTmp, axis=0)
+        aryIdx = np.take_along_axis(aryIdx, aryTmp, axis=0)
+
+    # Best k models of the retained models and the block:
+    aryVal = np.concatenate((aryTpkVal, aryVal), axis=0)
+    aryIdx = np.concatenate((aryTpkIdx, aryIdx), axis=0)
+    aryTmp = np.argpartition(-aryVal, (varNumK - 1), axis=0)[0:varNumK, :]
+
+    return (np.take_along_axis(aryVal, aryTmp, axis=0),
+            np.take_along_axis(aryIdx, aryTmp, axis=0))
+
+
+def tpk_out(aryTpkVal, aryTpkIdx, aryOut, vecSsTot, vecSsOff=None):
+    """
+    Sort the lists of best fitting models and write them into output array.
+
+    Parameters
+    ----------
+    aryTpkVal : np.array
+        Scores of the retained models (explained sum of squares), with shape
+        aryTpkVal[k, voxel].
+    aryTpkIdx : np.array
+        Indices of the retained models, with shape aryTpkIdx[k, voxel].
+    aryOut : np.array
+        Output array (chunk corresponding to the voxels), with shape
+        aryOut[voxel, k, 2]. The model indices (in the order of
+        `crt_mdl_prms`, -1 if fewer than k models were evaluated) and R2 of
+        the retained models are written into aryOut[:, :, 0] and
+        aryOut[:, :, 1], sorted by decreasing R2 (the R2 of entries with a
+        model index of -1 is zero).
+    vecSsTot : np.array
+        Total sum of squares of the voxel time courses.
+    vecSsOff : np.array or None
+        Offset of the residual sum of squares (if not None, the R2 is
+        calculated as 1 - (vecSsOff - score) / vecSsTot, otherwise as
+        score / vecSsTot).
+    """
+    # Sort by decreasing score:
+    aryTmp = np.argsort(-aryTpkVal, axis=0, kind='mergesort')
+    aryTpkVal = np.take_along_axis(aryTpkVal, aryTmp, axis=0)
+    aryTpkIdx = np.take_along_axis(aryTpkIdx, aryTmp, axis=0)
+
+    # Coefficient of determination (zero for voxels without variance):
+    vecSsTot = np.array(vecSsTot, dtype=np.float64)
+    vecLgcTmp = np.less_equal(vecSsTot, 0.0)
+    vecSsTot[vecLgcTmp] = np.inf
+    if vecSsOff is None:
+        aryR2 = np.divide(aryTpkVal, vecSsTot[None, :])
+    else:
+        aryR2 = np.subtract(1.0, np.divide(
+            np.subtract(np.asarray(vecSsOff, dtype=np.float64)[None, :],
+                        aryTpkVal), vecSsTot[None, :]))
+    aryR2[:, vecLgcTmp] = 0.0
+
+    # Empty entries (e.g. if fewer than k models were evaluated, or if models
+    # were not accepted) have an R2 of zero:
+    aryR2[np.less(aryTpkIdx, 0)] = 0.0
+
+    aryOut[:, :, 0] = aryTpkIdx.T
+    aryOut[:, :, 1] = aryR2.T
+
+
+def tpk_merge(aryTpkPrt, varNumSeg):
+    """
+    Merge the best k models of tasks that fitted different ranges of models.
+
+    Parameters
+    ----------
+    aryTpkPrt : np.array
+        Best k models of all ranges of models, with shape aryTpkPrt[range *
+        voxel, k, 2] (i.e. the voxels for the first range of models, followed
+        by those for the second range, etc.), as written by `tpk_out`.
+    varNumSeg : int
+        Number of ranges of models.
+
+    Returns
+    -------
+    aryTpk : np.array
+        Best k models over all ranges, with shape aryTpk[voxel, k, 2], sorted
+        by decreasing R2 (empty entries, with a model index of -1, last).
+    """
+    varNumK = aryTpkPrt.shape[1]
+    aryTpkPrt = np.reshape(aryTpkPrt, (varNumSeg, -1, varNumK, 2))
+
+    # All retained models of all ranges, with shape aryTmp[voxel, range * k,
+    # 2]:
+    aryTmp = np.concatenate([aryTpkPrt[idxSeg, :, :, :]
+                             for idxSeg in range(varNumSeg)], axis=1)
+
+    # Sort by decreasing R2, and put empty entries last:
+    aryIdx = np.lexsort((-aryTmp[:, :, 1],
+                         np.less(aryTmp[:, :, 0], 0.0)), axis=1)[:, 0:varNumK]
+
+    return np.take_along_axis(aryTmp, aryIdx[:, :, None], axis=1)
@@ -144,6 +144,45 @@ def crt_gauss(varSizeX, varSizeY, varPosX, varPosY, varSd):
     return aryGauss
 
 
+def crt_gauss_1d(varSize, vecPos, varSd):
+    """
+    Create one-dimensional Gaussian kernels.
+
+    Parameters
+    ----------
+    varSize : int, positive
+        Number of pixels along the dimension of the visual field.
+    vecPos : np.array
+        1D array with positions of the centres of the Gaussians (in pixels).
+    varSd : float, positive
+        Standard deviation of the Gaussians (in pixels).
+
+    Returns
+    -------
+    aryGauss : 2d numpy array, shape [len(vecPos), varSize]
+        One (unnormalised) Gaussian per row.
+
+    Notes
+    -----
+    An isotropic 2D Gaussian is the outer product of two 1D Gaussians. The 2D
+    Gaussian created by `crt_gauss(varSizeX, varSizeY, varPosX, varPosY,
+    varSd)` is equal to the outer product of `crt_gauss_1d(varSizeX, [varPosY],
+    varSd)` and `crt_gauss_1d(varSizeY, [varPosX], varSd)`, divided by
+    `2 * pi * varSd^2`.
+    """
+    # Pixel indices:
+    vecIdx = np.arange(int(varSize), dtype=np.float64)
+
+    # Positions of the centres:
+    vecPos = np.array(vecPos, dtype=np.float64, ndmin=1)
+
+    aryGauss = np.exp(-np.divide(np.square(np.subtract(vecIdx[None, :],
+                                                       vecPos[:, None])),
+                                 (2.0 * np.square(varSd))))
+
+    return aryGauss
+
+
 def crt_hrf(varNumVol, varTr):
     """Create double gamma function.
 
@@ -170,3 +209,52 @@ def crt_hrf(varNumVol, varTr):
     vecHrf = np.divide(vecHrf, np.max(vecHrf))
 
     return vecHrf
+
+
+
+def crt_mdl_prms(vecMdlXpos, vecMdlYpos, vecMdlSd):
+    """
+    Create array with parameters of all pRF models.
+
+    Parameters
+    ----------
+    vecMdlXpos : np.array
+        1D array with pRF model x positions.
+    vecMdlYpos : np.array
+        1D array with pRF model y positions.
+    vecMdlSd : np.array
+        1D array with pRF model sizes (SD of Gaussian).
+
+    Returns
+    -------
+    aryMdl : np.array
+        2D array with model parameters, with shape aryMdl[model, 3], where the
+        columns contain (0) the x-position, (1) the y-position, and (2) the
+        size of the pRF model.
+
+    Notes
+    -----
+    The order of models is the same as that of a flattened pRF time course
+    array with shape aryPrfTc[x-pos, y-pos, SD, ...], i.e. the index of a model
+    in the returned array corresponds to the index along the first dimension
+    of `np.reshape(aryPrfTc, (varNumX * varNumY * varNumPrfSizes, ...))`.
+    """
+    # Information about pRF model parameters:
+    varNumX = np.shape(vecMdlXpos)[0]
+    varNumY = np.shape(vecMdlYpos)[0]
+    varNumPrfSizes = np.shape(vecMdlSd)[0]
+
+    # Array for model parameters:
+    aryMdl = np.zeros(((varNumX * varNumY * varNumPrfSizes), 3),
+                      dtype=np.float32)
+
+    # The first column is to contain model x positions:
+    aryMdl[:, 0] = np.repeat(vecMdlXpos, int(varNumY * varNumPrfSizes))
+
+    # The second column is to contain model y positions:
+    aryMdl[:, 1] = np.repeat(np.tile(vecMdlYpos, varNumX), varNumPrfSizes)
+
+    # The third column is to contain model pRF sizes:
+    aryMdl[:, 2] = np.tile(vecMdlSd, int(varNumX * varNumY))
+
+    return aryMdl
@@ -11,6 +11,14 @@ import tables
 import numpy as np
 import scipy as sp
 from scipy.stats import gamma
+import sys
+# add analysis folder to path, in order to import the convolution engine
+strAnlysPath = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', 'analysis'))
+sys.path.insert(0, strAnlysPath)
+from convolution import conv_tc  # noqa
+# delete analysis path
+del sys.path[0]
 
 
 # ***  Define functions
@@ -116,18 +124,11 @@ def funcConvPar(aryDm,
     """
     Function for convolution of pixel-wise 'design matrix' with HRF model.
     """
-    # In order to avoid an artefact at the end of the time series, we have to
-    # concatenate an empty array to both the design matrix and the HRF model
-    # before convolution.
-    aryDm = np.concatenate((aryDm, np.zeros((aryDm.shape[0], 100))), axis=1)
-    vecHrf = np.concatenate((vecHrf, np.zeros((100,))))
-
-    aryDmConv = np.empty((aryDm.shape[0], varNumVol))
-    for idx in range(0, aryDm.shape[0]):
-        vecDm = aryDm[idx, :]
-        # Convolve design matrix with HRF model:
-        aryDmConv[idx, :] = np.convolve(vecDm, vecHrf,
-                                        mode='full')[:varNumVol]
+    # All time courses are convolved at once (the part of the convolution
+    # that extends beyond the last volume is discarded, see
+    # `analysis/convolution.py`):
+    aryDmConv = conv_tc(aryDm[:, :varNumVol], vecHrf).astype(np.float64)
+
     return aryDmConv
 
 # %%
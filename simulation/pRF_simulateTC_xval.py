@@ -21,6 +21,13 @@ from pRF_functions import (funcHrf, funcNrlTcTngCrv,
                            makeAoMTuneCurves, simulateGaussNoise,
                            simulateAR1, simulateAR2)
 import sys
+# add analysis folder to path, in order to import the convolution engine
+strAnlysPath = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', 'analysis'))
+sys.path.insert(0, strAnlysPath)
+from convolution import conv_tc  # noqa
+# delete analysis path
+del sys.path[0]
 
 # %%
 # *** Define parameters
@@ -110,6 +117,8 @@ varTme01 = time.time()
 # *** Load presentation order of conditions
 print('------Load presentation order of apert pos and mot dir')
 aryPresOrd = np.empty((0, 2))
+# number of time points per run (needed for the HRF convolution)
+lstRunLen = []
 for idx01 in range(0, varNumRuns):
     # reconstruct file name
     filename1 = (strPathPresOrd + str(idx01+1) + '.pickle')
@@ -119,6 +128,7 @@ for idx01 in range(0, varNumRuns):
     tempCond = array1["Conditions"]
     # add temp array to aryPresOrd
     aryPresOrd = np.concatenate((aryPresOrd, tempCond), axis=0)
+    lstRunLen.append(len(tempCond))
 aryPresOrd = aryPresOrd.astype(int)
 
 # deduce the number of time points (conditions/volumes) from len aryPresOrd
@@ -418,26 +428,14 @@ vecHrf = funcHrf(varNumTP, varTr)
 # reshape the ary containing model predictors for convolution with HRF
 aryNrlMdls = aryNrlMdls.reshape(varNumMdls, varNumTP)
 
-# preprocess the data for convolution
-# In order to avoid an artefact at the end of the time series, we have to
-# concatenate an empty array to both the HRF model and the neural time courses
-# before convolution.
-vecHrf = np.concatenate((vecHrf, np.zeros([100, 1]).flatten()))
-aryNrlMdls = np.hstack((aryNrlMdls, np.zeros((aryNrlMdls.shape[0], 100))))
-aryMdlConv = np.zeros((varNumMdls, varNumTP))
-
-# concolve every model time course with the HRF function
-for idx in range(0, varNumMdls):
-    temp = np.convolve(aryNrlMdls[idx, :], vecHrf, mode='full')[0:varNumTP]
-    aryMdlConv[idx, :] = temp
+# convolve all model time courses with the HRF function at once; the
+# convolution is restarted at the beginning of every run, so that responses
+# do not spill over into the next run (which would bias the cross-validation)
+aryMdlConv = conv_tc(aryNrlMdls, vecHrf, vecRunLen=lstRunLen)
 
 # reshape data so the time courses are stored more intuitively
 aryMdlConv = aryMdlConv.reshape(varNumXY, varNumPrfSizes,
                                 varNumTngCrv, varNumTP)
-
-# change data back to what it was before preprocessing
-vecHrf = vecHrf[:varNumTP]
-aryNrlMdls = aryNrlMdls[:, :varNumTP]
 aryNrlMdls = aryNrlMdls.reshape(varNumXY, varNumPrfSizes,
                                 varNumTngCrv, varNumTP)
 